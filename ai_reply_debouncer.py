@@ -0,0 +1,161 @@
+# ai_reply_debouncer.py
+"""
+AI 托管票据回复的防抖/合并调度器。
+
+- 票据创建者连续发送多条消息时，on_message 不再为每条消息各调用一次 AI，而是调用 submit(票据, 回复函数)。
+  同一票据在 quiet_period 秒内没有新消息后才真正生成回复，一次突发 (burst) 只调用一次 API；
+  回复函数看到的是最新一条消息，而对话状态 (ticket_ai_state.py) 已包含这次突发中的全部消息。
+- 为避免用户一直说话导致永远不回复，一次突发最多等待 max_delay 秒。
+- 正在生成中的回复如果被新消息取代 (用户在 AI 生成时又补充了内容)，直接取消该任务，
+  不会再发出基于旧上下文的回复。回复函数在开始向 Discord 发送消息前调用 guard.commit()，
+  此后不再取消；同一票据的下一次回复会等它发送完成后才开始，保证回复不会交错。
+- stats() 报告收到的请求数、实际调用数、节省的调用数和被取消的生成数。
+
+基准测试 (模拟用户连发短消息):
+    python ai_reply_debouncer.py --tickets 20 --bursts 10 --burst-size 4
+"""
+import asyncio
+import logging
+from typing import Any, Awaitable, Callable, Dict, Hashable, Optional, Tuple
+
+DEFAULT_QUIET_PERIOD = 2.0
+DEFAULT_MAX_DELAY = 8.0
+
+
+class ReplyGuard:
+    """传给回复函数；调用 commit() 之后该回复不会再被新消息取消。"""
+    __slots__ = ('committed',)
+
+    def __init__(self):
+        self.committed = False
+
+    def commit(self):
+        self.committed = True
+
+
+class _Burst:
+    __slots__ = ('first_at', 'factory', 'timer')
+
+    def __init__(self, first_at: float):
+        self.first_at = first_at
+        self.factory: Optional[Callable[[ReplyGuard], Awaitable[Any]]] = None
+        self.timer: Optional[asyncio.TimerHandle] = None
+
+
+class ReplyDebouncer:
+    """只在机器人事件循环中使用。"""
+
+    def __init__(self, quiet_period: float = DEFAULT_QUIET_PERIOD, max_delay: float = DEFAULT_MAX_DELAY):
+        self.quiet_period = quiet_period
+        self.max_delay = max_delay
+        self._bursts: Dict[Hashable, _Burst] = {}
+        self._running: Dict[Hashable, Tuple[asyncio.Task, ReplyGuard]] = {}
+        self.requests = 0
+        self.calls = 0
+        self.superseded = 0
+        self.errors = 0
+
+    def submit(self, key: Hashable, factory: Callable[[ReplyGuard], Awaitable[Any]]):
+        """登记一次回复请求。factory(guard) 返回回复协程；同一突发中只有最后登记的 factory 会被执行。"""
+        loop = asyncio.get_running_loop()
+        self.requests += 1
+        running = self._running.get(key)
+        if running and not running[1].committed and not running[0].done():
+            running[0].cancel() # 新输入取代了正在生成的回复
+            self.superseded += 1
+        now = loop.time()
+        burst = self._bursts.get(key)
+        if burst is None:
+            burst = self._bursts[key] = _Burst(now)
+        else:
+            burst.timer.cancel()
+        burst.factory = factory
+        delay = min(self.quiet_period, max(0.0, burst.first_at + self.max_delay - now))
+        burst.timer = loop.call_later(delay, self._fire, key)
+
+    def _fire(self, key: Hashable):
+        burst = self._bursts.pop(key)
+        self.calls += 1
+        asyncio.ensure_future(self._run(key, burst.factory))
+
+    async def _run(self, key: Hashable, factory: Callable[[ReplyGuard], Awaitable[Any]]):
+        current = asyncio.current_task()
+        previous = self._running.get(key)
+        guard = ReplyGuard()
+        self._running[key] = (current, guard)
+        try:
+            if previous and not previous[0].done():
+                await asyncio.wait({previous[0]}) # 上一次回复已在发送中，等它结束
+            await factory(guard)
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            self.errors += 1
+            logging.error(f"[AI Debounce] 执行回复时出错 (key: {key}): {e}", exc_info=True)
+        finally:
+            if self._running.get(key, (None,))[0] is current:
+                del self._running[key]
+
+    def cancel(self, key: Hashable):
+        """票据关闭或转为人工时丢弃尚未执行的回复，并取消未提交的生成。"""
+        burst = self._bursts.pop(key, None)
+        if burst is not None:
+            burst.timer.cancel()
+        running = self._running.get(key)
+        if running and not running[1].committed:
+            running[0].cancel()
+
+    def stats(self) -> Dict[str, int]:
+        return {"requests": self.requests, "calls": self.calls, "saved_calls": self.requests - self.calls - len(self._bursts),
+                "superseded": self.superseded, "errors": self.errors, "pending": len(self._bursts), "running": len(self._running)}
+
+
+# =========================================
+# == 基准测试
+# =========================================
+def _run_benchmark(tickets: int, bursts: int, burst_size: int, quiet_period: float, generation_time: float):
+    import random
+
+    async def main():
+        debouncer = ReplyDebouncer(quiet_period=quiet_period, max_delay=quiet_period * 4)
+        posted = {"legacy": 0, "debounced": 0}
+
+        async def generate(kind, guard=None):
+            await asyncio.sleep(generation_time) # 模拟 DeepSeek 调用
+            if guard: guard.commit()
+            posted[kind] += 1
+
+        async def user(ticket, debounced):
+            for _ in range(bursts):
+                for _ in range(burst_size):
+                    if debounced:
+                        debouncer.submit(ticket, lambda guard: generate("debounced", guard))
+                    else:
+                        asyncio.ensure_future(generate("legacy")) # 旧: 每条消息各调用一次
+                    await asyncio.sleep(random.uniform(0, quiet_period * 1.5)) # 间隔偶尔超过静默期，会取消进行中的生成
+                await asyncio.sleep(quiet_period + generation_time * 2) # 等待回复后再开始下一轮
+
+        await asyncio.gather(*(user(t, False) for t in range(tickets)))
+        await asyncio.sleep(generation_time * 2)
+        await asyncio.gather(*(user(t, True) for t in range(tickets)))
+        await asyncio.sleep(quiet_period * 4 + generation_time * 2)
+        total = tickets * bursts * burst_size
+        print(f"  用户消息: {total}")
+        print(f"  旧: 每条消息一次调用      API 调用 {total:>6}   发出回复 {posted['legacy']:>6}")
+        print(f"  ReplyDebouncer            API 调用 {debouncer.calls:>6}   发出回复 {posted['debounced']:>6}")
+        print(f"  {debouncer.stats()}")
+
+    asyncio.run(main())
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="AI 票据回复防抖基准测试")
+    parser.add_argument("--tickets", type=int, default=20)
+    parser.add_argument("--bursts", type=int, default=10)
+    parser.add_argument("--burst-size", type=int, default=4)
+    parser.add_argument("--quiet-period", type=float, default=0.05)
+    parser.add_argument("--generation-time", type=float, default=0.1)
+    args = parser.parse_args()
+    print(f"{args.tickets} 个票据, 每个 {args.bursts} 次突发, 每次突发 {args.burst_size} 条消息:")
+    _run_benchmark(args.tickets, args.bursts, args.burst_size, args.quiet_period, args.generation_time)
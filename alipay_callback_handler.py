@@ -3,7 +3,6 @@ from flask import Flask, request, jsonify # jsonify可能用不上，但先留
 import logging
 import datetime
 import os 
-import base64
 import json 
 import urllib.parse
 
@@ -26,19 +25,15 @@ except ImportError:
     database = FakeDB()
 
 
-# 导入支付宝SDK的验签工具
-# 我们将使用 alipay-sdk-python (官方SDK) 的验签方法
+# 支付宝回调验签 (alipay_verify.py: 公钥只解析一次，重复通知命中短期缓存)
 try:
-    from alipay.aop.api.util.SignatureUtils import verify_with_rsa
+    import alipay_verify
     ALIPAY_SDK_VERIFY_AVAILABLE = True
 except ImportError:
-    logging.critical("CRITICAL: Failed to import verify_with_rsa from alipay.aop.api.util.SignatureUtils. "
-                  "Ensure alipay-sdk-python is installed in the correct virtual environment. "
+    logging.critical("CRITICAL: Failed to import alipay_verify (requires pycryptodome). "
+                  "Ensure pycryptodome is installed in the correct virtual environment. "
                   "Signature verification will FAIL.")
     ALIPAY_SDK_VERIFY_AVAILABLE = False
-    def verify_with_rsa(content_bytes, sign_bytes, public_key_str, sign_type="RSA2"): # Fake function
-        logging.error("verify_with_rsa is not available due to import error. Signature verification will ALWAYS FAIL.")
-        return False
 
 app = Flask(__name__)
 
@@ -49,7 +44,7 @@ logging.basicConfig(level=logging.INFO,
 # --- 配置变量 ---
 # 【重要】支付宝公钥字符串 - 用于验证支付宝回调的签名
 # 从支付宝开放平台获取，确保是纯Base64编码的字符串 (不含头尾标记和换行)
-# 或者，如果是从PEM文件读取，确保此变量在被 verify_with_rsa 使用时是纯Base64格式
+# 也可以是完整的PEM内容 (alipay_verify 会自动识别)
 ALIPAY_PUBLIC_KEY_STR = os.environ.get("ALIPAY_PUBLIC_KEY_CONTENT_FOR_CALLBACK_VERIFY") 
 if not ALIPAY_PUBLIC_KEY_STR:
     ALIPAY_PUBLIC_KEY_STR = "请在这里替换为您的支付宝公钥的纯Base64字符串(用于回调验签)"
@@ -73,6 +68,13 @@ if ALIPAY_PUBLIC_KEY_STR == "请在这里替换为您的支付宝公钥的纯Bas
 if MY_APP_ID == "请在这里替换为您的支付宝应用APPID":
     logging.critical("FATAL: MY_APP_ID is not configured! Callback verification will fail.")
 
+alipay_verifier = None
+if ALIPAY_SDK_VERIFY_AVAILABLE and "请在这里替换" not in ALIPAY_PUBLIC_KEY_STR:
+    try:
+        alipay_verifier = alipay_verify.AlipayVerifier(ALIPAY_PUBLIC_KEY_STR)
+    except (ValueError, IndexError, TypeError) as e_key:
+        logging.critical(f"FATAL: ALIPAY_PUBLIC_KEY_STR could not be parsed as an RSA public key: {e_key}. Callback verification will fail.")
+
 # --- 辅助函数 ---
 def check_and_process_order(data_form: dict) -> bool:
     """
@@ -218,7 +220,7 @@ def alipay_notify_route():
         logging.info(f"Received Form Data: {data_form}")
 
         if not ALIPAY_SDK_VERIFY_AVAILABLE:
-            logging.critical("Alipay SDK for verification is not available. CANNOT VERIFY SIGNATURE. Ignoring callback.")
+            logging.critical("Signature verification module is not available. CANNOT VERIFY SIGNATURE. Ignoring callback.")
             return "failure", 200 # 返回 "failure" 但给支付宝200 OK避免重试，因为是服务器配置问题
 
         sign = data_form.pop('sign', None)
@@ -232,27 +234,13 @@ def alipay_notify_route():
             logging.error(f"Unsupported sign_type: {sign_type}. Expected RSA2. Data: {data_form}")
             return "failure", 200
         
-        if not ALIPAY_PUBLIC_KEY_STR or "请在这里替换" in ALIPAY_PUBLIC_KEY_STR:
-            logging.critical("ALIPAY_PUBLIC_KEY_STR (for callback verification) is not configured!")
+        if alipay_verifier is None:
+            logging.critical("ALIPAY_PUBLIC_KEY_STR (for callback verification) is not configured or invalid!")
             return "failure", 200 
 
-        params_to_sign_list = []
-        for key, value in sorted(data_form.items()):
-            if value is not None and value != '': 
-                params_to_sign_list.append(f"{key}={value}")
-        
-        message_to_verify = "&".join(params_to_sign_list)
-        # logging.debug(f"Message to verify for signature: {message_to_verify}")
-        # logging.debug(f"Signature from Alipay: {sign}")
-
         verify_success = False
         try:
-            verify_success = verify_with_rsa(
-                message_to_verify.encode('utf-8'), 
-                base64.b64decode(sign), 
-                ALIPAY_PUBLIC_KEY_STR,
-                "RSA2" 
-            )
+            verify_success = alipay_verifier.verify({**data_form, 'sign': sign, 'sign_type': sign_type})
             logging.info(f"Signature verification result: {verify_success}")
         except Exception as e_verify:
             logging.error(f"Exception during signature verification: {e_verify}", exc_info=True)
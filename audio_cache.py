@@ -0,0 +1,230 @@
+# audio_cache.py
+"""
+热门曲目的本地音频缓存 (可选)。
+
+- 以 "提取器-视频ID" 为键，把音频保存为 Ogg Opus 文件 (源本身是 Opus 时直接复制音轨，否则转码)，
+  之后的播放直接读本地文件，不再经过远程直链与 FFmpeg 的重连参数。
+- 只缓存 "热门" 曲目：所有服务器累计播放达到 AUDIO_CACHE_MIN_PLAYS 次，或正在单曲循环。
+- 总大小超过上限时按最近最少使用 (LRU) 淘汰；文件的 mtime 记录最近使用时间，重启后据此恢复顺序。
+- 下载与转码在专用的小线程池中执行，不占用事件循环；同一首歌同时只会下载一次。
+
+通过环境变量启用：MUSIC_AUDIO_CACHE_MB (上限，默认 0 = 关闭)、MUSIC_AUDIO_CACHE_DIR (默认 audio_cache)。
+"""
+import concurrent.futures
+import logging
+import os
+import re
+import shutil
+import subprocess
+import threading
+import time
+from collections import Counter, OrderedDict
+from typing import Any, Dict, List, Optional
+
+AUDIO_CACHE_DIR = os.getenv("MUSIC_AUDIO_CACHE_DIR", "audio_cache")
+AUDIO_CACHE_MAX_BYTES = int(float(os.getenv("MUSIC_AUDIO_CACHE_MB", "0")) * 1024 * 1024)
+AUDIO_CACHE_MIN_PLAYS = 2
+AUDIO_CACHE_WORKERS = 2
+MAX_CACHED_TRACK_SECONDS = 15 * 60  # 更长的 (混音、直播录像) 不缓存
+DOWNLOAD_TIMEOUT = 300
+PLAY_COUNT_LIMIT = 10000  # 播放计数表的上限，超过后清零重新统计
+OPUS_BITRATE = "128k"
+CACHE_SUFFIX = ".opus"
+
+
+class AudioCache:
+    """线程安全。max_bytes <= 0 或找不到 ffmpeg 时处于关闭状态，所有方法都是空操作。"""
+
+    def __init__(self, directory: str, max_bytes: int, min_plays: int = AUDIO_CACHE_MIN_PLAYS,
+                 workers: int = AUDIO_CACHE_WORKERS, ffmpeg: str = "ffmpeg"):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.min_plays = max(1, min_plays)
+        self.ffmpeg = shutil.which(ffmpeg) if max_bytes > 0 else None
+        self.enabled = bool(self.ffmpeg)
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[str, int]" = OrderedDict()  # 键 -> 文件大小，按最近使用排序
+        self._bytes = 0
+        self._plays: Counter = Counter()
+        self._pending: Dict[str, concurrent.futures.Future] = {}
+        self._executor: Optional[concurrent.futures.ThreadPoolExecutor] = None
+        self.hits = 0
+        self.misses = 0
+        self.downloads = 0
+        self.failures = 0
+        self.evictions = 0
+        if max_bytes > 0 and not self.ffmpeg:
+            print(f"⚠️ [AudioCache] 找不到 {ffmpeg}，本地音频缓存已关闭。")
+        if self.enabled:
+            os.makedirs(directory, exist_ok=True)
+            self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="audio-cache")
+            self._scan()
+            print(f"ℹ️ [AudioCache] 本地音频缓存: {directory} ({len(self._entries)} 个文件, "
+                  f"{self._bytes / 1024 / 1024:.0f}/{max_bytes / 1024 / 1024:.0f} MiB)")
+
+    @staticmethod
+    def cache_key(data: Dict[str, Any]) -> Optional[str]:
+        extractor = data.get('extractor_key') or data.get('extractor')
+        video_id = data.get('id')
+        if not extractor or not video_id:
+            return None
+        # 视频 ID 区分大小写，只替换文件名中不安全的字符
+        return re.sub(r"[^\w.-]", "_", f"{extractor}-{video_id}")
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, key + CACHE_SUFFIX)
+
+    def _scan(self):
+        files = []
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if name.endswith(".part"): # 上次运行中断留下的半成品
+                try: os.remove(path)
+                except OSError: pass
+            elif name.endswith(CACHE_SUFFIX):
+                try: stat = os.stat(path)
+                except OSError: continue
+                files.append((stat.st_mtime, name[:-len(CACHE_SUFFIX)], stat.st_size))
+        with self._lock:
+            for _, key, size in sorted(files):
+                self._entries[key] = size; self._bytes += size
+            self._evict_locked()
+
+    def _evict_locked(self):
+        while self._bytes > self.max_bytes and self._entries:
+            key, size = self._entries.popitem(last=False)
+            self._bytes -= size; self.evictions += 1
+            try: os.remove(self._path(key)) # 正在播放的文件在 POSIX 上删除不影响已打开的 FFmpeg
+            except OSError as e: logging.warning(f"[AudioCache] 删除缓存文件 {key} 失败: {e}")
+
+    # ---------------------------------------------------------------
+    # 查询与登记
+    # ---------------------------------------------------------------
+    def path_for(self, data: Dict[str, Any]) -> Optional[str]:
+        """已缓存时返回本地文件路径 (并标记为最近使用)，否则返回 None。"""
+        if not self.enabled:
+            return None
+        key = self.cache_key(data)
+        if key is None:
+            return None
+        path = self._path(key)
+        with self._lock:
+            if key not in self._entries:
+                self.misses += 1
+                return None
+            if not os.path.exists(path): # 被外部删除
+                self._bytes -= self._entries.pop(key); self.misses += 1
+                return None
+            self._entries.move_to_end(key); self.hits += 1
+        try: os.utime(path, None)
+        except OSError: pass
+        return path
+
+    def is_cached(self, data: Dict[str, Any]) -> bool:
+        key = self.cache_key(data) if self.enabled else None
+        with self._lock:
+            return key is not None and key in self._entries
+
+    @staticmethod
+    def _cacheable(data: Dict[str, Any]) -> bool:
+        duration = data.get('duration')
+        return bool(data.get('url')) and not data.get('is_live') and bool(duration) and 0 < duration <= MAX_CACHED_TRACK_SECONDS
+
+    def note_play(self, data: Dict[str, Any], *, looping: bool = False) -> Optional[concurrent.futures.Future]:
+        """每次开始播放时调用；曲目足够热门 (或正在单曲循环) 时在后台缓存，返回下载任务。"""
+        if not self.enabled or not self._cacheable(data):
+            return None
+        key = self.cache_key(data)
+        if key is None:
+            return None
+        with self._lock:
+            if len(self._plays) >= PLAY_COUNT_LIMIT:
+                self._plays.clear()
+            self._plays[key] += 1
+            if key in self._entries or key in self._pending:
+                return None
+            if not looping and self._plays[key] < self.min_plays:
+                return None
+            future = self._executor.submit(self._download, key, data['url'], data.get('acodec'), data.get('http_headers') or {})
+            self._pending[key] = future
+        future.add_done_callback(lambda _f, k=key: self._finish(k))
+        return future
+
+    def _finish(self, key: str):
+        with self._lock:
+            self._pending.pop(key, None)
+
+    # ---------------------------------------------------------------
+    # 下载与转码 (线程池中运行)
+    # ---------------------------------------------------------------
+    def _ffmpeg_command(self, url: str, output: str, copy: bool, headers: Dict[str, str]) -> List[str]:
+        command = [self.ffmpeg, "-nostdin", "-hide_banner", "-loglevel", "error", "-y"]
+        if url.startswith(("http://", "https://")):
+            command += ["-reconnect", "1", "-reconnect_streamed", "1", "-reconnect_delay_max", "5"]
+            if headers:
+                command += ["-headers", "".join(f"{k}: {v}\r\n" for k, v in headers.items())]
+        command += ["-i", url, "-vn", "-map", "0:a:0"]
+        command += ["-c:a", "copy"] if copy else ["-c:a", "libopus", "-b:a", OPUS_BITRATE, "-ar", "48000", "-ac", "2"]
+        return command + ["-f", "ogg", output]
+
+    def _download(self, key: str, url: str, acodec: Optional[str], headers: Dict[str, str]) -> Optional[str]:
+        path = self._path(key); tmp = path + ".part"
+        started = time.perf_counter()
+        attempts = [True, False] if acodec == "opus" else [False] # Opus 源先尝试直接复制音轨，失败再转码
+        try:
+            for copy in attempts:
+                result = subprocess.run(self._ffmpeg_command(url, tmp, copy, headers), stdout=subprocess.DEVNULL,
+                                        stderr=subprocess.PIPE, timeout=DOWNLOAD_TIMEOUT)
+                if result.returncode == 0 and os.path.getsize(tmp) > 0:
+                    break
+            else:
+                raise RuntimeError(result.stderr.decode("utf-8", "replace").strip()[-300:] or f"ffmpeg 退出码 {result.returncode}")
+            size = os.path.getsize(tmp)
+            if size > self.max_bytes:
+                raise RuntimeError(f"文件大小 {size} 超过缓存上限")
+            os.replace(tmp, path)
+        except Exception as e:
+            with self._lock: self.failures += 1
+            logging.warning(f"[AudioCache] 缓存 {key} 失败: {type(e).__name__} - {str(e)[:300]}")
+            try: os.remove(tmp)
+            except OSError: pass
+            return None
+        with self._lock:
+            self._entries[key] = size; self._bytes += size; self.downloads += 1
+            self._evict_locked()
+        print(f"[AudioCache] 已缓存 {key} ({size / 1024:.0f} KiB, 用时 {time.perf_counter() - started:.1f}s)")
+        return path
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "enabled": self.enabled,
+                "files": len(self._entries),
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / total, 3) if total else 0.0,
+                "downloads": self.downloads,
+                "pending": len(self._pending),
+                "failures": self.failures,
+                "evictions": self.evictions,
+            }
+
+    def shutdown(self):
+        if self._executor:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+
+
+_audio_cache: Optional[AudioCache] = None
+_audio_cache_lock = threading.Lock()
+
+
+def get_audio_cache() -> AudioCache:
+    """进程内共享的音频缓存 (按环境变量配置)。"""
+    global _audio_cache
+    with _audio_cache_lock:
+        if _audio_cache is None:
+            _audio_cache = AudioCache(AUDIO_CACHE_DIR, AUDIO_CACHE_MAX_BYTES)
+        return _audio_cache
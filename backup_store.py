@@ -0,0 +1,252 @@
+# backup_store.py
+"""
+服务器备份的版本化存储与差异引擎。
+
+目录结构 (每个服务器一份):
+    backups/<guild_id>/index.json                 版本列表 (元数据)
+    backups/<guild_id>/objects/<sha256>.json.gz   内容寻址的压缩对象 (完整快照或增量)
+
+- 完整快照与增量都以紧凑 JSON + gzip 存储，文件名为内容的 sha256，相同内容只存一份。
+- 每隔 KEYFRAME_INTERVAL 个版本存一次完整快照 (关键帧)，其余版本只存与上一版本的增量，
+  因此还原任意版本最多只需回放 KEYFRAME_INTERVAL - 1 个增量。
+- 与上一版本完全相同 (忽略时间戳) 的快照不会产生新版本。
+"""
+import copy
+import datetime
+import gzip
+import hashlib
+import json
+import logging
+import os
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional
+
+BACKUP_STORE_DIR = "backups"
+KEYFRAME_INTERVAL = 10
+SECTIONS = ("roles", "categories", "text_channels", "voice_channels")
+_SNAPSHOT_CACHE_SIZE = 8
+
+
+def _canonical_bytes(obj: Any) -> bytes:
+    return json.dumps(obj, sort_keys=True, separators=(',', ':'), ensure_ascii=False).encode('utf-8')
+
+
+def snapshot_hash(snapshot: Dict[str, Any]) -> str:
+    """快照内容的哈希，不包含 timestamp，用于判断两次备份是否有实际变化。"""
+    body = {k: v for k, v in snapshot.items() if k != 'timestamp'}
+    return hashlib.sha256(_canonical_bytes(body)).hexdigest()
+
+
+def _keyed(items: List[Dict[str, Any]]) -> "OrderedDict[str, Dict[str, Any]]":
+    """按 original_id 为条目建立有序索引；旧备份中的频道没有 ID，退回到 分类ID/名称，重名时追加序号。"""
+    keyed = OrderedDict()
+    for item in items:
+        key = item.get('original_id') or f"{item.get('category_original_id')}/{item.get('name')}"
+        base, n = key, 1
+        while key in keyed:
+            n += 1
+            key = f"{base}#{n}"
+        keyed[key] = item
+    return keyed
+
+
+# =========================================
+# == 差异引擎
+# =========================================
+def diff_snapshots(old: Dict[str, Any], new: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    计算 old -> new 的增量。每个分区记录 added / changed (完整条目)、removed (键)，
+    只有当顺序与“旧顺序去掉删除项再追加新增项”不同时才记录 order。
+    """
+    delta = {"timestamp": new.get("timestamp"), "version": new.get("version"), "sections": {}}
+    if new.get("guild_info") != old.get("guild_info"):
+        delta["guild_info"] = new.get("guild_info")
+
+    for section in SECTIONS:
+        old_items = _keyed(old.get(section, []))
+        new_items = _keyed(new.get(section, []))
+        added = [(k, v) for k, v in new_items.items() if k not in old_items]
+        changed = [(k, v) for k, v in new_items.items() if k in old_items and old_items[k] != v]
+        removed = [k for k in old_items if k not in new_items]
+
+        section_delta = {}
+        if added: section_delta["added"] = added
+        if changed: section_delta["changed"] = changed
+        if removed: section_delta["removed"] = removed
+        expected_order = [k for k in old_items if k in new_items] + [k for k, _ in added]
+        if list(new_items) != expected_order:
+            section_delta["order"] = list(new_items)
+        if section_delta:
+            delta["sections"][section] = section_delta
+    return delta
+
+
+def apply_delta(base: Dict[str, Any], delta: Dict[str, Any]) -> Dict[str, Any]:
+    """把 diff_snapshots 产生的增量应用到 base 上，返回新的完整快照 (不修改 base)。"""
+    result = {k: copy.deepcopy(v) for k, v in base.items() if k not in SECTIONS}
+    result["timestamp"] = delta.get("timestamp", base.get("timestamp"))
+    if delta.get("version") is not None:
+        result["version"] = delta["version"]
+    if "guild_info" in delta:
+        result["guild_info"] = delta["guild_info"]
+
+    for section in SECTIONS:
+        items = _keyed(base.get(section, []))
+        section_delta = delta.get("sections", {}).get(section)
+        if not section_delta:
+            result[section] = [copy.deepcopy(v) for v in items.values()]
+            continue
+        for key in section_delta.get("removed", []):
+            items.pop(key, None)
+        for key, item in section_delta.get("changed", []):
+            items[key] = item
+        for key, item in section_delta.get("added", []):
+            items[key] = item
+        order = section_delta.get("order") or list(items)
+        result[section] = [copy.deepcopy(items[k]) for k in order if k in items]
+    return result
+
+
+def summarize_delta(delta: Dict[str, Any]) -> Dict[str, Dict[str, int]]:
+    return {
+        section: {kind: len(d.get(kind, [])) for kind in ("added", "changed", "removed")}
+        for section, d in delta.get("sections", {}).items()
+    }
+
+
+# =========================================
+# == 版本化存储
+# =========================================
+class BackupStore:
+    """线程安全：Flask 线程与机器人事件循环 (经 run_in_executor) 都可能同时访问。"""
+
+    def __init__(self, root: str = BACKUP_STORE_DIR):
+        self.root = root
+        self._lock = threading.RLock()
+        self._snapshot_cache: "OrderedDict[tuple, Dict[str, Any]]" = OrderedDict()
+
+    def _guild_dir(self, guild_id: int) -> str:
+        return os.path.join(self.root, str(int(guild_id)))
+
+    def _object_path(self, guild_id: int, digest: str) -> str:
+        return os.path.join(self._guild_dir(guild_id), "objects", f"{digest}.json.gz")
+
+    def _write_object(self, guild_id: int, payload: Dict[str, Any]) -> str:
+        raw = _canonical_bytes(payload)
+        digest = hashlib.sha256(raw).hexdigest()
+        path = self._object_path(guild_id, digest)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = f"{path}.tmp"
+            with gzip.open(tmp_path, 'wb', compresslevel=6) as f:
+                f.write(raw)
+            os.replace(tmp_path, path)
+        return digest
+
+    def _read_object(self, guild_id: int, digest: str) -> Dict[str, Any]:
+        with gzip.open(self._object_path(guild_id, digest), 'rb') as f:
+            return json.loads(f.read().decode('utf-8'))
+
+    def _load_index(self, guild_id: int) -> List[Dict[str, Any]]:
+        path = os.path.join(self._guild_dir(guild_id), "index.json")
+        if not os.path.exists(path):
+            return []
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+
+    def _save_index(self, guild_id: int, index: List[Dict[str, Any]]):
+        path = os.path.join(self._guild_dir(guild_id), "index.json")
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(index, f, ensure_ascii=False)
+        os.replace(tmp_path, path)
+
+    def list_versions(self, guild_id: int) -> List[Dict[str, Any]]:
+        with self._lock:
+            return self._load_index(guild_id)
+
+    def save_snapshot(self, guild_id: int, snapshot: Dict[str, Any], trigger: str = "manual") -> Dict[str, Any]:
+        """
+        保存一个新快照，返回其版本条目。内容与最新版本相同时不新建版本，
+        返回的条目带有 "unchanged": True。
+        """
+        with self._lock:
+            index = self._load_index(guild_id)
+            content_hash = snapshot_hash(snapshot)
+            if index and index[-1]["snapshot_hash"] == content_hash:
+                return dict(index[-1], unchanged=True)
+
+            entry = {
+                "version": index[-1]["version"] + 1 if index else 1,
+                "created_at": snapshot.get("timestamp") or datetime.datetime.now(datetime.timezone.utc).isoformat(),
+                "trigger": trigger,
+                "snapshot_hash": content_hash,
+            }
+            chain_length = 0
+            for previous in reversed(index):
+                chain_length += 1
+                if previous["kind"] == "full":
+                    break
+
+            if not index or chain_length >= KEYFRAME_INTERVAL:
+                entry.update(kind="full", object=self._write_object(guild_id, snapshot))
+            else:
+                previous_snapshot = self._rebuild(guild_id, index, index[-1]["version"])
+                delta = diff_snapshots(previous_snapshot, snapshot)
+                entry.update(kind="delta", base=index[-1]["version"], object=self._write_object(guild_id, delta),
+                             summary=summarize_delta(delta))
+
+            index.append(entry)
+            self._save_index(guild_id, index)
+            self._remember(guild_id, entry["version"], copy.deepcopy(snapshot))
+            logging.info(f"[BackupStore] 服务器 {guild_id} 已保存备份版本 v{entry['version']} ({entry['kind']}, {trigger})")
+            return entry
+
+    def load_snapshot(self, guild_id: int, version: Optional[int] = None) -> Optional[Dict[str, Any]]:
+        """还原指定版本 (默认最新) 的完整快照；版本不存在时返回 None。"""
+        with self._lock:
+            index = self._load_index(guild_id)
+            if not index:
+                return None
+            if version is None:
+                version = index[-1]["version"]
+            if not any(e["version"] == version for e in index):
+                return None
+            return copy.deepcopy(self._rebuild(guild_id, index, version))
+
+    def diff_versions(self, guild_id: int, old_version: int, new_version: int) -> Optional[Dict[str, Any]]:
+        old = self.load_snapshot(guild_id, old_version)
+        new = self.load_snapshot(guild_id, new_version)
+        if old is None or new is None:
+            return None
+        return diff_snapshots(old, new)
+
+    def _rebuild(self, guild_id: int, index: List[Dict[str, Any]], version: int) -> Dict[str, Any]:
+        cached = self._snapshot_cache.get((guild_id, version))
+        if cached is not None:
+            self._snapshot_cache.move_to_end((guild_id, version))
+            return cached
+
+        by_version = {e["version"]: e for e in index}
+        chain = []
+        entry = by_version[version]
+        while True:
+            chain.append(entry)
+            if entry["kind"] == "full" or (guild_id, entry["version"]) in self._snapshot_cache:
+                break
+            entry = by_version[entry["base"]]
+
+        head = chain.pop()
+        snapshot = self._snapshot_cache.get((guild_id, head["version"])) or self._read_object(guild_id, head["object"])
+        for entry in reversed(chain):
+            snapshot = apply_delta(snapshot, self._read_object(guild_id, entry["object"]))
+        self._remember(guild_id, version, snapshot)
+        return snapshot
+
+    def _remember(self, guild_id: int, version: int, snapshot: Dict[str, Any]):
+        self._snapshot_cache[(guild_id, version)] = snapshot
+        self._snapshot_cache.move_to_end((guild_id, version))
+        while len(self._snapshot_cache) > _SNAPSHOT_CACHE_SIZE:
+            self._snapshot_cache.popitem(last=False)
@@ -0,0 +1,532 @@
+# bot_rpc.py
+"""
+机器人进程与 Web 面板工作进程之间的本地 RPC (Unix 套接字)。
+
+WEB_PANEL_MODE=process 时，Flask/Socket.IO 面板运行在独立的工作进程中 (可以有多个，共享同一端口)，
+机器人进程只负责 Discord 网关，不再与 eventlet 绿色线程和面板请求争抢同一个 GIL。
+
+- 帧格式: 4 字节大端长度 + 消息体。消息体用 msgpack 编码 (未安装 msgpack 时回退到 JSON，
+  bytes 以 base64 包装)。两端运行同一份代码和环境，编码方式总是一致的。
+- 请求 {"id", "method", "args", "kwargs"}，应答 {"id", "result"} 或 {"id", "error", "type"}。
+  同一连接上的请求在服务器端并发执行，应答按完成顺序写回。
+- RPCServer 运行在机器人的事件循环上。协程处理函数直接在循环上执行；阻塞的处理函数
+  (blocking=True，例如转发过来的 HTTP 请求) 在专用线程池中执行。
+- 订阅: 客户端发送 "__subscribe__" 后，该连接只接收推送 {"topic", "data"}。publish() 可以从任意线程调用；
+  某个订阅者积压超过 SUBSCRIBER_BUFFER_LIMIT 字节时丢弃给它的推送，不会拖慢机器人。
+- RPCClient 是阻塞式的、线程安全的 (在打过 eventlet 补丁的工作进程中即为绿色线程安全)，维护一个连接池。
+- SocketIOBridge 是基于订阅的 python-socketio PubSubManager：机器人进程里的 socketio.emit / join_room
+  经由 RPC 推送到所有工作进程，由持有对应客户端连接的工作进程执行。
+
+延迟测试 (面板请求在机器人进程内的线程中执行 vs. 在工作进程中执行时，机器人事件循环的延迟):
+    python bot_rpc.py --requests 400 --concurrency 8 --work-ms 5
+"""
+import asyncio
+import base64
+import concurrent.futures
+import itertools
+import json
+import logging
+import os
+import socket
+import stat
+import struct
+import tempfile
+import threading
+import time
+from typing import Any, Callable, Dict, Iterator, List, Optional, Set, Tuple
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    from socketio import PubSubManager
+except ImportError:
+    PubSubManager = object
+
+
+def _default_socket_path() -> str:
+    """当前用户私有的运行时目录 ($XDG_RUNTIME_DIR，否则为临时目录下按 uid 区分的子目录)。"""
+    runtime_dir = os.environ.get("XDG_RUNTIME_DIR")
+    if runtime_dir and os.path.isdir(runtime_dir):
+        return os.path.join(runtime_dir, "webvabot", "bot.sock")
+    return os.path.join(tempfile.gettempdir(), f"webvabot-{os.getuid()}", "bot.sock")
+
+
+DEFAULT_SOCKET_PATH = _default_socket_path()
+CALL_TIMEOUT = 30.0
+CONNECT_TIMEOUT = 2.0
+BLOCKING_WORKERS = 8
+CLIENT_POOL_SIZE = 16
+MAX_FRAME_BYTES = 64 * 1024 * 1024
+SUBSCRIBER_BUFFER_LIMIT = 4 * 1024 * 1024
+RESUBSCRIBE_DELAY = 1.0
+
+_HEADER = struct.Struct(">I")
+
+
+def _prepare_socket_dir(path: str) -> bool:
+    """
+    确保套接字所在目录只有当前用户可以访问 (不存在时以 0700 创建)。
+    返回 False 表示目录不是私有的 (例如 BOT_RPC_SOCKET 指向 /tmp 下)。
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, mode=0o700, exist_ok=True)
+    info = os.lstat(directory)
+    if stat.S_ISLNK(info.st_mode) or info.st_uid != os.getuid():
+        return False
+    if stat.S_IMODE(info.st_mode) & 0o077:
+        return False
+    return True
+
+
+class RPCError(Exception):
+    """远端处理函数抛出的异常。"""
+
+
+class RPCUnavailable(RPCError):
+    """无法连接机器人进程 (尚未启动、正在重启或连接中断)。"""
+
+
+# =========================================
+# == 编码
+# =========================================
+def _json_default(obj):
+    if isinstance(obj, (bytes, bytearray)):
+        return {"__bytes__": base64.b64encode(obj).decode()}
+    if isinstance(obj, (set, frozenset)):
+        return list(obj)
+    raise TypeError(f"无法序列化类型 {type(obj).__name__}")
+
+
+def _json_object_hook(obj):
+    return base64.b64decode(obj["__bytes__"]) if len(obj) == 1 and "__bytes__" in obj else obj
+
+
+def encode(message: Any) -> bytes:
+    if msgpack is not None:
+        body = msgpack.packb(message, use_bin_type=True, default=lambda o: list(o) if isinstance(o, (set, frozenset)) else o)
+    else:
+        body = json.dumps(message, ensure_ascii=False, default=_json_default).encode()
+    return _HEADER.pack(len(body)) + body
+
+
+def decode(body: bytes) -> Any:
+    if msgpack is not None:
+        return msgpack.unpackb(body, raw=False, strict_map_key=False)
+    return json.loads(body, object_hook=_json_object_hook)
+
+
+def _recv_exactly(sock: socket.socket, size: int) -> bytes:
+    chunks, remaining = [], size
+    while remaining:
+        chunk = sock.recv(min(remaining, 1 << 20))
+        if not chunk:
+            raise ConnectionError("连接已被对端关闭")
+        chunks.append(chunk)
+        remaining -= len(chunk)
+    return b"".join(chunks)
+
+
+def _recv_frame(sock: socket.socket) -> Any:
+    (size,) = _HEADER.unpack(_recv_exactly(sock, _HEADER.size))
+    if size > MAX_FRAME_BYTES:
+        raise ConnectionError(f"帧过大: {size} 字节")
+    return decode(_recv_exactly(sock, size))
+
+
+# =========================================
+# == 服务器 (机器人进程)
+# =========================================
+class RPCServer:
+    def __init__(self, path: str = DEFAULT_SOCKET_PATH, blocking_workers: int = BLOCKING_WORKERS):
+        self.path = path
+        self._handlers: Dict[str, Tuple[Callable, bool]] = {}
+        self._subscribers: Dict[str, Set[asyncio.StreamWriter]] = {}
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=blocking_workers, thread_name_prefix="bot-rpc")
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._server: Optional[asyncio.AbstractServer] = None
+        self._tasks: Set[asyncio.Task] = set()  # 事件循环只弱引用任务
+        self._lock = threading.Lock()
+        self._method_stats: Dict[str, List[float]] = {}  # 方法 -> [调用次数, 错误次数, 总耗时]
+        self.connections = 0
+        self.pushed = 0
+        self.push_dropped = 0
+        self.register("__publish__", self._publish_from_client)
+
+    def register(self, name: str, fn: Callable, blocking: bool = False):
+        """注册处理函数。协程函数在事件循环上执行；blocking=True 的普通函数在线程池中执行，否则直接在循环上调用。"""
+        self._handlers[name] = (fn, blocking)
+
+    async def start(self):
+        self._loop = asyncio.get_running_loop()
+        private_dir = _prepare_socket_dir(self.path)
+        if os.path.exists(self.path):
+            os.unlink(self.path)  # 上次运行残留的套接字文件
+        if not private_dir:
+            logging.warning(f"[BotRPC] 套接字目录 {os.path.dirname(self.path)} 不是当前用户私有的，建议把 BOT_RPC_SOCKET 放到私有目录中")
+        # 套接字在 bind 时就以 0600 创建，不存在其它本地用户可以连接的窗口
+        old_umask = os.umask(0o177)
+        try:
+            self._server = await asyncio.start_unix_server(self._handle_connection, path=self.path, limit=MAX_FRAME_BYTES)
+        finally:
+            os.umask(old_umask)
+        os.chmod(self.path, 0o600)
+        logging.info(f"[BotRPC] 正在监听 {self.path}")
+
+    async def close(self):
+        if self._server:
+            self._server.close()
+            await self._server.wait_closed()
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+    async def _handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.connections += 1
+        try:
+            while True:
+                (size,) = _HEADER.unpack(await reader.readexactly(_HEADER.size))
+                if size > MAX_FRAME_BYTES:
+                    raise ConnectionError(f"帧过大: {size} 字节")
+                message = decode(await reader.readexactly(size))
+                if message.get("method") == "__subscribe__":
+                    topic = message["args"][0]
+                    self._subscribers.setdefault(topic, set()).add(writer)
+                    writer.write(encode({"id": message["id"], "result": True}))
+                    continue
+                task = asyncio.create_task(self._dispatch(message, writer))
+                self._tasks.add(task)
+                task.add_done_callback(self._tasks.discard)
+        except (asyncio.IncompleteReadError, ConnectionError, asyncio.CancelledError):
+            pass # 对端断开或服务器关闭
+        except Exception as e:
+            logging.error(f"[BotRPC] 处理连接时出错: {e}", exc_info=True)
+        finally:
+            self.connections -= 1
+            for subscribers in self._subscribers.values():
+                subscribers.discard(writer)
+            # 已开始执行的请求 (例如向 Discord 发消息) 照常完成，只是应答不再写回
+            writer.close()
+
+    async def _dispatch(self, message: Dict[str, Any], writer: asyncio.StreamWriter):
+        method = message.get("method")
+        started = time.perf_counter()
+        failed = False
+        try:
+            if method not in self._handlers:
+                raise RPCError(f"未知的 RPC 方法: {method}")
+            fn, blocking = self._handlers[method]
+            args, kwargs = message.get("args") or [], message.get("kwargs") or {}
+            if asyncio.iscoroutinefunction(fn):
+                result = await fn(*args, **kwargs)
+            elif blocking:
+                result = await self._loop.run_in_executor(self._executor, lambda: fn(*args, **kwargs))
+            else:
+                result = fn(*args, **kwargs)
+            response = {"id": message.get("id"), "result": result}
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            failed = True
+            if not isinstance(e, RPCError):
+                logging.error(f"[BotRPC] 方法 {method} 执行失败: {e}", exc_info=True)
+            response = {"id": message.get("id"), "error": str(e), "type": type(e).__name__}
+        with self._lock:
+            entry = self._method_stats.setdefault(str(method), [0, 0, 0.0])
+            entry[0] += 1
+            entry[1] += failed
+            entry[2] += time.perf_counter() - started
+        try:
+            frame = encode(response)
+        except Exception as e:
+            frame = encode({"id": message.get("id"), "error": f"返回值无法序列化: {e}", "type": "TypeError"})
+        if not writer.is_closing():
+            writer.write(frame)
+            await writer.drain()
+
+    # ---------------------------------------------------------------
+    # 推送
+    # ---------------------------------------------------------------
+    def publish(self, topic: str, data: Any):
+        """把 data 推送给该主题的全部订阅者。线程安全；服务器尚未启动时直接丢弃。"""
+        loop = self._loop
+        if loop is None or not self._subscribers.get(topic):
+            return
+        frame = encode({"topic": topic, "data": data})
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+        if running is loop:
+            self._push(topic, frame)
+        else:
+            loop.call_soon_threadsafe(self._push, topic, frame)
+
+    def _publish_from_client(self, topic: str, data: Any):
+        self.publish(topic, data)
+
+    def _push(self, topic: str, frame: bytes):
+        for writer in list(self._subscribers.get(topic, ())):
+            if writer.is_closing():
+                continue
+            if writer.transport.get_write_buffer_size() > SUBSCRIBER_BUFFER_LIMIT:
+                self.push_dropped += 1
+                continue
+            writer.write(frame)
+            self.pushed += 1
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            methods = {name: {"calls": int(calls), "errors": int(errors), "avg_ms": round(total / calls * 1000, 2) if calls else 0.0}
+                       for name, (calls, errors, total) in self._method_stats.items()}
+        return {"connections": self.connections, "subscribers": sum(len(s) for s in self._subscribers.values()),
+                "pushed": self.pushed, "push_dropped": self.push_dropped, "methods": methods}
+
+
+# =========================================
+# == 客户端 (Web 工作进程)
+# =========================================
+class RPCClient:
+    def __init__(self, path: str = DEFAULT_SOCKET_PATH, pool_size: int = CLIENT_POOL_SIZE, timeout: float = CALL_TIMEOUT):
+        self.path = path
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self._pool: List[socket.socket] = []
+        self._lock = threading.Lock()
+        self._ids = itertools.count(1)
+        self.calls = 0
+        self.failures = 0
+
+    def _connect(self) -> socket.socket:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(CONNECT_TIMEOUT)
+        try:
+            sock.connect(self.path)
+        except OSError as e:
+            sock.close()
+            raise RPCUnavailable(f"无法连接机器人进程 ({self.path}): {e}") from e
+        return sock
+
+    def _acquire(self) -> Tuple[socket.socket, bool]:
+        with self._lock:
+            if self._pool:
+                return self._pool.pop(), True
+        return self._connect(), False
+
+    def _release(self, sock: socket.socket):
+        with self._lock:
+            if len(self._pool) < self.pool_size:
+                self._pool.append(sock)
+                return
+        sock.close()
+
+    def call(self, method: str, *args, timeout: Optional[float] = None, **kwargs) -> Any:
+        """调用机器人进程中注册的方法并等待结果。远端异常抛出 RPCError，连接失败抛出 RPCUnavailable，超时抛出 TimeoutError。"""
+        request_id = next(self._ids)
+        frame = encode({"id": request_id, "method": method, "args": list(args), "kwargs": kwargs})
+        self.calls += 1
+        for attempt in range(2):
+            sock, reused = self._acquire()
+            try:
+                sock.sendall(frame)
+            except OSError as e:
+                sock.close()
+                if reused and attempt == 0:
+                    continue # 池中的连接已失效 (例如机器人进程重启过)，请求尚未送达，换新连接重试一次
+                self.failures += 1
+                raise RPCUnavailable(f"发送 RPC 请求失败: {e}") from e
+            try:
+                sock.settimeout(timeout or self.timeout)
+                response = _recv_frame(sock)
+            except socket.timeout as e:
+                sock.close() # 迟到的应答会错位，这个连接不能再用
+                self.failures += 1
+                raise TimeoutError(f"RPC 方法 {method} 超时") from e
+            except (OSError, ValueError) as e:
+                sock.close()
+                self.failures += 1
+                raise RPCUnavailable(f"接收 RPC 应答失败: {e}") from e
+            self._release(sock)
+            if "error" in response:
+                raise RPCError(f"{response.get('type')}: {response['error']}")
+            return response.get("result")
+
+    def publish(self, topic: str, data: Any):
+        self.call("__publish__", topic, data)
+
+    def subscribe(self, topic: str) -> Iterator[Any]:
+        """无限迭代该主题的推送；连接断开后自动重连 (断开期间的推送会丢失)。"""
+        while True:
+            try:
+                sock = self._connect()
+            except RPCUnavailable as e:
+                logging.warning(f"[BotRPC] 订阅 {topic} 失败，{RESUBSCRIBE_DELAY:.0f} 秒后重试: {e}")
+                time.sleep(RESUBSCRIBE_DELAY)
+                continue
+            try:
+                sock.sendall(encode({"id": 0, "method": "__subscribe__", "args": [topic]}))
+                sock.settimeout(None)
+                _recv_frame(sock)  # 订阅确认
+                while True:
+                    message = _recv_frame(sock)
+                    if message.get("topic") == topic:
+                        yield message.get("data")
+            except (OSError, ValueError) as e:
+                logging.warning(f"[BotRPC] 订阅 {topic} 的连接中断: {e}")
+            finally:
+                sock.close()
+            time.sleep(RESUBSCRIBE_DELAY)
+
+    def close(self):
+        with self._lock:
+            pool, self._pool = self._pool, []
+        for sock in pool:
+            sock.close()
+
+    def stats(self) -> Dict[str, int]:
+        return {"calls": self.calls, "failures": self.failures, "pooled_connections": len(self._pool)}
+
+
+# =========================================
+# == Socket.IO 跨进程
+# =========================================
+class SocketIOBridge(PubSubManager):
+    """
+    python-socketio 的 client_manager。机器人进程中只写 (SocketIOBridge(server.publish))，
+    工作进程中收发 (SocketIOBridge(client.publish, client.subscribe))。
+    """
+    name = "bot-rpc"
+
+    def __init__(self, publish: Callable[[str, Any], None], subscribe: Optional[Callable[[str], Iterator[Any]]] = None,
+                 channel: str = "socketio"):
+        super().__init__(channel=channel, write_only=subscribe is None)
+        self._publish_fn = publish
+        self._subscribe_fn = subscribe
+
+    def _publish(self, data):
+        try:
+            self._publish_fn(self.channel, data)
+        except RPCError as e:
+            logging.warning(f"[BotRPC] 转发 Socket.IO 消息失败: {e}")
+
+    def _listen(self):
+        yield from self._subscribe_fn(self.channel)
+
+
+# =========================================
+# == 延迟测试
+# =========================================
+def _cpu_work(ms: float) -> int:
+    # 模拟一次面板请求的纯 Python 开销 (模板渲染、JSON 序列化等)，期间持有 GIL
+    deadline = time.perf_counter() + ms / 1000
+    n = 0
+    while time.perf_counter() < deadline:
+        n += len(json.dumps({"i": n, "roles": list(range(20))}))
+    return n
+
+
+async def _snapshot() -> Dict[str, Any]:
+    return {"guilds": 3, "users": 12345, "latency": 42}
+
+
+def _worker_process(path: str, requests: int, work_ms: float, go, results):
+    client = RPCClient(path)
+    go.wait()
+    for _ in range(requests):
+        client.call("snapshot")
+        _cpu_work(work_ms)
+    client.close()
+    results.put(requests)
+
+
+async def _measure(mode: str, requests: int, concurrency: int, work_ms: float, path: str) -> Dict[str, Any]:
+    import multiprocessing
+    loop = asyncio.get_running_loop()
+    lags: List[float] = []
+    stop = asyncio.Event()
+
+    async def monitor():
+        # 模拟网关心跳：每 10ms 醒来一次，记录被推迟的时间
+        interval = 0.01
+        while not stop.is_set():
+            started = time.perf_counter()
+            await asyncio.sleep(interval)
+            lags.append((time.perf_counter() - started - interval) * 1000)
+
+    server = None
+    procs = []
+    if mode == "process":
+        server = RPCServer(path)
+        server.register("snapshot", _snapshot)
+        await server.start()
+        # 工作进程启动较慢，先全部启动好再开始计时
+        ctx = multiprocessing.get_context("spawn")
+        go, results = ctx.Event(), ctx.Queue()
+        procs = [ctx.Process(target=_worker_process, args=(path, requests // concurrency, work_ms, go, results)) for _ in range(concurrency)]
+        for proc in procs:
+            proc.start()
+        await asyncio.sleep(2)
+    monitor_task = asyncio.create_task(monitor())
+    await asyncio.sleep(0.05)
+    started = time.perf_counter()
+    per_worker = requests // concurrency
+    if mode == "thread":
+        def panel_request():
+            asyncio.run_coroutine_threadsafe(_snapshot(), loop).result()
+            _cpu_work(work_ms)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=concurrency) as pool:
+            await asyncio.gather(*(loop.run_in_executor(pool, panel_request) for _ in range(per_worker * concurrency)))
+    else:
+        go.set()
+        for _ in procs:
+            await loop.run_in_executor(None, results.get)
+        for proc in procs:
+            proc.join()
+    elapsed = time.perf_counter() - started
+    stop.set()
+    await monitor_task
+    if server:
+        await server.close()
+        os.unlink(path)
+    lags.sort()
+    return {"mode": mode, "elapsed_s": round(elapsed, 2), "req_per_s": round(per_worker * concurrency / elapsed),
+            "lag_p50_ms": round(lags[len(lags) // 2], 2), "lag_p95_ms": round(lags[int(len(lags) * 0.95)], 2),
+            "lag_max_ms": round(lags[-1], 2)}
+
+
+def _measure_round_trip(calls: int, path: str) -> float:
+    async def run():
+        server = RPCServer(path)
+        server.register("snapshot", _snapshot)
+        await server.start()
+        client = RPCClient(path)
+        loop = asyncio.get_running_loop()
+
+        def hammer():
+            client.call("snapshot")  # 预热连接
+            started = time.perf_counter()
+            for _ in range(calls):
+                client.call("snapshot")
+            return time.perf_counter() - started
+
+        elapsed = await loop.run_in_executor(None, hammer)
+        client.close()
+        await server.close()
+        os.unlink(path)
+        return elapsed / calls * 1e6
+
+    return asyncio.run(run())
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Web 面板线程模式 vs. 工作进程模式的事件循环延迟测试")
+    parser.add_argument("--requests", type=int, default=400)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--work-ms", type=float, default=5.0, help="每个面板请求的 CPU 耗时")
+    args = parser.parse_args()
+    path = os.path.join(tempfile.mkdtemp(), "bench.sock")
+    print(f"编码: {'msgpack' if msgpack else 'JSON'}；单连接往返 {_measure_round_trip(5000, path):.0f} µs/次")
+    print(f"{args.requests} 个面板请求, 并发 {args.concurrency}, 每个请求 {args.work_ms:.0f}ms CPU:")
+    for mode in ("thread", "process"):
+        print(f"  {asyncio.run(_measure(mode, args.requests, args.concurrency, args.work_ms, path))}")
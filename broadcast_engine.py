@@ -0,0 +1,225 @@
+# broadcast_engine.py
+"""
+可恢复、自适应速率的全局私信广播引擎。
+
+- 收件人队列与断点保存在 SQLite (database.TABLE_BROADCAST_RECIPIENTS)，机器人重启后从未发送的收件人继续。
+- 发送间隔按 AIMD 调整：顺利时缓慢缩短，遇到 429 (或发送明显被 discord.py 的限速器拖慢) 时成倍拉长。
+- 每个服务器只构建一次 Embed 模板，模板不含 {user_name} 时所有收件人共用同一个对象。
+- 进度按固定时间间隔汇总上报，而不是每个用户一条日志。
+"""
+import asyncio
+import logging
+import time
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import discord
+
+import database
+
+FETCH_BATCH_SIZE = 200
+CHECKPOINT_BATCH_SIZE = 25
+PROGRESS_REPORT_INTERVAL = 2.0  # 秒
+MAX_RATE_LIMIT_RETRIES = 3
+CHECKPOINT_RETRIES = 4
+CHECKPOINT_RETRY_DELAY = 1.0  # 秒，每次重试翻倍
+
+
+class CheckpointError(Exception):
+    """发送结果无法写入数据库。继续发送会让这些收件人在下一次取批或恢复任务时被重复私信，因此任务必须停止。"""
+
+
+class AdaptiveRate:
+    """发送间隔的加性减小 / 乘性增大 (AIMD) 控制器。"""
+
+    def __init__(self, interval: float = 1.0, min_interval: float = 0.5, max_interval: float = 30.0):
+        self.interval = interval
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+
+    def on_success(self):
+        self.interval = max(self.min_interval, self.interval - 0.05)
+
+    def on_rate_limited(self, retry_after: Optional[float] = None):
+        self.interval = min(self.max_interval, max(self.interval * 2, retry_after or 0))
+
+
+class BroadcastJobRunner:
+    """
+    执行 (或继续执行) 一个已入队的广播任务。
+    report(message, type) 用于输出汇总日志，与原 perform_global_broadcast 的 log_progress 相同。
+    """
+
+    def __init__(self, bot, job: Dict[str, Any], report: Callable[..., None]):
+        self.bot = bot
+        self.job = job
+        self.job_id = job['job_id']
+        self.report = report
+        self.rate = AdaptiveRate(interval=job.get('send_interval') or 1.0)
+        self.sent = job.get('sent_count') or 0
+        self.failed = job.get('failed_count') or 0
+        self.total = job.get('total_count') or 0
+        self._pending_results: List[Tuple[int, str, Optional[str]]] = []
+        self._rate_limit_retries: Dict[int, int] = {}
+        self._embed_cache: Dict[int, Tuple[discord.Embed, bool]] = {}
+        self._last_report = 0.0
+        self._rate_limit_hits = 0
+
+    # ---------------------------------------------------------------
+    # Embed 模板
+    # ---------------------------------------------------------------
+    def _guild_template(self, guild_id: int) -> Tuple[discord.Embed, bool]:
+        cached = self._embed_cache.get(guild_id)
+        if cached:
+            return cached
+        guild = self.bot.get_guild(guild_id)
+        template = self.job['message_template'].replace('{server_name}', guild.name if guild else '')
+        embed = discord.Embed(title=self.job['title'], description=template, color=discord.Color.blue(),
+                              timestamp=discord.utils.utcnow())
+        if self.job.get('invite_url'):
+            embed.add_field(name="专属邀请", value=f"点击这里加入我们的社区：\n{self.job['invite_url']}", inline=False)
+        if self.bot.user and self.bot.user.avatar:
+            embed.set_footer(text=f"来自 {self.bot.user.name} 开发团队", icon_url=self.bot.user.avatar.url)
+        cached = (embed, '{user_name}' in template)
+        self._embed_cache[guild_id] = cached
+        return cached
+
+    def _embed_for(self, guild_id: int, display_name: str) -> discord.Embed:
+        embed, personalized = self._guild_template(guild_id)
+        if not personalized:
+            return embed
+        personal = embed.copy()
+        personal.description = embed.description.replace('{user_name}', display_name)
+        return personal
+
+    # ---------------------------------------------------------------
+    # 进度与断点
+    # ---------------------------------------------------------------
+    async def _checkpoint(self):
+        """写入断点；失败时保留结果并退避重试，仍失败则抛出 CheckpointError。"""
+        if not self._pending_results:
+            return
+        loop = asyncio.get_running_loop()
+        for attempt in range(CHECKPOINT_RETRIES):
+            saved = await loop.run_in_executor(
+                None, database.db_checkpoint_broadcast, self.job_id, list(self._pending_results), self.rate.interval
+            )
+            if saved:
+                self._pending_results = []
+                return
+            if attempt + 1 < CHECKPOINT_RETRIES:
+                await asyncio.sleep(CHECKPOINT_RETRY_DELAY * 2 ** attempt)
+        raise CheckpointError(f"{len(self._pending_results)} 条发送结果在 {CHECKPOINT_RETRIES} 次尝试后仍无法写入数据库")
+
+    async def _final_checkpoint(self, retry: bool = True):
+        """任务结束 (取消/出错) 前尽量保存剩余结果；失败时记录未保存的收件人，方便人工核对。"""
+        try:
+            if not retry:
+                raise CheckpointError("断点写入已失败")
+            await self._checkpoint()
+        except CheckpointError as e:
+            if self._pending_results:
+                unsaved = [user_id for user_id, _, _ in self._pending_results]
+                logging.error(f"[Broadcast] 广播任务 #{self.job_id} {e}，这些用户已处理但仍为 PENDING: {unsaved}")
+
+    def _maybe_report(self, force: bool = False):
+        now = time.monotonic()
+        if not force and now - self._last_report < PROGRESS_REPORT_INTERVAL:
+            return
+        self._last_report = now
+        done = self.sent + self.failed
+        remaining = max(self.total - done, 0)
+        self.report(
+            f"进度 {done}/{self.total}：成功 {self.sent}，失败 {self.failed}，"
+            f"当前间隔 {self.rate.interval:.2f} 秒，预计剩余 {remaining * self.rate.interval / 60:.1f} 分钟。", 'info'
+        )
+
+    def _record(self, user_id: int, status: str, error: Optional[str] = None):
+        self._pending_results.append((user_id, status, error))
+        if status == 'SENT':
+            self.sent += 1
+        else:
+            self.failed += 1
+
+    # ---------------------------------------------------------------
+    # 发送
+    # ---------------------------------------------------------------
+    async def _send_one(self, user_id: int, guild_id: int):
+        guild = self.bot.get_guild(guild_id)
+        recipient = (guild.get_member(user_id) if guild else None) or self.bot.get_user(user_id)
+        if recipient is None:
+            self._record(user_id, 'FAILED', 'NotFound')
+            return
+
+        started = time.monotonic()
+        try:
+            await recipient.send(embed=self._embed_for(guild_id, recipient.display_name))
+        except discord.HTTPException as e:
+            if e.status == 429 or e.code == 40003:  # 40003: 打开私信过快
+                self._rate_limit_hits += 1
+                self.rate.on_rate_limited(getattr(e, 'retry_after', None))
+                retries = self._rate_limit_retries.get(user_id, 0) + 1
+                self._rate_limit_retries[user_id] = retries
+                if retries >= MAX_RATE_LIMIT_RETRIES:
+                    self._record(user_id, 'FAILED', 'RateLimited')
+                # 否则保持 PENDING，下一批会重新取到
+                return
+            self._record(user_id, 'FAILED', 'Forbidden' if isinstance(e, discord.Forbidden) else f"HTTP {e.status}")
+            return
+        except Exception as e:
+            self._record(user_id, 'FAILED', type(e).__name__)
+            return
+
+        # discord.py 会在内部等待 429 后重试；发送耗时远超当前间隔说明已经被限速
+        if time.monotonic() - started > self.rate.interval + 2.0:
+            self._rate_limit_hits += 1
+            self.rate.on_rate_limited()
+        else:
+            self.rate.on_success()
+        self._record(user_id, 'SENT')
+
+    async def run(self) -> bool:
+        self.report(f"广播任务 #{self.job_id} 开始发送，共 {self.total} 名收件人 (已完成 {self.sent + self.failed})。", 'info')
+        loop = asyncio.get_running_loop()
+        try:
+            while True:
+                batch = await loop.run_in_executor(None, database.db_get_pending_broadcast_recipients, self.job_id, FETCH_BATCH_SIZE)
+                if not batch:
+                    break
+                for row in batch:
+                    await self._send_one(row['user_id'], row['guild_id'])
+                    if len(self._pending_results) >= CHECKPOINT_BATCH_SIZE:
+                        await self._checkpoint()
+                    self._maybe_report()
+                    await asyncio.sleep(self.rate.interval)
+                await self._checkpoint()
+        except asyncio.CancelledError:
+            await self._final_checkpoint()
+            raise
+        except Exception as e:
+            # 断点写不进去时停止任务 (标记为 FAILED，不会在重启后自动恢复)，避免重复私信
+            await self._final_checkpoint(retry=not isinstance(e, CheckpointError))
+            logging.error(f"[Broadcast] 广播任务 #{self.job_id} 执行出错: {e}", exc_info=not isinstance(e, CheckpointError))
+            await loop.run_in_executor(None, database.db_set_broadcast_job_status, self.job_id, 'FAILED')
+            self.report(f"广播任务 #{self.job_id} 执行出错: {e}", 'error')
+            return False
+
+        await loop.run_in_executor(None, database.db_set_broadcast_job_status, self.job_id, 'COMPLETED')
+        self._maybe_report(force=True)
+        self.report(f"广播任务完成！成功: {self.sent}, 失败: {self.failed}，期间触发限速 {self._rate_limit_hits} 次。", 'success')
+        return True
+
+
+async def enqueue_broadcast_recipients(bot, job_id: int, guilds: List[discord.Guild], report: Callable[..., None]) -> int:
+    """收集目标服务器的非机器人成员写入收件人队列 (同一用户只保留一次)，并把任务切换为 RUNNING。"""
+    recipients = []
+    for guild in guilds:
+        if not guild.chunked:
+            try:
+                await guild.chunk(cache=True)
+            except Exception as e:
+                report(f"警告：无法获取服务器 '{guild.name}' 的完整成员列表: {e}", 'warn')
+        recipients.extend((member.id, guild.id) for member in guild.members if not member.bot)
+    loop = asyncio.get_running_loop()
+    total = await loop.run_in_executor(None, database.db_add_broadcast_recipients, job_id, recipients)
+    await loop.run_in_executor(None, database.db_set_broadcast_job_status, job_id, 'RUNNING')
+    return total
@@ -7,6 +7,7 @@ import time
 import json # For extra_data
 import datetime # For audit log timestamp conversion
 import secrets # For generating secure access keys
+import hashlib
 
 # 数据库文件名
 DATABASE_FILE = "gjteam_bot.db"
@@ -24,6 +25,13 @@ TABLE_WEB_SUB_ACCOUNTS = "web_sub_accounts"
 # 【【【新增代码】】】
 TABLE_TICKET_DEPARTMENTS = "ticket_departments"
 TABLE_TICKETS = "tickets"
+TABLE_BROADCAST_JOBS = "broadcast_jobs"
+TABLE_BROADCAST_RECIPIENTS = "broadcast_recipients"
+TABLE_TRANSCRIPT_SEARCH = "transcript_search"  # FTS5 虚拟表
+TABLE_TRANSCRIPT_INDEX_STATE = "transcript_index_state"
+TABLE_MUSIC_QUEUE_STATE = "music_queue_state"
+TABLE_MUSIC_QUEUE_ENTRIES = "music_queue_entries"
+TABLE_PAYMENT_INBOX = "payment_inbox"
 # 【【【新增代码结束】】】
 
 def get_db_connection() -> sqlite3.Connection:
@@ -210,6 +218,102 @@ def initialize_database():
     add_column_if_not_exists(TABLE_TICKETS, 'is_ai_managed', 'INTEGER DEFAULT 0')
     # 【【【修复结束】】】
 
+    # --- 全局广播任务表 ---
+    cursor.execute(f"""
+    CREATE TABLE IF NOT EXISTS {TABLE_BROADCAST_JOBS} (
+        job_id INTEGER PRIMARY KEY AUTOINCREMENT,
+        title TEXT NOT NULL,
+        message_template TEXT NOT NULL,
+        invite_url TEXT,
+        created_by TEXT,
+        status TEXT NOT NULL DEFAULT 'PREPARING',
+        total_count INTEGER DEFAULT 0,
+        sent_count INTEGER DEFAULT 0,
+        failed_count INTEGER DEFAULT 0,
+        send_interval REAL,
+        created_at INTEGER NOT NULL,
+        updated_at INTEGER
+    )
+    """)
+
+    # --- 全局广播收件人队列 (每个用户只会出现一次) ---
+    cursor.execute(f"""
+    CREATE TABLE IF NOT EXISTS {TABLE_BROADCAST_RECIPIENTS} (
+        job_id INTEGER NOT NULL,
+        user_id INTEGER NOT NULL,
+        guild_id INTEGER NOT NULL,
+        status TEXT NOT NULL DEFAULT 'PENDING',
+        attempted_at INTEGER,
+        error TEXT,
+        PRIMARY KEY (job_id, user_id),
+        FOREIGN KEY (job_id) REFERENCES {TABLE_BROADCAST_JOBS}(job_id)
+    )
+    """)
+
+    # --- 聊天记录全文索引 (FTS5) ---
+    # trigram 分词器可以对中文做子串匹配；旧版本 SQLite 不支持时退回 unicode61。
+    for tokenizer in ("trigram", "unicode61"):
+        try:
+            cursor.execute(f"""
+            CREATE VIRTUAL TABLE IF NOT EXISTS {TABLE_TRANSCRIPT_SEARCH} USING fts5(
+                ticket_id UNINDEXED, guild_id UNINDEXED, author, timestamp UNINDEXED, content,
+                tokenize = '{tokenizer}'
+            )
+            """)
+            break
+        except sqlite3.OperationalError as e:
+            logging.warning(f"[Database] 使用 {tokenizer} 分词器创建聊天记录全文索引失败: {e}")
+    cursor.execute(f"""
+    CREATE TABLE IF NOT EXISTS {TABLE_TRANSCRIPT_INDEX_STATE} (
+        ticket_id INTEGER PRIMARY KEY,
+        guild_id INTEGER NOT NULL,
+        message_count INTEGER NOT NULL DEFAULT 0,
+        indexed_at INTEGER NOT NULL
+    )
+    """)
+
+    # --- 音乐播放队列 (重启/断线后恢复) ---
+    cursor.execute(f"""
+    CREATE TABLE IF NOT EXISTS {TABLE_MUSIC_QUEUE_STATE} (
+        guild_id INTEGER PRIMARY KEY,
+        voice_channel_id INTEGER,
+        text_channel_id INTEGER,
+        loop_mode TEXT NOT NULL DEFAULT 'none',
+        volume REAL NOT NULL DEFAULT 0.3,
+        updated_at INTEGER NOT NULL
+    )
+    """)
+    cursor.execute(f"""
+    CREATE TABLE IF NOT EXISTS {TABLE_MUSIC_QUEUE_ENTRIES} (
+        guild_id INTEGER NOT NULL,
+        position INTEGER NOT NULL,
+        title TEXT,
+        url TEXT,
+        duration INTEGER,
+        thumbnail TEXT,
+        uploader TEXT,
+        PRIMARY KEY (guild_id, position)
+    ) WITHOUT ROWID
+    """)
+
+    # --- 支付宝异步通知收件箱 (验签后先落库再应答，由后台任务处理) ---
+    cursor.execute(f"""
+    CREATE TABLE IF NOT EXISTS {TABLE_PAYMENT_INBOX} (
+        inbox_id INTEGER PRIMARY KEY AUTOINCREMENT,
+        notify_id TEXT UNIQUE NOT NULL,
+        out_trade_no TEXT,
+        trade_no TEXT,
+        trade_status TEXT,
+        payload TEXT NOT NULL,
+        status TEXT NOT NULL DEFAULT 'PENDING',
+        attempts INTEGER NOT NULL DEFAULT 0,
+        last_error TEXT,
+        received_at INTEGER NOT NULL,
+        next_attempt_at INTEGER NOT NULL,
+        processed_at INTEGER
+    )
+    """)
+
     # --- 创建所有索引 ---
     cursor.execute(f"CREATE INDEX IF NOT EXISTS idx_moderation_actions_user_guild_type ON {TABLE_MODERATION_ACTIONS} (guild_id, target_user_id, action_type, active)")
     cursor.execute(f"CREATE INDEX IF NOT EXISTS idx_recharge_requests_out_trade_no ON {TABLE_RECHARGE_REQUESTS} (out_trade_no)")
@@ -217,6 +321,19 @@ def initialize_database():
     cursor.execute(f"CREATE INDEX IF NOT EXISTS idx_audit_log_guild_status ON {TABLE_AUDIT_LOG} (guild_id, status)")
     cursor.execute(f"CREATE INDEX IF NOT EXISTS idx_sub_accounts_key ON {TABLE_WEB_SUB_ACCOUNTS} (access_key)")
     cursor.execute(f"CREATE INDEX IF NOT EXISTS idx_tickets_guild_status ON {TABLE_TICKETS} (guild_id, status)")
+    cursor.execute(f"CREATE INDEX IF NOT EXISTS idx_broadcast_recipients_job_status ON {TABLE_BROADCAST_RECIPIENTS} (job_id, status)")
+    cursor.execute(f"CREATE INDEX IF NOT EXISTS idx_payment_inbox_pending ON {TABLE_PAYMENT_INBOX} (next_attempt_at) WHERE status = 'PENDING'")
+    # 部分索引只包含活动行：到期调度与活动禁言查询的开销与历史数据量无关
+    cursor.execute(f"CREATE INDEX IF NOT EXISTS idx_recharge_requests_pending ON {TABLE_RECHARGE_REQUESTS} (requested_at) WHERE status = 'PENDING_PAYMENT'")
+    cursor.execute(f"CREATE INDEX IF NOT EXISTS idx_moderation_actions_active_mutes ON {TABLE_MODERATION_ACTIONS} (guild_id, expires_at) WHERE active = 1 AND action_type = 'mute'")
+
+    # --- 副账号访问密钥改为只保存哈希 (迁移旧的明文密钥，密钥本身不变) ---
+    cursor.execute(f"SELECT id, access_key FROM {TABLE_WEB_SUB_ACCOUNTS} WHERE access_key NOT LIKE ?", (ACCESS_KEY_HASH_PREFIX + "%",))
+    plaintext_keys = cursor.fetchall()
+    if plaintext_keys:
+        cursor.executemany(f"UPDATE {TABLE_WEB_SUB_ACCOUNTS} SET access_key = ? WHERE id = ?",
+                           [(hash_access_key(row["access_key"]), row["id"]) for row in plaintext_keys])
+        logging.warning(f"[DB Migration] 已将 {len(plaintext_keys)} 个副账号的明文访问密钥替换为哈希。")
 
     conn.commit()
     conn.close()
@@ -541,6 +658,36 @@ def db_get_all_active_mutes(guild_id: int) -> List[Dict[str, Any]]:
         conn.close()
     return active_mutes
 
+def db_get_active_mute_expiries() -> List[Tuple[int, int]]:
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    try:
+        cursor.execute(f"SELECT log_id, expires_at FROM {TABLE_MODERATION_ACTIONS} WHERE active = 1 AND action_type = 'mute' AND expires_at IS NOT NULL")
+        return [(row["log_id"], row["expires_at"]) for row in cursor.fetchall()]
+    except sqlite3.Error as e:
+        logging.error(f"[DB Moderation Error] 获取待到期禁言记录失败: {e}")
+        return []
+    finally:
+        conn.close()
+
+def db_expire_mutes(log_ids: List[int], now: int) -> Optional[int]:
+    """批量把已到期的禁言记录设为失效，返回更新的行数；失败返回 None。"""
+    if not log_ids:
+        return 0
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    try:
+        cursor.execute(f"UPDATE {TABLE_MODERATION_ACTIONS} SET active = 0 WHERE active = 1 AND action_type = 'mute' AND expires_at <= ? "
+                       f"AND log_id IN ({','.join('?' * len(log_ids))})", (now, *log_ids))
+        conn.commit()
+        return cursor.rowcount
+    except sqlite3.Error as e:
+        logging.error(f"[DB Moderation Error] 批量失效到期禁言记录失败: {e}")
+        conn.rollback()
+        return None
+    finally:
+        conn.close()
+
 # =========================================
 # == 充值请求操作
 # =========================================
@@ -602,7 +749,7 @@ def db_mark_recharge_as_paid(request_id: int, alipay_trade_no: str, paid_cny_amo
         if passback_params_received:
             sql += ", passback_params_received = ?"
             params.append(passback_params_received)
-        sql += " WHERE request_id = ? AND status = 'PENDING_PAYMENT'"
+        sql += " WHERE request_id = ? AND status IN ('PENDING_PAYMENT', 'EXPIRED')" # 订单到期后才到达的付款仍然入账
         params.append(request_id)
         
         cursor.execute(sql, tuple(params))
@@ -611,7 +758,7 @@ def db_mark_recharge_as_paid(request_id: int, alipay_trade_no: str, paid_cny_amo
             logging.info(f"[DB Recharge] Marked request ID {request_id} as PAID.")
             return True
         else:
-            logging.warning(f"[DB Recharge Warn] Could not mark request ID {request_id} as PAID (not found or not PENDING_PAYMENT).")
+            logging.warning(f"[DB Recharge Warn] Could not mark request ID {request_id} as PAID (not found or not PENDING_PAYMENT/EXPIRED).")
             return False
     except sqlite3.IntegrityError as e_int:
          logging.error(f"[DB Recharge Error] IntegrityError marking request ID {request_id} as PAID (duplicate alipay_trade_no): {e_int}")
@@ -643,6 +790,150 @@ def db_mark_recharge_as_completed(request_id: int) -> bool:
     finally:
         conn.close()
 
+def db_update_recharge_request_status(request_id: int, new_status: str, admin_note: Optional[str] = None,
+                                      admin_id: Optional[int] = None) -> bool:
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    try:
+        cursor.execute(f"UPDATE {TABLE_RECHARGE_REQUESTS} SET status = ?, admin_note = ?, admin_id = ?, processed_at = ? WHERE request_id = ?",
+                       (new_status, admin_note, admin_id, int(time.time()), request_id))
+        conn.commit()
+        return cursor.rowcount > 0
+    except sqlite3.Error as e:
+        logging.error(f"[DB Recharge Error] Updating status of request ID {request_id} to {new_status} failed: {e}")
+        conn.rollback()
+        return False
+    finally:
+        conn.close()
+
+def db_get_pending_recharge_expiries(order_timeout: int) -> List[Tuple[int, int]]:
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    try:
+        cursor.execute(f"SELECT request_id, requested_at + ? AS deadline FROM {TABLE_RECHARGE_REQUESTS} WHERE status = 'PENDING_PAYMENT'", (order_timeout,))
+        return [(row["request_id"], row["deadline"]) for row in cursor.fetchall()]
+    except sqlite3.Error as e:
+        logging.error(f"[DB Recharge Error] Fetching pending recharge expiries failed: {e}")
+        return []
+    finally:
+        conn.close()
+
+def db_expire_recharge_requests(request_ids: List[int], now: int) -> Optional[int]:
+    """批量把仍未支付的订单标记为 EXPIRED，返回更新的行数；失败返回 None。"""
+    if not request_ids:
+        return 0
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    try:
+        cursor.execute(f"UPDATE {TABLE_RECHARGE_REQUESTS} SET status = 'EXPIRED', processed_at = ? WHERE status = 'PENDING_PAYMENT' "
+                       f"AND request_id IN ({','.join('?' * len(request_ids))})", (now, *request_ids))
+        conn.commit()
+        return cursor.rowcount
+    except sqlite3.Error as e:
+        logging.error(f"[DB Recharge Error] Expiring recharge requests failed: {e}")
+        conn.rollback()
+        return None
+    finally:
+        conn.close()
+
+def db_credit_recharge_and_complete(request_id: int, guild_id: int, user_id: int, amount: int, default_balance: int) -> Optional[bool]:
+    """
+    在同一个事务中把 PAID 订单标记为 COMPLETED 并给用户加余额，保证每笔订单只入账一次。
+    返回 True 表示本次已入账，False 表示订单不是 PAID 状态 (已入账过)，None 表示数据库错误 (可重试)。
+    """
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    try:
+        cursor.execute("BEGIN IMMEDIATE")
+        cursor.execute(f"UPDATE {TABLE_RECHARGE_REQUESTS} SET status = 'COMPLETED' WHERE request_id = ? AND status = 'PAID'", (request_id,))
+        if cursor.rowcount == 0:
+            conn.rollback()
+            return False
+        cursor.execute(f"""
+        INSERT INTO {TABLE_USER_BALANCES} (guild_id, user_id, balance) VALUES (?, ?, ?)
+        ON CONFLICT(guild_id, user_id) DO UPDATE SET balance = balance + ?
+        """, (guild_id, user_id, default_balance + amount, amount))
+        conn.commit()
+        logging.info(f"[DB Recharge] Credited {amount} to user {user_id} (guild {guild_id}) and marked request ID {request_id} as COMPLETED.")
+        return True
+    except sqlite3.Error as e:
+        logging.error(f"[DB Recharge Error] Crediting request ID {request_id} failed: {e}")
+        conn.rollback()
+        return None
+    finally:
+        conn.close()
+
+# =========================================
+# == 支付宝通知收件箱
+# =========================================
+def db_store_payment_notification(notify_id: str, out_trade_no: Optional[str], trade_no: Optional[str],
+                                  trade_status: Optional[str], payload: str) -> bool:
+    """保存一条已验签的通知；同一 notify_id 的重复通知会被忽略但同样返回 True。只有写入失败时返回 False。"""
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    now = int(time.time())
+    try:
+        cursor.execute(f"""
+        INSERT OR IGNORE INTO {TABLE_PAYMENT_INBOX}
+        (notify_id, out_trade_no, trade_no, trade_status, payload, status, received_at, next_attempt_at)
+        VALUES (?, ?, ?, ?, ?, 'PENDING', ?, ?)
+        """, (notify_id, out_trade_no, trade_no, trade_status, payload, now, now))
+        conn.commit()
+        return True
+    except sqlite3.Error as e:
+        logging.error(f"[DB Payment Inbox Error] 保存通知 {notify_id} (out_trade_no: {out_trade_no}) 失败: {e}")
+        conn.rollback()
+        return False
+    finally:
+        conn.close()
+
+def db_get_due_payment_notifications(limit: int, now: Optional[int] = None) -> List[Dict[str, Any]]:
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    try:
+        cursor.execute(f"""
+        SELECT inbox_id, notify_id, out_trade_no, trade_status, payload, attempts FROM {TABLE_PAYMENT_INBOX}
+        WHERE status = 'PENDING' AND next_attempt_at <= ? ORDER BY next_attempt_at, inbox_id LIMIT ?
+        """, (int(time.time()) if now is None else now, limit))
+        return [dict(row) for row in cursor.fetchall()]
+    except sqlite3.Error as e:
+        logging.error(f"[DB Payment Inbox Error] 获取待处理通知失败: {e}")
+        return []
+    finally:
+        conn.close()
+
+def db_finish_payment_notification(inbox_id: int, status: str, attempts: int, error: Optional[str] = None,
+                                   next_attempt_at: Optional[int] = None) -> bool:
+    """status 为 DONE / FAILED 时结束该通知；为 PENDING 时在 next_attempt_at 重试。"""
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    now = int(time.time())
+    try:
+        cursor.execute(f"""
+        UPDATE {TABLE_PAYMENT_INBOX} SET status = ?, attempts = ?, last_error = ?, next_attempt_at = ?, processed_at = ?
+        WHERE inbox_id = ?
+        """, (status, attempts, error, next_attempt_at or now, None if status == 'PENDING' else now, inbox_id))
+        conn.commit()
+        return cursor.rowcount > 0
+    except sqlite3.Error as e:
+        logging.error(f"[DB Payment Inbox Error] 更新通知 {inbox_id} 的状态失败: {e}")
+        conn.rollback()
+        return False
+    finally:
+        conn.close()
+
+def db_get_payment_inbox_counts() -> Dict[str, int]:
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    try:
+        cursor.execute(f"SELECT status, COUNT(*) AS count FROM {TABLE_PAYMENT_INBOX} GROUP BY status")
+        return {row["status"]: row["count"] for row in cursor.fetchall()}
+    except sqlite3.Error as e:
+        logging.error(f"[DB Payment Inbox Error] 统计通知失败: {e}")
+        return {}
+    finally:
+        conn.close()
+
 # =========================================
 # == 审核事件日志 (Audit Log)
 # =========================================
@@ -752,6 +1043,12 @@ def db_get_economy_stats(guild_id: int) -> Dict[str, Any]:
 # =========================================
 # == Web 副账号与权限系统
 # =========================================
+ACCESS_KEY_HASH_PREFIX = "sha256$"
+
+def hash_access_key(access_key: str) -> str:
+    """access_key 列只保存密钥的哈希。密钥是 32 字节的随机令牌，无需加盐或慢哈希。"""
+    return ACCESS_KEY_HASH_PREFIX + hashlib.sha256(access_key.encode("utf-8")).hexdigest()
+
 def db_get_all_sub_accounts() -> List[Dict[str, Any]]:
     """获取所有副账号的信息（不包括密钥）。"""
     conn = get_db_connection()
@@ -778,10 +1075,10 @@ def db_create_sub_account(account_name: str, permissions: Dict) -> Optional[str]
     try:
         cursor.execute(
             f"INSERT INTO {TABLE_WEB_SUB_ACCOUNTS} (account_name, access_key, permissions_json, created_at) VALUES (?, ?, ?, ?)",
-            (account_name, access_key, permissions_json, created_at)
+            (account_name, hash_access_key(access_key), permissions_json, created_at)
         )
         conn.commit()
-        return access_key
+        return access_key # 明文密钥只在创建时返回一次
     except sqlite3.IntegrityError:
         logging.warning(f"[DB SubAccounts Error] 尝试创建同名副账号 '{account_name}'")
         return None
@@ -826,27 +1123,45 @@ def db_delete_sub_account(account_id: int) -> bool:
     finally:
         conn.close()
 
-def db_validate_access_key(access_key: str) -> Optional[Dict[str, Any]]:
-    """验证 access_key 并返回账号信息和权限。"""
+def db_get_sub_account_credentials(key_hash: Optional[str] = None, account_id: Optional[int] = None) -> List[Dict[str, Any]]:
+    """返回副账号的 id、名称、密钥哈希和已解析的权限；不带参数时返回全部副账号。"""
     conn = get_db_connection()
     cursor = conn.cursor()
+    query = f"SELECT id, account_name, access_key AS key_hash, permissions_json FROM {TABLE_WEB_SUB_ACCOUNTS}"
+    params: Tuple = ()
+    if key_hash is not None:
+        query += " WHERE access_key = ?"; params = (key_hash,)
+    elif account_id is not None:
+        query += " WHERE id = ?"; params = (account_id,)
     try:
-        cursor.execute(f"SELECT id, account_name, permissions_json FROM {TABLE_WEB_SUB_ACCOUNTS} WHERE access_key = ?", (access_key,))
-        row = cursor.fetchone()
-        if not row:
-            return None
-        
-        account_data = dict(row)
-        account_data['permissions'] = json.loads(account_data['permissions_json'])
-        
-        # 更新 last_used_at
-        cursor.execute(f"UPDATE {TABLE_WEB_SUB_ACCOUNTS} SET last_used_at = ? WHERE id = ?", (int(time.time()), account_data['id']))
-        conn.commit()
+        cursor.execute(query, params)
+        accounts = []
+        for row in cursor.fetchall():
+            account = dict(row)
+            account['permissions'] = json.loads(account.pop('permissions_json'))
+            accounts.append(account)
+        return accounts
+    except sqlite3.Error as e:
+        logging.error(f"[DB SubAccounts Error] 读取副账号凭据失败: {e}")
+        return []
+    finally:
+        conn.close()
 
-        return account_data
+def db_touch_sub_accounts(last_used: Dict[int, int]) -> bool:
+    """批量更新副账号的 last_used_at (account_id -> 时间戳)。"""
+    if not last_used:
+        return True
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    try:
+        cursor.executemany(f"UPDATE {TABLE_WEB_SUB_ACCOUNTS} SET last_used_at = ? WHERE id = ?",
+                           [(ts, account_id) for account_id, ts in last_used.items()])
+        conn.commit()
+        return True
     except sqlite3.Error as e:
-        logging.error(f"[DB SubAccounts Error] 验证 access_key 时失败: {e}")
-        return None
+        logging.error(f"[DB SubAccounts Error] 批量更新 last_used_at 失败: {e}")
+        conn.rollback()
+        return False
     finally:
         conn.close()
 
@@ -1096,6 +1411,324 @@ def db_set_ticket_ai_managed_status(ticket_id: int, is_managed: bool) -> bool:
     finally:
         conn.close()
 
+# =========================================
+# == 全局广播任务
+# =========================================
+def db_create_broadcast_job(title: str, message_template: str, invite_url: Optional[str], created_by: Optional[str]) -> Optional[int]:
+    """创建一个新的广播任务 (状态为 PREPARING，收件人入队后再切换为 RUNNING)。"""
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    now = int(time.time())
+    try:
+        cursor.execute(f"""
+        INSERT INTO {TABLE_BROADCAST_JOBS} (title, message_template, invite_url, created_by, status, created_at, updated_at)
+        VALUES (?, ?, ?, ?, 'PREPARING', ?, ?)
+        """, (title, message_template, invite_url, created_by, now, now))
+        conn.commit()
+        return cursor.lastrowid
+    except sqlite3.Error as e:
+        logging.error(f"[DB Broadcast Error] 创建广播任务失败: {e}")
+        conn.rollback()
+        return None
+    finally:
+        conn.close()
+
+def db_add_broadcast_recipients(job_id: int, recipients: List[Tuple[int, int]]) -> int:
+    """批量写入收件人 (user_id, guild_id)。同一用户重复出现时保留第一次写入的服务器。返回任务的收件人总数。"""
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    try:
+        cursor.executemany(f"""
+        INSERT OR IGNORE INTO {TABLE_BROADCAST_RECIPIENTS} (job_id, user_id, guild_id) VALUES (?, ?, ?)
+        """, [(job_id, user_id, guild_id) for user_id, guild_id in recipients])
+        cursor.execute(f"SELECT COUNT(*) FROM {TABLE_BROADCAST_RECIPIENTS} WHERE job_id = ?", (job_id,))
+        total = cursor.fetchone()[0]
+        cursor.execute(f"UPDATE {TABLE_BROADCAST_JOBS} SET total_count = ?, updated_at = ? WHERE job_id = ?",
+                       (total, int(time.time()), job_id))
+        conn.commit()
+        return total
+    except sqlite3.Error as e:
+        logging.error(f"[DB Broadcast Error] 写入广播收件人失败 (job: {job_id}): {e}")
+        conn.rollback()
+        return 0
+    finally:
+        conn.close()
+
+def db_get_broadcast_job(job_id: int) -> Optional[Dict[str, Any]]:
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    try:
+        cursor.execute(f"SELECT * FROM {TABLE_BROADCAST_JOBS} WHERE job_id = ?", (job_id,))
+        row = cursor.fetchone()
+        return dict(row) if row else None
+    except sqlite3.Error as e:
+        logging.error(f"[DB Broadcast Error] 获取广播任务失败 (job: {job_id}): {e}")
+        return None
+    finally:
+        conn.close()
+
+def db_get_unfinished_broadcast_jobs() -> List[Dict[str, Any]]:
+    """获取因重启等原因中断、需要继续执行的广播任务。"""
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    try:
+        cursor.execute(f"SELECT * FROM {TABLE_BROADCAST_JOBS} WHERE status = 'RUNNING' ORDER BY job_id")
+        return [dict(row) for row in cursor.fetchall()]
+    except sqlite3.Error as e:
+        logging.error(f"[DB Broadcast Error] 获取未完成的广播任务失败: {e}")
+        return []
+    finally:
+        conn.close()
+
+def db_get_pending_broadcast_recipients(job_id: int, limit: int) -> List[Dict[str, Any]]:
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    try:
+        cursor.execute(f"""
+        SELECT user_id, guild_id FROM {TABLE_BROADCAST_RECIPIENTS}
+        WHERE job_id = ? AND status = 'PENDING'
+        ORDER BY guild_id, user_id LIMIT ?
+        """, (job_id, limit))
+        return [dict(row) for row in cursor.fetchall()]
+    except sqlite3.Error as e:
+        logging.error(f"[DB Broadcast Error] 获取待发送收件人失败 (job: {job_id}): {e}")
+        return []
+    finally:
+        conn.close()
+
+def db_checkpoint_broadcast(job_id: int, results: List[Tuple[int, str, Optional[str]]], send_interval: float) -> bool:
+    """
+    在一个事务中写入一批发送结果 (user_id, 'SENT'/'FAILED', error) 并刷新任务计数，作为断点。
+    重启后只会从仍为 PENDING 的收件人继续。
+    """
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    now = int(time.time())
+    try:
+        cursor.executemany(f"""
+        UPDATE {TABLE_BROADCAST_RECIPIENTS} SET status = ?, error = ?, attempted_at = ?
+        WHERE job_id = ? AND user_id = ?
+        """, [(status, error, now, job_id, user_id) for user_id, status, error in results])
+        sent = sum(1 for _, status, _ in results if status == 'SENT')
+        failed = len(results) - sent
+        cursor.execute(f"""
+        UPDATE {TABLE_BROADCAST_JOBS}
+        SET sent_count = sent_count + ?, failed_count = failed_count + ?, send_interval = ?, updated_at = ?
+        WHERE job_id = ?
+        """, (sent, failed, send_interval, now, job_id))
+        conn.commit()
+        return True
+    except sqlite3.Error as e:
+        logging.error(f"[DB Broadcast Error] 写入广播断点失败 (job: {job_id}): {e}")
+        conn.rollback()
+        return False
+    finally:
+        conn.close()
+
+def db_set_broadcast_job_status(job_id: int, status: str) -> bool:
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    try:
+        cursor.execute(f"UPDATE {TABLE_BROADCAST_JOBS} SET status = ?, updated_at = ? WHERE job_id = ?",
+                       (status, int(time.time()), job_id))
+        conn.commit()
+        return cursor.rowcount > 0
+    except sqlite3.Error as e:
+        logging.error(f"[DB Broadcast Error] 更新广播任务状态失败 (job: {job_id}): {e}")
+        conn.rollback()
+        return False
+    finally:
+        conn.close()
+
+# =========================================
+# == 聊天记录全文搜索
+# =========================================
+def db_index_transcript_messages(rows: List[Tuple[int, int, str, str, str]]) -> bool:
+    """批量写入聊天记录消息行 (ticket_id, guild_id, author, timestamp, content)。"""
+    if not rows:
+        return True
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    try:
+        cursor.executemany(f"""
+        INSERT INTO {TABLE_TRANSCRIPT_SEARCH} (ticket_id, guild_id, author, timestamp, content) VALUES (?, ?, ?, ?, ?)
+        """, rows)
+        conn.commit()
+        return True
+    except sqlite3.Error as e:
+        logging.error(f"[DB Transcript Error] 写入聊天记录索引失败: {e}")
+        conn.rollback()
+        return False
+    finally:
+        conn.close()
+
+def db_mark_transcript_indexed(ticket_id: int, guild_id: int, message_count: int) -> bool:
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    try:
+        cursor.execute(f"""
+        INSERT OR REPLACE INTO {TABLE_TRANSCRIPT_INDEX_STATE} (ticket_id, guild_id, message_count, indexed_at)
+        VALUES (?, ?, ?, ?)
+        """, (ticket_id, guild_id, message_count, int(time.time())))
+        conn.commit()
+        return True
+    except sqlite3.Error as e:
+        logging.error(f"[DB Transcript Error] 记录索引状态失败 (ticket: {ticket_id}): {e}")
+        conn.rollback()
+        return False
+    finally:
+        conn.close()
+
+def db_get_unindexed_transcript_tickets() -> List[Dict[str, Any]]:
+    """所有已生成聊天记录文件、但还没有写入全文索引的票据 (用于回填)。"""
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    try:
+        cursor.execute(f"""
+        SELECT t.ticket_id, t.guild_id, t.transcript_filename FROM {TABLE_TICKETS} t
+        LEFT JOIN {TABLE_TRANSCRIPT_INDEX_STATE} s ON s.ticket_id = t.ticket_id
+        WHERE t.transcript_filename IS NOT NULL AND t.transcript_filename != '' AND s.ticket_id IS NULL
+        ORDER BY t.ticket_id
+        """)
+        return [dict(row) for row in cursor.fetchall()]
+    except sqlite3.Error as e:
+        logging.error(f"[DB Transcript Error] 获取待回填的票据失败: {e}")
+        return []
+    finally:
+        conn.close()
+
+def db_search_transcripts(guild_id: int, fts_query: str, limit: int = 20) -> List[Dict[str, Any]]:
+    """
+    在指定服务器的聊天记录中全文搜索，按 bm25 相关度排序。
+    片段中的命中词用 \x02 / \x03 包围，由调用方转义后再替换为高亮标签。
+    """
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    try:
+        cursor.execute(f"""
+        SELECT s.ticket_id, s.author, s.timestamp,
+               snippet({TABLE_TRANSCRIPT_SEARCH}, 4, char(2), char(3), '…', 16) AS snippet,
+               bm25({TABLE_TRANSCRIPT_SEARCH}) AS rank,
+               t.transcript_filename, t.creator_id, t.closed_at
+        FROM {TABLE_TRANSCRIPT_SEARCH} s
+        LEFT JOIN {TABLE_TICKETS} t ON t.ticket_id = s.ticket_id
+        WHERE {TABLE_TRANSCRIPT_SEARCH} MATCH ? AND s.guild_id = ?
+        ORDER BY rank LIMIT ?
+        """, (fts_query, guild_id, limit))
+        return [dict(row) for row in cursor.fetchall()]
+    except sqlite3.Error as e:
+        logging.error(f"[DB Transcript Error] 搜索聊天记录失败 (guild: {guild_id}, query: {fts_query!r}): {e}")
+        return []
+    finally:
+        conn.close()
+
+def db_search_transcripts_substring(guild_id: int, terms: List[str], limit: int = 20) -> List[Dict[str, Any]]:
+    """trigram 无法匹配少于 3 个字符的词 (例如两个汉字)，这种情况下退回到逐行子串匹配。"""
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    try:
+        conditions = " AND ".join("s.content LIKE ? ESCAPE '\\'" for _ in terms)
+        params = ["%" + t.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + "%" for t in terms]
+        cursor.execute(f"""
+        SELECT s.ticket_id, s.author, s.timestamp, s.content, t.transcript_filename, t.creator_id, t.closed_at
+        FROM {TABLE_TRANSCRIPT_SEARCH} s
+        LEFT JOIN {TABLE_TICKETS} t ON t.ticket_id = s.ticket_id
+        WHERE s.guild_id = ? AND {conditions}
+        ORDER BY s.rowid DESC LIMIT ?
+        """, (guild_id, *params, limit))
+        return [dict(row) for row in cursor.fetchall()]
+    except sqlite3.Error as e:
+        logging.error(f"[DB Transcript Error] 子串搜索聊天记录失败 (guild: {guild_id}): {e}")
+        return []
+    finally:
+        conn.close()
+
+# =========================================
+# == 音乐播放队列
+# =========================================
+def db_save_music_queue(guild_id: int, voice_channel_id: Optional[int], text_channel_id: Optional[int],
+                        loop_mode: str, volume: float, entries: List[Tuple]) -> bool:
+    """
+    用一个事务整体替换服务器的队列快照。entries 为按播放顺序排列的
+    (title, url, duration, thumbnail, uploader) 元组，第一项是正在播放的歌曲 (如有)。
+    """
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    try:
+        cursor.execute(f"""
+        INSERT INTO {TABLE_MUSIC_QUEUE_STATE} (guild_id, voice_channel_id, text_channel_id, loop_mode, volume, updated_at)
+        VALUES (?, ?, ?, ?, ?, ?)
+        ON CONFLICT(guild_id) DO UPDATE SET voice_channel_id = excluded.voice_channel_id, text_channel_id = excluded.text_channel_id,
+            loop_mode = excluded.loop_mode, volume = excluded.volume, updated_at = excluded.updated_at
+        """, (guild_id, voice_channel_id, text_channel_id, loop_mode, volume, int(time.time())))
+        cursor.execute(f"DELETE FROM {TABLE_MUSIC_QUEUE_ENTRIES} WHERE guild_id = ?", (guild_id,))
+        cursor.executemany(f"""
+        INSERT INTO {TABLE_MUSIC_QUEUE_ENTRIES} (guild_id, position, title, url, duration, thumbnail, uploader)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+        """, [(guild_id, position, *entry) for position, entry in enumerate(entries)])
+        conn.commit()
+        return True
+    except sqlite3.Error as e:
+        logging.error(f"[DB Music Error] 保存服务器 {guild_id} 的播放队列失败: {e}")
+        conn.rollback()
+        return False
+    finally:
+        conn.close()
+
+def db_load_music_queue(guild_id: int) -> Optional[Dict[str, Any]]:
+    """返回 {voice_channel_id, text_channel_id, loop_mode, volume, entries: [(title, url, duration, thumbnail, uploader), ...]}。"""
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    try:
+        cursor.execute(f"SELECT * FROM {TABLE_MUSIC_QUEUE_STATE} WHERE guild_id = ?", (guild_id,))
+        row = cursor.fetchone()
+        if not row:
+            return None
+        saved = dict(row)
+        cursor.execute(f"""
+        SELECT title, url, duration, thumbnail, uploader FROM {TABLE_MUSIC_QUEUE_ENTRIES}
+        WHERE guild_id = ? ORDER BY position
+        """, (guild_id,))
+        saved["entries"] = [tuple(r) for r in cursor.fetchall()]
+        return saved
+    except sqlite3.Error as e:
+        logging.error(f"[DB Music Error] 读取服务器 {guild_id} 的播放队列失败: {e}")
+        return None
+    finally:
+        conn.close()
+
+def db_get_saved_music_queues() -> List[Dict[str, Any]]:
+    """列出所有保存了非空队列的服务器 (guild_id, voice_channel_id, text_channel_id, entry_count)。"""
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    try:
+        cursor.execute(f"""
+        SELECT s.guild_id, s.voice_channel_id, s.text_channel_id, COUNT(e.position) AS entry_count
+        FROM {TABLE_MUSIC_QUEUE_STATE} s JOIN {TABLE_MUSIC_QUEUE_ENTRIES} e ON e.guild_id = s.guild_id
+        GROUP BY s.guild_id
+        """)
+        return [dict(row) for row in cursor.fetchall()]
+    except sqlite3.Error as e:
+        logging.error(f"[DB Music Error] 获取已保存的播放队列失败: {e}")
+        return []
+    finally:
+        conn.close()
+
+def db_clear_music_queue(guild_id: int) -> bool:
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    try:
+        cursor.execute(f"DELETE FROM {TABLE_MUSIC_QUEUE_ENTRIES} WHERE guild_id = ?", (guild_id,))
+        cursor.execute(f"DELETE FROM {TABLE_MUSIC_QUEUE_STATE} WHERE guild_id = ?", (guild_id,))
+        conn.commit()
+        return True
+    except sqlite3.Error as e:
+        logging.error(f"[DB Music Error] 清除服务器 {guild_id} 的播放队列失败: {e}")
+        conn.rollback()
+        return False
+    finally:
+        conn.close()
+
 if __name__ == "__main__":
     print("database.py 被直接运行。正在尝试初始化数据库...")
     initialize_database()
@@ -0,0 +1,245 @@
+# expiry_scheduler.py
+"""
+到期调度器：在截止时间把待支付订单标记为 EXPIRED、把到期的禁言记录设为失效。
+
+- 每种到期项 (kind) 注册两个数据库函数：load_pending() 返回仍处于活动状态的 (ID, 截止时间)，
+  expire_batch(ids, now) 用一条 UPDATE 批量失效并返回实际更新的行数。
+- 截止时间保存在一个最小堆里，只有一个后台任务睡到最早的截止时间；同一时刻到期的项合并为一次 UPDATE。
+  新增的截止时间比当前最早的还早时唤醒任务重新计算。
+- 取消 (订单已支付、手动解除禁言) 只从 _deadlines 中删除，堆里的旧条目在弹出时跳过。
+  即使没有取消，UPDATE 也只作用于仍处于活动状态的行，所以过期调度不会覆盖已经变化的状态。
+- 启动时从数据库加载活动项 (部分索引只覆盖活动行，历史数据再多也不影响加载速度)，已过期的立即批量处理。
+
+schedule / cancel 线程安全，可以在 Web 线程中调用。
+
+基准测试 (大量历史数据下的加载、查询、批量失效与定时精度):
+    python expiry_scheduler.py --history 2000000 --active 5000
+"""
+import asyncio
+import heapq
+import logging
+import threading
+import time
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+EXPIRY_RETRY_DELAY = 30  # 批量失效失败后的重试间隔 (秒)
+EXPIRY_BATCH_SIZE = 500  # 单条 UPDATE 的最大 ID 数 (低于 SQLite 的变量个数上限)
+UPCOMING_HORIZONS = (60, 300, 3600)
+
+
+class ExpiryScheduler:
+    def __init__(self, loop: asyncio.AbstractEventLoop):
+        self.loop = loop
+        self._handlers: Dict[str, Tuple[Callable[[List[int], int], Optional[int]], Optional[Callable[[], Iterable[Tuple[int, int]]]]]] = {}
+        self._heap: List[Tuple[float, str, int]] = []
+        self._deadlines: Dict[Tuple[str, int], float] = {}
+        self._lock = threading.Lock()
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self.expired: Dict[str, int] = {}
+        self.batches = 0
+        self.max_lateness = 0.0
+        self.load_seconds = 0.0
+
+    def register(self, kind: str, expire_batch: Callable[[List[int], int], Optional[int]],
+                 load_pending: Optional[Callable[[], Iterable[Tuple[int, int]]]] = None):
+        """expire_batch 返回 None 表示失败 (稍后重试)。两个函数都在线程池中执行。"""
+        self._handlers[kind] = (expire_batch, load_pending)
+        self.expired.setdefault(kind, 0)
+
+    def schedule(self, kind: str, item_id: int, deadline: float):
+        with self._lock:
+            self._deadlines[(kind, item_id)] = deadline
+            heapq.heappush(self._heap, (deadline, kind, item_id))
+            earliest = self._heap[0][0] == deadline
+        if earliest:
+            self.loop.call_soon_threadsafe(self._wakeup.set)
+
+    def cancel(self, kind: str, item_id: int):
+        with self._lock:
+            self._deadlines.pop((kind, item_id), None)
+
+    def start(self) -> asyncio.Task:
+        if self._task is None or self._task.done():
+            self._task = self.loop.create_task(self._run())
+        return self._task
+
+    async def _load(self):
+        started = time.perf_counter()
+        for kind, (_, load_pending) in self._handlers.items():
+            if load_pending is None:
+                continue
+            try:
+                rows = await self.loop.run_in_executor(None, lambda f=load_pending: list(f()))
+            except Exception as e:
+                logging.error(f"[ExpiryScheduler] 加载 {kind} 的活动项失败: {e}", exc_info=True)
+                continue
+            with self._lock:
+                for item_id, deadline in rows:
+                    self._deadlines[(kind, item_id)] = deadline
+                    self._heap.append((deadline, kind, item_id))
+                heapq.heapify(self._heap)
+            logging.info(f"[ExpiryScheduler] 已加载 {len(rows)} 个待到期的 {kind}")
+        self.load_seconds = time.perf_counter() - started
+
+    def _pop_due(self, now: float) -> Dict[str, List[int]]:
+        due: Dict[str, List[int]] = {}
+        with self._lock:
+            while self._heap and self._heap[0][0] <= now:
+                deadline, kind, item_id = heapq.heappop(self._heap)
+                if self._deadlines.get((kind, item_id)) != deadline:
+                    continue # 已取消或已改期
+                del self._deadlines[(kind, item_id)]
+                due.setdefault(kind, []).append(item_id)
+                self.max_lateness = max(self.max_lateness, now - deadline)
+        return due
+
+    async def _expire(self, due: Dict[str, List[int]], now: float):
+        for kind, ids in due.items():
+            expire_batch = self._handlers[kind][0]
+            for start in range(0, len(ids), EXPIRY_BATCH_SIZE):
+                chunk = ids[start:start + EXPIRY_BATCH_SIZE]
+                try:
+                    updated = await self.loop.run_in_executor(None, expire_batch, chunk, int(now))
+                except Exception as e:
+                    logging.error(f"[ExpiryScheduler] 批量失效 {kind} 时出错: {e}", exc_info=True)
+                    updated = None
+                if updated is None:
+                    for item_id in chunk:
+                        self.schedule(kind, item_id, now + EXPIRY_RETRY_DELAY)
+                    continue
+                self.batches += 1
+                self.expired[kind] += updated
+
+    async def _run(self):
+        await self._load()
+        while True:
+            self._wakeup.clear()
+            now = time.time()
+            due = self._pop_due(now)
+            if due:
+                await self._expire(due, now)
+                continue
+            with self._lock:
+                timeout = max(0.0, self._heap[0][0] - time.time()) if self._heap else None
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    def upcoming_counts(self, horizons: Iterable[int] = UPCOMING_HORIZONS) -> Dict[str, Dict[str, int]]:
+        """各类到期项在未来 N 秒内将到期的数量，以及总数。"""
+        now = time.time()
+        horizons = sorted(horizons)
+        counts = {kind: {**{f"{h}s": 0 for h in horizons}, "total": 0} for kind in self._handlers}
+        with self._lock:
+            deadlines = list(self._deadlines.items())
+        for (kind, _), deadline in deadlines:
+            bucket = counts.setdefault(kind, {**{f"{h}s": 0 for h in horizons}, "total": 0})
+            bucket["total"] += 1
+            for h in horizons:
+                if deadline - now <= h:
+                    bucket[f"{h}s"] += 1
+        return counts
+
+    def stats(self) -> Dict[str, object]:
+        return {"expired": dict(self.expired), "batches": self.batches, "max_lateness_ms": round(self.max_lateness * 1000, 1),
+                "load_ms": round(self.load_seconds * 1000, 1), "upcoming": self.upcoming_counts()}
+
+
+# =========================================
+# == 基准测试
+# =========================================
+def _run_benchmark(history: int, active: int, spread: float):
+    import os
+    import random
+    import sqlite3
+    import tempfile
+    import database
+    import payment_gateway
+
+    with tempfile.TemporaryDirectory() as tmp:
+        database.DATABASE_FILE = os.path.join(tmp, "bench.db")
+        database.initialize_database()
+        now = int(time.time())
+        conn = database.get_db_connection()
+        started = time.perf_counter()
+        batch = 100_000
+        for offset in range(0, history, batch):
+            n = min(batch, history - offset)
+            conn.executemany(f"INSERT INTO {database.TABLE_RECHARGE_REQUESTS} (guild_id, user_id, out_trade_no, requested_cny_amount, status, requested_at) "
+                             f"VALUES (1, ?, ?, 10.0, ?, ?)",
+                             ((i % 5000, f"H-{offset + i}", random.choice(("COMPLETED", "EXPIRED", "EXPIRED")), now - 86400 - i) for i in range(n)))
+            conn.executemany(f"INSERT INTO {database.TABLE_MODERATION_ACTIONS} (guild_id, target_user_id, moderator_user_id, action_type, created_at, expires_at, active) "
+                             f"VALUES (?, ?, 1, ?, ?, ?, 0)",
+                             ((i % 50, i % 5000, random.choice(("mute", "warn", "unmute")), now - 86400 - i, now - i) for i in range(n)))
+        order_timeout = payment_gateway.ORDER_TIMEOUT_SECONDS
+        load_orders = lambda: database.db_get_pending_recharge_expiries(order_timeout)
+        conn.executemany(f"INSERT INTO {database.TABLE_RECHARGE_REQUESTS} (guild_id, user_id, out_trade_no, requested_cny_amount, status, requested_at) "
+                         f"VALUES (1, ?, ?, 10.0, 'PENDING_PAYMENT', ?)",
+                         ((i, f"A-{i}", now - order_timeout + 1 + random.random() * spread) for i in range(active)))
+        conn.executemany(f"INSERT INTO {database.TABLE_MODERATION_ACTIONS} (guild_id, target_user_id, moderator_user_id, action_type, created_at, expires_at, active) "
+                         f"VALUES (?, ?, 1, 'mute', ?, ?, 1)",
+                         ((i % 50, i, now, now + 1 + int(random.random() * spread)) for i in range(active)))
+        conn.commit(); conn.close()
+        print(f"写入 {history:,} 条历史订单 + {history:,} 条历史审核记录，{active:,} 个活动订单 + {active:,} 个活动禁言: {time.perf_counter() - started:.1f}s")
+
+        def timed(label, fn, repeat=5):
+            best = float("inf")
+            for _ in range(repeat):
+                t = time.perf_counter(); result = fn(); best = min(best, time.perf_counter() - t)
+            print(f"  {label:<36} {best * 1000:>9.2f}ms")
+            return result
+
+        def without_partial_indexes(fn):
+            conn = sqlite3.connect(database.DATABASE_FILE)
+            conn.execute("DROP INDEX idx_recharge_requests_pending"); conn.execute("DROP INDEX idx_moderation_actions_active_mutes"); conn.commit()
+            try: return fn()
+            finally:
+                conn.close(); database.initialize_database() # 重新创建索引
+
+        print("查询耗时 (有部分索引 / 无部分索引):")
+        timed("加载待支付订单", load_orders)
+        timed("加载活动禁言", database.db_get_active_mute_expiries)
+        timed("db_get_all_active_mutes(单服务器)", lambda: database.db_get_all_active_mutes(7))
+        without_partial_indexes(lambda: (timed("加载待支付订单 (无索引)", load_orders, 1),
+                                         timed("加载活动禁言 (无索引)", database.db_get_active_mute_expiries, 1),
+                                         timed("db_get_all_active_mutes (无索引)", lambda: database.db_get_all_active_mutes(7), 1)))
+
+        async def run_scheduler():
+            # 查询测试耗时不定，启动前把活动行的截止时间 (整数秒，与实际数据一致) 重新分布到接下来的 spread 秒内
+            conn = database.get_db_connection()
+            base = int(time.time()) + 1
+            conn.execute(f"UPDATE {database.TABLE_RECHARGE_REQUESTS} SET requested_at = CAST(? + (abs(random()) % 1000000) * ? / 1000000.0 AS INTEGER) "
+                         f"WHERE status = 'PENDING_PAYMENT'", (base - order_timeout, spread))
+            conn.execute(f"UPDATE {database.TABLE_MODERATION_ACTIONS} SET expires_at = CAST(? + (abs(random()) % 1000000) * ? / 1000000.0 AS INTEGER) "
+                         f"WHERE active = 1 AND action_type = 'mute'", (base, spread))
+            conn.commit(); conn.close()
+            loop = asyncio.get_running_loop()
+            scheduler = ExpiryScheduler(loop)
+            scheduler.register("recharge", database.db_expire_recharge_requests, load_orders)
+            scheduler.register("mute", database.db_expire_mutes, database.db_get_active_mute_expiries)
+            scheduler.start()
+            await asyncio.sleep(0.2)
+            print(f"调度器: 即将到期 {scheduler.upcoming_counts((1, 5))}")
+            deadline = time.perf_counter() + spread + 30
+            while sum(scheduler.expired.values()) < 2 * active and time.perf_counter() < deadline:
+                await asyncio.sleep(0.05)
+            print(f"  {scheduler.stats()}")
+
+        asyncio.run(run_scheduler())
+        counts = database.get_db_connection()
+        left = counts.execute(f"SELECT (SELECT COUNT(*) FROM {database.TABLE_RECHARGE_REQUESTS} WHERE status = 'PENDING_PAYMENT'), "
+                              f"(SELECT COUNT(*) FROM {database.TABLE_MODERATION_ACTIONS} WHERE active = 1 AND action_type = 'mute')").fetchone()
+        counts.close()
+        print(f"  剩余活动订单 {left[0]}, 剩余活动禁言 {left[1]}")
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="到期调度器基准测试")
+    parser.add_argument("--history", type=int, default=1_000_000, help="每张表的历史 (非活动) 行数")
+    parser.add_argument("--active", type=int, default=5000, help="每张表的活动行数")
+    parser.add_argument("--spread", type=float, default=5.0, help="活动行的截止时间分布在未来多少秒内")
+    args = parser.parse_args()
+    _run_benchmark(args.history, args.active, args.spread)
@@ -0,0 +1,490 @@
+# guild_snapshot.py
+"""
+Web 面板使用的服务器只读模型 (read-model)。
+
+- 每个服务器保存身份组、频道、成员和语音状态的摘要 (普通 dict，可直接序列化为 JSON)。
+  摘要只在机器人事件循环中由网关事件增量维护 (attach() 注册监听器)，Web 线程只读取这里的数据，
+  不再跨线程遍历 discord.py 的缓存 (guild.members / guild.roles / vc.members ...)。
+- 视图 (VIEWS) 是已排序好的列表，按需计算并缓存。每次变更只让受影响的视图失效，并给它分配新的版本号；
+  未变化的视图直接返回同一个列表对象。
+- view_json() 额外缓存序列化后的响应字节和 ETag (由版本号生成)，接口可以直接返回字节，
+  或在 If-None-Match 命中时返回 304。
+- 身份组成员数由成员的身份组列表增量计数，不再对每个身份组调用 len(role.members) (O(成员数))。
+
+读取吞吐量测试 (对比每次请求遍历并排序 + jsonify):
+    python guild_snapshot.py --members 20000 --roles 200 --requests 2000
+"""
+import hashlib
+import itertools
+import json
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+TEXT, VOICE, CATEGORY, OTHER = "text", "voice", "category", "other"
+# discord.ChannelType 的名称 -> 摘要中的频道类型 (与 guild.text_channels / voice_channels / categories 一致)
+CHANNEL_TYPES = {"text": TEXT, "news": TEXT, "voice": VOICE, "category": CATEGORY}
+
+# 变更类别 -> 受影响的视图
+_MEMBER_VIEWS = ("members",)
+_ROLE_VIEWS = ("roles", "assignable_roles")
+_CHANNEL_VIEWS = ("text_channels", "voice_channels", "categories", "voice_activity")
+
+
+def _by_name(item: Dict[str, Any]):
+    return (item["name"].lower(), item["id"])
+
+
+def _public(item: Dict[str, Any]) -> Dict[str, Any]:
+    return {k: v for k, v in item.items() if not k.startswith("_")}
+
+
+def _voice_activity(state: "GuildState") -> List[Dict[str, Any]]:
+    occupants: Dict[str, List[Dict[str, Any]]] = {}
+    for member in state.in_voice.values():
+        voice = member["_voice"]
+        if voice["channel_id"] in state.channels:
+            occupants.setdefault(voice["channel_id"], []).append(
+                {"id": member["id"], "name": member["name"], "avatar_url": member["avatar_url"],
+                 "is_muted": voice["is_muted"], "is_deafened": voice["is_deafened"]})
+    channels = sorted((c for c in state.channels.values() if c["type"] == VOICE and c["id"] in occupants),
+                      key=lambda c: (c["position"], c["id"]))
+    return [{"id": c["id"], "name": c["name"], "members": sorted(occupants[c["id"]], key=_by_name)} for c in channels]
+
+
+def _channels_of(kind: str) -> Callable[["GuildState"], List[Dict[str, Any]]]:
+    return lambda state: sorted((_public(c) for c in state.channels.values() if c["type"] == kind), key=_by_name)
+
+
+def _roles(state: "GuildState", assignable_only: bool = False) -> List[Dict[str, Any]]:
+    roles = [dict(_public(r), member_count=state.role_counts.get(r["id"], 0))
+             for r in state.roles.values() if not (assignable_only and r["managed"])]
+    return sorted(roles, key=_by_name)
+
+
+# 视图名 -> (计算函数, 它读取的 GuildState 字段)。计算在锁外进行，参数是这些字段的浅拷贝。
+VIEWS: Dict[str, Tuple[Callable[["GuildState"], List[Dict[str, Any]]], Tuple[str, ...]]] = {
+    "roles": (_roles, ("roles", "role_counts")),                                  # 除 @everyone 外的全部身份组
+    "assignable_roles": (lambda state: _roles(state, True), ("roles", "role_counts")),  # 再排除集成/机器人管理的身份组
+    "members": (lambda state: sorted((_public(m) for m in state.members.values() if not m["bot"]), key=_by_name), ("members",)),
+    "text_channels": (_channels_of(TEXT), ("channels",)),
+    "voice_channels": (_channels_of(VOICE), ("channels",)),
+    "categories": (_channels_of(CATEGORY), ("channels",)),
+    "voice_activity": (_voice_activity, ("in_voice", "channels")),               # 有人的语音频道及其成员的静音状态
+}
+
+
+class GuildState:
+    """单个服务器的摘要。只能在持有 GuildSnapshotStore 的锁时修改。"""
+
+    def __init__(self, info: Dict[str, Any]):
+        self.info = info
+        self.roles: Dict[str, Dict[str, Any]] = {}
+        self.channels: Dict[str, Dict[str, Any]] = {}
+        self.members: Dict[str, Dict[str, Any]] = {}
+        self.in_voice: Dict[str, Dict[str, Any]] = {}   # 正在语音频道中的成员 (members 的子集)
+        self.role_counts: Dict[str, int] = {}
+        self.versions: Dict[str, int] = {}
+        self.views: Dict[str, Tuple[int, List[Dict[str, Any]]]] = {}              # 视图名 -> (版本, 列表)
+        self.encoded: Dict[Tuple[str, str], Tuple[int, bytes, str]] = {}          # (视图名, 键) -> (版本, 字节, ETag)
+
+    def copy(self, fields) -> "GuildState":
+        clone = GuildState(self.info)
+        for field in fields:
+            setattr(clone, field, dict(getattr(self, field)))
+        return clone
+
+    def index_voice(self, member_id: str, summary: Optional[Dict[str, Any]]):
+        if summary and summary["_voice"]:
+            self.in_voice[member_id] = summary
+        else:
+            self.in_voice.pop(member_id, None)
+
+
+class GuildSnapshotStore:
+    """线程安全。写入方法只应在机器人事件循环中调用 (它们会读取 discord.py 对象)。"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._guilds: Dict[int, GuildState] = {}
+        self._seq = itertools.count(1)
+        self.events = 0
+        self.rebuilds = 0
+        self.view_hits = 0
+        self.view_builds = 0
+        self.encodes = 0
+
+    # ---------------------------------------------------------------
+    # 从 discord.py 对象生成摘要
+    # ---------------------------------------------------------------
+    @staticmethod
+    def _guild_info(guild) -> Dict[str, Any]:
+        return {"id": guild.id, "name": guild.name, "owner_id": guild.owner_id, "member_count": guild.member_count,
+                "icon_url": str(guild.icon.url) if guild.icon else None}
+
+    @staticmethod
+    def _role(role) -> Dict[str, Any]:
+        return {"id": str(role.id), "name": role.name, "color": str(role.color), "position": role.position,
+                "managed": role.managed}
+
+    @staticmethod
+    def _channel(channel) -> Dict[str, Any]:
+        return {"id": str(channel.id), "name": channel.name, "type": CHANNEL_TYPES.get(channel.type.name, OTHER),
+                "position": channel.position, "category_id": str(channel.category_id) if channel.category_id else None}
+
+    @staticmethod
+    def _voice(member) -> Optional[Dict[str, Any]]:
+        voice = member.voice
+        if not voice or not voice.channel:
+            return None
+        return {"channel_id": str(voice.channel.id), "is_muted": voice.self_mute or voice.mute,
+                "is_deafened": voice.self_deaf or voice.deaf}
+
+    @classmethod
+    def _member(cls, member) -> Dict[str, Any]:
+        return {"id": str(member.id), "name": member.display_name, "avatar_url": str(member.display_avatar.url),
+                "joined_at": member.joined_at.strftime('%Y-%m-%d') if member.joined_at else 'N/A', "bot": member.bot,
+                "_roles": tuple(str(r.id) for r in member.roles if not r.is_default()), "_voice": cls._voice(member)}
+
+    # ---------------------------------------------------------------
+    # 内部：变更与失效 (调用方持有锁)
+    # ---------------------------------------------------------------
+    def _touch(self, state: GuildState, views):
+        for name in views:
+            state.versions[name] = next(self._seq)
+            state.views.pop(name, None)
+
+    def _count_roles(self, state: GuildState, role_ids, delta: int):
+        for role_id in role_ids:
+            state.role_counts[role_id] = state.role_counts.get(role_id, 0) + delta
+
+    def _put_member(self, state: GuildState, summary: Dict[str, Any]):
+        previous = state.members.get(summary["id"])
+        if previous == summary:
+            return
+        state.members[summary["id"]] = summary
+        state.index_voice(summary["id"], summary)
+        changed = []
+        profile_changed = previous is None or _public(previous) != _public(summary)
+        if profile_changed:
+            changed.extend(_MEMBER_VIEWS)
+        if previous is None or previous["_roles"] != summary["_roles"]:
+            self._count_roles(state, previous["_roles"] if previous else (), -1)
+            self._count_roles(state, summary["_roles"], 1)
+            changed.extend(_ROLE_VIEWS)
+        if (previous["_voice"] if previous else None) != summary["_voice"] or (summary["_voice"] and profile_changed):
+            changed.append("voice_activity")
+        self._touch(state, changed)
+
+    def _state(self, guild) -> Optional[GuildState]:
+        """取出服务器的摘要并刷新基本信息 (名称、图标、所有者、成员总数)。"""
+        state = self._guilds.get(guild.id)
+        if state is not None:
+            self.events += 1
+            state.info = self._guild_info(guild)
+        return state
+
+    # ---------------------------------------------------------------
+    # 写入 (机器人事件循环)
+    # ---------------------------------------------------------------
+    def build(self, guild):
+        """全量重建一个服务器的摘要 (on_ready / 加入服务器 / 服务器恢复可用时)。"""
+        state = GuildState(self._guild_info(guild))
+        for role in guild.roles:
+            if not role.is_default():
+                state.roles[str(role.id)] = self._role(role)
+        for channel in guild.channels:
+            state.channels[str(channel.id)] = self._channel(channel)
+        for member in guild.members:
+            summary = self._member(member)
+            state.members[summary["id"]] = summary
+            state.index_voice(summary["id"], summary)
+            self._count_roles(state, summary["_roles"], 1)
+        with self._lock:
+            self._touch(state, VIEWS)
+            self._guilds[guild.id] = state
+            self.rebuilds += 1
+
+    def remove_guild(self, guild_id: int):
+        with self._lock:
+            self._guilds.pop(guild_id, None)
+
+    def update_guild(self, guild):
+        with self._lock:
+            self._state(guild)
+
+    def upsert_member(self, member):
+        summary = self._member(member)
+        with self._lock:
+            state = self._state(member.guild)
+            if state is not None:
+                self._put_member(state, summary)
+
+    def remove_member(self, guild, user_id: int):
+        with self._lock:
+            state = self._state(guild)
+            previous = state.members.pop(str(user_id), None) if state else None
+            if previous is None:
+                return
+            state.index_voice(previous["id"], None)
+            self._count_roles(state, previous["_roles"], -1)
+            self._touch(state, _MEMBER_VIEWS + _ROLE_VIEWS + (("voice_activity",) if previous["_voice"] else ()))
+
+    def upsert_role(self, role):
+        if role.is_default():
+            return
+        summary = self._role(role)
+        with self._lock:
+            state = self._state(role.guild)
+            if state is not None and state.roles.get(summary["id"]) != summary:
+                state.roles[summary["id"]] = summary
+                self._touch(state, _ROLE_VIEWS)
+
+    def remove_role(self, guild_id: int, role_id: int):
+        with self._lock:
+            state = self._guilds.get(guild_id)
+            if state is not None and state.roles.pop(str(role_id), None) is not None:
+                self.events += 1
+                self._touch(state, _ROLE_VIEWS)
+
+    def upsert_channel(self, channel):
+        summary = self._channel(channel)
+        with self._lock:
+            state = self._state(channel.guild)
+            if state is not None and state.channels.get(summary["id"]) != summary:
+                state.channels[summary["id"]] = summary
+                self._touch(state, _CHANNEL_VIEWS)
+
+    def remove_channel(self, guild_id: int, channel_id: int):
+        with self._lock:
+            state = self._guilds.get(guild_id)
+            if state is not None and state.channels.pop(str(channel_id), None) is not None:
+                self.events += 1
+                self._touch(state, _CHANNEL_VIEWS)
+
+    def attach(self, bot):
+        """注册网关事件监听器。使用 add_listener，不会覆盖 bot 上已有的同名 @bot.event 处理器。"""
+        async def on_ready():
+            for guild in bot.guilds:
+                self.build(guild)
+
+        async def on_guild_available(guild):
+            self.build(guild)
+
+        async def on_guild_remove(guild):
+            self.remove_guild(guild.id)
+
+        async def on_guild_update(before, after):
+            self.update_guild(after)
+
+        async def on_member_join(member):
+            self.upsert_member(member)
+
+        async def on_member_update(before, after):
+            self.upsert_member(after)
+
+        async def on_raw_member_remove(payload):
+            guild = bot.get_guild(payload.guild_id)
+            if guild:
+                self.remove_member(guild, payload.user.id)
+
+        async def on_user_update(before, after):
+            for guild in after.mutual_guilds:
+                member = guild.get_member(after.id)
+                if member:
+                    self.upsert_member(member)
+
+        async def on_voice_state_update(member, before, after):
+            self.upsert_member(member)
+
+        async def on_guild_role_create(role):
+            self.upsert_role(role)
+
+        async def on_guild_role_update(before, after):
+            self.upsert_role(after)
+
+        async def on_guild_role_delete(role):
+            self.remove_role(role.guild.id, role.id)
+
+        async def on_guild_channel_create(channel):
+            self.upsert_channel(channel)
+
+        async def on_guild_channel_update(before, after):
+            self.upsert_channel(after)
+
+        async def on_guild_channel_delete(channel):
+            self.remove_channel(channel.guild.id, channel.id)
+
+        for name, listener in (
+                ("on_ready", on_ready), ("on_guild_join", on_guild_available), ("on_guild_available", on_guild_available),
+                ("on_guild_remove", on_guild_remove), ("on_guild_update", on_guild_update),
+                ("on_member_join", on_member_join), ("on_member_update", on_member_update),
+                ("on_raw_member_remove", on_raw_member_remove), ("on_user_update", on_user_update),
+                ("on_voice_state_update", on_voice_state_update),
+                ("on_guild_role_create", on_guild_role_create),
+                ("on_guild_role_update", on_guild_role_update), ("on_guild_role_delete", on_guild_role_delete),
+                ("on_guild_channel_create", on_guild_channel_create),
+                ("on_guild_channel_update", on_guild_channel_update), ("on_guild_channel_delete", on_guild_channel_delete)):
+            bot.add_listener(listener, name)
+
+    # ---------------------------------------------------------------
+    # 读取 (Web 线程)
+    # ---------------------------------------------------------------
+    def guild(self, guild_id: int) -> Optional[Dict[str, Any]]:
+        """服务器基本信息 {'id', 'name', 'owner_id', 'member_count', 'icon_url'}；尚未同步时返回 None。"""
+        with self._lock:
+            state = self._guilds.get(guild_id)
+            return dict(state.info) if state else None
+
+    def member(self, guild_id: int, user_id: int) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            state = self._guilds.get(guild_id)
+            member = state.members.get(str(user_id)) if state else None
+        return _public(member) if member else None
+
+    def channel(self, guild_id: int, channel_id: int) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            state = self._guilds.get(guild_id)
+            channel = state.channels.get(str(channel_id)) if state else None
+        return _public(channel) if channel else None
+
+    def _view(self, guild_id: int, name: str) -> Optional[Tuple[GuildState, int, List[Dict[str, Any]]]]:
+        with self._lock:
+            state = self._guilds.get(guild_id)
+            if state is None:
+                return None
+            version = state.versions[name]
+            cached = state.views.get(name)
+            if cached and cached[0] == version:
+                self.view_hits += 1
+                return state, version, cached[1]
+            compute, fields = VIEWS[name]
+            clone = state.copy(fields)
+        data = compute(clone) # 排序在锁外进行，不阻塞机器人事件循环中的写入
+        with self._lock:
+            self.view_builds += 1
+            if state.versions.get(name) == version:
+                state.views[name] = (version, data)
+        return state, version, data
+
+    def view(self, guild_id: int, name: str) -> Optional[List[Dict[str, Any]]]:
+        """已排序的视图 (VIEWS 中的名称)。返回的列表在多个请求间共享，调用方不得修改。"""
+        result = self._view(guild_id, name)
+        return result[2] if result else None
+
+    def view_json(self, guild_id: int, name: str, key: Optional[str] = None) -> Optional[Tuple[bytes, str]]:
+        """把视图序列化为 {"status": "success", key: [...]}，返回 (响应字节, ETag)。"""
+        key = key or name
+        result = self._view(guild_id, name)
+        if result is None:
+            return None
+        state, version, data = result
+        with self._lock:
+            cached = state.encoded.get((name, key))
+            if cached and cached[0] == version:
+                return cached[1], cached[2]
+        body = json.dumps({"status": "success", key: data}, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+        # ETag 取内容哈希而不是版本号：重启后版本号从头计数，不能让旧 ETag 误命中
+        etag = hashlib.blake2b(body, digest_size=12).hexdigest()
+        with self._lock:
+            self.encodes += 1
+            if state.versions.get(name) == version:
+                state.encoded[(name, key)] = (version, body, etag)
+        return body, etag
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {"guilds": len(self._guilds), "members": sum(len(s.members) for s in self._guilds.values()),
+                    "events": self.events, "rebuilds": self.rebuilds, "view_hits": self.view_hits,
+                    "view_builds": self.view_builds, "encodes": self.encodes}
+
+
+# =========================================
+# == 读取吞吐量测试
+# =========================================
+def _fake_guild(members: int, roles: int, voice_channels: int):
+    import datetime
+    import random
+    from types import SimpleNamespace as NS
+
+    guild = NS(id=1, name="bench", owner_id=1, member_count=members, icon=None)
+    default_role = NS(id=1, name="@everyone", color="#000000", position=0, managed=False, guild=guild, is_default=lambda: True)
+    guild.roles = [default_role] + [NS(id=1000 + i, name=f"role-{i}", color="#99aab5", position=i + 1, managed=i % 50 == 0,
+                                       guild=guild, is_default=lambda: False) for i in range(roles)]
+    kinds = ["text"] * 40 + ["voice"] * voice_channels + ["category"] * 10
+    guild.channels = [NS(id=5000 + i, name=f"{kind}-{i}", type=NS(name=kind), position=i, category_id=None, guild=guild)
+                      for i, kind in enumerate(kinds)]
+    guild.voice_channels = [c for c in guild.channels if c.type.name == "voice"]
+    joined = datetime.datetime(2024, 1, 1)
+    guild.members = []
+    for i in range(members):
+        member = NS(id=10 ** 6 + i, display_name=f"user-{random.randrange(10 ** 6)}", bot=i % 40 == 0, joined_at=joined,
+                    display_avatar=NS(url=f"https://cdn.discordapp.com/avatars/{i}.png"), guild=guild,
+                    roles=[default_role] + random.sample(guild.roles[1:], 3), voice=None)
+        if i % 100 == 0:
+            member.voice = NS(channel=random.choice(guild.voice_channels), self_mute=False, mute=False, self_deaf=False, deaf=False)
+        guild.members.append(member)
+    for role in guild.roles:
+        role.members = [m for m in guild.members if role in m.roles]
+    for channel in guild.voice_channels:
+        channel.members = [m for m in guild.members if m.voice and m.voice.channel is channel]
+    return guild
+
+
+def _run_benchmark(members: int, roles: int, requests: int, writes_per_request: int):
+    guild = _fake_guild(members, roles, voice_channels=20)
+
+    def legacy_guild_page():
+        members_data = [{'id': str(m.id), 'name': m.display_name, 'avatar_url': str(m.display_avatar.url),
+                         'joined_at': m.joined_at.strftime('%Y-%m-%d') if m.joined_at else 'N/A'} for m in guild.members if not m.bot]
+        members_data.sort(key=lambda x: x['name'].lower())
+        roles_data = sorted([{'id': str(r.id), 'name': r.name, 'color': str(r.color), 'member_count': len(r.members)}
+                             for r in guild.roles if r.name != '@everyone'], key=lambda x: x['name'].lower())
+        return members_data, roles_data
+
+    def legacy_voice_states():
+        data = [{'id': str(vc.id), 'name': vc.name, 'members': [{'id': str(m.id), 'name': m.display_name, 'avatar_url': str(m.display_avatar.url),
+                 'is_muted': m.voice.self_mute or m.voice.mute, 'is_deafened': m.voice.self_deaf or m.voice.deaf} for m in vc.members]}
+                for vc in guild.voice_channels if vc.members]
+        return json.dumps({"status": "success", "voice_channels": data}).encode()
+
+    store = GuildSnapshotStore()
+    started = time.perf_counter()
+    store.build(guild)
+    print(f"  全量构建: {(time.perf_counter() - started) * 1000:.1f}ms")
+
+    def snapshot_guild_page():
+        return store.view(guild.id, "members"), store.view(guild.id, "roles")
+
+    def snapshot_voice_states():
+        return store.view_json(guild.id, "voice_activity", "voice_channels")
+
+    talkers = [m for m in guild.members if m.voice]
+    for label, legacy, snapshot in (("服务器页 (成员+身份组)", legacy_guild_page, snapshot_guild_page),
+                                    ("语音状态 JSON", legacy_voice_states, snapshot_voice_states)):
+        started = time.perf_counter()
+        for _ in range(requests):
+            legacy()
+        legacy_rate = requests / (time.perf_counter() - started)
+        started = time.perf_counter()
+        for i in range(requests):
+            for j in range(writes_per_request): # 模拟请求之间到达的网关事件 (静音切换)
+                member = talkers[(i * writes_per_request + j) % len(talkers)]
+                member.voice.self_mute = not member.voice.self_mute
+                store.upsert_member(member)
+            snapshot()
+        snapshot_rate = requests / (time.perf_counter() - started)
+        print(f"  {label:<20} 旧: {legacy_rate:>8.0f} 次/秒   只读模型: {snapshot_rate:>9.0f} 次/秒  (x{snapshot_rate / legacy_rate:.1f})")
+    print(f"  {store.stats()}")
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="服务器只读模型读取吞吐量测试")
+    parser.add_argument("--members", type=int, default=20000)
+    parser.add_argument("--roles", type=int, default=200)
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--writes-per-request", type=int, default=0, help="每个请求之间到达的网关事件数")
+    args = parser.parse_args()
+    print(f"{args.members} 个成员, {args.roles} 个身份组, {args.requests} 次请求, 每次请求间 {args.writes_per_request} 个网关事件:")
+    _run_benchmark(args.members, args.roles, args.requests, args.writes_per_request)
@@ -0,0 +1,569 @@
+# music_bench.py
+"""
+音乐模块的多服务器离线基准 / 长时间浸泡测试。
+
+不连接 Discord、不访问网络：
+- 用本地的 FakeYoutubeDL 替换 music_extractor 实例池中的 YoutubeDL (可配置延迟与失败率)，
+  因此实例池、元数据缓存、single-flight 与流式播放列表都走真实代码；
+- 用 NullVoiceClient 代替语音连接：像 discord.py 的 AudioPlayer 一样在独立线程中每 20ms 读取一帧
+  (PCM 音源同样用 libopus 编码) 后丢弃；
+- 默认用内存中的静音 PCM 源代替 FFmpeg，--ffmpeg 时改用本地生成的 WAV 文件启动真实的 FFmpeg 进程。
+
+每个模拟服务器按 /music play、播放列表导入、/music skip、/music loop、/music queue 的实现方式
+直接驱动 YTDLSource 与 GuildMusicState，结束后报告曲间间隔、事件循环延迟、提取延迟、
+每路流的 CPU 占用与每个 GuildMusicState 的内存，并把结果追加到历史文件，方便跨版本对比。
+
+用法:
+    python music_bench.py --guilds 50 --duration 60
+    python music_bench.py --guilds 200 --duration 1800 --speed 10 --ffmpeg     # 浸泡测试
+    python music_bench.py --ffmpeg --mode pcm / --mode opus [--volume 100]      # 对比两种播放模式每核可承载的流数
+    python music_bench.py --compare                                            # 与上一次 (不同版本) 的结果对比
+"""
+import argparse
+import asyncio
+import contextlib
+import datetime
+import json
+import math
+import os
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import wave
+from typing import Any, Dict, List, Optional
+
+import discord
+import yt_dlp
+
+import database
+import music_cog
+import music_extractor
+from music_queue import QueueEntry
+
+RESULTS_FILE = os.path.join("bench_results", "music_bench.jsonl")
+FRAME_SECONDS = 0.02  # discord.py 每帧 20ms
+PCM_FRAME = b"\x00" * 3840  # 48kHz 立体声 16bit 的一帧
+SAMPLE_INTERVAL = 0.5
+
+
+# =========================================
+# == 模拟的提取器与音频
+# =========================================
+class FakeCatalog:
+    """离线曲库：曲目编号 -> 信息字典；所有 FakeYoutubeDL 实例共享。"""
+
+    def __init__(self, size: int, track_seconds: List[int], latency_ms: float, fail_rate: float,
+                 audio_files: Optional[Dict[int, str]] = None):
+        self.size = size
+        self.track_seconds = track_seconds
+        self.latency_ms = latency_ms
+        self.fail_rate = fail_rate
+        self.audio_files = audio_files or {}
+        self.calls = 0
+        self.failures = 0
+        self._lock = threading.Lock()
+
+    def track_id(self, query: str) -> int:
+        tail = query.rsplit("/", 1)[-1].rsplit(":", 1)[-1]
+        return int(tail) % self.size if tail.isdigit() else sum(map(ord, tail)) % self.size
+
+    def info(self, track_id: int) -> Dict[str, Any]:
+        duration = self.track_seconds[track_id % len(self.track_seconds)]
+        stream_url = self.audio_files.get(duration) or \
+            f"https://bench.invalid/stream/{track_id}?expire={int(time.time()) + 6 * 3600}"
+        return {
+            'id': f"{track_id:011d}", 'title': f"Bench track {track_id}", 'webpage_url': f"https://bench.invalid/watch/{track_id}",
+            'duration': duration, 'uploader': f"Bench artist {track_id % 20}", 'thumbnail': f"https://bench.invalid/thumb/{track_id}.jpg",
+            'url': stream_url, 'extractor': 'bench',
+        }
+
+    def simulate_request(self):
+        # 对数正态分布的延迟，近似真实的网络 + 解析耗时 (长尾)
+        time.sleep(random.lognormvariate(math.log(max(self.latency_ms, 1) / 1000), 0.5))
+        with self._lock:
+            self.calls += 1
+            if random.random() < self.fail_rate:
+                self.failures += 1
+                raise yt_dlp.utils.DownloadError("[bench] 模拟的提取失败")
+
+
+class FakeYoutubeDL:
+    catalog: Optional[FakeCatalog] = None
+
+    def __init__(self, options: Dict[str, Any]):
+        self.options = options
+
+    def extract_info(self, query: str, download: bool = False, process: bool = True, ie_key: Optional[str] = None):
+        catalog = self.catalog
+        catalog.simulate_request()
+        if query.startswith("bench-playlist:"):
+            start, count = (int(x) for x in query.split(":")[1:3])
+            entries = ({'_type': 'url', 'url': f"https://bench.invalid/watch/{(start + i) % catalog.size}",
+                        'title': f"Bench track {(start + i) % catalog.size}", 'duration': None} for i in range(count))
+            return {'_type': 'playlist', 'title': query, 'entries': entries if not process else list(entries)}
+        info = catalog.info(catalog.track_id(query))
+        if query.startswith(("ytsearch", "scsearch")):
+            return {'_type': 'playlist', 'entries': [info]}
+        return info
+
+    def prepare_filename(self, info: Dict[str, Any]) -> str:
+        return info['url']
+
+
+class NullPCMSource(discord.AudioSource):
+    """按时长产出静音帧的 PCM 源 (代替 FFmpegPCMAudio，不启动子进程)。"""
+
+    def __init__(self, duration: Optional[int]):
+        self.frames_left = int((duration or 30) / FRAME_SECONDS)
+
+    def read(self) -> bytes:
+        if self.frames_left <= 0:
+            return b""
+        self.frames_left -= 1
+        return PCM_FRAME
+
+    def is_opus(self) -> bool:
+        return False
+
+
+def _write_tone(path: str, seconds: int):
+    rate = 22050
+    period = [int(8000 * math.sin(2 * math.pi * 440 * i / rate)).to_bytes(2, "little", signed=True) for i in range(rate // 440 * 4)]
+    chunk = b"".join(period)
+    total = rate * seconds * 2
+    with wave.open(path, "wb") as f:
+        f.setnchannels(1); f.setsampwidth(2); f.setframerate(rate)
+        written = 0
+        while written < total:
+            f.writeframes(chunk[:total - written]); written += len(chunk)
+
+
+# =========================================
+# == 模拟的语音连接
+# =========================================
+class _FakeMember:
+    bot = False
+
+
+class _FakeGuild:
+    def __init__(self, guild_id: int):
+        self.id = guild_id
+        self.name = f"bench-guild-{guild_id}"
+
+
+class _FakeVoiceChannel:
+    def __init__(self, guild: _FakeGuild):
+        self.id = guild.id * 10
+        self.guild = guild
+        self.members = [_FakeMember()]
+
+
+def _pcm_encoder() -> Optional["discord.opus.Encoder"]:
+    try:
+        return discord.opus.Encoder()
+    except Exception: # 没有 libopus 时只能跳过编码，CPU 数字会偏低
+        return None
+
+
+class NullVoiceClient:
+    """实现 GuildMusicState 用到的 VoiceClient 接口；音频线程的行为与 discord.py 的 AudioPlayer 一致。"""
+
+    def __init__(self, guild_id: int, speed: float, metrics: "BenchMetrics"):
+        self.guild = _FakeGuild(guild_id)
+        self.channel = _FakeVoiceChannel(self.guild)
+        self.speed = speed
+        self.metrics = metrics
+        self.source: Optional[discord.AudioSource] = None
+        self._connected = True
+        self._end = threading.Event()
+        self._end.set()
+        self._thread: Optional[threading.Thread] = None
+
+    def is_connected(self) -> bool:
+        return self._connected
+
+    def is_playing(self) -> bool:
+        return not self._end.is_set()
+
+    def is_paused(self) -> bool:
+        return False
+
+    def play(self, source: discord.AudioSource, *, after=None):
+        if not self._connected:
+            raise discord.ClientException("Not connected to voice.")
+        if self.is_playing():
+            raise discord.ClientException("Already playing audio.")
+        self.source = source
+        self._end = end = threading.Event()
+        self._thread = threading.Thread(target=self._run, args=(source, end, after), daemon=True,
+                                        name=f"bench-audio-{self.guild.id}")
+        self._thread.start()
+
+    def _run(self, source: discord.AudioSource, end: threading.Event, after):
+        delay = FRAME_SECONDS / self.speed
+        started = next_at = time.perf_counter()
+        error: Optional[Exception] = None
+        frames = 0
+        encoder = None if source.is_opus() else _pcm_encoder()
+        if encoder is None and not source.is_opus():
+            self.metrics.pcm_unencoded = True
+        try:
+            while not end.is_set():
+                data = source.read()
+                if not data:
+                    break
+                if encoder is not None:
+                    encoder.encode(data, encoder.SAMPLES_PER_FRAME)
+                frames += 1
+                next_at += delay
+                wait = next_at - time.perf_counter()
+                if wait > 0:
+                    time.sleep(wait)
+        except Exception as e:
+            error = e
+        finally:
+            end.set()
+            self.metrics.add_stream_time(time.perf_counter() - started, frames)
+            if after:
+                after(error)
+            source.cleanup()
+
+    def stop(self):
+        self._end.set()
+
+    async def disconnect(self, *, force: bool = False):
+        self.stop()
+        self._connected = False
+
+
+# =========================================
+# == 指标
+# =========================================
+def _percentile(values: List[float], pct: float) -> Optional[float]:
+    if not values:
+        return None
+    ordered = sorted(values)
+    return round(ordered[min(len(ordered) - 1, int(len(ordered) * pct))], 1)
+
+
+def _ffmpeg_children() -> Dict[int, float]:
+    """本进程的 FFmpeg 子进程 -> 已消耗 CPU 秒数 (仅 Linux 的 /proc；其他平台返回空)。"""
+    result = {}
+    if not os.path.isdir("/proc"):
+        return result
+    me = os.getpid(); ticks = os.sysconf("SC_CLK_TCK")
+    for pid in os.listdir("/proc"):
+        if not pid.isdigit():
+            continue
+        try:
+            with open(f"/proc/{pid}/stat") as f:
+                stat = f.read()
+        except OSError:
+            continue
+        comm = stat[stat.index("(") + 1:stat.rindex(")")]
+        fields = stat[stat.rindex(")") + 2:].split()
+        if int(fields[1]) == me and comm.startswith("ffmpeg"):
+            result[int(pid)] = (int(fields[11]) + int(fields[12])) / ticks
+    return result
+
+
+class BenchMetrics:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.stream_seconds = 0.0
+        self.frames = 0
+        self.loop_lag_ms: List[float] = []
+        self.extract_ms: List[float] = []
+        self.concurrent_streams: List[int] = []
+        self.ffmpeg_cpu: Dict[int, float] = {}
+        self.max_ffmpeg = 0
+        self.commands: Dict[str, int] = {}
+        self.playback_errors = 0
+        self.pcm_unencoded = False
+
+    def add_stream_time(self, seconds: float, frames: int):
+        with self._lock:
+            self.stream_seconds += seconds
+            self.frames += frames
+
+    def count(self, command: str):
+        self.commands[command] = self.commands.get(command, 0) + 1
+
+    async def monitor(self, states: List[music_cog.GuildMusicState]):
+        """采样事件循环延迟、同时播放的流数与 FFmpeg 子进程。"""
+        loop = asyncio.get_running_loop()
+        while True:
+            before = loop.time()
+            await asyncio.sleep(SAMPLE_INTERVAL)
+            self.loop_lag_ms.append((loop.time() - before - SAMPLE_INTERVAL) * 1000)
+            self.concurrent_streams.append(sum(1 for s in states if s.voice_client and s.voice_client.is_playing()))
+            children = await loop.run_in_executor(None, _ffmpeg_children)
+            self.max_ffmpeg = max(self.max_ffmpeg, len(children))
+            self.ffmpeg_cpu.update(children)
+
+
+def _install_extract_timer(extractor: music_extractor.MusicExtractor, metrics: BenchMetrics):
+    original = extractor.extract
+
+    async def timed_extract(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return await original(*args, **kwargs)
+        finally:
+            metrics.extract_ms.append((time.perf_counter() - started) * 1000)
+
+    extractor.extract = timed_extract
+
+
+# =========================================
+# == 模拟用户操作
+# =========================================
+async def _play(state: music_cog.GuildMusicState, catalog: FakeCatalog, rng: random.Random, metrics: BenchMetrics):
+    """与 /music play 的单曲路径相同：解析 -> 记录为已解析条目 -> 释放音源 -> 请求播放。"""
+    track = rng.randrange(catalog.size)
+    query = f"ytsearch:bench {track}" if rng.random() < 0.3 else f"https://bench.invalid/watch/{track}"
+    try:
+        source = await music_cog.YTDLSource.from_url(query, stream=True)
+    except yt_dlp.utils.DownloadError:
+        metrics.count("play_failed"); return
+    state.queue.append(QueueEntry.from_info(source.data, resolved=True))
+    source.cleanup()
+    state.mark_queue_dirty(); state.request_playback(); state.schedule_prefetch()
+    metrics.count("play")
+
+
+async def _import_playlist(state: music_cog.GuildMusicState, catalog: FakeCatalog, rng: random.Random,
+                           metrics: BenchMetrics, size: int):
+    """与 MusicCog._import_playlist 相同的流式导入。"""
+    async for batch in music_cog.extractor.iter_playlist(f"bench-playlist:{rng.randrange(catalog.size)}:{size}"):
+        records = [r for r in (music_cog.playlist_record(e) for e in batch) if r]
+        state.queue.extend(records)
+        state.mark_queue_dirty(); state.request_playback(); state.schedule_prefetch(); state.schedule_lookahead()
+    metrics.count("playlist")
+
+
+async def _drive_guild(state: music_cog.GuildMusicState, catalog: FakeCatalog, rng: random.Random,
+                       metrics: BenchMetrics, deadline: float, speed: float, playlist_size: int):
+    loop = asyncio.get_running_loop()
+    try:
+        await _import_playlist(state, catalog, rng, metrics, playlist_size)
+    except yt_dlp.utils.DownloadError:
+        metrics.count("playlist_failed")
+    while loop.time() < deadline:
+        await asyncio.sleep(rng.uniform(2, 20) / speed)
+        action = rng.random()
+        try:
+            if action < 0.25:
+                await _play(state, catalog, rng, metrics)
+            elif action < 0.45:
+                if state.voice_client.is_playing() and state.current_song:
+                    state.post_event(music_cog.EVENT_SKIP); metrics.count("skip")
+            elif action < 0.55:
+                state.loop_mode = rng.choice(("none", "song", "queue"))
+                state.schedule_prefetch(); state.mark_queue_dirty(); metrics.count("loop")
+            elif action < 0.6 and len(state.queue) < playlist_size:
+                await _import_playlist(state, catalog, rng, metrics, playlist_size // 2)
+            else:
+                state.create_now_playing_embed(); state.transition_stats(); metrics.count("queue")
+        except yt_dlp.utils.DownloadError:
+            metrics.count("playlist_failed")
+        if not state.queue and state.current_song is None:
+            await _play(state, catalog, rng, metrics)
+
+
+# =========================================
+# == 运行与报告
+# =========================================
+def _git_revision() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__)), timeout=5).stdout.strip() or "unknown"
+    except (OSError, subprocess.SubprocessError):
+        return "unknown"
+
+
+async def run_bench(args: argparse.Namespace, catalog: FakeCatalog) -> Dict[str, Any]:
+    loop = asyncio.get_running_loop()
+    metrics = BenchMetrics()
+    _install_extract_timer(music_cog.extractor, metrics)
+    music_cog.TRANSITION_GAP_SAMPLES = 1_000_000  # 保留所有样本
+
+    tracemalloc.start()
+    baseline, _ = tracemalloc.get_traced_memory()
+    states = []
+    for guild_id in range(1, args.guilds + 1):
+        state = music_cog.GuildMusicState(loop, guild_id)
+        state.voice_client = NullVoiceClient(guild_id, args.speed, metrics)
+        if args.volume is not None:
+            state.volume = args.volume / 100
+        state.last_interaction_channel_id = guild_id * 10 + 1
+        states.append(state)
+    per_state_bytes = (tracemalloc.get_traced_memory()[0] - baseline) / args.guilds
+    tracemalloc.stop()
+
+    original_send = music_cog.GuildMusicState._send_to_text_channel
+
+    async def count_errors(self, content, interaction_for_reply=None):
+        metrics.playback_errors += 1
+        await original_send(self, content, interaction_for_reply)
+
+    music_cog.GuildMusicState._send_to_text_channel = count_errors
+
+    monitor = loop.create_task(metrics.monitor(states))
+    cpu_before = time.process_time(); wall_before = time.perf_counter()
+    deadline = loop.time() + args.duration
+    rng = random.Random(args.seed)
+    drivers = [loop.create_task(_drive_guild(s, catalog, random.Random(rng.random()), metrics, deadline,
+                                             args.speed, args.playlist_size)) for s in states]
+    await asyncio.gather(*drivers)
+    queued_entries = sum(len(s.queue) for s in states)
+    wall = time.perf_counter() - wall_before; cpu = time.process_time() - cpu_before
+
+    for state in states:  # 与 /music stop 相同的清理
+        state.queue.clear(); state.current_song = None; state.current_entry = None
+        state.cancel_prefetch(); state.post_event(music_cog.EVENT_STOP)
+        await state.forget_saved_queue()
+        await state.voice_client.disconnect()
+    await asyncio.sleep(1.0)
+    monitor.cancel()
+    leftover_tasks = [t for t in asyncio.all_tasks() if t is not asyncio.current_task() and not t.done() and t is not monitor]
+    leftover_ffmpeg = len(_ffmpeg_children())
+    music_cog.GuildMusicState._send_to_text_channel = original_send
+
+    gaps = [g for s in states for g in s.transition_gaps_ms]
+    hits = sum(s.prefetch_hits for s in states); misses = sum(s.prefetch_misses for s in states)
+    ffmpeg_cpu = sum(metrics.ffmpeg_cpu.values())
+    avg_streams = sum(metrics.concurrent_streams) / len(metrics.concurrent_streams) if metrics.concurrent_streams else 0.0
+    return {
+        "transitions": len(gaps),
+        "gap_ms_p50": _percentile(gaps, 0.5),
+        "gap_ms_p95": _percentile(gaps, 0.95),
+        "gap_ms_max": round(max(gaps), 1) if gaps else None,
+        "prefetch_hit_rate": round(hits / (hits + misses), 3) if hits + misses else None,
+        "loop_lag_ms_p95": _percentile(metrics.loop_lag_ms, 0.95),
+        "loop_lag_ms_max": round(max(metrics.loop_lag_ms), 1) if metrics.loop_lag_ms else None,
+        "extract_ms_p50": _percentile(metrics.extract_ms, 0.5),
+        "extract_ms_p95": _percentile(metrics.extract_ms, 0.95),
+        "extractor": music_cog.extractor.stats(),
+        "audio_cache": music_cog.track_cache.stats(),
+        "fake_extractions": catalog.calls,
+        "fake_failures": catalog.failures,
+        "playback_errors": metrics.playback_errors,
+        "avg_concurrent_streams": round(avg_streams, 1),
+        "stream_seconds": round(metrics.stream_seconds, 1),
+        "cpu_seconds": round(cpu, 2),
+        "ffmpeg_cpu_seconds": round(ffmpeg_cpu, 2),
+        # 每路流占用一个 CPU 核心的百分比 (Python 进程 + FFmpeg 子进程)
+        "cpu_pct_per_stream": round(100 * (cpu + ffmpeg_cpu) / metrics.stream_seconds, 2) if metrics.stream_seconds else None,
+        "streams_per_core": round(metrics.stream_seconds / (cpu + ffmpeg_cpu), 1) if cpu + ffmpeg_cpu else None,
+        "pcm_encoded": not metrics.pcm_unencoded,
+        "max_ffmpeg_processes": metrics.max_ffmpeg,
+        "state_bytes": round(per_state_bytes),
+        "queued_entries_at_end": queued_entries,
+        "peak_rss_mib": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        "wall_seconds": round(wall, 1),
+        "commands": metrics.commands,
+        "leftover_tasks": len(leftover_tasks),
+        "leftover_ffmpeg": leftover_ffmpeg,
+    }
+
+
+def _load_history(path: str) -> List[Dict[str, Any]]:
+    if not os.path.exists(path):
+        return []
+    with open(path, encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def _print_comparison(current: Dict[str, Any], previous: Dict[str, Any]):
+    print(f"与 {previous['revision']} ({previous['timestamp']}) 对比:")
+    for key, value in current["metrics"].items():
+        old = previous["metrics"].get(key)
+        if isinstance(value, (int, float)) and isinstance(old, (int, float)) and old:
+            print(f"  {key:<24} {old:>12} -> {value:<12} ({(value - old) / old * 100:+.1f}%)")
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description="音乐模块多服务器离线基准 / 浸泡测试")
+    parser.add_argument("--guilds", type=int, default=50)
+    parser.add_argument("--duration", type=float, default=60.0, help="运行时长 (秒)")
+    parser.add_argument("--speed", type=float, default=5.0, help="播放倍速；>1 时曲目更快结束，切歌更频繁")
+    parser.add_argument("--track-seconds", default="20,30,45,60", help="曲目时长 (秒)，逗号分隔")
+    parser.add_argument("--catalog", type=int, default=500, help="曲库大小 (越小缓存命中越多)")
+    parser.add_argument("--playlist-size", type=int, default=20)
+    parser.add_argument("--extract-ms", type=float, default=300.0, help="模拟提取延迟的中位数")
+    parser.add_argument("--fail-rate", type=float, default=0.02, help="模拟提取失败的概率")
+    parser.add_argument("--ffmpeg", action="store_true", help="使用真实的 FFmpeg 进程 (本地 WAV 文件)")
+    parser.add_argument("--mode", choices=("opus", "pcm"), default="opus", help="播放模式 (仅 --ffmpeg 时有区别)")
+    parser.add_argument("--volume", type=int, default=None, help="所有服务器的音量百分比 (默认使用机器人的默认音量)")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--results", default=RESULTS_FILE, help="历史结果文件 (JSON Lines)")
+    parser.add_argument("--no-save", action="store_true")
+    parser.add_argument("--compare", action="store_true", help="只打印最近一次结果与之前不同版本的对比")
+    parser.add_argument("--verbose", action="store_true", help="显示音乐模块自身的输出")
+    args = parser.parse_args(argv)
+
+    history = _load_history(args.results)
+    if args.compare:
+        if not history:
+            print(f"{args.results} 中没有历史结果。"); return
+        previous = next((r for r in reversed(history[:-1]) if r["revision"] != history[-1]["revision"]), None)
+        if previous: _print_comparison(history[-1], previous)
+        else: print("没有其他版本的结果可以对比。")
+        return
+
+    track_seconds = [int(s) for s in args.track_seconds.split(",") if s.strip()]
+    random.seed(args.seed)
+    with tempfile.TemporaryDirectory() as tmp:
+        audio_files = {}
+        if args.ffmpeg:
+            for seconds in track_seconds:
+                audio_files[seconds] = os.path.join(tmp, f"tone-{seconds}.wav")
+                _write_tone(audio_files[seconds], seconds)
+            music_cog.FFMPEG_OPTIONS = {'before_options': '', 'options': '-vn'}  # 本地文件不需要重连参数
+        else:
+            music_cog.YTDLSource.from_data = classmethod(
+                lambda cls, data, **kwargs: cls(NullPCMSource(data.get('duration')), data=data, volume=kwargs.get('volume', 0.5)))
+        music_cog.OPUS_PASSTHROUGH = args.mode == "opus"
+        catalog = FakeCatalog(args.catalog, track_seconds, args.extract_ms, args.fail_rate, audio_files)
+        FakeYoutubeDL.catalog = catalog
+        real_youtube_dl = music_extractor.yt_dlp.YoutubeDL
+        music_extractor.yt_dlp.YoutubeDL = FakeYoutubeDL
+        try:
+            music_cog.extractor = music_extractor.MusicExtractor(music_cog.YTDL_FORMAT_OPTIONS)
+        finally:
+            music_extractor.yt_dlp.YoutubeDL = real_youtube_dl
+        database.DATABASE_FILE = os.path.join(tmp, "bench.db")
+        database.initialize_database()
+
+        output = contextlib.nullcontext() if args.verbose else contextlib.redirect_stdout(open(os.devnull, "w"))
+        with output:
+            metrics = asyncio.run(run_bench(args, catalog))
+        music_cog.extractor.shutdown()
+
+    record = {
+        "timestamp": datetime.datetime.now().isoformat(timespec="seconds"),
+        "revision": _git_revision(),
+        "python": sys.version.split()[0],
+        "params": {k: getattr(args, k) for k in ("guilds", "duration", "speed", "track_seconds", "catalog",
+                                                 "playlist_size", "extract_ms", "fail_rate", "ffmpeg", "mode", "volume", "seed")},
+        "metrics": metrics,
+    }
+    print(json.dumps(record, ensure_ascii=False, indent=2))
+    previous = next((r for r in reversed(history) if r["revision"] != record["revision"] and r["params"] == record["params"]), None)
+    if previous:
+        _print_comparison(record, previous)
+    if not args.no_save:
+        os.makedirs(os.path.dirname(args.results) or ".", exist_ok=True)
+        with open(args.results, "a", encoding="utf-8") as f:
+            f.write(json.dumps(record, ensure_ascii=False) + "\n")
+        print(f"结果已追加到 {args.results}")
+
+
+if __name__ == "__main__":
+    main()
@@ -8,6 +8,12 @@ from collections import deque
 import re
 from typing import Optional, List, Dict, Any, Union # Added more specific types
 import os # For checking cookie file existence
+import time
+
+import audio_cache
+import database
+import music_extractor
+from music_queue import QueueEntry, RESOLVE_DONE, RESOLVE_FAILED, RESOLVE_PENDING, entries_from_rows, entries_to_rows
 
 # Suppress noise about console usage from errors
 # Updated lambda to accept arbitrary arguments
@@ -55,16 +61,76 @@ else:
     print(f"   Please see instructions in music_cog.py for setting up YouTube cookies.")
 
 
+# 预取：当前歌曲开始播放后立即解析下一首的直链；在当前歌曲结束前 PREFETCH_AUDIO_LEAD 秒启动下一首的 FFmpeg 进程
+PREFETCH_AUDIO_LEAD = 15
+STREAM_REFRESH_MARGIN = 120  # 直链剩余有效期少于这么多秒时重新解析
+TRANSITION_GAP_SAMPLES = 50
+# 播放列表导入：条目以轻量记录入队，之后只并发解析即将播放的 LOOKAHEAD_RESOLVE_COUNT 首
+LOOKAHEAD_RESOLVE_COUNT = 5
+RESOLVE_CONCURRENCY = 3  # 所有服务器共享的并发解析上限
+IMPORT_PROGRESS_INTERVAL = 1.5
+# 播放器事件 (由 GuildMusicState 的播放器任务按顺序处理)
+EVENT_TRACK_ENDED = "track_ended"
+EVENT_SKIP = "skip"
+EVENT_STOP = "stop"
+EVENT_ENQUEUE = "enqueue"
+RESOLVE_TIMEOUT = 30.0
+MAX_CONSECUTIVE_FAILURES = 5   # 连续这么多首解析/播放失败后暂停，避免把整个队列刷成错误消息
+REPLAY_ON_ERROR_WINDOW = 10.0  # 开播这么多秒内因错误结束的歌曲会重新解析后重播一次
+QUEUE_SAVE_DELAY = 2.0  # 队列变化后延迟这么多秒再写入数据库，合并连续的修改
+SPOTIFY_COLLECTION_RE = re.compile(r"https?://open\.spotify\.com/(?:intl-\w+/)?(?:playlist|album)/(\w+)")
+
 FFMPEG_OPTIONS = {
     'before_options': '-reconnect 1 -reconnect_streamed 1 -reconnect_delay_max 5',
     'options': '-vn',
 }
 
-ytdl = yt_dlp.YoutubeDL(YTDL_FORMAT_OPTIONS)
+# 共享的提取服务：预先创建的 YoutubeDL 实例池 + 专用线程池 + 元数据缓存 (见 music_extractor.py)
+extractor = music_extractor.get_music_extractor(YTDL_FORMAT_OPTIONS)
+# 可选的本地音频缓存：热门 / 单曲循环的曲目下载为 Opus 文件后从本地播放 (见 audio_cache.py)
+track_cache = audio_cache.get_audio_cache()
 
-class YTDLSource(discord.PCMVolumeTransformer):
-    def __init__(self, source: discord.AudioSource, *, data: dict, volume: float = 0.5):
-        super().__init__(source, volume)
+# Opus 直通：FFmpeg 直接输出 Opus 包，跳过 Python 侧的 PCM 音量运算与 discord.py 的逐帧 Opus 编码 (见 YTDLOpusSource)
+OPUS_PASSTHROUGH = os.getenv("MUSIC_OPUS_PASSTHROUGH", "1") != "0"
+OPUS_BITRATE = 128  # kbps，需要在 FFmpeg 中重新编码时使用
+
+
+def _search_profile_for(query: str) -> str:
+    return music_extractor.PROFILE_SEARCH if re.match(r"^(yt|sc)search\d*:", query) else music_extractor.PROFILE_SINGLE
+
+
+_resolve_semaphore: Optional[asyncio.Semaphore] = None
+
+def _get_resolve_semaphore() -> asyncio.Semaphore:
+    global _resolve_semaphore
+    if _resolve_semaphore is None: _resolve_semaphore = asyncio.Semaphore(RESOLVE_CONCURRENCY)
+    return _resolve_semaphore
+
+
+def playlist_record(entry: Dict[str, Any], *, spotify: bool = False) -> Optional[QueueEntry]:
+    """把扁平提取的播放列表条目转换为轻量队列记录；Spotify 条目以 "歌名 歌手" 作为之后在 YouTube 搜索的关键词。"""
+    if spotify:
+        title = entry.get('track') or entry.get('title'); artist = entry.get('artist') or entry.get('uploader')
+        query_for_entry = f"{title} {artist}" if title and artist else title
+        if not query_for_entry: return None
+        return QueueEntry(query_for_entry, None, entry.get('duration'), entry.get('thumbnail'), "Spotify")
+    if not (entry.get('webpage_url') or entry.get('url')): return None
+    record = QueueEntry.from_info(entry)
+    record.title = record.title or '未知标题'
+    return record
+
+
+def _opus_codec(data: Dict[str, Any]) -> Optional[str]:
+    """根据 yt-dlp 给出的 acodec 判断音频编码 ("opus" 可以直接复制音轨)；未知时返回 None。"""
+    acodec = (data.get('acodec') or '').lower()
+    if not acodec or acodec == 'none': return None
+    return 'opus' if acodec.startswith('opus') else acodec
+
+
+class _TrackInfo:
+    volume_adjustable = True  # 能否在播放中途直接改变音量
+
+    def _init_track_info(self, data: dict):
         self.data: dict = data
         self.title: Optional[str] = data.get('title')
         self.uploader: Optional[str] = data.get('uploader')
@@ -72,126 +138,134 @@ class YTDLSource(discord.PCMVolumeTransformer):
         self.duration: Optional[int] = data.get('duration')
         self.thumbnail: Optional[str] = data.get('thumbnail')
 
-    @classmethod
-    async def from_url(cls, url: str, *, loop: Optional[asyncio.AbstractEventLoop] = None, stream: bool = True, 
-                       playlist: bool = False) -> Union['YTDLSource', List[Dict[str, Any]], None]: # 移除了 search 参数
-        loop = loop or asyncio.get_event_loop()
-        
-        current_ytdl_opts = YTDL_FORMAT_OPTIONS.copy()
-        # 确保cookiefile选项在每个YTDL实例中都得到应用
-        current_ytdl_opts['cookiefile'] = COOKIE_FILE_PATH if os.path.exists(COOKIE_FILE_PATH) else None
-
-        if playlist:
-            current_ytdl_opts['noplaylist'] = False
-            current_ytdl_opts['extract_flat'] = 'discard_in_playlist' # 获取播放列表中的所有条目信息
-            current_ytdl_opts['playlistend'] = 25 # 限制一次处理的播放列表条目数量
-        else:
-            current_ytdl_opts['noplaylist'] = True
 
+class YTDLOpusSource(_TrackInfo, discord.FFmpegOpusAudio):
+    """
+    Opus 直通音源。音量由 FFmpeg 的 volume 滤镜实现，播放中途改变音量需要从当前位置重建音源
+    (GuildMusicState.apply_volume)；源本身是 Opus 且音量为 100% 时直接复制音轨，完全不重新编码。
+    """
+    volume_adjustable = False
 
-        custom_ytdl = yt_dlp.YoutubeDL(current_ytdl_opts)
-        
-        # 为避免lambda中变量捕获问题，可以这样写：
-        def ytdl_extract_sync(): # 重命名以避免与外部函数重名 (如果存在)
-            return custom_ytdl.extract_info(url, download=not stream)
-        data = await loop.run_in_executor(None, ytdl_extract_sync)
+    def __init__(self, path: str, *, data: dict, volume: float, codec: Optional[str], before_options: Optional[str]):
+        self.volume = volume
+        self.passthrough = codec == 'opus' and abs(volume - 1.0) < 0.005
+        options = FFMPEG_OPTIONS['options'] + ('' if self.passthrough else f" -af volume={volume:.3f}")
+        super().__init__(path, bitrate=OPUS_BITRATE, codec='opus' if self.passthrough else None,
+                         before_options=before_options, options=options)
+        self._init_track_info(data)
+
+
+class YTDLSource(_TrackInfo, discord.PCMVolumeTransformer):
+    def __init__(self, source: discord.AudioSource, *, data: dict, volume: float = 0.5):
+        super().__init__(source, volume)
+        self._init_track_info(data)
 
+    @classmethod
+    def from_data(cls, data: Dict[str, Any], *, volume: float = 0.5,
+                  start_at: Optional[float] = None) -> Union['YTDLSource', YTDLOpusSource]:
+        """
+        用已解析好直链的 data 创建音源 (会立即启动 FFmpeg 进程)；曲目已在本地缓存时读本地文件。
+        OPUS_PASSTHROUGH 时返回 YTDLOpusSource，否则返回 PCM 音源。start_at 为起始播放位置 (秒)。
+        """
+        cached_path = track_cache.path_for(data)
+        before_options = '' if cached_path else FFMPEG_OPTIONS['before_options'] # 本地文件不需要重连参数
+        if start_at: before_options = f"{before_options} -ss {start_at:.2f}".strip()
+        path = cached_path or data['url']
+        if OPUS_PASSTHROUGH:
+            codec = 'opus' if cached_path else _opus_codec(data)
+            return YTDLOpusSource(path, data=data, volume=volume, codec=codec, before_options=before_options or None)
+        return cls(discord.FFmpegPCMAudio(path, before_options=before_options or None, options=FFMPEG_OPTIONS['options']),
+                   data=data, volume=volume)
+
+    @staticmethod
+    async def probe_codec(data: Dict[str, Any]):
+        """yt-dlp 没有给出 acodec 时用 ffprobe 探测直链的编码并写回 data (只在预取中调用，不占用切歌时间)。"""
+        if data.get('acodec') or not data.get('url'): return
+        try: codec, _ = await discord.FFmpegOpusAudio.probe(data['url'])
+        except Exception as e: codec = None; print(f"探测音频编码失败 ({data.get('title')}): {type(e).__name__} - {e}")
+        data['acodec'] = codec or 'unknown'
+
+    @staticmethod
+    def _with_stream_url(data: Dict[str, Any]) -> Dict[str, Any]:
+        # 确保 'url' 字段存在于 data 中，这是 FFmpeg 需要的流地址
+        if 'url' not in data: # 有时，主 'url' 不在顶层，而在 'formats' 中
+            best_audio_format = None
+            for f_format in data.get('formats', []): # 遍历所有可用的格式
+                #寻找最佳的纯音频流
+                if f_format.get('vcodec') == 'none' and f_format.get('acodec') != 'none' and 'url' in f_format:
+                    if best_audio_format is None or (f_format.get('abr') or 0) > (best_audio_format.get('abr') or 0): # abr = average bitrate
+                        best_audio_format = f_format
+            if best_audio_format and 'url' in best_audio_format:
+                data['url'] = best_audio_format['url'] # 将找到的最佳音频流URL赋给顶层'url'
+                data['acodec'] = best_audio_format.get('acodec') # Opus 直通据此判断能否直接复制音轨
+            else:
+                # 如果在所有格式中都找不到合适的音频流URL
+                raise yt_dlp.utils.DownloadError(f"无法从 '{data.get('title', '未知视频')}' 提取有效的音频流URL。")
+        return data
+
+    @classmethod
+    async def extract_stream_data(cls, url: str, *, refresh: bool = False) -> Dict[str, Any]:
+        """解析单曲链接或搜索词，返回带有可播放直链 data['url'] 的信息字典。refresh=True 时跳过缓存重新提取。"""
+        data = await extractor.extract(url, _search_profile_for(url), use_cache=not refresh)
         if not data:
             # 根据 url 前缀判断是搜索还是直接链接
-            if url.startswith("scsearch:") or url.startswith("ytsearch:"): # 包括各种数量的搜索，如 scsearch1:
+            if url.startswith("scsearch") or url.startswith("ytsearch"): # 包括各种数量的搜索，如 scsearch1:
                 search_term = url.split(":", 1)[1] if ":" in url else url # 安全地获取搜索词
                 raise yt_dlp.utils.DownloadError(f"未找到与 '{search_term}' 相关的搜索结果。")
             else:
                 raise yt_dlp.utils.DownloadError(f"无法从URL '{url}' 获取信息。")
 
-        if 'entries' in data: # 这是播放列表或搜索结果的标志
-            if not data['entries']: # 空的播放列表或没有搜索结果
-                if playlist: 
-                    raise yt_dlp.utils.DownloadError(f"播放列表 '{data.get('title', url)}' 为空或无法访问。")
-                else: # 搜索没有结果
-                    search_term = url.split(":", 1)[1] if ":" in url else url
-                    raise yt_dlp.utils.DownloadError(f"未找到与 '{search_term}' 相关的搜索结果。")
-
-            if playlist: # 如果明确要求处理为播放列表 (例如 SoundCloud set/album, YouTube playlist)
-                return [
-                    {'title': entry.get('title', '未知标题'), 
-                     'webpage_url': entry.get('webpage_url', entry.get('url')), # 'url' 是备用
-                     'duration': entry.get('duration'),
-                     'thumbnail': entry.get('thumbnail'),
-                     'uploader': entry.get('uploader')} 
-                    for entry in data['entries'] if entry and (entry.get('webpage_url') or entry.get('url')) # 确保每个条目有效且有URL
-                ]
-            else: 
-                # 如果不是显式播放列表请求，但 'entries' 存在 (例如来自 scsearch1: 或 ytsearch1:)
-                # 我们只取第一个结果作为单曲
-                data = data['entries'][0]
-        
-        # 到这里，data 应该是一个单独的歌曲条目信息
-        if not stream: # 如果需要下载文件 (通常不用于音乐机器人)
-            filename = custom_ytdl.prepare_filename(data) # yt-dlp 会处理文件名
+        if 'entries' in data: # 搜索结果 (例如来自 scsearch1: 或 ytsearch1:)
+            if not data['entries']:
+                search_term = url.split(":", 1)[1] if ":" in url else url
+                raise yt_dlp.utils.DownloadError(f"未找到与 '{search_term}' 相关的搜索结果。")
+            # 我们只取第一个结果作为单曲 (拷贝一份，避免改动缓存中的条目)
+            data = dict(data['entries'][0])
+
+        return cls._with_stream_url(data)
+
+    @classmethod
+    async def from_url(cls, url: str, *, loop: Optional[asyncio.AbstractEventLoop] = None, stream: bool = True, 
+                       playlist: bool = False) -> Union['YTDLSource', List[QueueEntry], None]: # 移除了 search 参数
+        if not stream: # 如果需要下载文件 (通常不用于音乐机器人)，不走缓存
+            data, filename = await extractor.download(url)
             return cls(discord.FFmpegPCMAudio(filename, **FFMPEG_OPTIONS), data=data)
-        else: # 流式播放
-            # 确保 'url' 字段存在于 data 中，这是 FFmpeg 需要的流地址
-            if 'url' not in data: # 有时，主 'url' 不在顶层，而在 'formats' 中
-                best_audio_format = None
-                for f_format in data.get('formats', []): # 遍历所有可用的格式
-                    #寻找最佳的纯音频流
-                    if f_format.get('vcodec') == 'none' and f_format.get('acodec') != 'none' and 'url' in f_format:
-                        if best_audio_format is None or f_format.get('abr', 0) > best_audio_format.get('abr', 0): # abr = average bitrate
-                            best_audio_format = f_format
-                if best_audio_format and 'url' in best_audio_format:
-                    data['url'] = best_audio_format['url'] # 将找到的最佳音频流URL赋给顶层'url'
-                elif data.get('url'): # 如果顶层已经有一个url (可能是视频+音频)
-                    pass # 允许它，FFmpeg的-vn会尝试去除视频
-                else:
-                    # 如果在所有格式中都找不到合适的音频流URL
-                    raise yt_dlp.utils.DownloadError(f"无法从 '{data.get('title', '未知视频')}' 提取有效的音频流URL。")
-            return cls(discord.FFmpegPCMAudio(data['url'], **FFMPEG_OPTIONS), data=data)
+        if not playlist:
+            return cls.from_data(await cls.extract_stream_data(url))
+
+        # 显式播放列表请求 (例如 SoundCloud set/album, YouTube playlist)
+        data = await extractor.extract(url, music_extractor.PROFILE_PLAYLIST)
+        if not data:
+            raise yt_dlp.utils.DownloadError(f"无法从URL '{url}' 获取信息。")
+        if 'entries' not in data: # 链接实际上是单曲
+            return cls.from_data(cls._with_stream_url(data))
+        if not data['entries']:
+            raise yt_dlp.utils.DownloadError(f"播放列表 '{data.get('title', url)}' 为空或无法访问。")
+        return [record for record in (playlist_record(entry) for entry in data['entries'] if entry) if record] # 确保每个条目有效且有URL
 
     @classmethod
-    async def from_spotify(cls, url: str, *, loop: Optional[asyncio.AbstractEventLoop] = None) -> Union['YTDLSource', List[Dict[str, Any]], str, None]:
-        loop = loop or asyncio.get_event_loop()
-        
+    async def from_spotify(cls, url: str, *, loop: Optional[asyncio.AbstractEventLoop] = None) -> Union[Dict[str, Any], List[QueueEntry], str, None]:
+        """单曲返回信息字典 (不创建音源)，歌单/专辑返回队列条目列表，私有歌单返回 "private_playlist"。"""
         spotify_track_match = re.match(r"https?://open\.spotify\.com/(?:intl-\w+/)?track/(\w+)", url)
         spotify_playlist_match = re.match(r"https?://open\.spotify\.com/(?:intl-\w+/)?playlist/(\w+)", url)
         spotify_album_match = re.match(r"https?://open\.spotify\.com/(?:intl-\w+/)?album/(\w+)", url)
         search_query = None
 
-        # Ensure ytdl instance used for Spotify also respects cookie settings
-        # Create a temporary ytdl instance with current cookie settings for Spotify processing
-        spotify_ytdl_opts = YTDL_FORMAT_OPTIONS.copy()
-        spotify_ytdl_opts['cookiefile'] = COOKIE_FILE_PATH if os.path.exists(COOKIE_FILE_PATH) else None
-        current_ytdl_for_spotify = yt_dlp.YoutubeDL(spotify_ytdl_opts)
-
-
         try:
             if spotify_track_match:
-                data = await loop.run_in_executor(None, lambda: current_ytdl_for_spotify.extract_info(url, download=False))
-                if 'entries' in data: data = data['entries'][0]
-                if data.get('title') and data.get('url'): return cls(discord.FFmpegPCMAudio(data['url'], **FFMPEG_OPTIONS), data=data)
+                data = await extractor.extract(url, music_extractor.PROFILE_SINGLE)
+                if 'entries' in data: data = dict(data['entries'][0])
+                if data.get('title') and data.get('url'): return data
                 title = data.get('track') or data.get('title'); artist = data.get('artist') or data.get('uploader')
                 if title and artist: search_query = f"ytsearch:{title} {artist}"
                 elif title: search_query = f"ytsearch:{title}"
                 else: return None
             
             elif spotify_playlist_match or spotify_album_match:
-                playlist_ytdl_opts = {**YTDL_FORMAT_OPTIONS, 'noplaylist': False, 'extract_flat': 'discard_in_playlist', 'playlistend': 20}
-                playlist_ytdl_opts['cookiefile'] = COOKIE_FILE_PATH if os.path.exists(COOKIE_FILE_PATH) else None
-                custom_ytdl = yt_dlp.YoutubeDL(playlist_ytdl_opts)
-                data = await loop.run_in_executor(None, lambda: custom_ytdl.extract_info(url, download=False))
-                if 'entries' in data:
-                    processed_entries = []
-                    for entry in data['entries']:
-                        if not entry: continue
-                        entry_title = entry.get('track') or entry.get('title'); entry_artist = entry.get('artist') or entry.get('uploader')
-                        query_for_entry = f"{entry_title} {entry_artist}" if entry_title and entry_artist else entry_title
-                        if not query_for_entry: continue
-                        processed_entries.append({
-                            'title': query_for_entry, 'webpage_url': entry.get('url') or entry.get('webpage_url'), 
-                            'duration': entry.get('duration'), 'thumbnail': entry.get('thumbnail'), 'uploader': entry_artist or "Spotify"
-                        })
-                    return processed_entries
-                elif data.get('title') and data.get('url'): return cls(discord.FFmpegPCMAudio(data['url'], **FFMPEG_OPTIONS), data=data)
+                data = await extractor.extract(url, music_extractor.PROFILE_PLAYLIST)
+                if 'entries' in data: # 歌手只放进搜索关键词；uploader 必须是 "Spotify" 才会在播放前搜索 YouTube
+                    return [record for record in (playlist_record(entry, spotify=True) for entry in data['entries'] if entry) if record]
+                elif data.get('title') and data.get('url'): return data
                 return None
             else: return None
         except yt_dlp.utils.DownloadError as e:
@@ -203,20 +277,44 @@ class YTDLSource(discord.PCMVolumeTransformer):
             print(f"处理Spotify链接 '{url}' 时发生未知错误: {e}")
             return None
         
-        if search_query: return await cls.from_url(search_query, loop=loop, stream=True, search=True)
+        if search_query: return await cls.extract_stream_data(search_query)
         return None
 
 class GuildMusicState:
-    def __init__(self, bot_loop: asyncio.AbstractEventLoop):
-        self.queue: deque[Dict[str, Any]] = deque()
+    def __init__(self, bot_loop: asyncio.AbstractEventLoop, guild_id: Optional[int] = None):
+        self.queue: deque[QueueEntry] = deque()
         self.voice_client: Optional[discord.VoiceClient] = None
-        self.current_song: Optional[YTDLSource] = None
+        self.current_song: Optional[Union[YTDLSource, YTDLOpusSource]] = None
+        self.current_entry: Optional[QueueEntry] = None # current_song 对应的队列条目 (循环模式下重新入队的就是它)
+        self.guild_id: Optional[int] = guild_id
+        self._save_task: Optional[asyncio.Task] = None
+        self._save_lock = asyncio.Lock()
+        self._persist_enabled = True
         self.loop_mode: str = "none"
         self.bot_loop: asyncio.AbstractEventLoop = bot_loop
         self.now_playing_message: Optional[discord.Message] = None
         self.volume: float = 0.3
         self.leave_task: Optional[asyncio.Task] = None
         self.last_interaction_channel_id: Optional[int] = None # Store channel ID for NP messages
+        # 预取状态：_prefetch_entry 是预取针对的队列条目 (按对象身份匹配)
+        self.prefetch_task: Optional[asyncio.Task] = None
+        self._prefetch_entry: Optional[QueueEntry] = None
+        self._prefetched_data: Optional[Dict[str, Any]] = None
+        self._prefetched_source: Optional[Union[YTDLSource, YTDLOpusSource]] = None
+        self._track_started_at: Optional[float] = None
+        self._track_ended_at: Optional[float] = None
+        # 曲间间隔指标 (上一首结束 -> 下一首开始播放，毫秒)
+        self.transition_gaps_ms: deque[float] = deque(maxlen=TRANSITION_GAP_SAMPLES)
+        self.prefetch_hits = 0
+        self.prefetch_misses = 0
+        self.lookahead_task: Optional[asyncio.Task] = None
+        # 播放器任务与事件队列；_track_token 用来识别已被替换的曲目发来的结束事件
+        self.events: asyncio.Queue = asyncio.Queue()
+        self.player_task: Optional[asyncio.Task] = None
+        self._track_token = 0
+        self._skip_requested = False
+        self._entry_replayed = False
+        self._force_refresh = False
 
     def _get_guild_name_for_debug(self) -> str:
         return self.voice_client.guild.name if self.voice_client and self.voice_client.guild else "未知服务器"
@@ -234,6 +332,7 @@ class GuildMusicState:
             guild_name = self._get_guild_name_for_debug()
             last_text_channel_id = self.last_interaction_channel_id
             
+            self.cancel_prefetch(); self.post_event(EVENT_STOP); await self.forget_saved_queue()
             await self.voice_client.disconnect()
             self.voice_client = None # Critical to set this to None
             if self.now_playing_message:
@@ -250,124 +349,365 @@ class GuildMusicState:
                         try: await last_text_channel.send("🎵 播放结束且频道内无人，我先走啦！下次见~", delete_after=30)
                         except: pass # Ignore send errors
 
-    def play_next_song_sync(self, error: Optional[Exception] = None):
+    # ---------------------------------------------------------------
+    # 预取
+    # ---------------------------------------------------------------
+    def _next_entry_to_play(self) -> Optional[QueueEntry]:
+        """当前歌曲结束后将要播放的条目 (与 _select_next_entry 的选择逻辑一致)。"""
+        if self.current_entry and self.loop_mode == "song": return self.current_entry
+        if self.queue: return self.queue[0]
+        if self.current_entry and self.loop_mode == "queue": return self.current_entry
+        return None
+
+    async def _resolve_entry_data(self, entry: QueueEntry, *, refresh: bool = False) -> Dict[str, Any]:
+        if not isinstance(entry, QueueEntry) or not (entry.url or entry.title):
+            raise ValueError(f"队列中的歌曲数据格式无效: {entry}")
+        url_to_play = entry.url
+        title_for_search = entry.title
+        if entry.is_spotify_search:
+            if not title_for_search: raise ValueError("Spotify条目缺少标题无法搜索YouTube。")
+            print(f"[{self._get_guild_name_for_debug()}] Spotify条目 '{title_for_search}' 需要二次搜索YouTube。")
+            return await YTDLSource.extract_stream_data(f"ytsearch:{title_for_search}", refresh=refresh)
+        if url_to_play:
+            return await YTDLSource.extract_stream_data(url_to_play, refresh=refresh)
+        if title_for_search: # Fallback to search if no proper URL but title exists (e.g. from a malformed Spotify entry)
+            print(f"[{self._get_guild_name_for_debug()}] 条目缺少URL但有标题'{title_for_search}', 尝试YouTube搜索。")
+            return await YTDLSource.extract_stream_data(f"ytsearch:{title_for_search}", refresh=refresh)
+        raise ValueError(f"队列中的歌曲数据格式无效: {entry}")
+
+    @staticmethod
+    def _stream_expiring(data: Dict[str, Any]) -> bool:
+        if track_cache.is_cached(data): return False # 从本地文件播放，与直链有效期无关
+        expiry = music_extractor.stream_url_expiry(data)
+        return expiry is not None and expiry - time.time() < STREAM_REFRESH_MARGIN
+
+    def _remaining_seconds(self) -> Optional[float]:
+        if not self.current_song or not self.current_song.duration or self._track_started_at is None: return None
+        return self.current_song.duration - (time.monotonic() - self._track_started_at)
+
+    def schedule_prefetch(self):
+        """在播放开始、队列头部或循环模式变化后调用；目标条目未变时不会重复预取。"""
+        entry = self._next_entry_to_play()
+        if entry is None:
+            self.cancel_prefetch(); return
+        if entry is self._prefetch_entry and (self._prefetched_source or self._prefetched_data or
+                                              (self.prefetch_task and not self.prefetch_task.done())):
+            return
+        self.cancel_prefetch()
+        self._prefetch_entry = entry
+        self.prefetch_task = self.bot_loop.create_task(self._prefetch(entry))
+
+    async def _prefetch(self, entry: QueueEntry):
+        guild_name = self._get_guild_name_for_debug()
+        try:
+            data = await self._resolve_entry_data(entry)
+            if OPUS_PASSTHROUGH: await YTDLSource.probe_codec(data)
+            self._prefetched_data = data
+            remaining = self._remaining_seconds()
+            if remaining is None: return # 直播或时长未知：只预解析直链，FFmpeg 在切歌时再启动
+            if remaining > PREFETCH_AUDIO_LEAD: await asyncio.sleep(remaining - PREFETCH_AUDIO_LEAD)
+            if self._stream_expiring(data):
+                print(f"[{guild_name}] 预取的直链即将过期，重新解析: {data.get('title')}")
+                data = await self._resolve_entry_data(entry, refresh=True)
+                self._prefetched_data = data
+            if self._prefetch_entry is entry:
+                self._prefetched_source = YTDLSource.from_data(data, volume=self.volume)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            # 预取失败不影响播放，切歌时会按原流程重新解析并报告错误
+            print(f"[{guild_name}] 预取下一首失败: {type(e).__name__} - {str(e)[:200]}")
+            self._prefetched_data = None
+
+    def _take_prefetched(self, entry: QueueEntry) -> Optional[Union[YTDLSource, YTDLOpusSource]]:
+        """如果预取的正是 entry，交出已就绪的音源 (必要时用预解析的直链现场创建)，否则返回 None。"""
+        if entry is not self._prefetch_entry:
+            self.cancel_prefetch(); return None
+        source, data = self._prefetched_source, self._prefetched_data
+        self._prefetched_source = None
+        self.cancel_prefetch()
+        # Opus 音源的音量在创建时就已固定，预取之后音量被修改过的要重建
+        if source is not None and not self._stream_expiring(source.data) and \
+                (source.volume_adjustable or source.volume == self.volume): return source
+        if source is not None: source.cleanup()
+        if data is not None and not self._stream_expiring(data): return YTDLSource.from_data(data, volume=self.volume)
+        return None
+
+    def schedule_lookahead(self):
+        """并发解析队列前 LOOKAHEAD_RESOLVE_COUNT 个尚未解析的条目，把解析成本分摊到播放过程中。"""
+        if self.lookahead_task and not self.lookahead_task.done(): return
+        targets = [e for e in list(self.queue)[:LOOKAHEAD_RESOLVE_COUNT]
+                   if e.resolve_state == RESOLVE_PENDING]
+        if targets: self.lookahead_task = self.bot_loop.create_task(self._resolve_upcoming(targets))
+
+    async def _resolve_upcoming(self, targets: List[QueueEntry]):
+        await asyncio.gather(*(self._resolve_record(e) for e in targets))
+        self.lookahead_task = None
+        self.schedule_lookahead() # 解析期间队列可能已经前进
+
+    async def _resolve_record(self, entry: QueueEntry):
+        try:
+            async with _get_resolve_semaphore():
+                data = await self._resolve_entry_data(entry)
+        except Exception as e:
+            entry.resolve_state = RESOLVE_FAILED # 播放到它时会重试一次并向用户报告错误
+            print(f"[{self._get_guild_name_for_debug()}] 预解析 '{entry.title}' 失败: {type(e).__name__} - {str(e)[:150]}")
+            return
+        # 用解析结果补全记录；Spotify 条目换成匹配到的 YouTube 链接，播放时不再重复搜索 (直链已在提取缓存中)
+        resolved = QueueEntry.from_info(data)
+        entry.title = resolved.title or entry.title; entry.url = resolved.url or entry.url
+        entry.duration = resolved.duration or entry.duration; entry.thumbnail = resolved.thumbnail or entry.thumbnail
+        entry.uploader = resolved.uploader or entry.uploader; entry.resolve_state = RESOLVE_DONE
+        self.mark_queue_dirty()
+
+    def cancel_prefetch(self):
+        if self.lookahead_task and not self.lookahead_task.done(): self.lookahead_task.cancel()
+        self.lookahead_task = None
+        if self.prefetch_task and not self.prefetch_task.done(): self.prefetch_task.cancel()
+        self.prefetch_task = None
+        if self._prefetched_source is not None:
+            self._prefetched_source.cleanup() # 结束未使用的 FFmpeg 进程
+        self._prefetched_source = None; self._prefetched_data = None; self._prefetch_entry = None
+
+    def transition_stats(self) -> Dict[str, Any]:
+        gaps = sorted(self.transition_gaps_ms)
+        return {
+            "transitions": len(gaps),
+            "avg_gap_ms": round(sum(gaps) / len(gaps), 1) if gaps else None,
+            "p95_gap_ms": round(gaps[min(len(gaps) - 1, int(len(gaps) * 0.95))], 1) if gaps else None,
+            "prefetch_hits": self.prefetch_hits,
+            "prefetch_misses": self.prefetch_misses,
+        }
+
+    # ---------------------------------------------------------------
+    # 队列持久化
+    # ---------------------------------------------------------------
+    def mark_queue_dirty(self):
+        """队列、循环模式或音量变化后调用；QUEUE_SAVE_DELAY 秒内的多次修改合并为一次写入。"""
+        if self.guild_id is None or not self._persist_enabled: return
+        if self._save_task and not self._save_task.done(): return
+        self._save_task = self.bot_loop.create_task(self._save_queue_later())
+
+    async def _save_queue_later(self):
+        await asyncio.sleep(QUEUE_SAVE_DELAY)
+        await self.save_queue_now()
+
+    async def save_queue_now(self):
+        if self.guild_id is None: return
+        # 在事件循环中生成快照，数据库写入放到线程池
+        rows = entries_to_rows(([self.current_entry] if self.current_entry else []) + list(self.queue))
+        voice_channel_id = self.voice_client.channel.id if self.voice_client and self.voice_client.channel else None
+        async with self._save_lock:
+            if not self._persist_enabled: return
+            await self.bot_loop.run_in_executor(None, database.db_save_music_queue, self.guild_id, voice_channel_id,
+                                                self.last_interaction_channel_id, self.loop_mode, self.volume, rows)
+
+    async def forget_saved_queue(self):
+        """用户主动停止播放时调用：不再保存，并删除数据库中的队列快照。"""
+        self._persist_enabled = False
+        if self._save_task and not self._save_task.done(): self._save_task.cancel()
+        self._save_task = None
+        if self.guild_id is None: return
+        async with self._save_lock:
+            await self.bot_loop.run_in_executor(None, database.db_clear_music_queue, self.guild_id)
+
+    async def restore_saved_queue(self) -> int:
+        """队列为空时从数据库恢复上次未播放完的队列 (包括当时正在播放的歌曲)，返回恢复的条目数。"""
+        if self.guild_id is None or self.queue or self.current_entry: return 0
+        saved = await self.bot_loop.run_in_executor(None, database.db_load_music_queue, self.guild_id)
+        if not saved or not saved["entries"]: return 0
+        self.queue.extend(entries_from_rows(saved["entries"]))
+        self.loop_mode = saved["loop_mode"] or "none"; self.volume = saved["volume"]
+        if not self.last_interaction_channel_id: self.last_interaction_channel_id = saved["text_channel_id"]
+        print(f"[{self._get_guild_name_for_debug()}] 已从数据库恢复 {len(saved['entries'])} 首歌曲的播放队列。")
+        return len(saved["entries"])
+
+    # ---------------------------------------------------------------
+    # 播放器任务 (事件驱动)
+    # ---------------------------------------------------------------
+    def post_event(self, kind: str, payload: Any = None):
+        """线程安全地投递播放器事件；可以在 discord.py 的音频线程 (after 回调) 中调用，立即返回。"""
+        try: running_loop = asyncio.get_running_loop()
+        except RuntimeError: running_loop = None
+        if running_loop is self.bot_loop: self._post_event_local(kind, payload)
+        else: self.bot_loop.call_soon_threadsafe(self._post_event_local, kind, payload)
+
+    def _post_event_local(self, kind: str, payload: Any):
+        running = self.player_task is not None and not self.player_task.done()
+        if kind == EVENT_STOP: self._track_token += 1 # 停止后旧曲目的结束事件一律作废
+        if not running:
+            if kind in (EVENT_STOP, EVENT_TRACK_ENDED): return # 没有运行中的播放器，无需处理
+            self.player_task = self.bot_loop.create_task(self._player_loop())
+        self.events.put_nowait((kind, payload))
+
+    def request_playback(self, interaction_for_reply: Optional[discord.Interaction] = None):
+        """有新歌入队时调用；播放器空闲时会开始播放队首。"""
+        self.post_event(EVENT_ENQUEUE, interaction_for_reply)
+
+    def _on_track_end(self, token: int, error: Optional[Exception]):
+        # 在音频线程中运行：只记录时间并投递事件，不做任何阻塞操作
+        self._track_ended_at = time.monotonic()
+        self.post_event(EVENT_TRACK_ENDED, (token, error))
+
+    def _is_idle(self) -> bool:
+        return self.current_song is None and not (self.voice_client and (self.voice_client.is_playing() or self.voice_client.is_paused()))
+
+    async def _player_loop(self):
         guild_name = self._get_guild_name_for_debug()
-        if error: print(f'[{guild_name}] 播放器错误: {error}')
-        if self.leave_task: self.leave_task.cancel(); self.leave_task = None
-        fut = asyncio.run_coroutine_threadsafe(self.play_next_song_async(), self.bot_loop)
-        try: fut.result(timeout=10)
-        except asyncio.TimeoutError: print(f"[{guild_name}] play_next_song_sync: fut.result timed out.")
-        except Exception as e: print(f'[{guild_name}] 安排下一首歌时出错: {e}')
-
-    async def play_next_song_async(self, interaction_for_reply: Optional[discord.Interaction] = None):
+        while True:
+            kind, payload = await self.events.get()
+            try:
+                if kind == EVENT_STOP:
+                    self.cancel_prefetch(); return
+                if kind == EVENT_TRACK_ENDED:
+                    token, error = payload
+                    if token != self._track_token: continue # 已被替换的旧曲目发来的迟到事件
+                    if error: print(f'[{guild_name}] 播放器错误: {error}')
+                    if self.leave_task: self.leave_task.cancel(); self.leave_task = None
+                    await self._advance(None, playback_error=error)
+                elif kind == EVENT_SKIP:
+                    if self.voice_client and (self.voice_client.is_playing() or self.voice_client.is_paused()):
+                        self._skip_requested = True; self.voice_client.stop() # after 回调随后会投递 TRACK_ENDED
+                elif kind == EVENT_ENQUEUE:
+                    if self._is_idle(): await self._advance(payload)
+            except Exception as e: # 播放器任务不能因为单个事件出错而退出
+                print(f"[{guild_name}] 处理播放器事件 {kind} 时出错: {type(e).__name__} - {e}")
+                import traceback; traceback.print_exc()
+
+    def _select_next_entry(self, playback_error: Optional[Exception]) -> Optional[QueueEntry]:
+        skip_requested, self._skip_requested = self._skip_requested, False
+        finished = self.current_entry if self.current_song else None
+        self.current_song = None
+        if finished is None: return self.queue.popleft() if self.queue else None
+        # 刚开始就因播放错误结束 (多为直链失效)：强制重新解析后重播一次
+        if playback_error and not skip_requested and not self._entry_replayed and \
+                time.monotonic() - (self._track_started_at or 0) < REPLAY_ON_ERROR_WINDOW:
+            self._entry_replayed = True; self._force_refresh = True
+            return finished
+        if self.loop_mode == "song" and not skip_requested: return finished
+        if self.loop_mode == "queue": self.queue.append(finished)
+        return self.queue.popleft() if self.queue else None
+
+    async def _source_for(self, entry: QueueEntry) -> Union[YTDLSource, YTDLOpusSource]:
+        if self._force_refresh:
+            self._force_refresh = False; self.cancel_prefetch()
+            return YTDLSource.from_data(await asyncio.wait_for(self._resolve_entry_data(entry, refresh=True), RESOLVE_TIMEOUT), volume=self.volume)
+        source = self._take_prefetched(entry)
+        if source is not None:
+            self.prefetch_hits += 1; return source
+        if self._track_ended_at is not None: self.prefetch_misses += 1 # 首次播放不计入
+        try:
+            return YTDLSource.from_data(await asyncio.wait_for(self._resolve_entry_data(entry), RESOLVE_TIMEOUT), volume=self.volume)
+        except yt_dlp.utils.DownloadError:
+            # 重试预算：缓存中的信息可能已失效，跳过缓存再试一次
+            return YTDLSource.from_data(await asyncio.wait_for(self._resolve_entry_data(entry, refresh=True), RESOLVE_TIMEOUT), volume=self.volume)
+
+    async def _advance(self, interaction_for_reply: Optional[discord.Interaction] = None, playback_error: Optional[Exception] = None):
+        """选出下一首并开始播放；解析失败的条目依次跳过 (迭代而非递归)，连续失败超过预算时停止。"""
         guild_name = self._get_guild_name_for_debug()
         if self.voice_client is None or not self.voice_client.is_connected():
-            self.current_song = None; self.queue.clear(); return
+            self.current_song = None; self.queue.clear(); self.cancel_prefetch(); return
 
         if interaction_for_reply and interaction_for_reply.channel: # Update last channel from interaction
              self.last_interaction_channel_id = interaction_for_reply.channel.id
 
-        next_song_data_to_play: Optional[Dict[str, Any]] = None
-        if self.loop_mode == "song" and self.current_song: next_song_data_to_play = self.current_song.data
-        elif self.loop_mode == "queue" and self.current_song: self.queue.append(self.current_song.data); self.current_song = None
-        else: self.current_song = None
-
-        if self.current_song is None:
-            if not self.queue:
-                self.current_song = None
-                if self.now_playing_message:
-                    try: await self.now_playing_message.edit(content="✅ 队列已播放完毕。", embed=None, view=None)
-                    except: pass # Ignore errors
-                    self.now_playing_message = None
-                if self.voice_client and not any(m for m in self.voice_client.channel.members if not m.bot): self._schedule_leave()
-                else: print(f"[{guild_name}] 队列播放完毕，但频道内尚有其他成员。")
+        previous_entry = self.current_entry
+        entry = self._select_next_entry(playback_error)
+        if entry is not previous_entry: self._entry_replayed = False
+        failures = 0
+        while entry is not None:
+            self.current_entry = entry
+            try:
+                self.current_song = await self._source_for(entry)
+                if not self.current_song.title: raise ValueError("未能成功创建YTDLSource对象或对象缺少标题。")
+                if self.voice_client is None or not self.voice_client.is_connected(): # 解析期间已断开
+                    self.current_song.cleanup(); self.current_song = None; return
+                self._start_playback()
+                await self._send_now_playing(interaction_for_reply)
                 return
-            else: next_song_data_to_play = self.queue.popleft()
-        
-        if next_song_data_to_play is None:
-            print(f"[{guild_name}] 错误：next_song_data_to_play 为空，无法播放。")
-            if self.queue: await self.play_next_song_async(interaction_for_reply); return
-        
-        original_interaction_channel_id = self.last_interaction_channel_id # Use the stored channel ID
-
-        try:
-            if isinstance(next_song_data_to_play, YTDLSource): self.current_song = next_song_data_to_play # Should not happen often
-            elif isinstance(next_song_data_to_play, dict) and ('webpage_url' in next_song_data_to_play or 'title' in next_song_data_to_play):
-                url_to_play = next_song_data_to_play.get('webpage_url')
-                title_for_search = next_song_data_to_play.get('title')
-                
-                if next_song_data_to_play.get('uploader') == "Spotify" and (not url_to_play or not url_to_play.startswith(('http://', 'https://'))):
-                    if not title_for_search: raise ValueError("Spotify条目缺少标题无法搜索YouTube。")
-                    print(f"[{guild_name}] Spotify条目 '{title_for_search}' 需要二次搜索YouTube。")
-                    self.current_song = await YTDLSource.from_url(f"ytsearch:{title_for_search}", loop=self.bot_loop, stream=True, search=True)
-                elif url_to_play: 
-                    self.current_song = await YTDLSource.from_url(url_to_play, loop=self.bot_loop, stream=True)
-                elif title_for_search: # Fallback to search if no proper URL but title exists (e.g. from a malformed Spotify entry)
-                    print(f"[{guild_name}] 条目缺少URL但有标题'{title_for_search}', 尝试YouTube搜索。")
-                    self.current_song = await YTDLSource.from_url(f"ytsearch:{title_for_search}", loop=self.bot_loop, stream=True, search=True)
-                else:
-                    raise ValueError(f"队列中的歌曲数据格式无效: {next_song_data_to_play}")
-            else:
-                raise ValueError(f"队列中的歌曲数据格式无效: {next_song_data_to_play}")
-            
-            if not self.current_song or not self.current_song.title: raise ValueError("未能成功创建YTDLSource对象或对象缺少标题。")
-
-            self.current_song.volume = self.volume
-            self.voice_client.play(self.current_song, after=lambda e: self.play_next_song_sync(e))
-            print(f"[{guild_name}] 正在播放: {self.current_song.title}")
-
-            target_text_channel: Optional[discord.TextChannel] = None
-            if interaction_for_reply and interaction_for_reply.channel: target_text_channel = interaction_for_reply.channel
-            elif original_interaction_channel_id and self.bot_loop:
-                 bot_instance = getattr(self.bot_loop, '_bot_instance_for_music_cog', None)
-                 if bot_instance: target_text_channel = bot_instance.get_channel(original_interaction_channel_id)
-            
-            if target_text_channel and isinstance(target_text_channel, discord.TextChannel):
-                embed = self.create_now_playing_embed(); view = self.create_music_controls_view()
-                if self.now_playing_message:
-                    try: await self.now_playing_message.edit(embed=embed, view=view)
-                    except: self.now_playing_message = await target_text_channel.send(embed=embed, view=view) # Fallback to send new
-                else:
-                    if interaction_for_reply and not interaction_for_reply.response.is_done(): # Should be rare
-                        await interaction_for_reply.response.send_message(embed=embed, view=view); self.now_playing_message = await interaction_for_reply.original_response()
-                    elif interaction_for_reply: self.now_playing_message = await interaction_for_reply.followup.send(embed=embed, view=view, wait=True)
-                    else: self.now_playing_message = await target_text_channel.send(embed=embed, view=view)
-        
-        except (yt_dlp.utils.DownloadError, ValueError) as e_play:
-            song_title_debug = getattr(self.current_song, 'title', None) or (next_song_data_to_play.get('title', '未知歌曲') if isinstance(next_song_data_to_play, dict) else "未知歌曲")
-            error_type = "下载" if isinstance(e_play, yt_dlp.utils.DownloadError) else "值"
-            error_message = f"❌ 播放时发生{error_type}错误 ({song_title_debug}): {str(e_play)[:300]}"
-            print(f"[{guild_name}] {error_message}")
-            
-            channel_to_reply_id = (interaction_for_reply.channel.id if interaction_for_reply and interaction_for_reply.channel 
-                                   else original_interaction_channel_id)
-            if channel_to_reply_id and self.bot_loop:
-                bot_instance = getattr(self.bot_loop, '_bot_instance_for_music_cog', None)
-                if bot_instance:
-                    channel_to_reply_obj = bot_instance.get_channel(channel_to_reply_id)
-                    if channel_to_reply_obj and isinstance(channel_to_reply_obj, discord.TextChannel):
-                        try: await channel_to_reply_obj.send(error_message, delete_after=20)
-                        except Exception as send_err: print(f"[{guild_name}] 发送播放错误消息时出错: {send_err}")
-            
-            if self.queue: await self.play_next_song_async(None) # Try next song, pass None for interaction
-            else: self._schedule_leave()
-        except Exception as e_generic: # Catch-all for other unexpected errors
-            song_title_debug = getattr(self.current_song, 'title', None) or (next_song_data_to_play.get('title', '未知歌曲') if isinstance(next_song_data_to_play, dict) else "未知歌曲")
-            error_message = f"❌ 播放时发生未知错误 ({song_title_debug}): {type(e_generic).__name__} - {str(e_generic)[:200]}"
+            except (yt_dlp.utils.DownloadError, ValueError, asyncio.TimeoutError) as e_play:
+                error_type = "下载" if isinstance(e_play, yt_dlp.utils.DownloadError) else "超时" if isinstance(e_play, asyncio.TimeoutError) else "值"
+                error_message = f"❌ 播放时发生{error_type}错误 ({entry.title or '未知歌曲'}): {str(e_play)[:300]}"
+            except Exception as e_generic: # Catch-all for other unexpected errors
+                error_message = f"❌ 播放时发生未知错误 ({entry.title or '未知歌曲'}): {type(e_generic).__name__} - {str(e_generic)[:200]}"
+                import traceback; traceback.print_exc()
             print(f"[{guild_name}] {error_message}")
-            import traceback; traceback.print_exc()
-            channel_to_reply_id = (interaction_for_reply.channel.id if interaction_for_reply and interaction_for_reply.channel 
-                                   else original_interaction_channel_id)
-            if channel_to_reply_id and self.bot_loop:
-                bot_instance = getattr(self.bot_loop, '_bot_instance_for_music_cog', None)
-                if bot_instance:
-                    channel_to_reply_obj = bot_instance.get_channel(channel_to_reply_id)
-                    if channel_to_reply_obj and isinstance(channel_to_reply_obj, discord.TextChannel):
-                        try: await channel_to_reply_obj.send(error_message, delete_after=20)
-                        except Exception as send_err: print(f"[{guild_name}] 发送通用播放错误消息时出错: {send_err}")
+            if self.current_song: self.current_song.cleanup()
+            self.current_song = None
+            await self._send_to_text_channel(error_message, interaction_for_reply)
+            interaction_for_reply = None
+            failures += 1
+            if failures >= MAX_CONSECUTIVE_FAILURES:
+                await self._send_to_text_channel(f"⚠️ 连续 {failures} 首歌曲播放失败，已暂停播放。使用 /music play 继续。")
+                self.current_entry = None; self.mark_queue_dirty(); return
+            entry = self.queue.popleft() if self.queue else None
+            self._entry_replayed = False
+
+        # 队列已播放完毕
+        self.current_song = None; self.current_entry = None; self.cancel_prefetch(); self.mark_queue_dirty()
+        if self.now_playing_message:
+            try: await self.now_playing_message.edit(content="✅ 队列已播放完毕。", embed=None, view=None)
+            except: pass # Ignore errors
+            self.now_playing_message = None
+        if self.voice_client and not any(m for m in self.voice_client.channel.members if not m.bot): self._schedule_leave()
+        else: print(f"[{guild_name}] 队列播放完毕，但频道内尚有其他成员。")
+
+    def _start_playback(self):
+        guild_name = self._get_guild_name_for_debug()
+        self._track_token += 1
+        if self.current_song.volume_adjustable: self.current_song.volume = self.volume
+        self.voice_client.play(self.current_song, after=lambda e, token=self._track_token: self._on_track_end(token, e))
+        self._track_started_at = time.monotonic()
+        if self._track_ended_at is not None:
+            gap_ms = (self._track_started_at - self._track_ended_at) * 1000
+            self.transition_gaps_ms.append(gap_ms); self._track_ended_at = None
+            print(f"[{guild_name}] 正在播放: {self.current_song.title} (曲间间隔 {gap_ms:.0f}ms)")
+        else: print(f"[{guild_name}] 正在播放: {self.current_song.title}")
+        track_cache.note_play(self.current_song.data, looping=self.loop_mode == "song")
+        self.schedule_prefetch(); self.schedule_lookahead(); self.mark_queue_dirty()
+
+    def apply_volume(self) -> bool:
+        """把 self.volume 应用到正在播放的歌曲；Opus 音源从当前位置重建 (短暂停顿)。返回是否已生效。"""
+        song = self.current_song
+        if not song or not self.voice_client or not (self.voice_client.is_playing() or self.voice_client.is_paused()): return False
+        if song.volume_adjustable:
+            song.volume = self.volume; return True
+        if song.volume == self.volume: return True
+        if not song.duration or self._track_started_at is None: return False # 直播无法定位，从下一首开始生效
+        position = time.monotonic() - self._track_started_at
+        try: new_song = YTDLSource.from_data(song.data, volume=self.volume, start_at=position)
+        except Exception as e:
+            print(f"[{self._get_guild_name_for_debug()}] 以新音量重建音源失败: {type(e).__name__} - {e}"); return False
+        self.voice_client.source = new_song # 替换正在播放的音源，after 回调与曲目令牌保持不变
+        self.current_song = new_song; song.cleanup()
+        return True
 
-            if self.queue: await self.play_next_song_async(None)
-            else: self._schedule_leave()
+    def _resolve_text_channel(self, interaction_for_reply: Optional[discord.Interaction] = None) -> Optional[discord.TextChannel]:
+        if interaction_for_reply and isinstance(interaction_for_reply.channel, discord.TextChannel): return interaction_for_reply.channel
+        bot_instance = getattr(self.bot_loop, '_bot_instance_for_music_cog', None)
+        if self.last_interaction_channel_id and bot_instance:
+            channel = bot_instance.get_channel(self.last_interaction_channel_id)
+            if isinstance(channel, discord.TextChannel): return channel
+        return None
+
+    async def _send_to_text_channel(self, content: str, interaction_for_reply: Optional[discord.Interaction] = None):
+        channel = self._resolve_text_channel(interaction_for_reply)
+        if channel:
+            try: await channel.send(content, delete_after=20)
+            except Exception as send_err: print(f"[{self._get_guild_name_for_debug()}] 发送播放错误消息时出错: {send_err}")
+
+    async def _send_now_playing(self, interaction_for_reply: Optional[discord.Interaction] = None):
+        target_text_channel = self._resolve_text_channel(interaction_for_reply)
+        if not target_text_channel: return
+        embed = self.create_now_playing_embed(); view = self.create_music_controls_view()
+        if self.now_playing_message:
+            try: await self.now_playing_message.edit(embed=embed, view=view)
+            except: self.now_playing_message = await target_text_channel.send(embed=embed, view=view) # Fallback to send new
+        else:
+            if interaction_for_reply and not interaction_for_reply.response.is_done(): # Should be rare
+                await interaction_for_reply.response.send_message(embed=embed, view=view); self.now_playing_message = await interaction_for_reply.original_response()
+            elif interaction_for_reply: self.now_playing_message = await interaction_for_reply.followup.send(embed=embed, view=view, wait=True)
+            else: self.now_playing_message = await target_text_channel.send(embed=embed, view=view)
 
     def create_now_playing_embed(self) -> discord.Embed:
         if not self.current_song: return discord.Embed(title="当前没有播放歌曲", color=discord.Color.greyple())
@@ -380,7 +720,7 @@ class GuildMusicState:
         embed.add_field(name="循环模式", value=self.loop_mode.capitalize(), inline=True)
         embed.add_field(name="音量", value=f"{int(self.volume * 100)}%", inline=True)
         if self.queue:
-            next_up_data = self.queue[0]; next_up_title = next_up_data.get('title', '未知标题') if isinstance(next_up_data, dict) else getattr(next_up_data, 'title', '未知标题')
+            next_up_title = self.queue[0].title or '未知标题'
             if len(next_up_title) > 70: next_up_title = next_up_title[:67] + "..."
             embed.add_field(name="下一首", value=next_up_title, inline=False)
         else: embed.add_field(name="下一首", value="队列已空", inline=False)
@@ -396,7 +736,7 @@ class GuildMusicState:
             state = MusicCog._guild_states_ref.get(interaction.guild_id) # Get state using static ref
             if not state or not interaction.user.voice or not state.voice_client or interaction.user.voice.channel != state.voice_client.channel:
                 await interaction.response.send_message("🚫 你需要和机器人在同一个语音频道才能控制播放。", ephemeral=True, delete_after=10); return
-            if state.voice_client and state.voice_client.is_playing(): state.voice_client.stop(); await interaction.response.send_message("⏭️ 已跳过当前歌曲。", ephemeral=True, delete_after=5)
+            if state.voice_client and state.voice_client.is_playing(): state.post_event(EVENT_SKIP); await interaction.response.send_message("⏭️ 已跳过当前歌曲。", ephemeral=True, delete_after=5)
             else: await interaction.response.send_message("当前没有歌曲可以跳过。", ephemeral=True, delete_after=5)
         skip_button.callback = skip_callback; view.add_item(skip_button)
 
@@ -405,7 +745,8 @@ class GuildMusicState:
             state = MusicCog._guild_states_ref.get(interaction.guild_id)
             if not state or not interaction.user.voice or not state.voice_client or interaction.user.voice.channel != state.voice_client.channel:
                 await interaction.response.send_message("🚫 你需要和机器人在同一个语音频道才能控制播放。", ephemeral=True, delete_after=10); return
-            state.queue.clear(); state.current_song = None; state.loop_mode = "none"
+            state.queue.clear(); state.current_song = None; state.current_entry = None; state.loop_mode = "none"; state.cancel_prefetch(); state.post_event(EVENT_STOP)
+            await state.forget_saved_queue()
             if state.voice_client: state.voice_client.stop(); await state.voice_client.disconnect(); state.voice_client = None
             if state.now_playing_message: 
                 try: await state.now_playing_message.delete()
@@ -423,6 +764,7 @@ class GuildMusicState:
             if state.loop_mode == "none": state.loop_mode = "song"
             elif state.loop_mode == "song": state.loop_mode = "queue"
             else: state.loop_mode = "none" # Cycle back to "none"
+            state.schedule_prefetch(); state.mark_queue_dirty()
             
             for item in view.children:
                 if isinstance(item, ui.Button) and item.custom_id == f"music_loop_{guild_id_for_custom_id}": 
@@ -443,10 +785,45 @@ class MusicCog(commands.Cog, name="音乐播放"):
         self.bot = bot
         bot.loop._bot_instance_for_music_cog = bot 
         MusicCog._guild_states_ref = {}
+        self._resume_task: Optional[asyncio.Task] = None
+
+    async def cog_load(self):
+        self._resume_task = self.bot.loop.create_task(self._resume_saved_queues())
+
+    async def cog_unload(self):
+        if self._resume_task: self._resume_task.cancel()
+        # 卸载前立即写入所有服务器的队列，下次加载时可以恢复
+        for state in list(MusicCog._guild_states_ref.values()):
+            if state._save_task and not state._save_task.done(): state._save_task.cancel()
+            if state._persist_enabled: await state.save_queue_now()
+            state.cancel_prefetch(); state.post_event(EVENT_STOP)
+
+    async def _resume_saved_queues(self):
+        """机器人启动后，回到保存了队列且仍有成员在的语音频道继续播放；其余队列在下次 /music join 或 /play 时恢复。"""
+        await self.bot.wait_until_ready()
+        await self.bot.loop.run_in_executor(None, database.initialize_database) # 经济系统关闭时表可能尚未创建
+        saved_queues = await self.bot.loop.run_in_executor(None, database.db_get_saved_music_queues)
+        for saved in saved_queues:
+            guild = self.bot.get_guild(saved["guild_id"])
+            channel = guild.get_channel(saved["voice_channel_id"]) if guild and saved["voice_channel_id"] else None
+            if not isinstance(channel, (discord.VoiceChannel, discord.StageChannel)) or not any(not m.bot for m in channel.members): continue
+            if guild.voice_client: continue
+            state = self.get_guild_state(guild.id)
+            try:
+                state.voice_client = await channel.connect(timeout=10.0, self_deaf=True)
+            except (discord.ClientException, asyncio.TimeoutError) as e:
+                print(f"[{guild.name}] 恢复播放队列时无法连接语音频道: {e}"); continue
+            restored = await state.restore_saved_queue()
+            if not restored: continue
+            text_channel = guild.get_channel(state.last_interaction_channel_id) if state.last_interaction_channel_id else None
+            if isinstance(text_channel, discord.TextChannel):
+                try: await text_channel.send(f"♻️ 机器人已重新连接，继续播放上次的队列 (共 {restored} 首)。", delete_after=60)
+                except discord.HTTPException: pass
+            state.request_playback()
 
     def get_guild_state(self, guild_id: int) -> GuildMusicState:
         if guild_id not in MusicCog._guild_states_ref:
-            MusicCog._guild_states_ref[guild_id] = GuildMusicState(self.bot.loop)
+            MusicCog._guild_states_ref[guild_id] = GuildMusicState(self.bot.loop, guild_id)
         return MusicCog._guild_states_ref[guild_id]
 
     async def ensure_voice(self, interaction: discord.Interaction, state: GuildMusicState) -> bool:
@@ -458,6 +835,8 @@ class MusicCog(commands.Cog, name="音乐播放"):
             try: state.voice_client = await user_vc.connect(timeout=10.0, self_deaf=True); state.last_interaction_channel_id = interaction.channel.id
             except discord.ClientException: await interaction.followup.send(" 机器人似乎已在其他语音频道，或无法连接。", ephemeral=True); return False
             except asyncio.TimeoutError: await interaction.followup.send(" 连接到语音频道超时。", ephemeral=True); return False
+            restored = await state.restore_saved_queue() # 重启或被断开后重新连接时，接着上次的队列
+            if restored: await interaction.followup.send(f"♻️ 已恢复上次未播放完的 **{restored}** 首歌曲。", ephemeral=True)
         elif state.voice_client.channel != user_vc:
             try: await state.voice_client.move_to(user_vc); state.last_interaction_channel_id = interaction.channel.id
             except asyncio.TimeoutError: await interaction.followup.send(" 移动到你的语音频道超时。", ephemeral=True); return False
@@ -470,14 +849,17 @@ class MusicCog(commands.Cog, name="音乐播放"):
     @music_group.command(name="join", description="让机器人加入你所在的语音频道。")
     async def join_cmd(self, interaction: discord.Interaction):
         await interaction.response.defer(ephemeral=True); state = self.get_guild_state(interaction.guild_id)
-        if await self.ensure_voice(interaction, state): await interaction.followup.send(f"✅ 已加入语音频道 **{state.voice_client.channel.name}**。", ephemeral=True)
+        if await self.ensure_voice(interaction, state):
+            await interaction.followup.send(f"✅ 已加入语音频道 **{state.voice_client.channel.name}**。", ephemeral=True)
+            if state.queue: state.request_playback()
 
     @music_group.command(name="leave", description="让机器人离开语音频道并清空队列。")
     async def leave_cmd(self, interaction: discord.Interaction):
         await interaction.response.defer(ephemeral=True); state = self.get_guild_state(interaction.guild_id)
         guild_name_debug_leave = interaction.guild.name if interaction.guild else "未知服务器"
         if state.voice_client and state.voice_client.is_connected():
-            state.queue.clear(); state.current_song = None; state.loop_mode = "none"
+            state.queue.clear(); state.current_song = None; state.current_entry = None; state.loop_mode = "none"; state.cancel_prefetch(); state.post_event(EVENT_STOP)
+            await state.forget_saved_queue()
             if state.voice_client.is_playing(): state.voice_client.stop()
             await state.voice_client.disconnect(); state.voice_client = None 
             if state.now_playing_message:
@@ -516,8 +898,8 @@ class MusicCog(commands.Cog, name="音乐播放"):
         # 粗略判断是否是其他直接链接 (不是上述平台)
         is_direct_link = query.startswith(('http://', 'https://')) and not (is_youtube_url or is_soundcloud_url or is_spotify_url)
 
-        songs_to_add_data: List[Dict[str, Any]] = []
-        source_or_list_of_data: Union[YTDLSource, List[Dict[str, Any]], str, None] = None
+        songs_to_add_data: List[QueueEntry] = []
+        source_or_list_of_data: Union[Dict[str, Any], List[QueueEntry], str, None] = None
         initial_feedback_sent = False # 标记是否已发送过临时反馈
         pre_message: Optional[discord.WebhookMessage] = None # 用于编辑的初始反馈消息
 
@@ -552,17 +934,16 @@ class MusicCog(commands.Cog, name="音乐播放"):
             # 发送初始的“处理中”消息 (ephemeral)
             pre_message = await interaction.followup.send(processing_message_content, ephemeral=True, wait=True)
             
-            # 调用核心处理逻辑
+            # 播放列表 / Spotify 歌单与专辑：流式导入，边取边排队
+            if is_playlist_request or (is_spotify_url and SPOTIFY_COLLECTION_RE.match(query)):
+                await self._import_playlist(interaction, state, url_to_process, pre_message, spotify=is_spotify_url)
+                return
+
+            # 调用核心处理逻辑：单曲只提取信息入队，音源在播放时才创建
             if is_spotify_url:
                 source_or_list_of_data = await YTDLSource.from_spotify(query, loop=self.bot.loop)
             else:
-                # from_url 不再需要 search=True 参数，因为它现在只处理直接的 URL 或已构造好的搜索查询
-                source_or_list_of_data = await YTDLSource.from_url(
-                    url_to_process, 
-                    loop=self.bot.loop, 
-                    stream=True, 
-                    playlist=is_playlist_request # 传递是否按播放列表处理
-                )
+                source_or_list_of_data = await YTDLSource.extract_stream_data(url_to_process)
 
             # 处理返回结果
             if source_or_list_of_data == "private_playlist": # Spotify 私有播放列表的特殊返回值
@@ -575,8 +956,8 @@ class MusicCog(commands.Cog, name="音乐播放"):
             # 将获取到的数据统一到 songs_to_add_data 列表中
             if isinstance(source_or_list_of_data, list): # 如果返回的是播放列表
                 songs_to_add_data.extend(source_or_list_of_data)
-            elif isinstance(source_or_list_of_data, YTDLSource): # 如果返回的是单个YTDLSource对象
-                songs_to_add_data.append(source_or_list_of_data.data) # 我们需要的是原始数据字典
+            elif isinstance(source_or_list_of_data, dict): # 单曲的信息字典
+                songs_to_add_data.append(QueueEntry.from_info(source_or_list_of_data, resolved=True)) # 只保留轻量的队列条目
             else: # 理论上不应该到这里，因为上面已经检查了 None
                 await pre_message.edit(content=f"❓ 未能找到与查询 `{query}` 相关的内容或格式无法识别。")
                 return
@@ -586,8 +967,8 @@ class MusicCog(commands.Cog, name="音乐播放"):
                 return
 
             # 将所有找到的歌曲数据添加到服务器的播放队列
-            for song_data_dict in songs_to_add_data:
-                state.queue.append(song_data_dict)
+            state.queue.extend(songs_to_add_data); state.mark_queue_dirty()
+            if state.current_song: state.schedule_prefetch(); state.schedule_lookahead() # 队列原本为空时，新的队首需要预取
             
             # 构建成功反馈消息
             source_name = "SoundCloud" if url_to_process.startswith("scsearch") or is_soundcloud_url else \
@@ -596,7 +977,7 @@ class MusicCog(commands.Cog, name="音乐播放"):
                           "直接链接" if is_direct_link else "搜索结果"
 
             num_songs_added = len(songs_to_add_data)
-            first_song_title_added = songs_to_add_data[0].get('title', '歌曲') if num_songs_added > 0 else "歌曲"
+            first_song_title_added = (songs_to_add_data[0].title or '歌曲') if num_songs_added > 0 else "歌曲"
             
             if num_songs_added == 1:
                 final_feedback_msg = f"✅ 已将来自 {source_name} 的歌曲 **{first_song_title_added}** 添加到队列。"
@@ -626,22 +1007,42 @@ class MusicCog(commands.Cog, name="音乐播放"):
             elif not initial_feedback_sent: await interaction.followup.send(error_content_generic, ephemeral=True)
             return # 出错后不再继续
 
-        # 如果当前没有歌曲在播放，并且队列不为空，则开始播放
+        # 通知播放器任务有新歌入队；播放器空闲时会开始播放队首。
         # 注意：如果 initial_feedback_sent 为 True，表示已经通过 pre_message.edit 给了用户反馈，
-        # play_next_song_async 内部发送的“正在播放”消息应该是公开的。
-        # 如果 initial_feedback_sent 为 False (例如 pre_message 发送失败了)，
-        # 并且 play_next_song_async 是第一次播放，它应该使用 interaction.followup.send 来发送公开的“正在播放”消息。
-        if not state.voice_client.is_playing() and not state.current_song: 
-            # 如果已经发送了临时的 "已添加" 反馈，play_next_song_async 不需要原始的 interaction 来回复
-            # 它会自己创建新的 "正在播放" 消息。
-            # 如果上面的 pre_message.edit 失败了，这里传递 interaction 确保至少有一次回应。
-            await state.play_next_song_async(interaction if not initial_feedback_sent and not interaction.response.is_done() else None) 
+        # 播放器发送的“正在播放”消息应该是公开的。
+        # 如果 initial_feedback_sent 为 False (例如 pre_message 发送失败了)，传递 interaction 确保至少有一次回应。
+        state.request_playback(interaction if not initial_feedback_sent and not interaction.response.is_done() else None)
+
+    async def _import_playlist(self, interaction: discord.Interaction, state: GuildMusicState, url: str,
+                               pre_message: discord.WebhookMessage, *, spotify: bool = False):
+        """流式导入播放列表：每取到一批条目就以轻量记录入队，第一批到达即可开始播放。"""
+        guild_id = interaction.guild_id
+        added = 0; skipped = 0; first_title = None; last_progress = time.monotonic()
+        async for batch in extractor.iter_playlist(url):
+            if MusicCog._guild_states_ref.get(guild_id) is not state or not state.voice_client: # 导入期间机器人已停止/离开
+                await pre_message.edit(content=f"⏹️ 播放已停止，播放列表导入中止 (已加入 {added} 首)。"); return
+            records = [r for r in (playlist_record(e, spotify=spotify) for e in batch) if r]
+            skipped += len(batch) - len(records)
+            if not records: continue
+            state.queue.extend(records); added += len(records); first_title = first_title or records[0].title
+            state.mark_queue_dirty()
+            state.request_playback(); state.schedule_prefetch(); state.schedule_lookahead()
+            if time.monotonic() - last_progress >= IMPORT_PROGRESS_INTERVAL:
+                last_progress = time.monotonic()
+                try: await pre_message.edit(content=f"⏳ 正在导入播放列表… 已加入 **{added}** 首。")
+                except discord.HTTPException: pass
+        if not added:
+            await pre_message.edit(content=f"列表 `{url[:100]}` 中未找到可播放的歌曲。"); return
+        source_name = "Spotify (将在YouTube匹配)" if spotify else "播放列表"
+        note = f"，跳过 {skipped} 个无效条目" if skipped else ""
+        await pre_message.edit(content=f"✅ 已将来自 {source_name} 的 **{added} 首歌** 添加到队列 (第一首: {first_title[:50]}{'...' if len(first_title)>50 else ''}){note}。")
+        print(f"[{interaction.guild.name if interaction.guild else guild_id}] 导入播放列表 {url} 完成，共 {added} 首。")
 
     @music_group.command(name="skip", description="跳过当前播放的歌曲。")
     async def skip_cmd(self, interaction: discord.Interaction):
         await interaction.response.defer(ephemeral=True); state = self.get_guild_state(interaction.guild_id)
         if not interaction.user.voice or not state.voice_client or interaction.user.voice.channel != state.voice_client.channel: await interaction.followup.send("🚫 你需要和机器人在同一个语音频道才能跳歌。", ephemeral=True); return
-        if state.voice_client and state.voice_client.is_playing() and state.current_song: state.voice_client.stop(); await interaction.followup.send("⏭️ 已跳过当前歌曲。", ephemeral=True)
+        if state.voice_client and state.voice_client.is_playing() and state.current_song: state.post_event(EVENT_SKIP); await interaction.followup.send("⏭️ 已跳过当前歌曲。", ephemeral=True)
         else: await interaction.followup.send(" 当前没有歌曲可以跳过。", ephemeral=True)
 
 
@@ -658,7 +1059,11 @@ class MusicCog(commands.Cog, name="音乐播放"):
         if state.voice_client and state.voice_client.is_connected():
             state.queue.clear()
             state.current_song = None
+            state.current_entry = None
             state.loop_mode = "none"
+            state.cancel_prefetch()
+            state.post_event(EVENT_STOP)
+            await state.forget_saved_queue()
             if state.voice_client.is_playing():
                 state.voice_client.stop()
             
@@ -696,10 +1101,13 @@ class MusicCog(commands.Cog, name="音乐播放"):
         else:
             description_lines.append("\n**等待播放:**")
             for i, song_data_item in enumerate(list(state.queue)[:queue_display_limit]): 
-                title_item = song_data_item.get('title', '未知标题') 
+                title_item = song_data_item.title or '未知标题' 
                 if len(title_item) > 60: title_item = title_item[:57] + "..."
                 description_lines.append(f"{i+1}. {title_item}")
             if len(state.queue) > queue_display_limit: description_lines.append(f"\n...还有 **{len(state.queue) - queue_display_limit}** 首歌在队列中。")
+        transition_stats = state.transition_stats()
+        if transition_stats["transitions"]:
+            embed.set_footer(text=f"平均切歌间隔 {transition_stats['avg_gap_ms']:.0f}ms · 预取命中 {transition_stats['prefetch_hits']}/{transition_stats['prefetch_hits'] + transition_stats['prefetch_misses']}")
         embed.description = "\n".join(description_lines); await interaction.followup.send(embed=embed, ephemeral=True)
 
 
@@ -724,9 +1132,9 @@ class MusicCog(commands.Cog, name="音乐播放"):
         await interaction.response.defer(ephemeral=True); state = self.get_guild_state(interaction.guild_id)
         if not state.voice_client or not state.voice_client.is_connected(): await interaction.followup.send(" 我需要先连接到语音频道才能调节音量。", ephemeral=True); return
         if not interaction.user.voice or state.voice_client.channel != interaction.user.voice.channel: await interaction.followup.send(" 你需要和我在同一个语音频道才能调节音量。", ephemeral=True); return
-        new_volume_float = level / 100.0; state.volume = new_volume_float
-        if state.voice_client.source and isinstance(state.voice_client.source, discord.PCMVolumeTransformer): state.voice_client.source.volume = new_volume_float
-        await interaction.followup.send(f"🔊 音量已设置为 **{level}%**。", ephemeral=True)
+        new_volume_float = level / 100.0; state.volume = new_volume_float; state.mark_queue_dirty()
+        applied = state.apply_volume() or not state.current_song
+        await interaction.followup.send(f"🔊 音量已设置为 **{level}%**。" + ("" if applied else " (将从下一首开始生效)"), ephemeral=True)
         if state.now_playing_message and state.current_song: 
             try: view_for_vol_update = state.create_music_controls_view(); await state.now_playing_message.edit(embed=state.create_now_playing_embed(), view=view_for_vol_update)
             except: pass
@@ -737,7 +1145,7 @@ class MusicCog(commands.Cog, name="音乐播放"):
     async def loop_cmd(self, interaction: discord.Interaction, mode: app_commands.Choice[str]):
         await interaction.response.defer(ephemeral=True); state = self.get_guild_state(interaction.guild_id)
         if not interaction.user.voice or not state.voice_client or interaction.user.voice.channel != state.voice_client.channel: await interaction.followup.send("🚫 你需要和机器人在同一个语音频道才能设置循环模式。", ephemeral=True); return
-        state.loop_mode = mode.value; await interaction.followup.send(f"🔁 循环模式已设置为 **{mode.name}**。", ephemeral=True)
+        state.loop_mode = mode.value; state.schedule_prefetch(); state.mark_queue_dirty(); await interaction.followup.send(f"🔁 循环模式已设置为 **{mode.name}**。", ephemeral=True)
         if state.now_playing_message and state.current_song: 
             try: view_for_loop_update = state.create_music_controls_view(); await state.now_playing_message.edit(embed=state.create_now_playing_embed(), view=view_for_loop_update)
             except: pass
@@ -759,6 +1167,7 @@ class MusicCog(commands.Cog, name="音乐播放"):
                     
                     if state.leave_task:
                         state.leave_task.cancel()
+                    state.cancel_prefetch(); state.post_event(EVENT_STOP)
                     print(f"机器人已从 {guild_name_listener} 的语音频道断开，音乐状态已清理。")
             return 
         
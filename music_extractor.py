@@ -0,0 +1,301 @@
+# music_extractor.py
+"""
+音乐元数据提取服务 (yt-dlp)。
+
+- 每种选项配置 (single / playlist / search) 各有一组预先创建好的 YoutubeDL 实例，
+  在专用的有界线程池中执行 extract_info，不再占用事件循环的默认执行器，也不再每首歌新建实例。
+  YoutubeDL 实例不是线程安全的，每次提取时从池中独占借出一个，用完归还。
+- 提取结果进入 LRU + TTL 缓存，键为 (配置, 链接/搜索词)；单曲结果还会以 webpage_url 再登记一次，
+  因此重播、循环模式和重复点歌都不会重复提取。
+  含直链的结果的过期时间不会晚于直链自身的 expire 参数。
+- 同一个键的并发请求只会触发一次提取 (single-flight)。
+- iter_playlist 以 process=False 的扁平方式逐页读取播放列表，分批交给调用方，
+  大型播放列表不必等全部条目取完就能开始排队播放。
+"""
+import asyncio
+import concurrent.futures
+import copy
+import os
+import queue
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, AsyncIterator, Callable, Dict, Iterator, List, Optional, Tuple
+from urllib.parse import parse_qs, urlparse
+
+import yt_dlp
+
+EXTRACTOR_WORKERS = int(os.getenv("MUSIC_EXTRACTOR_WORKERS", "4"))
+METADATA_CACHE_SIZE = 512
+STREAM_INFO_TTL = 20 * 60       # 含直链的单曲 / 搜索结果 (秒)
+PLAYLIST_INFO_TTL = 60 * 60     # 扁平播放列表只有条目信息，不含直链
+STREAM_EXPIRY_MARGIN = 5 * 60   # 直链到期前这么久就视为过期
+PLAYLIST_MAX_ENTRIES = int(os.getenv("MUSIC_PLAYLIST_MAX_ENTRIES", "5000"))  # 0 表示不限制；防止无限的“合辑/电台”列表
+PLAYLIST_CHUNK_SIZE = 50
+
+PROFILE_SINGLE = "single"
+PROFILE_PLAYLIST = "playlist"
+PROFILE_SEARCH = "search"
+
+
+def build_profiles(base_options: Dict[str, Any]) -> Dict[str, Dict[str, Any]]:
+    return {
+        PROFILE_SINGLE: {**base_options, 'noplaylist': True},
+        PROFILE_PLAYLIST: {**base_options, 'noplaylist': False, 'extract_flat': 'in_playlist'},
+        PROFILE_SEARCH: {**base_options, 'noplaylist': True},
+    }
+
+
+def stream_url_expiry(info: Dict[str, Any]) -> Optional[float]:
+    """从直链 (如 googlevideo 的 ...&expire=1700000000) 中解析到期时间戳；没有时返回 None。"""
+    stream_url = info.get('url')
+    if not stream_url or not isinstance(stream_url, str):
+        return None
+    try:
+        values = parse_qs(urlparse(stream_url).query).get('expire')
+        return float(values[0]) if values else None
+    except (ValueError, TypeError):
+        return None
+
+
+class _MetadataCache:
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self._items: "OrderedDict[Tuple[str, str], Tuple[float, Dict[str, Any]]]" = OrderedDict()
+
+    def get(self, key: Tuple[str, str]) -> Optional[Dict[str, Any]]:
+        item = self._items.get(key)
+        if item is None:
+            return None
+        expires_at, info = item
+        if expires_at <= time.time():
+            del self._items[key]
+            return None
+        self._items.move_to_end(key)
+        return info
+
+    def put(self, key: Tuple[str, str], info: Dict[str, Any], expires_at: float):
+        self._items[key] = (expires_at, info)
+        self._items.move_to_end(key)
+        while len(self._items) > self.max_size:
+            self._items.popitem(last=False)
+
+    def discard(self, key: Tuple[str, str]):
+        self._items.pop(key, None)
+
+    def __len__(self):
+        return len(self._items)
+
+
+class MusicExtractor:
+    """线程安全；异步接口需在事件循环中调用。"""
+
+    def __init__(self, base_options: Dict[str, Any], workers: int = EXTRACTOR_WORKERS,
+                 cache_size: int = METADATA_CACHE_SIZE):
+        self.workers = max(1, workers)
+        self.profiles = build_profiles(base_options)
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="ytdl")
+        # 每个配置的实例数与线程数相同，借用永远不会阻塞在池上
+        self._pools: Dict[str, "queue.LifoQueue[yt_dlp.YoutubeDL]"] = {}
+        for name, options in self.profiles.items():
+            pool = queue.LifoQueue()
+            for _ in range(self.workers):
+                pool.put(yt_dlp.YoutubeDL(options))
+            self._pools[name] = pool
+        self._cache = _MetadataCache(cache_size)
+        self._lock = threading.RLock()  # add_done_callback 可能在持锁时同步回调
+        self._inflight: Dict[Tuple[str, str], concurrent.futures.Future] = {}
+        self.hits = 0
+        self.misses = 0
+        self.extractions = 0
+        self.extract_seconds = 0.0
+        print(f"ℹ️ [MusicExtractor] 已初始化 {len(self._pools)} 组 YoutubeDL 实例，每组 {self.workers} 个。")
+
+    # ---------------------------------------------------------------
+    # 线程池侧
+    # ---------------------------------------------------------------
+    def _with_instance(self, profile: str, fn: Callable[[yt_dlp.YoutubeDL], Any]) -> Any:
+        pool = self._pools[profile]
+        ydl = pool.get()
+        try:
+            return fn(ydl)
+        finally:
+            pool.put(ydl)
+
+    def _extract_sync(self, profile: str, query: str) -> Optional[Dict[str, Any]]:
+        started = time.perf_counter()
+        try:
+            return self._with_instance(profile, lambda ydl: ydl.extract_info(query, download=False))
+        finally:
+            with self._lock:
+                self.extractions += 1
+                self.extract_seconds += time.perf_counter() - started
+
+    def _expires_at(self, profile: str, info: Dict[str, Any]) -> float:
+        now = time.time()
+        if profile == PROFILE_PLAYLIST:
+            return now + PLAYLIST_INFO_TTL
+        expires_at = now + STREAM_INFO_TTL
+        for entry in (info, *(info.get('entries') or [])[:1]):
+            if entry:
+                stream_expiry = stream_url_expiry(entry)
+                if stream_expiry:
+                    expires_at = min(expires_at, stream_expiry - STREAM_EXPIRY_MARGIN)
+        return expires_at
+
+    def _store(self, profile: str, query: str, info: Optional[Dict[str, Any]]):
+        if not info:
+            return
+        expires_at = self._expires_at(profile, info)
+        if expires_at <= time.time():
+            return
+        with self._lock:
+            self._cache.put((profile, query), info, expires_at)
+            single = info
+            if profile == PROFILE_SEARCH and info.get('entries'):
+                single = info['entries'][0]
+            if profile != PROFILE_PLAYLIST and single and single.get('webpage_url') and single.get('webpage_url') != query:
+                self._cache.put((PROFILE_SINGLE, single['webpage_url']), single, expires_at)
+
+    # ---------------------------------------------------------------
+    # 异步接口
+    # ---------------------------------------------------------------
+    async def extract(self, query: str, profile: str = PROFILE_SINGLE, *, use_cache: bool = True) -> Optional[Dict[str, Any]]:
+        """
+        返回 extract_info(query, download=False) 的结果。结果来自共享缓存，
+        返回的是浅拷贝：调用方可以改写顶层字段，但不要原地修改嵌套的列表/字典。
+        """
+        key = (profile, query)
+        with self._lock:
+            if use_cache:
+                cached = self._cache.get(key)
+                if cached is not None:
+                    self.hits += 1
+                    return dict(cached)
+            self.misses += 1
+            future = self._inflight.get(key)
+            if future is None:
+                future = self._executor.submit(self._extract_sync, profile, query)
+                self._inflight[key] = future
+                future.add_done_callback(lambda f, k=key: self._on_extracted(k, f))
+        info = await asyncio.wrap_future(future)
+        return dict(info) if info else info
+
+    def _on_extracted(self, key: Tuple[str, str], future: concurrent.futures.Future):
+        with self._lock:
+            self._inflight.pop(key, None)
+        if not future.cancelled() and future.exception() is None:
+            self._store(key[0], key[1], future.result())
+
+    async def download(self, query: str) -> Tuple[Dict[str, Any], str]:
+        """下载模式 (不走缓存)，返回 (info, 本地文件名)。"""
+        def run(ydl):
+            info = ydl.extract_info(query, download=True)
+            if info and 'entries' in info and info['entries']:
+                info = info['entries'][0]
+            return info, ydl.prepare_filename(info)
+        return await asyncio.wrap_future(self._executor.submit(self._with_instance, PROFILE_SINGLE, run))
+
+    @staticmethod
+    def _walk_playlist(ydl: yt_dlp.YoutubeDL, query: str, stop: threading.Event) -> Iterator[Dict[str, Any]]:
+        """不做 process 的扁平提取：跟随 url 重定向，按需翻页产出条目；非播放列表链接产出其自身。"""
+        info = ydl.extract_info(query, download=False, process=False)
+        for _ in range(3):
+            if not info or info.get('_type') not in ('url', 'url_transparent'):
+                break
+            info = ydl.extract_info(info['url'], download=False, process=False, ie_key=info.get('ie_key'))
+        if not info:
+            return
+        entries = info.get('entries')
+        if entries is None:
+            yield info
+            return
+        if hasattr(entries, 'getslice'): # yt-dlp 的 PagedList：按页切片读取
+            start = 0
+            while not stop.is_set():
+                page = entries.getslice(start, start + PLAYLIST_CHUNK_SIZE)
+                if not page:
+                    return
+                yield from page
+                start += len(page)
+        else: # 列表或生成器 (生成器在迭代时才去请求下一页)
+            for entry in entries:
+                if stop.is_set():
+                    return
+                yield entry
+
+    async def iter_playlist(self, query: str, *, max_entries: int = PLAYLIST_MAX_ENTRIES,
+                            chunk_size: int = PLAYLIST_CHUNK_SIZE) -> AsyncIterator[List[Dict[str, Any]]]:
+        """
+        分批产出播放列表的扁平条目 (每批最多 chunk_size 个)。提取在线程池中进行，
+        调用方提前结束迭代时会通知提取线程停止翻页。提取错误会在迭代中原样抛出。
+        """
+        loop = asyncio.get_running_loop()
+        batches: asyncio.Queue = asyncio.Queue()
+        stop = threading.Event()
+        done = object()
+
+        def run(ydl):
+            batch, count = [], 0
+            try:
+                for entry in self._walk_playlist(ydl, query, stop):
+                    if not entry or entry.get('_type') == 'playlist': # 嵌套列表 (如频道的子标签页) 不展开
+                        continue
+                    batch.append(entry); count += 1
+                    if len(batch) >= chunk_size:
+                        loop.call_soon_threadsafe(batches.put_nowait, batch); batch = []
+                    if stop.is_set() or (max_entries and count >= max_entries):
+                        break
+                if batch:
+                    loop.call_soon_threadsafe(batches.put_nowait, batch)
+                loop.call_soon_threadsafe(batches.put_nowait, done)
+            except BaseException as e:
+                loop.call_soon_threadsafe(batches.put_nowait, e)
+
+        self._executor.submit(self._with_instance, PROFILE_PLAYLIST, run)
+        try:
+            while True:
+                item = await batches.get()
+                if item is done:
+                    return
+                if isinstance(item, BaseException):
+                    raise item
+                yield item
+        finally:
+            stop.set()
+
+    def invalidate(self, query: str, profile: str = PROFILE_SINGLE):
+        """直链失效 (如播放时 403) 时调用，下次 extract 会重新提取。"""
+        with self._lock:
+            self._cache.discard((profile, query))
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "workers": self.workers,
+                "cached": len(self._cache),
+                "hits": self.hits,
+                "misses": self.misses,
+                "extractions": self.extractions,
+                "hit_rate": round(self.hits / total, 3) if total else 0.0,
+                "avg_extract_ms": round(self.extract_seconds * 1000 / self.extractions, 1) if self.extractions else 0.0,
+            }
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+
+_extractor: Optional[MusicExtractor] = None
+_extractor_lock = threading.Lock()
+
+
+def get_music_extractor(base_options: Optional[Dict[str, Any]] = None) -> MusicExtractor:
+    """进程内共享的提取服务；首次调用时必须传入 base_options。"""
+    global _extractor
+    with _extractor_lock:
+        if _extractor is None:
+            if base_options is None:
+                raise RuntimeError("MusicExtractor 尚未初始化。")
+            _extractor = MusicExtractor(copy.deepcopy(base_options))
+        return _extractor
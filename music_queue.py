@@ -0,0 +1,138 @@
+# music_queue.py
+"""
+紧凑的音乐队列条目与持久化辅助函数。
+
+队列里只保存播放所需的五个字段，而不是 yt-dlp 返回的完整信息字典 (其中的 formats 列表动辄几十 KB)；
+需要直链时再通过 music_extractor 的缓存解析。队列快照保存在 SQLite 中
+(database.TABLE_MUSIC_QUEUE_ENTRIES)，机器人重启或被断开后可以恢复。
+
+内存基准测试:
+    python music_queue.py --bench 10000
+"""
+import sys
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+RESOLVE_PENDING = 0
+RESOLVE_DONE = 1
+RESOLVE_FAILED = 2
+
+
+def _intern(value: Optional[str]) -> Optional[str]:
+    # 同一播放列表的上传者名称大量重复，驻留后所有条目共享同一个字符串对象
+    return sys.intern(value) if value else value
+
+
+class QueueEntry:
+    __slots__ = ("title", "url", "duration", "thumbnail", "uploader", "resolve_state")
+
+    def __init__(self, title: Optional[str], url: Optional[str], duration: Optional[int] = None,
+                 thumbnail: Optional[str] = None, uploader: Optional[str] = None, resolve_state: int = RESOLVE_PENDING):
+        self.title = title
+        self.url = url
+        self.duration = int(duration) if duration else None
+        self.thumbnail = thumbnail
+        self.uploader = _intern(uploader)
+        self.resolve_state = resolve_state
+
+    @classmethod
+    def from_info(cls, info: Dict[str, Any], resolved: bool = False) -> "QueueEntry":
+        """从 yt-dlp 的信息字典 (完整或扁平) 创建条目，只保留需要的字段。"""
+        thumbnail = info.get('thumbnail') or ((info.get('thumbnails') or [{}])[-1].get('url'))
+        return cls(info.get('title'), info.get('webpage_url') or info.get('url'), info.get('duration'), thumbnail,
+                   info.get('uploader') or info.get('channel'), RESOLVE_DONE if resolved else RESOLVE_PENDING)
+
+    @property
+    def is_spotify_search(self) -> bool:
+        """Spotify 条目需要以 "歌名 歌手" 在 YouTube 上搜索 (没有可直接提取的链接)。"""
+        return self.uploader == "Spotify" and (not self.url or not self.url.startswith(('http://', 'https://'))
+                                               or "open.spotify.com/" in self.url)
+
+    def to_row(self) -> Tuple[Optional[str], Optional[str], Optional[int], Optional[str], Optional[str]]:
+        return (self.title, self.url, self.duration, self.thumbnail, self.uploader)
+
+    @classmethod
+    def from_row(cls, row: Iterable[Any]) -> "QueueEntry":
+        return cls(*row)
+
+    def __repr__(self) -> str:
+        return f"QueueEntry(title={self.title!r}, url={self.url!r})"
+
+
+def entries_to_rows(entries: Iterable[QueueEntry]) -> List[Tuple]:
+    return [entry.to_row() for entry in entries]
+
+
+def entries_from_rows(rows: Iterable[Iterable[Any]]) -> List[QueueEntry]:
+    return [QueueEntry.from_row(row) for row in rows]
+
+
+# =========================================
+# == 基准测试
+# =========================================
+def _fake_info(i: int) -> Dict[str, Any]:
+    """模拟 yt-dlp 对一个 YouTube 视频返回的信息字典 (字段与 formats 数量取常见值)。"""
+    video_id = f"{i:011d}"
+    formats = [{
+        'format_id': str(140 + n), 'url': f"https://rr1---sn-example.googlevideo.com/videoplayback?id={video_id}&itag={140 + n}&expire=1700000000&sig=" + "x" * 200,
+        'ext': 'webm' if n % 2 else 'm4a', 'acodec': 'opus' if n % 2 else 'mp4a.40.2', 'vcodec': 'none' if n < 4 else 'avc1',
+        'abr': 48 + n * 16, 'asr': 48000, 'filesize': 3_000_000 + n, 'protocol': 'https', 'http_headers': {'User-Agent': 'Mozilla/5.0'},
+    } for n in range(20)]
+    return {
+        'id': video_id, 'title': f"Track number {i} - Some Artist (Official Audio)", 'webpage_url': f"https://www.youtube.com/watch?v={video_id}",
+        'duration': 180 + i % 120, 'thumbnail': f"https://i.ytimg.com/vi/{video_id}/maxresdefault.jpg", 'uploader': f"Artist Channel {i % 40}",
+        'description': "Lorem ipsum dolor sit amet. " * 20, 'tags': ["music", "audio", "official"], 'formats': formats,
+        'url': formats[0]['url'], 'extractor': 'youtube', 'view_count': 123456 + i,
+    }
+
+
+def _run_benchmark(track_count: int, guild_count: int = 50):
+    import os
+    import tempfile
+    import time
+    import tracemalloc
+    from collections import deque
+
+    import database
+
+    def measure(build):
+        tracemalloc.start()
+        queues = build()
+        current, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        return queues, current
+
+    def build_full():
+        queues = [deque() for _ in range(guild_count)]
+        for i in range(track_count):
+            queues[i % guild_count].append(_fake_info(i))
+        return queues
+
+    def build_compact():
+        queues = [deque() for _ in range(guild_count)]
+        for i in range(track_count):
+            queues[i % guild_count].append(QueueEntry.from_info(_fake_info(i)))
+        return queues
+
+    _, full_bytes = measure(build_full)
+    compact_queues, compact_bytes = measure(build_compact)
+    print(f"{track_count} 首歌 / {guild_count} 个服务器:")
+    print(f"  完整信息字典: {full_bytes / 1024 / 1024:.1f} MiB, 每首 {full_bytes / track_count:.0f} 字节")
+    print(f"  QueueEntry  : {compact_bytes / 1024 / 1024:.2f} MiB, 每首 {compact_bytes / track_count:.0f} 字节")
+
+    with tempfile.TemporaryDirectory() as tmp:
+        database.DATABASE_FILE = os.path.join(tmp, "bench.db")
+        database.initialize_database()
+        started = time.perf_counter()
+        for guild_id, queue in enumerate(compact_queues, start=1):
+            database.db_save_music_queue(guild_id, 1, 2, "none", 0.3, entries_to_rows(queue))
+        saved = time.perf_counter() - started
+        started = time.perf_counter()
+        restored = sum(len(entries_from_rows(database.db_load_music_queue(guild_id)["entries"]))
+                       for guild_id in range(1, guild_count + 1))
+        loaded = time.perf_counter() - started
+        print(f"  SQLite: 保存 {saved * 1000:.0f}ms, 恢复 {restored} 首 {loaded * 1000:.0f}ms")
+
+
+if __name__ == "__main__":
+    count = int(sys.argv[sys.argv.index("--bench") + 1]) if "--bench" in sys.argv else 10000
+    _run_benchmark(count)
@@ -0,0 +1,217 @@
+# payment_gateway.py
+"""
+支付宝当面付 (precreate) 网关。
+
+- 复用启动时配置好的 DefaultAlipayClient，不再每次充值都重新构造客户端。
+- precreate 是阻塞的 HTTP 调用，在专用的有界线程池 (PRECREATE_WORKERS 个线程) 中执行，
+  事件循环在等待支付宝应答期间照常处理其他事件；单次调用超过 PRECREATE_TIMEOUT 秒按失败处理。
+- 二维码 PNG 在另一个线程池中渲染。相同的二维码内容 (同一订单重复请求时支付宝返回相同的 qr_code)
+  在订单有效期内 (QR_CACHE_TTL) 直接复用已渲染的图片，同一内容同时只渲染一次。
+
+突发压力测试 (模拟支付宝往返耗时，对比旧的事件循环内阻塞调用的循环延迟):
+    python payment_gateway.py --burst 50 --alipay-ms 300
+"""
+import asyncio
+import concurrent.futures
+import io
+import json
+import logging
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Optional, Tuple
+
+import qrcode
+
+try:
+    from alipay.aop.api.request.AlipayTradePrecreateRequest import AlipayTradePrecreateRequest
+except ImportError:
+    AlipayTradePrecreateRequest = None
+
+PRECREATE_WORKERS = 4
+PRECREATE_TIMEOUT = 20.0
+QR_RENDER_WORKERS = 2
+ORDER_TIMEOUT_SECONDS = 5 * 60  # 到期后由 expiry_scheduler 把仍未支付的订单标记为 EXPIRED
+ORDER_TIMEOUT_EXPRESS = f"{ORDER_TIMEOUT_SECONDS // 60}m"
+QR_CACHE_TTL = ORDER_TIMEOUT_SECONDS + 60  # 订单有效期 + 余量
+QR_CACHE_MAX_ENTRIES = 256
+
+
+def render_qr_png(payload: str) -> bytes:
+    img_byte_arr = io.BytesIO()
+    qrcode.make(payload).save(img_byte_arr, format='PNG')
+    return img_byte_arr.getvalue()
+
+
+class PaymentGateway:
+    def __init__(self, client, notify_url: Optional[str], precreate_workers: int = PRECREATE_WORKERS,
+                 qr_workers: int = QR_RENDER_WORKERS, request_factory=None):
+        self.client = client
+        self.notify_url = notify_url
+        self._request_factory = request_factory or AlipayTradePrecreateRequest
+        self._precreate_pool = concurrent.futures.ThreadPoolExecutor(max_workers=precreate_workers, thread_name_prefix="alipay-precreate")
+        self._qr_pool = concurrent.futures.ThreadPoolExecutor(max_workers=qr_workers, thread_name_prefix="qr-render")
+        self._qr_cache: "OrderedDict[str, Tuple[bytes, float]]" = OrderedDict()  # 内容 -> (PNG, 过期时间)
+        self._qr_rendering: Dict[str, asyncio.Future] = {}
+        self._lock = threading.Lock()
+        self.precreate_calls = 0
+        self.precreate_failures = 0
+        self.precreate_seconds = 0.0
+        self.qr_renders = 0
+        self.qr_cache_hits = 0
+
+    # ---------------------------------------------------------------
+    # 预创建订单
+    # ---------------------------------------------------------------
+    def _execute_precreate(self, biz_content: Dict[str, Any]) -> Dict[str, Any]:
+        model = self._request_factory()
+        model.notify_url = self.notify_url
+        model.biz_content = biz_content
+        started = time.perf_counter()
+        try:
+            response_str = self.client.execute(model)
+        finally:
+            with self._lock:
+                self.precreate_calls += 1
+                self.precreate_seconds += time.perf_counter() - started
+        logging.info(f"Raw Alipay API Response for {biz_content.get('out_trade_no')}: {response_str}")
+        return json.loads(response_str).get("alipay_trade_precreate_response", {})
+
+    async def precreate(self, out_trade_no: str, amount: float, subject: str, passback_params: Optional[str] = None,
+                        timeout_express: str = ORDER_TIMEOUT_EXPRESS) -> Dict[str, Any]:
+        """返回 alipay_trade_precreate_response 字典；网络异常或超时会抛出 (超时为 asyncio.TimeoutError)。"""
+        biz_content = {
+            "out_trade_no": out_trade_no,
+            "total_amount": f"{amount:.2f}",
+            "subject": subject,
+            "timeout_express": timeout_express,
+        }
+        if passback_params:
+            biz_content["passback_params"] = passback_params
+        logging.info(f"Calling Alipay API (alipay.trade.precreate) with biz_content: {biz_content}")
+        loop = asyncio.get_running_loop()
+        try:
+            return await asyncio.wait_for(loop.run_in_executor(self._precreate_pool, self._execute_precreate, biz_content), PRECREATE_TIMEOUT)
+        except Exception:
+            with self._lock: self.precreate_failures += 1
+            raise
+
+    # ---------------------------------------------------------------
+    # 二维码
+    # ---------------------------------------------------------------
+    async def qr_png(self, payload: str) -> bytes:
+        """返回二维码 PNG 的字节内容 (discord.File 只能发送一次，调用方每次自行包装 BytesIO)。"""
+        now = time.monotonic()
+        cached = self._qr_cache.get(payload)
+        if cached and cached[1] > now:
+            self._qr_cache.move_to_end(payload)
+            self.qr_cache_hits += 1
+            return cached[0]
+        pending = self._qr_rendering.get(payload)
+        if pending is not None: # 同一内容正在渲染，等待同一结果
+            self.qr_cache_hits += 1
+            return await asyncio.shield(pending)
+        loop = asyncio.get_running_loop()
+        future = loop.run_in_executor(self._qr_pool, render_qr_png, payload)
+        self._qr_rendering[payload] = future
+        try:
+            png = await future
+        finally:
+            self._qr_rendering.pop(payload, None)
+        self.qr_renders += 1
+        self._qr_cache[payload] = (png, time.monotonic() + QR_CACHE_TTL)
+        self._qr_cache.move_to_end(payload)
+        while self._qr_cache and (len(self._qr_cache) > QR_CACHE_MAX_ENTRIES or next(iter(self._qr_cache.values()))[1] <= now):
+            self._qr_cache.popitem(last=False)
+        return png
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            calls = self.precreate_calls
+            return {
+                "precreate_calls": calls,
+                "precreate_failures": self.precreate_failures,
+                "precreate_avg_ms": round(self.precreate_seconds / calls * 1000, 1) if calls else 0.0,
+                "qr_renders": self.qr_renders,
+                "qr_cache_hits": self.qr_cache_hits,
+                "qr_cached": len(self._qr_cache),
+            }
+
+    def shutdown(self):
+        self._precreate_pool.shutdown(wait=False, cancel_futures=True)
+        self._qr_pool.shutdown(wait=False, cancel_futures=True)
+
+
+# =========================================
+# == 突发压力测试
+# =========================================
+class _FakePrecreateRequest:
+    notify_url = None
+    biz_content = None
+
+
+class _FakeAlipayClient:
+    """模拟支付宝网关：阻塞 alipay_ms 毫秒后返回成功应答。"""
+
+    def __init__(self, alipay_ms: float):
+        self.alipay_ms = alipay_ms
+
+    def execute(self, model) -> str:
+        time.sleep(self.alipay_ms / 1000)
+        qr = f"https://qr.alipay.com/bax0{model.biz_content['out_trade_no']}"
+        return json.dumps({"alipay_trade_precreate_response": {"code": "10000", "msg": "Success", "qr_code": qr,
+                                                               "out_trade_no": model.biz_content["out_trade_no"]}})
+
+
+async def _measure_burst(mode: str, burst: int, alipay_ms: float, repeat_rate: float) -> Dict[str, Any]:
+    import random
+    client = _FakeAlipayClient(alipay_ms)
+    gateway = PaymentGateway(client, "https://example.com/alipay/notify", request_factory=_FakePrecreateRequest)
+    lags = []
+    stop = asyncio.Event()
+
+    async def monitor():
+        interval = 0.01
+        while not stop.is_set():
+            started = time.perf_counter()
+            await asyncio.sleep(interval)
+            lags.append((time.perf_counter() - started - interval) * 1000)
+
+    # 部分用户会对同一订单重复请求二维码
+    orders = [f"GJTRC-1-{i}" if i == 0 or random.random() >= repeat_rate else f"GJTRC-1-{random.randrange(i)}" for i in range(burst)]
+
+    async def recharge_inline(order):
+        # 旧做法：在协程里直接调用阻塞的 execute 并在事件循环上渲染二维码
+        model = _FakePrecreateRequest(); model.biz_content = {"out_trade_no": order}
+        resp = json.loads(client.execute(model))["alipay_trade_precreate_response"]
+        return render_qr_png(resp["qr_code"])
+
+    async def recharge_gateway(order):
+        resp = await gateway.precreate(order, 10.0, "bench")
+        return await gateway.qr_png(resp["qr_code"])
+
+    handler = recharge_inline if mode == "inline" else recharge_gateway
+    monitor_task = asyncio.create_task(monitor())
+    await asyncio.sleep(0.05)
+    started = time.perf_counter()
+    await asyncio.gather(*(handler(order) for order in orders))
+    elapsed = time.perf_counter() - started
+    stop.set(); await monitor_task
+    gateway.shutdown()
+    lags.sort()
+    return {"mode": mode, "elapsed_s": round(elapsed, 2), "lag_p50_ms": round(lags[len(lags) // 2], 1),
+            "lag_p95_ms": round(lags[int(len(lags) * 0.95)], 1), "lag_max_ms": round(lags[-1], 1),
+            "gateway": gateway.stats() if mode == "gateway" else None}
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="充值请求突发时的事件循环延迟测试")
+    parser.add_argument("--burst", type=int, default=50)
+    parser.add_argument("--alipay-ms", type=float, default=300.0, help="模拟的支付宝往返耗时")
+    parser.add_argument("--repeat-rate", type=float, default=0.2, help="重复请求同一订单二维码的比例")
+    args = parser.parse_args()
+    print(f"{args.burst} 个充值请求同时到达，支付宝往返 {args.alipay_ms:.0f}ms:")
+    for mode in ("inline", "gateway"):
+        result = asyncio.run(_measure_burst(mode, args.burst, args.alipay_ms, args.repeat_rate))
+        print(f"  {result}")
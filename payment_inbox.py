@@ -0,0 +1,248 @@
+# payment_inbox.py
+"""
+支付宝异步通知的接收与持久化处理。
+
+- NotifyHTTPServer 为每个连接分配一个线程，验签慢的通知不会阻塞其他通知。
+- AlipayNotifyHandler 验签通过后先把通知写入收件箱表 (database.TABLE_PAYMENT_INBOX)，
+  写入成功才向支付宝应答 "success"；写入失败应答 failure，支付宝会按它的重试策略再次通知。
+  同一 notify_id 的重复通知只保存一次。
+- PaymentInboxWorker 在机器人事件循环上逐条取出待处理的通知交给业务处理函数。
+  业务函数必须幂等 (重复处理同一笔订单不会重复入账)；返回 False 或抛出异常时按指数退避重试，
+  超过 MAX_ATTEMPTS 次后标记为 FAILED 等待人工处理。进程在处理途中退出时，通知仍是 PENDING，重启后继续处理。
+
+突发压力测试:
+    python payment_inbox.py --burst 500 --concurrency 50 --verify-ms 20
+"""
+import asyncio
+import json
+import logging
+import time
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+import database
+
+SUCCESS_TRADE_STATUSES = ("TRADE_SUCCESS", "TRADE_FINISHED")
+INBOX_BATCH_SIZE = 20
+INBOX_POLL_INTERVAL = 30.0  # 没有新通知时也定期检查到期的重试
+MAX_ATTEMPTS = 10
+RETRY_BASE_DELAY = 5
+RETRY_MAX_DELAY = 3600
+MAX_BODY_BYTES = 64 * 1024
+
+
+def notification_key(params: Dict[str, str]) -> str:
+    """去重键：优先使用支付宝的 notify_id；缺失时用交易号 + 交易状态代替。"""
+    return params.get("notify_id") or f"{params.get('trade_no')}:{params.get('trade_status')}:{params.get('out_trade_no')}"
+
+
+def store_notification(params: Dict[str, str]) -> bool:
+    return database.db_store_payment_notification(notification_key(params), params.get("out_trade_no"), params.get("trade_no"),
+                                                  params.get("trade_status"), json.dumps(params, ensure_ascii=False))
+
+
+# =========================================
+# == HTTP 回调服务器
+# =========================================
+class NotifyHTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+    def __init__(self, server_address, verify: Callable[[Dict[str, str]], bool], on_stored: Optional[Callable[[], None]] = None):
+        super().__init__(server_address, AlipayNotifyHandler)
+        self.verify = verify
+        self.on_stored = on_stored
+
+
+class AlipayNotifyHandler(BaseHTTPRequestHandler):
+    server: NotifyHTTPServer
+
+    def _reply(self, code: int, body: bytes):
+        self.send_response(code)
+        self.send_header("Content-Type", "text/plain; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        try:
+            length = int(self.headers.get("Content-Length") or 0)
+            if length <= 0 or length > MAX_BODY_BYTES:
+                self._reply(400, b"failure"); return
+            params = dict(urllib.parse.parse_qsl(self.rfile.read(length).decode("utf-8"), keep_blank_values=True))
+        except (ValueError, UnicodeDecodeError) as e:
+            logging.warning(f"[PaymentInbox] 无法解析的支付宝通知: {e}")
+            self._reply(400, b"failure"); return
+        logging.info(f"[PaymentInbox] 收到支付宝通知: out_trade_no={params.get('out_trade_no')}, "
+                     f"trade_status={params.get('trade_status')}, notify_id={params.get('notify_id')}")
+        try:
+            verified = self.server.verify(params)
+        except Exception as e:
+            logging.error(f"[PaymentInbox] 验签时发生异常: {e}", exc_info=True)
+            verified = False
+        if not verified:
+            logging.warning(f"[PaymentInbox] 支付宝通知验签失败: out_trade_no={params.get('out_trade_no')}")
+            self._reply(200, b"failure"); return
+        if not store_notification(params):
+            self._reply(500, b"failure"); return # 未能落库：不应答 success，让支付宝重试
+        if self.server.on_stored:
+            self.server.on_stored()
+        self._reply(200, b"success")
+
+    def do_GET(self):
+        self._reply(200, b"OK (Alipay callback listener. Notifications are POST.)")
+
+    def log_message(self, format, *args):
+        logging.debug(f"[PaymentInbox] {self.address_string()} - {format % args}")
+
+
+# =========================================
+# == 收件箱处理
+# =========================================
+class PaymentInboxWorker:
+    """process(params) 返回 True 表示该通知已处理完毕 (包括决定忽略)，False 表示需要稍后重试。"""
+
+    def __init__(self, loop: asyncio.AbstractEventLoop, process: Callable[[Dict[str, Any]], Awaitable[bool]],
+                 batch_size: int = INBOX_BATCH_SIZE, poll_interval: float = INBOX_POLL_INTERVAL):
+        self.loop = loop
+        self.process = process
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self.processed = 0
+        self.retried = 0
+        self.failed = 0
+
+    def start(self) -> asyncio.Task:
+        if self._task is None or self._task.done():
+            self._task = self.loop.create_task(self._run())
+        return self._task
+
+    def wake(self):
+        """线程安全：HTTP 处理线程保存新通知后调用。"""
+        self.loop.call_soon_threadsafe(self._wakeup.set)
+
+    async def _run(self):
+        while True:
+            self._wakeup.clear()
+            try:
+                handled = await self.drain_once()
+            except Exception as e:
+                logging.error(f"[PaymentInbox] 处理收件箱时出错: {e}", exc_info=True)
+                handled = 0
+            if handled >= self.batch_size:
+                continue # 可能还有积压，立即处理下一批
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+
+    async def drain_once(self) -> int:
+        rows = await self.loop.run_in_executor(None, database.db_get_due_payment_notifications, self.batch_size)
+        for row in rows:
+            await self._handle(row)
+        return len(rows)
+
+    async def _handle(self, row: Dict[str, Any]):
+        error = None
+        try:
+            done = row["trade_status"] not in SUCCESS_TRADE_STATUSES or await self.process(json.loads(row["payload"]))
+        except Exception as e:
+            logging.error(f"[PaymentInbox] 处理通知 {row['notify_id']} (out_trade_no: {row['out_trade_no']}) 时出错: {e}", exc_info=True)
+            done, error = False, f"{type(e).__name__}: {e}"[:500]
+        attempts = row["attempts"] + 1
+        if done:
+            self.processed += 1
+            await self.loop.run_in_executor(None, database.db_finish_payment_notification, row["inbox_id"], "DONE", attempts)
+        elif attempts >= MAX_ATTEMPTS:
+            self.failed += 1
+            logging.critical(f"[PaymentInbox] 通知 {row['notify_id']} (out_trade_no: {row['out_trade_no']}) 重试 {attempts} 次仍未处理成功，需要人工处理！")
+            await self.loop.run_in_executor(None, database.db_finish_payment_notification, row["inbox_id"], "FAILED", attempts,
+                                            error or "processing returned False")
+        else:
+            self.retried += 1
+            delay = min(RETRY_BASE_DELAY * 2 ** (attempts - 1), RETRY_MAX_DELAY)
+            await self.loop.run_in_executor(None, database.db_finish_payment_notification, row["inbox_id"], "PENDING", attempts,
+                                            error or "processing returned False", int(time.time()) + delay)
+
+    def stats(self) -> Dict[str, Any]:
+        return {"processed": self.processed, "retried": self.retried, "failed": self.failed,
+                "inbox": database.db_get_payment_inbox_counts()}
+
+
+# =========================================
+# == 突发压力测试
+# =========================================
+def _run_burst_test(burst: int, concurrency: int, verify_ms: float, duplicate_rate: float):
+    import concurrent.futures
+    import os
+    import random
+    import tempfile
+    import threading
+    import urllib.request
+
+    with tempfile.TemporaryDirectory() as tmp:
+        database.DATABASE_FILE = os.path.join(tmp, "bench.db")
+        database.initialize_database()
+
+        def slow_verify(params):
+            time.sleep(verify_ms / 1000) # 模拟 RSA 验签耗时
+            return params.get("sign") == "ok"
+
+        loop = asyncio.new_event_loop()
+        seen: Dict[str, int] = {}
+
+        async def process(params):
+            seen[params["out_trade_no"]] = seen.get(params["out_trade_no"], 0) + 1
+            return True
+
+        worker = PaymentInboxWorker(loop, process)
+        server = NotifyHTTPServer(("127.0.0.1", 0), slow_verify, worker.wake)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        threading.Thread(target=loop.run_forever, daemon=True).start()
+        asyncio.run_coroutine_threadsafe(asyncio.sleep(0), loop).result()
+        loop.call_soon_threadsafe(worker.start)
+        url = f"http://127.0.0.1:{server.server_address[1]}/alipay/notify"
+
+        # 支付宝对同一通知的重试会带相同的 notify_id
+        notifications = [i if random.random() >= duplicate_rate else random.randrange(max(i, 1)) for i in range(burst)]
+        latencies = []
+
+        def post(i):
+            body = urllib.parse.urlencode({"notify_id": f"n{i}", "out_trade_no": f"order{i}", "trade_no": f"t{i}",
+                                           "trade_status": "TRADE_SUCCESS", "total_amount": "1.00", "sign": "ok"}).encode()
+            started = time.perf_counter()
+            with urllib.request.urlopen(urllib.request.Request(url, data=body), timeout=30) as resp:
+                assert resp.read() == b"success"
+            latencies.append((time.perf_counter() - started) * 1000)
+
+        started = time.perf_counter()
+        with concurrent.futures.ThreadPoolExecutor(concurrency) as pool:
+            list(pool.map(post, notifications))
+        elapsed = time.perf_counter() - started
+        unique = len(set(notifications))
+        deadline = time.time() + 60
+        while sum(seen.values()) < unique and time.time() < deadline:
+            time.sleep(0.05)
+        drained = time.perf_counter() - started
+        server.shutdown()
+
+        latencies.sort()
+        print(f"{burst} 条通知 ({unique} 条不重复)，并发 {concurrency}，模拟验签 {verify_ms:.0f}ms:")
+        print(f"  应答: {burst / elapsed:.0f} 条/秒, p50 {latencies[len(latencies) // 2]:.0f}ms, "
+              f"p95 {latencies[int(len(latencies) * 0.95)]:.0f}ms, 最大 {latencies[-1]:.0f}ms")
+        print(f"  全部处理完成用时 {drained:.2f}s; 处理 {sum(seen.values())} 次, "
+              f"重复处理 {sum(1 for c in seen.values() if c > 1)} 笔; 收件箱: {database.db_get_payment_inbox_counts()}")
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="支付宝通知收件箱突发压力测试")
+    parser.add_argument("--burst", type=int, default=500)
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--verify-ms", type=float, default=20.0)
+    parser.add_argument("--duplicate-rate", type=float, default=0.1)
+    args = parser.parse_args()
+    _run_burst_test(args.burst, args.concurrency, args.verify_ms, args.duplicate_rate)
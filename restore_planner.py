@@ -0,0 +1,300 @@
+# restore_planner.py
+"""
+服务器备份恢复规划器。
+
+按依赖顺序 (身份组 -> 分类 -> 频道 -> 清理) 分阶段恢复备份：
+- 每个阶段先与服务器现有结构做差异比较，未变化的对象直接跳过，只对缺失/变化的对象发起请求。
+- 同一阶段内互不依赖的操作并发执行，每类路由用信号量限制并发数，
+  具体的 429/速率桶等待交给 discord.py 自带的 HTTP 限速器处理，不再硬编码 sleep。
+- 权限覆盖 (overwrites) 在创建频道/分类时一并传入，新对象直接使用 API 返回值，不再按名称回查。
+"""
+import asyncio
+import logging
+from collections import defaultdict
+from typing import Any, Callable, Dict, List
+
+import discord
+
+RESTORE_REASON = "服务器恢复"
+
+# 每类路由允许同时在途的请求数。
+# 创建类路由共用一个 guild 级速率桶，并发过高只会在桶里排队，所以保守一些；
+# 删除/编辑类路由按 channel_id / role_id 分桶，可以放宽。
+ROUTE_CONCURRENCY = {
+    "role_create": 2,
+    "role_edit": 3,
+    "role_delete": 4,
+    "channel_create": 2,
+    "channel_edit": 4,
+    "channel_delete": 4,
+}
+
+
+def _is_restorable_role(role: discord.Role) -> bool:
+    """与 _create_backup_async 的筛选条件保持一致：跳过 @everyone 与各类托管身份组。"""
+    return not (role.is_default() or role.is_bot_managed() or role.is_integration() or role.is_premium_subscriber())
+
+
+def _overwrites_signature(overwrites: Dict[Any, discord.PermissionOverwrite]) -> Dict[int, tuple]:
+    """把权限覆盖转成 {target_id: (allow, deny)}，用于比较。@everyone 不在备份里，比较时忽略。"""
+    signature = {}
+    for target, overwrite in overwrites.items():
+        if isinstance(target, discord.Role) and target.is_default():
+            continue
+        allow, deny = overwrite.pair()
+        signature[target.id] = (allow.value, deny.value)
+    return signature
+
+
+class GuildRestorePlanner:
+    """
+    将一份备份 (version 2 格式，见 _create_backup_async) 增量地应用到服务器上。
+    log 回调签名与 _perform_restore_async 里的 log_progress 相同: log(message, type)。
+    """
+
+    def __init__(self, guild: discord.Guild, backup_data: Dict[str, Any], log: Callable[..., None]):
+        self.guild = guild
+        self.backup = backup_data
+        self.log = log
+        self.role_map: Dict[str, discord.Role] = {}  # { old_id_str: role }
+        self.category_map: Dict[str, discord.CategoryChannel] = {}  # { old_id_str: category }
+        self.matched_channel_ids = set()
+        self.stats = {"created": 0, "updated": 0, "unchanged": 0, "deleted": 0, "failed": 0}
+        self._semaphores = {route: asyncio.Semaphore(limit) for route, limit in ROUTE_CONCURRENCY.items()}
+
+    # ---------------------------------------------------------------
+    # 执行器
+    # ---------------------------------------------------------------
+    async def _run_op(self, route: str, stat: str, label: str, factory: Callable[[], Any]):
+        async with self._semaphores[route]:
+            try:
+                result = await factory()
+            except discord.HTTPException as e:
+                self.stats["failed"] += 1
+                self.log(f"  警告：{label} 失败: {e}", 'warn')
+                return None
+            except Exception as e:
+                self.stats["failed"] += 1
+                logging.error(f"[RestorePlanner] {label} 时发生意外错误: {e}", exc_info=True)
+                self.log(f"  错误：{label} 时发生意外错误: {e}", 'error')
+                return None
+        self.stats[stat] += 1
+        self.log(f"  {label} ✔")
+        return result
+
+    async def _run_stage(self, ops: List[tuple]) -> List[Any]:
+        """并发执行一个阶段内的所有操作，返回与 ops 顺序一致的结果列表 (失败为 None)。"""
+        if not ops:
+            return []
+        return await asyncio.gather(*(self._run_op(*op) for op in ops))
+
+    # ---------------------------------------------------------------
+    # 工具
+    # ---------------------------------------------------------------
+    def _build_overwrites(self, overwrites_data: List[Dict[str, Any]]) -> Dict[Any, discord.PermissionOverwrite]:
+        overwrites = {}
+        for ow in overwrites_data or []:
+            if ow.get('target_type') == 'role':
+                target = self.role_map.get(ow.get('target_original_id'))
+            else:
+                # 成员ID是全局的，只要该成员仍在服务器内就可以直接还原
+                try:
+                    target = self.guild.get_member(int(ow.get('target_original_id')))
+                except (TypeError, ValueError):
+                    target = None
+            if target is None:
+                continue
+            overwrites[target] = discord.PermissionOverwrite.from_pair(
+                discord.Permissions(ow.get('allow', 0)), discord.Permissions(ow.get('deny', 0))
+            )
+        return overwrites
+
+    def _with_live_default(self, channel, overwrites):
+        """编辑已有频道时保留其 @everyone 覆盖 (备份中不含 @everyone，整体替换会把它抹掉)。"""
+        default_ow = channel.overwrites_for(self.guild.default_role)
+        if not default_ow.is_empty():
+            overwrites = dict(overwrites)
+            overwrites[self.guild.default_role] = default_ow
+        return overwrites
+
+    def _clamp_bitrate(self, bitrate) -> int:
+        return min(int(bitrate or 64000), int(self.guild.bitrate_limit))
+
+    # ---------------------------------------------------------------
+    # 阶段 1: 身份组
+    # ---------------------------------------------------------------
+    async def _restore_roles(self):
+        bot_top = self.guild.me.top_role
+        live_by_name = defaultdict(list)
+        for role in sorted(self.guild.roles, key=lambda r: r.position, reverse=True):
+            if _is_restorable_role(role):
+                live_by_name[role.name].append(role)
+
+        ops, op_keys = [], []
+        for role_data in self.backup.get('roles', []):
+            candidates = live_by_name.get(role_data['name'])
+            if candidates:
+                role = candidates.pop(0)
+                self.role_map[role_data['original_id']] = role
+                unchanged = (
+                    role.permissions.value == role_data['permissions'] and role.color.value == role_data['color']
+                    and role.hoist == role_data['hoist'] and role.mentionable == role_data['mentionable']
+                )
+                if unchanged:
+                    self.stats["unchanged"] += 1
+                    continue
+                if role >= bot_top:
+                    self.log(f"  警告：身份组 @{role.name} 层级不低于机器人，无法更新，保持原样。", 'warn')
+                    self.stats["failed"] += 1
+                    continue
+                ops.append(("role_edit", "updated", f"更新身份组 @{role.name}", lambda role=role, d=role_data: role.edit(
+                    permissions=discord.Permissions(d['permissions']), color=discord.Color(d['color']),
+                    hoist=d['hoist'], mentionable=d['mentionable'], reason=RESTORE_REASON)))
+                op_keys.append(None)
+            else:
+                ops.append(("role_create", "created", f"创建身份组 @{role_data['name']}", lambda d=role_data: self.guild.create_role(
+                    name=d['name'], permissions=discord.Permissions(d['permissions']), color=discord.Color(d['color']),
+                    hoist=d['hoist'], mentionable=d['mentionable'], reason=RESTORE_REASON)))
+                op_keys.append(role_data['original_id'])
+
+        # 备份中不存在的身份组一并删除，与创建/更新互不依赖，放在同一批并发执行
+        for leftovers in live_by_name.values():
+            for role in leftovers:
+                if role >= bot_top:
+                    continue
+                ops.append(("role_delete", "deleted", f"删除身份组 @{role.name}", lambda role=role: role.delete(reason=RESTORE_REASON)))
+                op_keys.append(None)
+
+        results = await self._run_stage(ops)
+        for original_id, result in zip(op_keys, results):
+            if original_id and isinstance(result, discord.Role):
+                self.role_map[original_id] = result
+
+        await self._restore_role_order()
+
+    async def _restore_role_order(self):
+        """并发创建会打乱顺序，最后用一次批量请求按备份顺序 (从高到低) 排列身份组。"""
+        bot_top = self.guild.me.top_role
+        desired = []
+        for role_data in self.backup.get('roles', []):
+            role = self.role_map.get(role_data['original_id'])
+            if role and role < bot_top and role not in desired:
+                desired.append(role)
+        if len(desired) < 2:
+            return
+        current = sorted(desired, key=lambda r: (r.position, r.id), reverse=True)
+        if [r.id for r in current] == [r.id for r in desired] and len({r.position for r in desired}) == len(desired):
+            return
+        start = min(max(r.position for r in desired) + len(desired), bot_top.position - 1)
+        positions = {role: max(1, start - i) for i, role in enumerate(desired)}
+        try:
+            await self.guild.edit_role_positions(positions=positions, reason=RESTORE_REASON)
+            self.log(f"  已按备份顺序重新排列 {len(positions)} 个身份组。")
+        except discord.HTTPException as e:
+            self.log(f"  警告：调整身份组顺序失败: {e}", 'warn')
+
+    # ---------------------------------------------------------------
+    # 阶段 2: 分类
+    # ---------------------------------------------------------------
+    async def _restore_categories(self):
+        live_by_name = defaultdict(list)
+        for category in sorted(self.guild.categories, key=lambda c: c.position):
+            live_by_name[category.name].append(category)
+
+        ops, op_keys = [], []
+        for position, cat_data in enumerate(self.backup.get('categories', [])):
+            overwrites = self._build_overwrites(cat_data.get('overwrites'))
+            candidates = live_by_name.get(cat_data['name'])
+            if candidates:
+                category = candidates.pop(0)
+                self.category_map[cat_data['original_id']] = category
+                self.matched_channel_ids.add(category.id)
+                if _overwrites_signature(category.overwrites) == _overwrites_signature(overwrites):
+                    self.stats["unchanged"] += 1
+                    continue
+                ops.append(("channel_edit", "updated", f"更新分类 {category.name} 的权限", lambda c=category, o=overwrites: c.edit(
+                    overwrites=self._with_live_default(c, o), reason=RESTORE_REASON)))
+                op_keys.append(None)
+            else:
+                ops.append(("channel_create", "created", f"创建分类 {cat_data['name']}", lambda d=cat_data, o=overwrites, p=position: self.guild.create_category(
+                    name=d['name'], overwrites=o, position=p, reason=RESTORE_REASON)))
+                op_keys.append(cat_data['original_id'])
+
+        results = await self._run_stage(ops)
+        for original_id, result in zip(op_keys, results):
+            if isinstance(result, discord.CategoryChannel):
+                self.matched_channel_ids.add(result.id)
+                if original_id:
+                    self.category_map[original_id] = result
+
+    # ---------------------------------------------------------------
+    # 阶段 3: 文本/语音频道
+    # ---------------------------------------------------------------
+    async def _restore_channels(self):
+        live_by_key = defaultdict(list)
+        for channel in sorted(self.guild.channels, key=lambda c: c.position):
+            if isinstance(channel, (discord.TextChannel, discord.VoiceChannel)):
+                live_by_key[(type(channel), channel.name, channel.category_id)].append(channel)
+
+        ops = []
+        for kind, list_key in ((discord.TextChannel, 'text_channels'), (discord.VoiceChannel, 'voice_channels')):
+            for position, chan_data in enumerate(self.backup.get(list_key, [])):
+                category = self.category_map.get(chan_data.get('category_original_id'))
+                overwrites = self._build_overwrites(chan_data.get('overwrites'))
+                candidates = live_by_key.get((kind, chan_data['name'], category.id if category else None))
+                if candidates:
+                    channel = candidates.pop(0)
+                    self.matched_channel_ids.add(channel.id)
+                    changes = {}
+                    if _overwrites_signature(channel.overwrites) != _overwrites_signature(overwrites):
+                        changes['overwrites'] = self._with_live_default(channel, overwrites)
+                    if kind is discord.TextChannel:
+                        if (channel.topic or None) != (chan_data.get('topic') or None):
+                            changes['topic'] = chan_data.get('topic')
+                    else:
+                        if channel.user_limit != chan_data.get('user_limit', 0):
+                            changes['user_limit'] = chan_data.get('user_limit', 0)
+                        bitrate = self._clamp_bitrate(chan_data.get('bitrate'))
+                        if channel.bitrate != bitrate:
+                            changes['bitrate'] = bitrate
+                    if not changes:
+                        self.stats["unchanged"] += 1
+                        continue
+                    ops.append(("channel_edit", "updated", f"更新频道 #{channel.name}", lambda c=channel, kw=changes: c.edit(reason=RESTORE_REASON, **kw)))
+                elif kind is discord.TextChannel:
+                    ops.append(("channel_create", "created", f"创建文本频道 #{chan_data['name']}", lambda d=chan_data, c=category, o=overwrites, p=position: self.guild.create_text_channel(
+                        name=d['name'], topic=d.get('topic'), category=c, overwrites=o, position=p, reason=RESTORE_REASON)))
+                else:
+                    ops.append(("channel_create", "created", f"创建语音频道 #{chan_data['name']}", lambda d=chan_data, c=category, o=overwrites, p=position: self.guild.create_voice_channel(
+                        name=d['name'], category=c, user_limit=d.get('user_limit', 0), bitrate=self._clamp_bitrate(d.get('bitrate')),
+                        overwrites=o, position=p, reason=RESTORE_REASON)))
+
+        for result in await self._run_stage(ops):
+            if result is not None:
+                self.matched_channel_ids.add(result.id)
+
+    # ---------------------------------------------------------------
+    # 阶段 4: 清理备份中不存在的频道与分类
+    # ---------------------------------------------------------------
+    async def _delete_leftover_channels(self):
+        leftovers = [c for c in self.guild.channels if c.id not in self.matched_channel_ids]
+        # 先删子频道再删分类，避免分类先被删除时其子频道被逐个移到顶层
+        for group in ([c for c in leftovers if not isinstance(c, discord.CategoryChannel)],
+                      [c for c in leftovers if isinstance(c, discord.CategoryChannel)]):
+            await self._run_stage([
+                ("channel_delete", "deleted", f"删除频道 #{channel.name}", lambda c=channel: c.delete(reason=RESTORE_REASON))
+                for channel in group
+            ])
+
+    async def run(self) -> Dict[str, int]:
+        stages = (
+            ("身份组", self._restore_roles),
+            ("分类", self._restore_categories),
+            ("文本/语音频道", self._restore_channels),
+            ("清理多余频道", self._delete_leftover_channels),
+        )
+        for index, (name, stage) in enumerate(stages, start=1):
+            self.log(f'--- 阶段 {index}: {name} ---', 'warn')
+            await stage()
+            self.log(f'阶段 {index} 完成。', 'success')
+        return self.stats
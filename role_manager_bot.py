@@ -4,9 +4,20 @@
 # ===================================================================
 # == 【核心修复】Eventlet 猴子补丁必须在所有网络相关库导入之前执行
 # ===================================================================
+import os
+import sys
+from dotenv import load_dotenv
+load_dotenv() # WEB_PANEL_MODE 决定是否打补丁，需要先读取 .env
 import eventlet
 import eventlet.wsgi # <---【核心修复】添加这一行
-eventlet.monkey_patch()
+
+# thread:  Web 面板运行在机器人进程的 eventlet 线程中 (默认)
+# process: Web 面板运行在独立的工作进程中 (python role_manager_bot.py --web-worker)，经由 bot_rpc 与机器人通信；
+#          机器人进程本身不再打 eventlet 补丁
+WEB_PANEL_MODE = os.environ.get("WEB_PANEL_MODE", "thread").strip().lower()
+IS_WEB_WORKER = WEB_PANEL_MODE == "process" and "--web-worker" in sys.argv
+if WEB_PANEL_MODE != "process" or IS_WEB_WORKER:
+    eventlet.monkey_patch()
 # ===================================================================
 
 import discord
@@ -37,22 +48,37 @@ except ImportError:
 try:
     from alipay.aop.api.AlipayClientConfig import AlipayClientConfig
     from alipay.aop.api.DefaultAlipayClient import DefaultAlipayClient
-    from alipay.aop.api.request.AlipayTradePrecreateRequest import AlipayTradePrecreateRequest
-    from alipay.aop.api.util.SignatureUtils import verify_with_rsa
     ALIPAY_SDK_AVAILABLE = True
     logging.info("Successfully imported official alipay-sdk-python.")
 except ImportError:
     ALIPAY_SDK_AVAILABLE = False
     logging.critical("CRITICAL: 'alipay-sdk-python' not found...")
     
-import qrcode
 import io
-import html
+import gzip
 from collections import deque
 import sys
 import database
+import restore_planner
+import backup_store
+import broadcast_engine
+import transcript_writer
+import transcript_search
+import payment_inbox
+import alipay_verify
+import payment_gateway
+import expiry_scheduler
+import web_auth_cache
+import sub_account_auth
+import socket_event_bus
+import guild_snapshot
+import ticket_message_cache
+import ticket_ai_state
+import ai_reply_debouncer
+import bot_rpc
 import threading
-from http.server import HTTPServer, BaseHTTPRequestHandler
+import secrets
+import subprocess
 
 # 在尝试获取环境变量之前加载 .env 文件
 # load_dotenv() 会自动在当前运行目录下寻找一个叫做 .env 的文件
@@ -92,7 +118,6 @@ if ALIPAY_SDK_AVAILABLE and ALIPAY_APP_ID and ALIPAY_PRIVATE_KEY_STR and ALIPAY_
     try:
         # --- 使用 pycryptodome 预先加载和验证私钥格式 ---
         # 这一步能确保我们从文件读取的密钥内容是有效的
-        from Crypto.PublicKey import RSA
         RSA.import_key(ALIPAY_PRIVATE_KEY_STR)
         logging.info("Private key format check passed (loadable by pycryptodome).")
         # --- 预检验结束 ---
@@ -130,6 +155,9 @@ else:
     logging.critical(f"  - Private Key Loaded: {bool(ALIPAY_PRIVATE_KEY_STR)}")
     logging.critical(f"  - Public Key Loaded: {bool(ALIPAY_PUBLIC_KEY_FOR_SDK)}")
 
+# 复用上面配置好的客户端；precreate 与二维码渲染都在线程池中执行 (见 payment_gateway.py)
+alipay_gateway = payment_gateway.PaymentGateway(alipay_client, ALIPAY_NOTIFY_URL) if alipay_client else None
+
 
 
 # --- 充值与通知系统配置 (增加启动诊断) ---
@@ -319,64 +347,53 @@ bot.approved_bot_whitelist = {}
 bot.persistent_views_added_in_setup = False
 
 # ==========================================================
-# == 轻量级 HTTP 服务器，用于接收支付宝回调
+# == 支付宝回调监听 (多线程 HTTP 服务器 + 持久化收件箱，见 payment_inbox.py)
 # ==========================================================
-class AlipayCallbackHandler(BaseHTTPRequestHandler):
-    def do_POST(self):
-        try:
-            # 1. 获取并解析POST数据
-            content_length = int(self.headers['Content-Length'])
-            post_data = self.rfile.read(content_length)
-            params = dict(urllib.parse.parse_qsl(post_data.decode('utf-8')))
-            logging.info(f"Received Alipay POST notify: {params}")
-
-            # 2. 验签
-            sign = params.pop('sign')
-            params.pop('sign_type')
-            message_to_verify = "&".join(f"{k}={v}" for k, v in sorted(params.items()))
-
-            is_verified = verify_with_rsa(
-                message_to_verify.encode('utf-8'),
-                sign.encode('utf-8'),
-                ALIPAY_PUBLIC_KEY_FOR_VERIFY.encode('utf-8'),
-                "RSA2"
-            )
-
-            if not is_verified:
-                logging.warning("Alipay signature verification FAILED.")
-                self.send_response(200)
-                self.end_headers()
-                self.wfile.write(b'failure')
-                return
+payment_inbox_worker: Optional[payment_inbox.PaymentInboxWorker] = None
 
-            # 3. 处理业务逻辑
-            logging.info("Alipay signature verification SUCCEEDED.")
-            trade_status = params.get('trade_status')
-            
-            if trade_status == 'TRADE_SUCCESS':
-                # 在一个新的线程或使用 asyncio.run_coroutine_threadsafe 来处理，避免阻塞HTTP服务器
-                asyncio.run_coroutine_threadsafe(process_successful_payment(params), bot.loop)
+alipay_verifier: Optional[alipay_verify.AlipayVerifier] = None
+if ALIPAY_PUBLIC_KEY_FOR_VERIFY:
+    try:
+        alipay_verifier = alipay_verify.AlipayVerifier(ALIPAY_PUBLIC_KEY_FOR_VERIFY)
+    except (ValueError, IndexError, TypeError) as e:
+        logging.critical(f"CRITICAL: 无法解析用于回调验签的支付宝公钥: {e}。所有支付宝通知都将验签失败。")
 
-            self.send_response(200)
-            self.end_headers()
-            self.wfile.write(b'success')
+def verify_alipay_notification(params: Dict[str, str]) -> bool:
+    # 公钥在启动时解析一次；同一通知的重复推送命中短期去重缓存 (见 alipay_verify.py)
+    return alipay_verifier is not None and alipay_verifier.verify(params)
 
-        except Exception as e:
-            logging.error(f"Error handling Alipay callback: {e}", exc_info=True)
-            self.send_response(500)
-            self.end_headers()
-            self.wfile.write(b'failure')
+def _wake_payment_inbox_worker():
+    # 在 HTTP 处理线程中调用；工作任务尚未启动时，启动后会自动处理积压的通知
+    if payment_inbox_worker:
+        payment_inbox_worker.wake()
 
 def run_http_server(port=8080):
-    server_address = ('', port)
-    httpd = HTTPServer(server_address, AlipayCallbackHandler)
+    httpd = payment_inbox.NotifyHTTPServer(('', port), verify_alipay_notification, _wake_payment_inbox_worker)
     logging.info(f"Starting Alipay callback listener on port {port}...")
     httpd.serve_forever()
 
+# ==========================================================
+# == 到期调度 (待支付订单超时、禁言到期，见 expiry_scheduler.py)
+# ==========================================================
+expiry_manager: Optional[expiry_scheduler.ExpiryScheduler] = None
+
+def schedule_expiry(kind: str, item_id: Optional[int], deadline: float):
+    # setup_hook 之前创建的记录会在调度器启动时从数据库加载
+    if expiry_manager and item_id:
+        expiry_manager.schedule(kind, item_id, deadline)
+
+def cancel_expiry(kind: str, item_id: Optional[int]):
+    if expiry_manager and item_id:
+        expiry_manager.cancel(kind, item_id)
+
 # ==========================================================
 # == 异步处理支付成功的业务逻辑
 # ==========================================================
-async def process_successful_payment(params: Dict[str, Any]):
+async def process_successful_payment(params: Dict[str, Any]) -> bool:
+    """
+    由 PaymentInboxWorker 调用，必须幂等：同一通知可能被处理多次 (支付宝重发、处理途中重启)。
+    返回 True 表示已处理完毕 (包括决定忽略)，False 表示暂时失败、稍后重试。
+    """
     out_trade_no = params.get('out_trade_no')
     alipay_trade_no = params.get('trade_no')
     total_amount_str = params.get('total_amount')
@@ -385,50 +402,60 @@ async def process_successful_payment(params: Dict[str, Any]):
     order = database.db_get_recharge_request_by_out_trade_no(out_trade_no)
     if not order:
         logging.error(f"Order not found in DB for out_trade_no: {out_trade_no}")
-        return
+        return True
 
-    # 2. 检查订单状态，防止重复处理
-    if order['status'] != 'PENDING_PAYMENT':
+    # 2. 检查订单状态，防止重复处理 (已标记 PAID 但尚未入账的订单继续入账；超时后才付款的 EXPIRED 订单照常入账)
+    resuming = order['status'] == 'PAID' and order['alipay_trade_no'] == alipay_trade_no
+    if order['status'] not in ('PENDING_PAYMENT', 'EXPIRED') and not resuming:
         logging.warning(f"Order {out_trade_no} already processed. Status: {order['status']}")
-        return
-        
-    # 3. 检查支付宝交易号是否已被使用
-    if database.db_is_alipay_trade_no_processed(alipay_trade_no):
-        logging.error(f"CRITICAL: Alipay trade_no {alipay_trade_no} has already been processed!")
-        database.db_update_recharge_request_status(order['request_id'], 'DUPLICATE_ALIPAY_TRADE', f"Duplicate Alipay trade_no: {alipay_trade_no}")
-        return
-
-    # 4. 核对金额
-    paid_amount = float(total_amount_str)
-    requested_amount = float(order['requested_cny_amount'])
-    if abs(paid_amount - requested_amount) > 0.01:
-        logging.error(f"Amount mismatch for {out_trade_no}. Expected {requested_amount}, paid {paid_amount}")
-        database.db_update_recharge_request_status(order['request_id'], 'AMOUNT_ISSUE', f"Expected {requested_amount}, paid {paid_amount}")
-        return
+        return True
 
-    # 5. 更新订单状态为 "PAID"
-    if not database.db_mark_recharge_as_paid(order['request_id'], alipay_trade_no, paid_amount):
-        logging.error(f"Failed to mark order {out_trade_no} as PAID in DB.")
-        return
-
-    # 6. 给用户上分
+    try:
+        paid_amount = float(total_amount_str)
+    except (TypeError, ValueError):
+        logging.error(f"Invalid total_amount '{total_amount_str}' in notification for {out_trade_no}")
+        return True
+
+    if not resuming:
+        # 3. 检查支付宝交易号是否已被使用
+        if database.db_is_alipay_trade_no_processed(alipay_trade_no):
+            logging.error(f"CRITICAL: Alipay trade_no {alipay_trade_no} has already been processed!")
+            database.db_update_recharge_request_status(order['request_id'], 'DUPLICATE_ALIPAY_TRADE', f"Duplicate Alipay trade_no: {alipay_trade_no}")
+            return True
+
+        # 4. 核对金额
+        requested_amount = float(order['requested_cny_amount'])
+        if abs(paid_amount - requested_amount) > 0.01:
+            logging.error(f"Amount mismatch for {out_trade_no}. Expected {requested_amount}, paid {paid_amount}")
+            database.db_update_recharge_request_status(order['request_id'], 'AMOUNT_ISSUE', f"Expected {requested_amount}, paid {paid_amount}")
+            return True
+
+        # 5. 更新订单状态为 "PAID"
+        if not database.db_mark_recharge_as_paid(order['request_id'], alipay_trade_no, paid_amount):
+            logging.error(f"Failed to mark order {out_trade_no} as PAID in DB.")
+            return False # 重试时会重新读取订单状态
+        cancel_expiry("recharge", order['request_id'])
+
+    # 6. 给用户上分并把订单更新为 "COMPLETED" (同一事务，只会入账一次)
     user_id = int(order['user_id'])
     guild_id = int(order['guild_id'])
     amount_to_credit = int(paid_amount * RECHARGE_CONVERSION_RATE)
-    
-    if database.db_update_user_balance(guild_id, user_id, amount_to_credit, is_delta=True, default_balance=ECONOMY_DEFAULT_BALANCE):
-        logging.info(f"Successfully credited {amount_to_credit} units to user {user_id} for order {out_trade_no}")
-        # 7. 更新订单状态为 "COMPLETED"
-        database.db_mark_recharge_as_completed(order['request_id'])
-        
-        # 8. (可选) 私信通知用户
-        try:
-            user = await bot.fetch_user(user_id)
-            await user.send(f"🎉 你的充值已成功到账！\n- 订单号: `{out_trade_no}`\n- 充值金额: {paid_amount:.2f} 元\n- 获得: {amount_to_credit} 金币")
-        except Exception as e:
-            logging.warning(f"Failed to send DM notification to user {user_id}: {e}")
-    else:
-        logging.critical(f"CRITICAL: FAILED to update balance for user {user_id} for order {out_trade_no} AFTER marking as PAID.")
+
+    credited = database.db_credit_recharge_and_complete(order['request_id'], guild_id, user_id, amount_to_credit, ECONOMY_DEFAULT_BALANCE)
+    if credited is None:
+        logging.critical(f"CRITICAL: FAILED to update balance for user {user_id} for order {out_trade_no} AFTER marking as PAID. Will retry.")
+        return False
+    if not credited:
+        return True # 已在之前的处理中入账
+    logging.info(f"Successfully credited {amount_to_credit} units to user {user_id} for order {out_trade_no}")
+
+    # 7. (可选) 私信通知用户
+    try:
+        user = await bot.fetch_user(user_id)
+        await user.send(f"🎉 你的充值已成功到账！\n- 订单号: `{out_trade_no}`\n- 充值金额: {paid_amount:.2f} 元\n- 获得: {amount_to_credit} 金币")
+    except Exception as e:
+        logging.warning(f"Failed to send DM notification to user {user_id}: {e}")
+    return True
 
 class CloseTicketView(ui.View):
     """
@@ -600,6 +627,13 @@ class PersistentTicketCreationView(ui.View):
 # --- 新增：机器人白名单文件存储 (可选, 但推荐) ---
 BOT_WHITELIST_FILE = "bot_whitelist.json" # <--- 新增这一行 (如果使用文件存储)
 
+# --- 票据聊天记录 ---
+TRANSCRIPT_GZIP = os.environ.get("TRANSCRIPT_GZIP", "true").lower() == "true" # 以 .html.gz 保存聊天记录
+
+# --- 服务器备份版本库 ---
+SCHEDULED_BACKUP_INTERVAL_HOURS = float(os.environ.get("SCHEDULED_BACKUP_INTERVAL_HOURS", "24")) # 设为 0 关闭定时备份
+guild_backup_store = backup_store.BackupStore()
+
 # --- 经济系统配置 ---
 ECONOMY_ENABLED = True  # 经济系统全局开关
 ECONOMY_CURRENCY_NAME = "金币"
@@ -896,223 +930,23 @@ async def get_deepseek_dialogue_response(session, api_key, model, messages_for_a
 # --- (get_deepseek_dialogue_response 函数定义结束) ---
 
 # --- Helper Function: Generate HTML Transcript for Tickets ---
-# async def generate_ticket_transcript_html(channel: discord.TextChannel) -> Optional[str]:
-# ... (接下来的函数定义)
-    """使用 DeepSeek API 检查内容。返回中文违规类型或 None。"""
-    if not DEEPSEEK_API_KEY:
-        # print("DEBUG: DeepSeek API Key 未设置，跳过检查。")
-        return None # Skip if no key
-
-    headers = {
-        "Content-Type": "application/json",
-        "Authorization": f"Bearer {DEEPSEEK_API_KEY}"
-    }
-
-    # !!! --- 重要：设计和优化你的 Prompt --- !!!
-    # --- V2: 要求返回中文分类 ---
-    prompt = f"""
-    请分析以下 Discord 消息内容是否包含严重的违规行为。
-    严重违规分类包括：仇恨言论、骚扰/欺凌、露骨的 NSFW 内容、严重威胁。
-    - 如果检测到明确的严重违规，请【仅】返回对应的中文分类名称（例如：“仇恨言论”）。
-    - 如果内容包含一些轻微问题（如刷屏、普通脏话）但【不构成】上述严重违规，请【仅】返回：“轻微违规”。
-    - 如果内容安全，没有任何违规，请【仅】返回：“安全”。
-
-    消息内容：“{message_content}”
-    分析结果："""
-    # !!! --- Prompt 结束 --- !!!
-
-    data = {
-        "model": DEEPSEEK_MODEL,
-        "messages": [{"role": "user", "content": prompt}],
-        "max_tokens": 30, # 限制返回长度，只需要分类名称
-        "temperature": 0.1, # 较低的温度，追求更确定的分类
-        "stream": False
-    }
-
-    loop = asyncio.get_event_loop()
-    try:
-        # 使用 run_in_executor 避免阻塞事件循环
-        response = await loop.run_in_executor(
-            None,
-            lambda: requests.post(DEEPSEEK_API_URL, headers=headers, json=data, timeout=8) # 设置超时
-        )
-        response.raise_for_status() # 检查 HTTP 错误
-        result = response.json()
-        api_response_text = result.get("choices", [{}])[0].get("message", {}).get("content", "").strip()
-
-        # print(f"DEBUG: DeepSeek 对 '{message_content[:30]}...' 的响应: {api_response_text}") # Debug log
-
-        # --- 处理中文响应 ---
-        if not api_response_text: # 空响应视为安全
-             return None
-        if api_response_text == "安全":
-            return None
-        if api_response_text == "轻微违规":
-             # 对于轻微违规，我们目前也视为不需要机器人直接干预（交给刷屏或本地违禁词处理）
-             return None
-        # 如果不是 "安全" 或 "轻微违规"，则假定返回的是中文的严重违规类型
-        # （例如 “仇恨言论”, “骚扰/欺凌” 等）
-        return api_response_text
-
-    except requests.exceptions.Timeout:
-        print(f"❌ 调用 DeepSeek API 超时")
-        return None
-    except requests.exceptions.RequestException as e:
-        print(f"❌ 调用 DeepSeek API 时发生网络错误: {e}")
-        return None
-    except json.JSONDecodeError:
-        print(f"❌ 解析 DeepSeek API 响应失败 (非 JSON): {response.text}")
-        return None
-    except Exception as e:
-        print(f"❌ DeepSeek 检查期间发生意外错误: {e}")
-        return None
-
-        # --- Helper Function: Generate HTML Transcript for Tickets ---
-async def generate_ticket_transcript_html(channel: discord.TextChannel) -> Optional[str]:
-    """Generates an HTML transcript for the given text channel."""
-    if not isinstance(channel, discord.TextChannel):
-        return None
-
-    messages_history = []
-    # Fetch all messages, oldest first.
-    async for message in channel.history(limit=None, oldest_first=True):
-        messages_history.append(message)
-
-    if not messages_history:
-        return f"""
-        <!DOCTYPE html><html lang="zh-CN"><head><meta charset="UTF-8"><title>票据记录 - {html.escape(channel.name)}</title>
-        <style>body {{ font-family: Arial, sans-serif; margin: 20px; background-color: #2C2F33; color: #DCDDDE; text-align: center; }} 
-        .container {{ background-color: #36393F; padding: 20px; border-radius: 8px; display: inline-block; }}</style></head>
-        <body><div class="container"><h1>票据 #{html.escape(channel.name)}</h1><p>此票据中没有消息。</p></div></body></html>
-        """
-
-    message_html_blocks = []
-    for msg in messages_history:
-        author_name_full = html.escape(f"{msg.author.name}#{msg.author.discriminator if msg.author.discriminator != '0' else ''}")
-        author_id = msg.author.id
-        avatar_url = msg.author.display_avatar.url
-        timestamp = msg.created_at.strftime("%Y-%m-%d %H:%M:%S UTC")
-        
-        content_escaped = ""
-        is_system_message = msg.type != discord.MessageType.default and msg.type != discord.MessageType.reply
-
-        if is_system_message:
-            if msg.system_content:
-                content_escaped = f"<em>系统消息: {html.escape(msg.system_content)}</em>"
-            else:
-                content_escaped = f"<em>(系统消息: {msg.type.name})</em>"
-        elif msg.content:
-            content_escaped = html.escape(msg.content).replace("\n", "<br>")
-
-        attachments_html = ""
-        if msg.attachments:
-            links = []
-            for attachment in msg.attachments:
-                links.append(f'<a href="{attachment.url}" target="_blank" rel="noopener noreferrer">[{html.escape(attachment.filename)}]</a>')
-            attachments_html = f'<div class="attachments">附件: {", ".join(links)}</div>'
-
-        embeds_html = ""
-        if msg.embeds:
-            embed_parts = []
-            for embed_idx, embed in enumerate(msg.embeds):
-                embed_str = f'<div class="embed embed-{embed_idx+1}">'
-                if embed.title:
-                    embed_str += f'<div class="embed-title">{html.escape(embed.title)}</div>'
-                if embed.description:
-                    escaped_description = html.escape(embed.description).replace("\n", "<br>")
-                    embed_str += f'<div class="embed-description">{escaped_description}</div>'
-                
-                fields_html = ""
-                if embed.fields:
-                    fields_html += '<div class="embed-fields">'
-                    for field in embed.fields:
-                        field_name = html.escape(field.name) if field.name else " "
-                        field_value = html.escape(field.value).replace("\n", "<br>") if field.value else " "
-                        inline_class = " embed-field-inline" if field.inline else ""
-                        fields_html += f'<div class="embed-field{inline_class}"><strong>{field_name}</strong><br>{field_value}</div>'
-                    fields_html += '</div>'
-                embed_str += fields_html
-
-                if embed.footer and embed.footer.text:
-                    embed_str += f'<div class="embed-footer">{html.escape(embed.footer.text)}</div>'
-                if embed.author and embed.author.name:
-                    embed_str += f'<div class="embed-author">作者: {html.escape(embed.author.name)}</div>'
-                if not embed.title and not embed.description and not embed.fields:
-                    embed_str += '<em>(嵌入内容)</em>'
-                embed_str += '</div>'
-                embed_parts.append(embed_str)
-            embeds_html = "".join(embed_parts)
-
-        message_block = f"""
-        <div class="message {'system-message' if is_system_message else ''}">
-            <div class="message-header">
-                <img src="{avatar_url}" alt="{html.escape(msg.author.name)}'s avatar" class="author-avatar">
-                <div class="author-details">
-                    <span class="author" title="User ID: {author_id}">{author_name_full}</span>
-                </div>
-                <span class="timestamp">{timestamp}</span>
-            </div>
-            <div class="content-area">
-                {f'<div class="content"><p>{content_escaped}</p></div>' if content_escaped else ""}
-                {attachments_html}
-                {embeds_html}
-            </div>
-        </div>
-        """
-        message_html_blocks.append(message_block)
-
-    full_html_template = f"""
-    <!DOCTYPE html>
-    <html lang="zh-CN">
-    <head>
-        <meta charset="UTF-8">
-        <meta name="viewport" content="width=device-width, initial-scale=1.0">
-        <title>票据记录 - {html.escape(channel.name)}</title>
-        <style>
-            body {{ font-family: 'Whitney', 'Helvetica Neue', Helvetica, Arial, sans-serif; margin: 0; padding: 0; background-color: #36393f; color: #dcddde; font-size: 16px; line-height: 1.6; }}
-            .container {{ max-width: 90%; width: 800px; margin: 20px auto; background-color: #36393f; padding: 20px; border-radius: 8px; box-shadow: 0 0 15px rgba(0,0,0,0.5); }}
-            .header {{ text-align: center; border-bottom: 1px solid #4f545c; padding-bottom: 15px; margin-bottom: 20px; }}
-            .header h1 {{ color: #ffffff; margin: 0 0 5px 0; font-size: 24px; }}
-            .header p {{ font-size: 12px; color: #b9bbbe; margin: 0; }}
-            .message {{ display: flex; flex-direction: column; padding: 12px 0; border-top: 1px solid #40444b; }}
-            .message:first-child {{ border-top: none; }}
-            .message-header {{ display: flex; align-items: center; margin-bottom: 6px; }}
-            .author-avatar {{ width: 40px; height: 40px; border-radius: 50%; margin-right: 12px; background-color: #2f3136; }}
-            .author-details {{ display: flex; flex-direction: column; flex-grow: 1; }}
-            .author {{ font-weight: 500; color: #ffffff; font-size: 1em; }}
-            .timestamp {{ font-size: 0.75em; color: #72767d; margin-left: 8px; white-space: nowrap; }}
-            .content-area {{ margin-left: 52px; /* Align with author name, after avatar */ }}
-            .content p {{ margin: 0 0 5px 0; white-space: pre-wrap; word-wrap: break-word; color: #dcddde; }}
-            .attachments, .embed {{ margin-top: 8px; font-size: 0.9em; }}
-            .attachments {{ padding: 5px; background-color: #2f3136; border-radius: 3px; }}
-            .attachment a {{ color: #00aff4; text-decoration: none; margin-right: 5px; }}
-            .attachment a:hover {{ text-decoration: underline; }}
-            .embed {{ border-left: 4px solid #4f545c; padding: 10px; background-color: #2f3136; border-radius: 4px; margin-bottom: 5px; }}
-            .embed-title {{ font-weight: bold; color: #ffffff; margin-bottom: 4px; }}
-            .embed-description {{ color: #b9bbbe; font-size: 0.95em; }}
-            .embed-fields {{ display: flex; flex-wrap: wrap; margin-top: 8px; }}
-            .embed-field {{ padding: 5px; margin-bottom: 5px; flex-basis: 100%; }}
-            .embed-field-inline {{ flex-basis: calc(50% - 10px); margin-right: 10px; }} /* Adjust for closer to Discord layout */
-            .embed-field strong {{ color: #ffffff; }}
-            .embed-footer, .embed-author {{ font-size: 0.8em; color: #72767d; margin-top: 5px; }}
-            .system-message .content p {{ font-style: italic; color: #72767d; }}
-            em {{ color: #b9bbbe; }}
-        </style>
-    </head>
-    <body>
-        <div class="container">
-            <div class="header">
-                <h1>票据记录: #{html.escape(channel.name)}</h1>
-                <p>服务器: {html.escape(channel.guild.name)} ({channel.guild.id})</p>
-                <p>频道 ID: {channel.id}</p>
-                <p>生成时间: {datetime.datetime.now(datetime.timezone.utc).strftime("%Y-%m-%d %H:%M:%S UTC")}</p>
-            </div>
-            {''.join(message_html_blocks)}
-        </div>
-    </body>
-    </html>
+async def save_ticket_transcript(channel: discord.TextChannel, ticket_id: Optional[int] = None):
+    """
+    将票据频道的聊天记录流式写入 transcripts/ 目录，返回 (文件名, 路径)。
+    TRANSCRIPT_GZIP 开启时保存为 .html.gz，Web 面板以 gzip 编码直接返回给浏览器。
+    传入 ticket_id 时同时把消息写入全文搜索索引。
     """
-    return full_html_template.strip()
+    extension = ".html.gz" if TRANSCRIPT_GZIP else ".html"
+    transcript_filename = f"transcript-{channel.guild.id}-{channel.id}-{int(time.time())}{extension}"
+    transcript_path = os.path.join(transcript_writer.TRANSCRIPT_FOLDER, transcript_filename)
+    indexer = transcript_search.TranscriptIndexer(ticket_id, channel.guild.id, loop=asyncio.get_running_loop()) if ticket_id else None
+    stats = await transcript_writer.write_ticket_transcript(channel, transcript_path, compress=TRANSCRIPT_GZIP,
+                                                           on_message=indexer.add_message if indexer else None)
+    if indexer:
+        await indexer.finish_async()
+    if stats:
+        print(f"[Transcript] #{channel.name}: 已写入 {stats['message_count']} 条消息 ({stats['bytes'] / 1024:.0f} KiB)")
+    return transcript_filename, transcript_path
 
 def save_bot_whitelist_to_file():
     """将机器人白名单保存到JSON文件。"""
@@ -1175,6 +1009,7 @@ def load_server_settings():
                 guild_knowledge_bases = {int(k): v for k, v in data.get("guild_knowledge_bases", {}).items()}
                 welcome_message_settings = data.get("welcome_message_settings", {})
                 web_permissions = {int(k): v for k, v in data.get("web_permissions", {}).items()} # 【新增】
+                web_auth.clear()
                 print(f"[Settings] 已成功从 {SERVER_SETTINGS_FILE} 加载服务器设置。")
     except json.JSONDecodeError:
         print(f"[Settings Error] 解析 {SERVER_SETTINGS_FILE} 失败，将使用空设置启动。")
@@ -1357,27 +1192,21 @@ async def on_interaction(interaction: discord.Interaction):
             await channel.send(f"⏳ {user.mention} 已请求关闭此票据。正在生成聊天记录并归档...")
 
             # 1. 生成并保存聊天记录
-            transcript_content = await generate_ticket_transcript_html(channel)
-            transcript_filename = f"transcript-{guild.id}-{channel.id}-{int(time.time())}.html"
-            transcript_folder = "transcripts"
-            os.makedirs(transcript_folder, exist_ok=True)
-            transcript_path = os.path.join(transcript_folder, transcript_filename)
-            with open(transcript_path, "w", encoding="utf-8") as f:
-                f.write(transcript_content)
+            transcript_filename, transcript_path = await save_ticket_transcript(channel, ticket_db_id)
 
             # 2. 发送给管理员日志频道 (你需要配置这个频道ID)
             admin_log_channel_id = PUBLIC_WARN_LOG_CHANNEL_ID # 使用您已有的公共日志频道ID
             admin_log_channel = guild.get_channel(admin_log_channel_id)
             if admin_log_channel:
                 try:
-                    await admin_log_channel.send(f"票据 `#{channel.name}` 已由 {user.mention} 关闭。聊天记录见附件。", file=discord.File(transcript_path, filename=transcript_filename))
+                    await admin_log_channel.send(f"票据 `#{channel.name}` 已由 {user.mention} 关闭。聊天记录见附件。", file=transcript_writer.open_transcript_for_upload(transcript_path, transcript_filename))
                 except Exception as e:
                     logging.warning(f"无法发送票据日志到管理员频道: {e}")
 
             # 3. 发送给用户
             try:
                 creator = await bot.fetch_user(ticket_info['creator_id'])
-                await creator.send(f"您在服务器 **{guild.name}** 创建的票据 `#{channel.name}` 已关闭。聊天记录副本见附件。", file=discord.File(transcript_path, filename=transcript_filename))
+                await creator.send(f"您在服务器 **{guild.name}** 创建的票据 `#{channel.name}` 已关闭。聊天记录副本见附件。", file=transcript_writer.open_transcript_for_upload(transcript_path, transcript_filename))
             except Exception as e:
                 logging.warning(f"无法私信票据记录给用户 {ticket_info['creator_id']}: {e}")
             
@@ -1686,6 +1515,7 @@ bot.persistent_views_added = False
 
 # 为加载 cogs 添加 setup_hook
 async def setup_hook_for_bot():
+    global payment_inbox_worker, expiry_manager
     print("正在运行 setup_hook...")
     
     # 加载音乐 Cog
@@ -1716,6 +1546,34 @@ async def setup_hook_for_bot():
     # 机器人会通过 on_interaction 事件监听器来捕获它们的交互，而不是依赖于预注册。
     # 所以我们把这里的 add_view 调用全部移除。
     
+    # 继续上次被中断的全局广播任务
+    bot.loop.create_task(resume_unfinished_broadcasts())
+
+    # 为历史聊天记录回填全文搜索索引
+    bot.loop.create_task(backfill_transcript_search_index())
+
+    # 处理支付宝通知收件箱 (包括上次退出前未处理完的通知)
+    if alipay_client:
+        payment_inbox_worker = payment_inbox.PaymentInboxWorker(bot.loop, process_successful_payment)
+        payment_inbox_worker.start()
+
+    # 在截止时间把超时未支付的订单标记为 EXPIRED、把到期的禁言记录设为失效
+    expiry_manager = expiry_scheduler.ExpiryScheduler(bot.loop)
+    expiry_manager.register("recharge", database.db_expire_recharge_requests,
+                            lambda: database.db_get_pending_recharge_expiries(payment_gateway.ORDER_TIMEOUT_SECONDS))
+    expiry_manager.register("mute", database.db_expire_mutes, database.db_get_active_mute_expiries)
+    expiry_manager.start()
+
+    # WEB_PANEL_MODE=process: 为 Web 工作进程提供快照、命令和请求转发
+    if bot_rpc_server:
+        register_bot_rpc_handlers(bot_rpc_server)
+        await bot_rpc_server.start()
+
+    # 启动定时增量备份
+    if SCHEDULED_BACKUP_INTERVAL_HOURS > 0:
+        bot.loop.create_task(scheduled_backup_loop())
+        print(f"[定时备份] 已启用，每 {SCHEDULED_BACKUP_INTERVAL_HOURS} 小时备份一次。")
+
     # 我们可以设置一个标志，表示 setup_hook 已运行
     bot.persistent_views_added_in_setup = True
     print("Setup_hook 已运行。注意：动态票据视图不再通过 add_view() 注册。")
@@ -1800,6 +1658,31 @@ async def on_app_command_error(interaction: discord.Interaction, error: app_comm
 # 将错误处理函数绑定到 bot 的指令树
 bot.tree.on_error = on_app_command_error
 
+# --- Events: 使 Web 面板授权缓存失效 ---
+@bot.event
+async def on_member_update(before: discord.Member, after: discord.Member):
+    if before.roles != after.roles:
+        web_auth.invalidate_member(after.guild.id, after.id)
+
+@bot.event
+async def on_member_remove(member: discord.Member):
+    web_auth.invalidate_member(member.guild.id, member.id)
+
+@bot.event
+async def on_guild_role_update(before: discord.Role, after: discord.Role):
+    # 身份组的 Discord 权限 (例如管理员) 会改变其所有成员的 Web 面板权限
+    if before.permissions != after.permissions:
+        web_auth.invalidate_guild(after.guild.id)
+
+@bot.event
+async def on_guild_role_delete(role: discord.Role):
+    web_auth.invalidate_guild(role.guild.id)
+
+@bot.event
+async def on_guild_update(before: discord.Guild, after: discord.Guild):
+    if before.owner_id != after.owner_id:
+        web_auth.invalidate_guild(after.id)
+
 # --- Event: Member Join - Assign Separator Roles & Welcome ---
 @bot.event
 async def on_member_join(member: discord.Member):
@@ -2185,7 +2068,7 @@ async def on_message(message: discord.Message):
 
     if ticket_info:
         # A. 转发消息到Web面板
-        if ticket_info['status'] in ['OPEN', 'CLAIMED'] and socketio:
+        if ticket_info['status'] in ['OPEN', 'CLAIMED'] and socket_events:
             msg_data = {
                 'id': str(message.id),
                 'author': {
@@ -2199,13 +2082,13 @@ async def on_message(message: discord.Message):
                 'timestamp': message.created_at.isoformat(),
                 'channel_id': str(message.channel.id)
             }
-            socketio.emit('new_ticket_message', msg_data, room=f'ticket_{message.channel.id}')
+            socket_events.publish('new_ticket_message', msg_data, room=f'ticket_{message.channel.id}')
         
         # B. 检查并处理AI托管的票据
-        # 【【【核心修复】】】使用简单的 await 调用，并增加日志
+        # 连续的多条消息由防抖调度器合并，只在用户停顿后回复一次；新消息会取消尚未发出的旧回复
         if ticket_info.get('is_ai_managed') and ticket_info['creator_id'] == message.author.id:
-            logging.info(f"[on_message] AI托管票据 {ticket_info['ticket_id']} 收到用户新消息，准备调用 handle_ai_ticket_reply...")
-            await handle_ai_ticket_reply(message)
+            logging.info(f"[on_message] AI托管票据 {ticket_info['ticket_id']} 收到用户新消息，已加入AI回复调度...")
+            ticket_ai_replies.submit(channel.id, lambda guard: handle_ai_ticket_reply(message, ticket_info, guard))
         
         return
     
@@ -2228,8 +2111,6 @@ async def on_message(message: discord.Message):
 
     # --- 6. 内容审核核心逻辑 (仅对非豁免用户执行) ---
     if not is_exempt:
-        loop = asyncio.get_running_loop()
-        
         async def handle_violation(violation_type_str: str, msg_content: str):
             print(f"[AUDIT] Detected violation: '{violation_type_str}' by {author.id}")
             
@@ -2244,7 +2125,7 @@ async def on_message(message: discord.Message):
             except Exception as del_err:
                 print(f"  - FAILED to auto-delete: {del_err}")
 
-            if socketio:
+            if socket_events:
                 event_data = {
                     'user': {'id': str(author.id), 'name': author.display_name, 'avatar_url': str(author.display_avatar.url)},
                     'message': {'id': str(message.id), 'content': msg_content[:500], 'channel_id': str(channel.id), 'channel_name': channel.name, 'jump_url': message.jump_url},
@@ -2258,7 +2139,7 @@ async def on_message(message: discord.Message):
                 
                 if event_id:
                     event_data['event_id'] = event_id
-                    await loop.run_in_executor(None, lambda: socketio.emit('new_violation', event_data, room=f'guild_{guild.id}'))
+                    socket_events.publish('new_violation', event_data, room=f'guild_{guild.id}')
                     print(f"  - Action: Logged to DB (Event ID: {event_id}) and sent 'new_violation' event to web audit room.")
                 else:
                     print("  - CRITICAL: Failed to log violation to database. Event was not sent to web panel.")
@@ -3432,17 +3313,17 @@ async def recharge_request_cmd(
         await interaction.followup.send(f"经济系统当前未启用，无法处理{ECONOMY_CURRENCY_NAME}充值请求。", ephemeral=True)
         return
 
-    if not ALIPAY_SDK_AVAILABLE or not alipay_client_config:
+    if not ALIPAY_SDK_AVAILABLE or not alipay_gateway:
         await interaction.followup.send("❌ 支付宝支付功能当前不可用，请联系管理员 (SDK配置问题)。", ephemeral=True)
-        logging.error("Alipay SDK not available or client_config not initialized for /recharge request.")
+        logging.error("Alipay SDK not available or client not initialized for /recharge request.")
         return
     
     # 详细检查配置是否仍为占位符
     is_config_placeholder = False
     if not ALIPAY_APP_ID or "请替换" in ALIPAY_APP_ID: is_config_placeholder = True
-    if not APP_PRIVATE_KEY_STR or "请在这里粘贴您" in APP_PRIVATE_KEY_STR: is_config_placeholder = True
+    if not ALIPAY_PRIVATE_KEY_STR or "请在这里粘贴您" in ALIPAY_PRIVATE_KEY_STR: is_config_placeholder = True
     if not ALIPAY_NOTIFY_URL or ("gjteampiaoj.ggff.net/alipay/notify" == ALIPAY_NOTIFY_URL and "请替换" in ALIPAY_NOTIFY_URL.lower()): is_config_placeholder = True 
-    if not ALIPAY_PUBLIC_KEY_STR_FOR_SDK or "请替换" in ALIPAY_PUBLIC_KEY_STR_FOR_SDK: is_config_placeholder = True
+    if not ALIPAY_PUBLIC_KEY_FOR_SDK or "请替换" in ALIPAY_PUBLIC_KEY_FOR_SDK: is_config_placeholder = True
     
     if is_config_placeholder:
         logging.critical(f"支付宝关键配置包含占位符或不完整，无法发起支付。 User: {user.id}")
@@ -3479,30 +3360,18 @@ async def recharge_request_cmd(
         await interaction.followup.send("❌ 创建充值请求时发生内部错误，请稍后再试或联系管理员。", ephemeral=True)
         return
     logging.info(f"Initial recharge request record (DB request_id: {internal_db_request_id}) created for out_trade_no: {out_trade_no}")
+    schedule_expiry("recharge", internal_db_request_id, time.time() + payment_gateway.ORDER_TIMEOUT_SECONDS)
 
-    # 3. 调用支付宝“当面付”预创建订单接口
-    current_client = DefaultAlipayClient(alipay_client_config=alipay_client_config, logger=alipay_logger)
-
-    model = AlipayTradePrecreateRequest()
-    model.notify_url = ALIPAY_NOTIFY_URL 
-    model.biz_content = {
-        "out_trade_no": out_trade_no,
-        "total_amount": f"{amount:.2f}", 
-        "subject": f"充值{ECONOMY_CURRENCY_NAME} - {guild.name} ({user.name})", # 商品标题
-        "timeout_express": "5m", 
-        "passback_params": passback_params_encoded
-    }
-    
+    # 3. 调用支付宝“当面付”预创建订单接口 (在支付网关的线程池中执行，不阻塞事件循环)
     qr_code_url_from_alipay = None
     alipay_api_error_msg = None
 
     try:
-        logging.info(f"Calling Alipay API (alipay.trade.precreate) with biz_content: {model.biz_content}")
-        response_str = current_client.execute(model)
-        logging.info(f"Raw Alipay API Response for {out_trade_no}: {response_str}")
-        
-        response_data = json.loads(response_str)
-        alipay_resp_data = response_data.get("alipay_trade_precreate_response", {})
+        alipay_resp_data = await alipay_gateway.precreate(
+            out_trade_no, amount,
+            subject=f"充值{ECONOMY_CURRENCY_NAME} - {guild.name} ({user.name})", # 商品标题
+            passback_params=passback_params_encoded
+        )
         
         if alipay_resp_data.get("code") == "10000":
             qr_code_url_from_alipay = alipay_resp_data.get("qr_code")
@@ -3525,11 +3394,8 @@ async def recharge_request_cmd(
 
     if qr_code_url_from_alipay:
         try:
-            qr_img_obj = qrcode.make(qr_code_url_from_alipay)
-            img_byte_arr = io.BytesIO()
-            qr_img_obj.save(img_byte_arr, format='PNG')
-            img_byte_arr.seek(0)
-            qr_file = discord.File(fp=img_byte_arr, filename="alipay_recharge_qr.png")
+            qr_png = await alipay_gateway.qr_png(qr_code_url_from_alipay)
+            qr_file = discord.File(fp=io.BytesIO(qr_png), filename="alipay_recharge_qr.png")
 
             embed = discord.Embed(
                 title=f"{ECONOMY_CURRENCY_SYMBOL} 请扫描二维码支付",
@@ -4011,6 +3877,7 @@ async def manage_mute(interaction: discord.Interaction, user: discord.Member, du
             duration_seconds=actual_duration_seconds,
             expires_at=expires_at_timestamp
         )
+        schedule_expiry("mute", log_id, expires_at_timestamp)
 
         timeout_display_timestamp = f"<t:{expires_at_timestamp}:R>"
         response_msg = f"✅ 用户 {user.mention} 已被成功禁言 **{duration_text_log}**，预计 {timeout_display_timestamp} 解除。\n原因: {reason}"
@@ -4054,6 +3921,7 @@ async def manage_unmute(interaction: discord.Interaction, user: discord.Member,
         active_mute_log = database.db_get_latest_active_log_for_user(guild.id, user.id, "mute")
         if active_mute_log:
             database.db_deactivate_log(active_mute_log["log_id"], f"Unmuted by {author.id}", author.id)
+            cancel_expiry("mute", active_mute_log["log_id"])
         
         # Log the unmute action
         log_id = database.db_log_moderation_action(
@@ -4532,7 +4400,7 @@ recharge_group = app_commands.Group(name="recharge", description="金币充值
 async def recharge_request(interaction: discord.Interaction, amount: app_commands.Range[float, 1.0, 10000.0]):
     await interaction.response.defer(ephemeral=True)
 
-    if not alipay_client:
+    if not alipay_gateway:
         await interaction.followup.send("❌ 抱歉，支付功能当前未配置或不可用，请联系管理员。", ephemeral=True)
         return
 
@@ -4548,31 +4416,18 @@ async def recharge_request(interaction: discord.Interaction, amount: app_command
     if not db_req_id:
         await interaction.followup.send("❌ 创建充值请求时发生内部错误，请稍后再试。", ephemeral=True)
         return
+    schedule_expiry("recharge", db_req_id, time.time() + payment_gateway.ORDER_TIMEOUT_SECONDS)
 
-    # 调用支付宝API
-    model = AlipayTradePrecreateRequest()
-    model.notify_url = ALIPAY_NOTIFY_URL
-    model.biz_content = {
-        "out_trade_no": out_trade_no,
-        "total_amount": f"{amount:.2f}",
-        "subject": f"GJ服务器 - 金币充值 ({interaction.user.name})",
-        "timeout_express": "5m"
-    }
-
+    # 调用支付宝API (支付网关线程池) 并在后台线程渲染二维码
     try:
-        response_str = await bot.loop.run_in_executor(None, lambda: alipay_client.execute(model))
-        response_data = json.loads(response_str)
-        alipay_resp = response_data.get("alipay_trade_precreate_response", {})
+        alipay_resp = await alipay_gateway.precreate(out_trade_no, amount, subject=f"GJ服务器 - 金币充值 ({interaction.user.name})")
 
         if alipay_resp.get("code") == "10000":
             qr_code_url = alipay_resp.get("qr_code")
             
             # 生成二维码图片
-            qr_img = qrcode.make(qr_code_url)
-            img_byte_arr = io.BytesIO()
-            qr_img.save(img_byte_arr, format='PNG')
-            img_byte_arr.seek(0)
-            qr_file = discord.File(fp=img_byte_arr, filename="alipay_qr.png")
+            qr_png = await alipay_gateway.qr_png(qr_code_url)
+            qr_file = discord.File(fp=io.BytesIO(qr_png), filename="alipay_qr.png")
 
             embed = discord.Embed(
                 title="掃描二維碼支付",
@@ -5301,9 +5156,10 @@ bot.tree.add_command(recharge_group)
 # ==              网页管理面板 (FLASK)                    ==
 # ==========================================================
 try:
-    from flask import Flask, render_template, request, redirect, url_for, session, flash, jsonify
+    from flask import Flask, Response, render_template, request, redirect, url_for, session, flash, jsonify
     from flask_socketio import SocketIO, join_room, disconnect
     from werkzeug.middleware.proxy_fix import ProxyFix
+    from werkzeug.test import EnvironBuilder, run_wsgi_app
     import threading
     
     # 【核心修复第一步】添加猴子补丁
@@ -5362,6 +5218,41 @@ AVAILABLE_PERMISSIONS = {
 
 # --- Web面板权限系统 ---
 web_permissions = {}
+# 按 (用户/副账号, 服务器) 缓存编译好的权限位集；身份组或权限配置变化时失效 (见 web_auth_cache.py)
+web_permission_index = web_auth_cache.PermissionIndex(AVAILABLE_PERMISSIONS)
+web_auth = web_auth_cache.AuthCache()
+# 副账号密钥只以哈希保存；已解析的权限缓存在内存中，last_used_at 后台批量写入 (见 sub_account_auth.py)
+sub_accounts = sub_account_auth.SubAccountAuth(on_change=lambda account_id: web_auth.invalidate_principal(f"sub_{account_id}"))
+# 票据消息/审核事件经由事件总线按房间每 100ms 批量推送 (见 socket_event_bus.py)；Web 未启用时为 None
+socket_events: Optional[socket_event_bus.SocketEventBus] = None
+# Web 页面读取的服务器只读模型 (身份组/频道/成员/语音状态摘要)，由网关事件增量维护 (见 guild_snapshot.py)
+guild_snapshots = guild_snapshot.GuildSnapshotStore()
+guild_snapshots.attach(bot)
+# 票据频道最近消息的环形缓冲区，Web 面板历史记录和 AI 回复共用 (见 ticket_message_cache.py)
+ticket_messages = ticket_message_cache.TicketMessageCache()
+ticket_messages.attach(bot)
+# AI 托管票据的对话状态 (增量追加的对话轮次 + 知识库版本)，提示词按 token 预算裁剪 (见 ticket_ai_state.py)
+TICKET_AI_PROMPT_BUDGET = int(os.environ.get("TICKET_AI_PROMPT_BUDGET", str(ticket_ai_state.DEFAULT_PROMPT_BUDGET)))
+knowledge_bases = ticket_ai_state.KnowledgeBaseCache(database.db_get_knowledge_base)
+ticket_conversations = ticket_ai_state.TicketConversationStore()
+ticket_conversations.attach(bot)
+# 票据创建者连发多条消息时合并为一次AI回复：静默 TICKET_AI_DEBOUNCE_SECONDS 秒后才生成 (见 ai_reply_debouncer.py)
+TICKET_AI_DEBOUNCE_SECONDS = float(os.environ.get("TICKET_AI_DEBOUNCE_SECONDS", str(ai_reply_debouncer.DEFAULT_QUIET_PERIOD)))
+TICKET_AI_MAX_DEBOUNCE_SECONDS = float(os.environ.get("TICKET_AI_MAX_DEBOUNCE_SECONDS", str(ai_reply_debouncer.DEFAULT_MAX_DELAY)))
+ticket_ai_replies = ai_reply_debouncer.ReplyDebouncer(TICKET_AI_DEBOUNCE_SECONDS, TICKET_AI_MAX_DEBOUNCE_SECONDS)
+
+# --- Web 面板工作进程模式 (WEB_PANEL_MODE=process，见 bot_rpc.py) ---
+BOT_RPC_SOCKET = os.environ.get("BOT_RPC_SOCKET", bot_rpc.DEFAULT_SOCKET_PATH)
+WEB_WORKERS = int(os.environ.get("WEB_WORKERS", "2"))
+WEB_WORKER_RESTART_DELAY = 3
+FORWARDED_REQUEST_TIMEOUT = 90 # 转发的路由内部最长等待机器人 60 秒 (批量操作)，留出余量
+if WEB_PANEL_MODE == "process" and not IS_WEB_WORKER and not os.environ.get("FLASK_SECRET_KEY"):
+    # 工作进程和机器人进程 (执行转发的请求) 必须用同一个密钥签名会话；工作进程继承此环境变量
+    os.environ["FLASK_SECRET_KEY"] = secrets.token_hex(32)
+# 机器人进程中为 RPC 服务器，工作进程中为 RPC 客户端，线程模式下两者都为 None
+bot_rpc_server: Optional[bot_rpc.RPCServer] = bot_rpc.RPCServer(BOT_RPC_SOCKET) if WEB_PANEL_MODE == "process" and not IS_WEB_WORKER else None
+bot_rpc_client: Optional[bot_rpc.RPCClient] = bot_rpc.RPCClient(BOT_RPC_SOCKET) if IS_WEB_WORKER else None
+web_worker_processes: Dict[int, subprocess.Popen] = {}
 
 # 新增：用于存储欢迎消息设置的内存字典
 welcome_message_settings = {}
@@ -5384,7 +5275,7 @@ if FLASK_AVAILABLE:
     # 注册自定义过滤器，使其在模板中可用
     web_app.jinja_env.filters['strftime'] = format_timestamp
 
-    web_app.secret_key = os.urandom(24)
+    web_app.secret_key = os.environ.get("FLASK_SECRET_KEY") or os.urandom(24)
     
     # 【核心修复】应用 ProxyFix 中间件，让 Flask 知道它在代理后面
     web_app.wsgi_app = ProxyFix(
@@ -5395,74 +5286,53 @@ if FLASK_AVAILABLE:
     web_app.config['SESSION_COOKIE_SAMESITE'] = 'None' 
     web_app.config['SESSION_COOKIE_SECURE'] = True
 
+    socketio_options = {}
+    if bot_rpc_server:
+        # 机器人进程没有客户端连接，emit/join_room 经由 RPC 推送给工作进程
+        socketio_options['client_manager'] = bot_rpc.SocketIOBridge(bot_rpc_server.publish)
+    elif bot_rpc_client:
+        socketio_options['client_manager'] = bot_rpc.SocketIOBridge(bot_rpc_client.publish, bot_rpc_client.subscribe)
     socketio = SocketIO(
         web_app, 
-        async_mode='eventlet', 
+        async_mode='threading' if bot_rpc_server else 'eventlet', # 工作进程模式下机器人进程没有打 eventlet 补丁
         cors_allowed_origins="*",
-        path='my-custom-socket-path' # <-- 使用一个自定义的、唯一的路径
+        path='my-custom-socket-path', # <-- 使用一个自定义的、唯一的路径
+        **socketio_options
     )
+    # 票据/审核事件只在机器人进程中产生
+    socket_events = socket_event_bus.SocketEventBus(socketio) if not bot_rpc_client else None
 
     # --- 新的辅助函数，用于在后端计算用户权限 ---
+    def _sub_account_permissions(user_info) -> Dict[str, Any]:
+        # 使用副账号当前的权限而不是登录时存入会话的副本；账号已删除时没有任何权限
+        try:
+            account_id = int(str(user_info.get('id')).removeprefix("sub_"))
+        except ValueError:
+            return {}
+        return sub_accounts.permissions(account_id) or {}
+
+    def _compiled_web_auth(user_info, guild_id) -> web_auth_cache.CompiledAuth:
+        guild_id = int(guild_id)
+        if bot_rpc_client: # 工作进程中没有 Discord 缓存，由机器人进程编译 (并缓存)
+            mask, error = bot_rpc_client.call('web_auth', {'id': user_info.get('id'), 'is_sub_account': user_info.get('is_sub_account')}, guild_id)
+            return mask, tuple(error) if error else None
+        if user_info.get('is_sub_account'):
+            compile_fn = lambda: web_auth_cache.compile_sub_account(web_permission_index, _sub_account_permissions(user_info), guild_id)
+        else:
+            compile_fn = lambda: web_auth_cache.compile_member(web_permission_index, bot.get_guild(guild_id), user_info.get('id'), web_permissions.get(guild_id, {}))
+        return web_auth.get_or_compile(str(user_info.get('id')), guild_id, compile_fn)
+
     def get_user_permissions(user_info, guild_id):
         if not user_info or not guild_id:
             return []
-        
-        all_possible_perms = list(AVAILABLE_PERMISSIONS.keys())
-        for data in AVAILABLE_PERMISSIONS.values():
-            if "tabs" in data:
-                all_possible_perms.extend(data["tabs"].keys())
-
         if user_info.get('is_superuser'):
-            return all_possible_perms
-        
-        if user_info.get('is_sub_account'):
-            perms = user_info.get('permissions', {})
-            granted_perms = set(perms.get('global_permissions', []))
-            
-            if perms.get('can_manage_all_guilds'):
-                return all_possible_perms
-            elif str(guild_id) in perms.get('guilds', []):
-                # 副账号如果能访问服务器，则授予其下所有标签页权限 (这是针对副账号的特定逻辑)
-                granted_perms.add("page_guild_management")
-                granted_perms.update(AVAILABLE_PERMISSIONS["page_guild_management"]["tabs"].keys())
-            
-            return list(granted_perms)
+            return web_permission_index.perms_of(web_permission_index.all_mask)
+        # 副账号无权访问该服务器时仍保留其全局权限；Discord 用户出错时位集为 0
+        mask, _ = _compiled_web_auth(user_info, guild_id)
+        return web_permission_index.perms_of(mask)
 
-        # --- 普通 Discord 用户权限计算 ---
-        guild = bot.get_guild(int(guild_id))
-        if not guild:
-            return []
-        
-        user_id = user_info.get('id')
-        if not user_id:
-            return []
-        try:
-            member = guild.get_member(int(user_id))
-        except (ValueError, TypeError):
-            return []
-            
-        if not member:
-            return []
-
-        # 服务器所有者或管理员拥有所有权限
-        if member.id == guild.owner_id or member.guild_permissions.administrator:
-            return all_possible_perms
-
-        user_role_ids = {str(role.id) for role in member.roles}
-        guild_web_perms = web_permissions.get(guild_id, {})
-        
-        # 1. 直接从角色配置中获取所有授予的权限
-        granted_perms = set()
-        for role_id in user_role_ids:
-            if role_id in guild_web_perms:
-                granted_perms.update(guild_web_perms[role_id].get("permissions", []))
-        
-        # 2. 【【【核心修复】】】如果用户拥有任何一个子标签页的权限，则自动为他们添加父页面的访问权，
-        # 这样他们才能看到父级导航菜单。但反之则不然。
-        if any(p.startswith("tab_") for p in granted_perms):
-             granted_perms.add("page_guild_management")
-        
-        return list(granted_perms)
+    def _permission_denied(required_permission):
+        return False, (f"您没有访问 '{web_permission_index.display_name(required_permission)}' 的权限。", 403)
 
     # --- 只有在 Flask 可用时才定义路由 ---
     def check_auth(guild_id=None, required_permission=None):
@@ -5473,56 +5343,89 @@ if FLASK_AVAILABLE:
         if user_info.get('is_superuser'):
             return True, None
         
-        if user_info.get('is_sub_account'):
-            if guild_id is None and required_permission is None:
-                return True, None
-            
-            perms = user_info.get('permissions', {})
-            can_manage_all = perms.get('can_manage_all_guilds', False)
-            allowed_guilds = perms.get('guilds', [])
-            
-            if guild_id and not can_manage_all and str(guild_id) not in allowed_guilds:
-                return False, (f"副账号无权访问服务器 {guild_id}", 403)
-    
-            if required_permission:
-                user_granted_perms = get_user_permissions(user_info, guild_id)
-                if required_permission not in user_granted_perms:
-                    perm_name = "未知页面"
-                    for page_id, page_data in AVAILABLE_PERMISSIONS.items():
-                        if page_id == required_permission: perm_name = page_data['name']; break
-                        if 'tabs' in page_data and required_permission in page_data['tabs']: perm_name = page_data['tabs'][required_permission]; break
-                    return False, (f"您没有访问 '{perm_name}' 的权限。", 403)
+        if guild_id is None:
+            if user_info.get('is_sub_account') and required_permission is not None:
+                return _permission_denied(required_permission)
             return True, None
-        
-        else: # 普通 Discord 用户
-            user_id_str = str(user_info.get('id'))
-            if guild_id is None:
-                return True, None
-            guild = bot.get_guild(guild_id)
-            if not guild:
-                return False, ("机器人不在该服务器中或服务器ID无效。", 404)
-            try: member = guild.get_member(int(user_id_str))
-            except (ValueError, TypeError): return False, ("无效的用户ID格式。", 400)
-            if not member: return False, ("您不是该服务器的成员。", 403)
-            if member.id == guild.owner_id or member.guild_permissions.administrator: return True, None
-            if required_permission is None: return True, None
-            granted_perms_discord = get_user_permissions(user_info, guild_id)
-            if required_permission in granted_perms_discord: return True, None
-        
-        perm_name = "未知页面"
-        for page_id, page_data in AVAILABLE_PERMISSIONS.items():
-            if page_id == required_permission: perm_name = page_data['name']; break
-            if 'tabs' in page_data and required_permission in page_data['tabs']: perm_name = page_data['tabs'][required_permission]; break
-        return False, (f"您没有访问 '{perm_name}' 的权限。", 403)
+
+        mask, error = _compiled_web_auth(user_info, guild_id)
+        if error:
+            return False, error
+        if required_permission is None or mask & web_permission_index.bits.get(required_permission, 0):
+            return True, None
+        return _permission_denied(required_permission)
 
     @web_app.context_processor
     def inject_permissions_checker():
         return dict(check_user_web_permissions=get_user_permissions)
 
+    # =======================
+    # == Web 工作进程
+    # =======================
+    # 在工作进程中直接处理的路由 (只用到会话、数据库以及 bot_call/RPC 快照)；其余请求原样转发给机器人进程执行
+    WORKER_LOCAL_ENDPOINTS = {'static'}
+
+    def worker_local(view):
+        WORKER_LOCAL_ENDPOINTS.add(view.__name__)
+        return view
+
+    def bot_call(coro_fn, *args, timeout=30):
+        """在机器人事件循环上执行 coro_fn(*args) 并等待结果；工作进程中经由 RPC 调用机器人进程中注册的同名命令。"""
+        if bot_rpc_client:
+            return bot_rpc_client.call(coro_fn.__name__, *args, timeout=timeout)
+        return asyncio.run_coroutine_threadsafe(coro_fn(*args), bot.loop).result(timeout=timeout)
+
+    def bot_submit(coro_fn, *args):
+        """同 bot_call，但不等待结果。"""
+        if not bot_rpc_client:
+            asyncio.run_coroutine_threadsafe(coro_fn(*args), bot.loop)
+            return
+        def call():
+            try:
+                bot_rpc_client.call(coro_fn.__name__, *args)
+            except (bot_rpc.RPCError, TimeoutError) as e:
+                logging.error(f"[WebWorker] 调用机器人命令 {coro_fn.__name__} 失败: {e}")
+        socketio.start_background_task(call)
+
+    @web_app.before_request
+    def forward_to_bot_process():
+        if not bot_rpc_client or request.endpoint in WORKER_LOCAL_ENDPOINTS:
+            return None
+        forwarded = {
+            'method': request.method, 'path': request.path, 'query_string': request.query_string.decode('latin-1'),
+            'headers': list(request.headers.items()), 'body': request.get_data(),
+            'remote_addr': request.remote_addr, 'scheme': request.scheme,
+        }
+        try:
+            status, headers, body = bot_rpc_client.call('http', forwarded, timeout=FORWARDED_REQUEST_TIMEOUT)
+        except bot_rpc.RPCUnavailable:
+            return jsonify(status="error", message="机器人进程暂时不可用，请稍后重试。"), 503
+        except TimeoutError:
+            return jsonify(status="error", message="机器人进程处理请求超时。"), 504
+        except bot_rpc.RPCError as e:
+            logging.error(f"[WebWorker] 转发请求 {request.method} {request.path} 失败: {e}")
+            return jsonify(status="error", message=f"内部错误: {e}"), 502
+        return Response(body, status=status, headers=headers)
+
+    def dispatch_forwarded_request(forwarded):
+        """机器人进程中执行工作进程转发过来的请求，返回 (状态码, 响应头, 响应体)。"""
+        environ = EnvironBuilder(
+            path=forwarded['path'], method=forwarded['method'], query_string=forwarded['query_string'],
+            headers=forwarded['headers'], data=forwarded['body'],
+            environ_overrides={'REMOTE_ADDR': forwarded['remote_addr'], 'wsgi.url_scheme': forwarded['scheme']},
+        ).get_environ()
+        app_iter, status, headers = run_wsgi_app(web_app, environ, buffered=True)
+        try:
+            body = b"".join(app_iter)
+        finally:
+            if hasattr(app_iter, 'close'): app_iter.close()
+        return int(status.split(' ', 1)[0]), list(headers.items()), body
+
     # =======================
     # == OAuth2 & 登录/登出
     # =======================
     @web_app.route('/')
+    @worker_local
     def index():
         if 'user' in session: return redirect(url_for('dashboard'))
         return render_template('login.html', oauth_url=DISCORD_OAUTH2_URL, client_id=DISCORD_CLIENT_ID)
@@ -5543,7 +5446,7 @@ if FLASK_AVAILABLE:
             flash('请输入访问密钥。', 'warning')
             return redirect(url_for('index'))
         
-        account_data = database.db_validate_access_key(access_key)
+        account_data = sub_accounts.authenticate(access_key)
         if account_data:
             session.clear()
             session['user'] = {
@@ -5603,6 +5506,7 @@ if FLASK_AVAILABLE:
         return redirect(url_for('dashboard'))
 
     @web_app.route('/logout')
+    @worker_local
     def logout():
         session.clear()
         flash('您已成功登出。', 'success')
@@ -5633,7 +5537,7 @@ if FLASK_AVAILABLE:
         if user_info.get('is_superuser'):
             guilds_data = sorted([{'id': g.id, 'name': g.name} for g in bot.guilds], key=lambda x: x['name'])
         elif user_info.get('is_sub_account'):
-            perms = user_info.get('permissions', {})
+            perms = _sub_account_permissions(user_info)
             if perms.get('can_manage_all_guilds'):
                 guilds_data = sorted([{'id': g.id, 'name': g.name} for g in bot.guilds], key=lambda x: x['name'])
             else:
@@ -5648,40 +5552,39 @@ if FLASK_AVAILABLE:
     def guild_page(guild_id):
         is_authed, error = check_auth(guild_id, required_permission="page_guild_management")
         if not is_authed: flash(error[0], 'danger'); return redirect(url_for('dashboard'))
-        guild = bot.get_guild(guild_id)
+        guild = guild_snapshots.guild(guild_id)
         if not guild: return "服务器未找到", 404
         user_info = session['user']
         user_perms = get_user_permissions(user_info, guild_id)
-        members_data = [{'id': str(m.id), 'name': m.display_name, 'avatar_url': str(m.display_avatar.url), 'joined_at': m.joined_at.strftime('%Y-%m-%d') if m.joined_at else 'N/A'} for m in guild.members if not m.bot][:1000]
-        members_data.sort(key=lambda x: x['name'].lower())
-        roles_data = sorted([{'id': str(r.id), 'name': r.name, 'color': str(r.color), 'member_count': len(r.members)} for r in guild.roles if r.name != '@everyone'], key=lambda x: x['name'].lower())
-        return render_template('guild.html', title=guild.name, user=user_info, guild=guild, members=members_data, roles=roles_data, user_perms=user_perms, DISCORD_PERMISSIONS=DISCORD_PERMISSIONS)
+        members_data = guild_snapshots.view(guild_id, 'members')[:1000]
+        roles_data = guild_snapshots.view(guild_id, 'roles')
+        return render_template('guild.html', title=guild['name'], user=user_info, guild=guild, members=members_data, roles=roles_data, user_perms=user_perms, DISCORD_PERMISSIONS=DISCORD_PERMISSIONS)
 
     @web_app.route('/guild/<int:guild_id>/settings')
     def settings_page(guild_id):
         is_authed, error = check_auth(guild_id, required_permission="page_settings")
         if not is_authed: flash(error[0], 'danger'); return redirect(url_for('dashboard'))
-        guild = bot.get_guild(guild_id)
+        guild = guild_snapshots.guild(guild_id)
         if not guild: return "服务器未找到", 404
         user_info = session['user']
         user_perms = get_user_permissions(user_info, guild_id)
-        roles_data = sorted([{'id': str(r.id), 'name': r.name} for r in guild.roles if r.name != "@everyone"], key=lambda x: x.get('name', '').lower())
-        text_channels_data = sorted(guild.text_channels, key=lambda c: c.name)
-        voice_channels_data = sorted(guild.voice_channels, key=lambda c: c.name)
-        categories_data = sorted(guild.categories, key=lambda c: c.name)
+        roles_data = guild_snapshots.view(guild_id, 'roles')
+        text_channels_data = guild_snapshots.view(guild_id, 'text_channels')
+        voice_channels_data = guild_snapshots.view(guild_id, 'voice_channels')
+        categories_data = guild_snapshots.view(guild_id, 'categories')
         settings_data = {'ticket': ticket_settings.get(guild_id, {}), 'temp_vc': temp_vc_settings.get(guild_id, {})}
-        is_owner = (not user_info.get('is_sub_account') and not user_info.get('is_superuser') and str(user_info.get('id')) == str(guild.owner_id)) or user_info.get('is_superuser')
+        is_owner = (not user_info.get('is_sub_account') and not user_info.get('is_superuser') and str(user_info.get('id')) == str(guild['owner_id'])) or user_info.get('is_superuser')
         return render_template('settings.html', title="机器人设置", user=user_info, guild=guild, roles=roles_data, text_channels=text_channels_data, voice_channels=voice_channels_data, categories=categories_data, settings=settings_data, is_owner=is_owner, user_perms=user_perms)
 
     @web_app.route('/guild/<int:guild_id>/moderation')
     def moderation_page(guild_id):
         is_authed, error = check_auth(guild_id, required_permission="page_moderation")
         if not is_authed: flash(error[0], 'danger'); return redirect(url_for('dashboard'))
-        guild = bot.get_guild(guild_id)
+        guild = guild_snapshots.guild(guild_id)
         if not guild: return "服务器未找到", 404
         user_info = session['user']
         user_perms = get_user_permissions(user_info, guild_id)
-        members_data = sorted([m for m in guild.members if not m.bot], key=lambda m: m.display_name)
+        members_data = guild_snapshots.view(guild_id, 'members')
         return render_template('moderation.html', title="禁言/审核", user=user_info, guild=guild, members=members_data, user_perms=user_perms)
 
     
@@ -5759,19 +5662,16 @@ if FLASK_AVAILABLE:
     @web_app.route('/permissions/<int:guild_id>')
     def permissions_page(guild_id):
         user_info = session.get('user', {})
-        guild = bot.get_guild(guild_id)
+        guild = guild_snapshots.guild(guild_id)
         if not guild: return "服务器未找到", 404
         
-        is_discord_owner = (not user_info.get('is_sub_account') and not user_info.get('is_superuser') and str(user_info.get('id')) == str(guild.owner_id))
+        is_discord_owner = (not user_info.get('is_sub_account') and not user_info.get('is_superuser') and str(user_info.get('id')) == str(guild['owner_id']))
         if not user_info.get('is_superuser') and not is_discord_owner:
             flash("您无权访问此页面。", "danger")
             return redirect(url_for('dashboard'))
         
         user_perms = get_user_permissions(user_info, guild_id)
-        roles_data = sorted(
-            [{'id': str(r.id), 'name': r.name} for r in guild.roles if r.name != "@everyone" and not r.managed],
-            key=lambda x: x['name'].lower()
-        )
+        roles_data = guild_snapshots.view(guild_id, 'assignable_roles')
         return render_template('permissions.html', title="权限管理", user=user_info, guild=guild, roles=roles_data, available_permissions=AVAILABLE_PERMISSIONS, user_perms=user_perms)
 
     @web_app.route('/guild/<int:guild_id>/backup')
@@ -5829,13 +5729,20 @@ if FLASK_AVAILABLE:
                  raise ValueError("请求中缺少有效的服务器ID字符串。")
             guild_id = int(guild_id_str)
 
-            # 从新的字段 backup_data_str 获取文件字符串
-            backup_data_str = data.get('backup_data_str')
-            if not backup_data_str:
-                raise ValueError("请求中缺少备份文件内容字符串。")
-            
-            # 由Python后端来解析JSON，Python没有JS的数字精度问题
-            backup_data = json.loads(backup_data_str)
+            # 可以直接指定服务器端版本库中的某个版本，也可以上传备份文件字符串
+            backup_version = data.get('backup_version')
+            if backup_version is not None:
+                backup_data = guild_backup_store.load_snapshot(guild_id, int(backup_version))
+                if backup_data is None:
+                    raise ValueError(f"备份版本 v{backup_version} 不存在。")
+            else:
+                # 从新的字段 backup_data_str 获取文件字符串
+                backup_data_str = data.get('backup_data_str')
+                if not backup_data_str:
+                    raise ValueError("请求中缺少备份文件内容字符串。")
+                
+                # 由Python后端来解析JSON，Python没有JS的数字精度问题
+                backup_data = json.loads(backup_data_str)
             
             confirmation = data.get('confirmation')
         except (ValueError, TypeError, AttributeError, json.JSONDecodeError) as e:
@@ -5937,15 +5844,35 @@ if FLASK_AVAILABLE:
             
            print("[Ticket Reply] Authentication successful. Calling send_reply_to_discord...")
         # 【重要】确保这里也传递整数类型的 guild_id
-           asyncio.run_coroutine_threadsafe(send_reply_to_discord(guild_id_int, data.get('channel_id'), session.get('user', {}), data.get('content')), bot.loop)
-        
+           bot_submit(send_reply_to_discord, guild_id_int, data.get('channel_id'), dict(session.get('user', {})), data.get('content'))
+        
+
+    def snapshot_json_response(guild_id, view, key):
+        """直接返回只读模型中缓存的 JSON 字节；带 ETag，浏览器轮询时内容未变则返回 304。"""
+        encoded = guild_snapshots.view_json(guild_id, view, key)
+        if encoded is None: return jsonify(status="error", message="服务器未找到"), 404
+        body, etag = encoded
+        response = Response(body, mimetype='application/json')
+        response.set_etag(etag)
+        response.headers['Cache-Control'] = 'private, no-cache'
+        return response.make_conditional(request)
+
+    def stats_snapshot():
+        if not bot.is_ready(): return dict(guilds=0, users=0, latency=0, commands=0)
+        return { 'guilds': len(bot.guilds), 'users': sum(g.member_count for g in bot.guilds if g.member_count), 'latency': round(bot.latency * 1000), 'commands': len(bot.tree.get_commands()),
+                 'upcoming_expiries': expiry_manager.upcoming_counts() if expiry_manager else {},
+                 'socket_events': socket_events.stats() if socket_events else {},
+                 'ticket_messages': ticket_messages.stats(),
+                 'ticket_ai': {**ticket_conversations.stats(), 'knowledge_base': knowledge_bases.stats(), 'replies': ticket_ai_replies.stats()},
+                 'guild_snapshots': guild_snapshots.stats(),
+                 'bot_rpc': bot_rpc_server.stats() if bot_rpc_server else {} }
 
     @web_app.route('/api/stats')
+    @worker_local
     def api_stats():
         is_authed, _ = check_auth()
         if not is_authed: return jsonify(error="未授权"), 401
-        if not bot.is_ready(): return jsonify(guilds=0, users=0, latency=0, commands=0)
-        return jsonify({ 'guilds': len(bot.guilds), 'users': sum(g.member_count for g in bot.guilds if g.member_count), 'latency': round(bot.latency * 1000), 'commands': len(bot.tree.get_commands()) })
+        return jsonify(bot_rpc_client.call('stats') if bot_rpc_client else stats_snapshot())
 
     @web_app.route('/api/guild/<int:guild_id>/member/<int:member_id>/roles')
     def api_get_member_roles(guild_id, member_id):
@@ -5961,10 +5888,7 @@ if FLASK_AVAILABLE:
     def api_get_voice_states(guild_id):
         is_authed, error = check_auth(guild_id)
         if not is_authed: return jsonify(status="error", message=error[0]), error[1]
-        guild = bot.get_guild(guild_id)
-        if not guild: return jsonify(status="error", message="服务器未找到"), 404
-        voice_channels_data = [{'id': str(vc.id), 'name': vc.name, 'members': [{'id': str(m.id), 'name': m.display_name, 'avatar_url': str(m.display_avatar.url), 'is_muted': m.voice.self_mute or m.voice.mute, 'is_deafened': m.voice.self_deaf or m.voice.deaf} for m in vc.members]} for vc in guild.voice_channels if vc.members]
-        return jsonify(status="success", voice_channels=voice_channels_data)
+        return snapshot_json_response(guild_id, 'voice_activity', 'voice_channels')
     
     @web_app.route('/api/guild/<int:guild_id>/muted_users', methods=['GET'])
     def api_get_muted_users(guild_id):
@@ -6007,13 +5931,12 @@ if FLASK_AVAILABLE:
         if not is_authed: 
             return jsonify(status="error", message=error[0]), error[1]
         
-        guild = bot.get_guild(guild_id)
-        if not guild:
+        if not guild_snapshots.guild(guild_id):
             return jsonify(status="error", message="服务器未找到"), 404
 
         # --- 知识库数据 ---
         if data_type == 'kb': 
-            return jsonify(kb=database.db_get_knowledge_base(guild_id))
+            return jsonify(kb=knowledge_bases.get(guild_id)[1])
         
         # --- FAQ 数据 ---
         if data_type == 'faq': 
@@ -6035,43 +5958,29 @@ if FLASK_AVAILABLE:
         if data_type == 'exempt_users':
             users_info = []
             for user_id in exempt_users_from_ai_check:
-                user = guild.get_member(user_id)
-                if user and user.guild.id == guild_id: # 确保用户还在这个服务器
-                    users_info.append({'id': str(user.id), 'name': user.display_name})
+                member = guild_snapshots.member(guild_id, user_id)
+                if member: # 确保用户还在这个服务器
+                    users_info.append({'id': member['id'], 'name': member['name']})
             return jsonify(users=users_info)
 
         # --- 【新】AI审查豁免频道数据 ---
         if data_type == 'exempt_channels':
             channels_info = []
             for channel_id in exempt_channels_from_ai_check:
-                channel = guild.get_channel(channel_id)
-                if channel and channel.guild.id == guild_id: # 确保频道属于这个服务器
-                    channels_info.append({'id': str(channel.id), 'name': channel.name})
+                channel = guild_snapshots.channel(guild_id, channel_id)
+                if channel: # 确保频道属于这个服务器
+                    channels_info.append({'id': channel['id'], 'name': channel['name']})
             return jsonify(channels=channels_info)
             
         # --- AI 直接对话频道数据 ---
         if data_type == 'ai_dep_channels':
             guild_dep_channels = []
             for ch_id, config in ai_dep_channels_config.items():
-                channel = bot.get_channel(ch_id)
-                if channel and channel.guild.id == guild_id:
+                channel = guild_snapshots.channel(guild_id, ch_id)
+                if channel:
                     guild_dep_channels.append({
                         'id': str(ch_id), 
-                        'name': channel.name, 
-                        'model': config.get("model", "未知")
-                    })
-            return jsonify(channels=guild_dep_channels)
-            
-        
-        # --- AI 直接对话频道数据 ---
-        if data_type == 'ai_dep_channels':
-            guild_dep_channels = []
-            for ch_id, config in ai_dep_channels_config.items():
-                channel = bot.get_channel(ch_id)
-                if channel and channel.guild.id == guild_id:
-                    guild_dep_channels.append({
-                        'id': str(ch_id), 
-                        'name': channel.name, 
+                        'name': channel['name'], 
                         'model': config.get("model", "未知")
                     })
             return jsonify(channels=guild_dep_channels)
@@ -6248,6 +6157,7 @@ def api_superuser_accounts():
                 if action == 'create':
                     access_key = database.db_create_sub_account(account_name, permissions)
                     if access_key:
+                        sub_accounts.register(access_key)
                         return jsonify(status="success", message=f"账号 '{account_name}' 已创建！", access_key=access_key)
                     else:
                         return jsonify(status="error", message="创建失败，可能是账号名称已存在"), 409
@@ -6256,6 +6166,8 @@ def api_superuser_accounts():
                     if not account_id:
                         return jsonify(status="error", message="缺少账号ID"), 400
                     if database.db_update_sub_account_permissions(int(account_id), permissions):
+                        sub_accounts.invalidate(int(account_id))
+                        web_auth.invalidate_principal(f"sub_{int(account_id)}")
                         return jsonify(status="success", message="权限已更新！")
                     else:
                         return jsonify(status="error", message="更新失败"), 500
@@ -6265,6 +6177,8 @@ def api_superuser_accounts():
                 if not account_id:
                     return jsonify(status="error", message="缺少账号ID"), 400
                 if database.db_delete_sub_account(int(account_id)):
+                    sub_accounts.invalidate(int(account_id))
+                    web_auth.invalidate_principal(f"sub_{int(account_id)}")
                     return jsonify(status="success", message="账号已删除！")
                 else:
                     return jsonify(status="error", message="删除失败"), 500
@@ -6401,7 +6315,43 @@ def view_transcript(guild_id, filename):
         return "文件未找到", 404
     
     # 使用 send_file，但移除 as_attachment=True，并明确 mimetype，以便在浏览器中直接显示
-    return send_file(file_path, mimetype='text/html')
+    if not file_path.endswith('.gz'):
+        return send_file(file_path, mimetype='text/html')
+    if 'gzip' in request.headers.get('Accept-Encoding', ''):
+        response = send_file(file_path, mimetype='text/html')
+        response.headers['Content-Encoding'] = 'gzip'
+        response.headers['Vary'] = 'Accept-Encoding'
+        return response
+    # 极少数不支持 gzip 的客户端：边读边解压
+    def _decompressed_chunks():
+        with gzip.open(file_path, 'rb') as f:
+            while chunk := f.read(64 * 1024):
+                yield chunk
+    return web_app.response_class(_decompressed_chunks(), mimetype='text/html')
+
+@web_app.route('/api/guild/<int:guild_id>/transcripts/search')
+def api_search_transcripts(guild_id):
+    is_authed, error = check_auth(guild_id, required_permission="tab_tickets")
+    if not is_authed:
+        return jsonify(status="error", message=error[0]), error[1]
+
+    query = request.args.get('q', '').strip()
+    if not query:
+        return jsonify(status="error", message="请输入搜索关键词。"), 400
+    limit = min(max(request.args.get('limit', 20, type=int), 1), 100)
+
+    started_at = time.perf_counter()
+    results = transcript_search.search_transcripts(guild_id, query, limit)
+    return jsonify(status="success", results=results, took_ms=round((time.perf_counter() - started_at) * 1000, 2))
+
+async def backfill_transcript_search_index():
+    """启动后为建立索引之前就已存在的聊天记录文件回填全文索引。"""
+    await bot.wait_until_ready()
+    tickets, messages = await bot.loop.run_in_executor(
+        None, transcript_search.backfill_transcript_index, transcript_writer.TRANSCRIPT_FOLDER
+    )
+    if tickets:
+        print(f"[TranscriptSearch] 已为 {tickets} 个历史票据回填 {messages} 条消息的全文索引。")
 
 # [ 结束新增代码块 ]
 
@@ -6501,25 +6451,19 @@ async def close_ticket_from_web(ticket_id: int, closer_info: dict):
     
     await channel.send(f"⏳ {closer_name} 已从Web面板请求关闭此票据。正在生成聊天记录并归档...")
 
-    transcript_content = await generate_ticket_transcript_html(channel)
-    transcript_filename = f"transcript-{guild.id}-{channel.id}-{int(time.time())}.html"
-    transcript_folder = "transcripts"
-    os.makedirs(transcript_folder, exist_ok=True)
-    transcript_path = os.path.join(transcript_folder, transcript_filename)
-    with open(transcript_path, "w", encoding="utf-8") as f:
-        f.write(transcript_content)
+    transcript_filename, transcript_path = await save_ticket_transcript(channel, ticket_id)
 
     admin_log_channel_id = PUBLIC_WARN_LOG_CHANNEL_ID
     admin_log_channel = guild.get_channel(admin_log_channel_id)
     if admin_log_channel:
         try:
-            await admin_log_channel.send(f"票据 `#{channel.name}` 已由 {closer_name} (Web) 关闭。", file=discord.File(transcript_path))
+            await admin_log_channel.send(f"票据 `#{channel.name}` 已由 {closer_name} (Web) 关闭。", file=transcript_writer.open_transcript_for_upload(transcript_path, transcript_filename))
         except Exception as e:
             logging.warning(f"无法发送票据日志到管理员频道: {e}")
 
     try:
         creator = await bot.fetch_user(ticket_info['creator_id'])
-        await creator.send(f"您在服务器 **{guild.name}** 的票据 `#{channel.name}` 已被关闭。", file=discord.File(transcript_path))
+        await creator.send(f"您在服务器 **{guild.name}** 的票据 `#{channel.name}` 已被关闭。", file=transcript_writer.open_transcript_for_upload(transcript_path, transcript_filename))
     except Exception as e:
         logging.warning(f"无法私信票据记录给用户 {ticket_info['creator_id']}: {e}")
 
@@ -6537,40 +6481,39 @@ async def close_ticket_from_web(ticket_id: int, closer_info: dict):
 
 
 async def _get_ticket_history_for_ai(channel: discord.TextChannel, creator_id: int) -> str:
-    """获取票据的聊天记录并格式化为AI可读的字符串。"""
+    """获取票据最近 50 条聊天记录 (优先读取消息缓存) 并格式化为AI可读的字符串。"""
     history_lines = []
-    async for message in channel.history(limit=50, oldest_first=True):
-        if message.author.bot and not message.embeds:
+    records, _ = await ticket_messages.history(channel, limit=50)
+    for record in records:
+        author = record['author']
+        if author['is_bot'] and not record['embeds']:
             continue # 忽略没有嵌入内容的机器人消息
         
         # 确定发言者身份
         speaker = "User"
-        if message.author.id != creator_id:
-            speaker = "Staff" if not message.author.bot else "System"
+        if author['id'] != str(creator_id):
+            speaker = "Staff" if not author['is_bot'] else "System"
 
         # 格式化消息内容
-        content = message.clean_content
-        if message.embeds and message.embeds[0].description:
+        content = record['content']
+        if record['embeds'] and record['embeds'][0]['description']:
             # 如果是嵌入消息，也附上其描述
-            content += f" [Embed: {message.embeds[0].description}]"
+            content += f" [Embed: {record['embeds'][0]['description']}]"
         
         if content.strip():
-            history_lines.append(f"{speaker} ({message.author.name}): {content.strip()}")
+            history_lines.append(f"{speaker} ({record['_username']}): {content.strip()}")
 
     return "\n".join(history_lines)
 
 @web_app.route('/api/guild/<int:guild_id>/ticket/<int:ticket_id>/ai_suggest', methods=['POST'])
+@worker_local
 def api_ticket_ai_suggest(guild_id, ticket_id):
     is_authed, error = check_auth(guild_id, required_permission="tab_tickets")
     if not is_authed:
         return jsonify(status="error", message=error[0]), error[1]
 
-    future = asyncio.run_coroutine_threadsafe(
-        _ticket_ai_suggest_async(guild_id, ticket_id),
-        bot.loop
-    )
     try:
-        result_json, status_code = future.result(timeout=120) # 增加超时时间以应对复杂的AI请求
+        result_json, status_code = bot_call(_ticket_ai_suggest_async, guild_id, ticket_id, timeout=120) # 增加超时时间以应对复杂的AI请求
         return jsonify(result_json), status_code
     except Exception as e:
         logging.error(f"AI建议功能超时或发生未知错误 (Ticket ID: {ticket_id}): {e}", exc_info=True)
@@ -6603,7 +6546,7 @@ async def _ticket_ai_suggest_async(guild_id: int, ticket_id: int):
         ]
         
         # 加入服务器知识库
-        knowledge_base = database.db_get_knowledge_base(guild_id)
+        _, knowledge_base = knowledge_bases.get(guild_id)
         if knowledge_base:
             system_prompt_parts.append("\n--- SERVER KNOWLEDGE BASE (Use this for context) ---")
             system_prompt_parts.extend(knowledge_base)
@@ -6647,14 +6590,38 @@ async def _ticket_ai_suggest_async(guild_id: int, ticket_id: int):
         return {'status': 'error', 'message': f'处理AI建议时发生内部错误: {type(e).__name__}'}, 500
 # [ 结束新增代码块 ]
 
-async def handle_ai_ticket_reply(message: discord.Message):
+def _ai_ticket_system_prompt(knowledge_base: List[str]) -> str:
+    """AI 托管票据的系统提示词；只在知识库版本变化时重新生成。"""
+    system_prompt_parts = [
+        "You are a professional, friendly, and helpful customer support assistant for a Discord server.",
+        "The conversation so far follows as separate messages. Messages from the support side are prefixed with [Staff <name>] or [System <name>].",
+        "Your primary task is to understand the user's intent from their latest message.",
+        "First, analyze the user's last message to determine their intent. The possible intents are: 'CONTINUE_CONVERSATION', 'CLOSE_TICKET', or 'ESCALATE_TO_STAFF'.",
+        "If the user explicitly asks to contact a developer, staff, admin, or requires human help (e.g., 'contact developer', 'talk to a real person', 'need human help'), the intent is 'ESCALATE_TO_STAFF'.",
+        "If the user asks a general question, needs help with a known issue, or provides more information, the intent is 'CONTINUE_CONVERSATION'.",
+        "If the user explicitly asks to close the ticket, says they are done, or expresses that their issue is resolved, the intent is 'CLOSE_TICKET'.",
+        "You MUST respond in a specific JSON format: {\"intent\": \"<INTENT_HERE>\", \"reply\": \"<YOUR_REPLY_HERE>\"}.",
+        "For 'CONTINUE_CONVERSATION', the 'reply' should be a helpful answer to the user's question.",
+        "For 'CLOSE_TICKET', the 'reply' should be a friendly closing message.",
+        "For 'ESCALATE_TO_STAFF', the 'reply' should inform the user that you have notified the staff and they will be in touch shortly."
+    ]
+    if knowledge_base:
+        system_prompt_parts.append("\n--- SERVER KNOWLEDGE BASE (Use this for context when replying) ---")
+        system_prompt_parts.extend(knowledge_base)
+        system_prompt_parts.append("--- END KNOWLEDGE BASE ---")
+    return "\n".join(system_prompt_parts)
+
+async def handle_ai_ticket_reply(message: discord.Message, ticket_info: Optional[Dict[str, Any]] = None,
+                                 reply_guard: Optional[ai_reply_debouncer.ReplyGuard] = None):
     """
     一个独立的函数，用于处理对AI托管票据中用户消息的自动回复。
-    【V6 - 已修复 NameError】
+    ticket_info 由 on_message 传入 (不再重复查询)；对话轮次保存在 ticket_conversations 中，每次只追加新消息。
+    经由 ticket_ai_replies 调度时，API 返回后调用 reply_guard.commit()，之后的发送不会再被新消息取消。
     """
     channel = message.channel
     guild = message.guild
-    ticket_info = database.db_get_ticket_by_channel(channel.id)
+    if ticket_info is None:
+        ticket_info = database.db_get_ticket_by_channel(channel.id)
     if not ticket_info:
         logging.error(f"[AI Reply] 无法在 handle_ai_ticket_reply 中找到票据信息 (Channel: {channel.id})")
         return
@@ -6667,48 +6634,19 @@ async def handle_ai_ticket_reply(message: discord.Message):
 
     try:
         async with channel.typing():
-            logging.info(f"[AI Reply] 正在获取票据 {ticket_info['ticket_id']} 的历史记录...")
-            history_str = await _get_ticket_history_for_ai(channel, ticket_info['creator_id'])
-            if not history_str:
+            conversation = ticket_conversations.get(ticket_info)
+            ticket_messages.add(message) # 确保触发回复的消息已在缓存中 (缓存监听器可能尚未运行)
+            records, _ = await ticket_messages.history(channel, limit=ticket_messages.capacity)
+            added = conversation.sync(records)
+            if not conversation.turns:
                 logging.warning(f"[AI Reply] 票据 {ticket_info['ticket_id']} 历史记录为空，无法生成回复。")
                 return
 
-            logging.info(f"[AI Reply] 正在为票据 {ticket_info['ticket_id']} 构建AI提示...")
-            
-            system_prompt_parts = [
-                "You are a professional, friendly, and helpful customer support assistant for a Discord server.",
-                "Your primary task is to understand the user's intent from their latest message.",
-                "First, analyze the user's last message to determine their intent. The possible intents are: 'CONTINUE_CONVERSATION', 'CLOSE_TICKET', or 'ESCALATE_TO_STAFF'.",
-                "If the user explicitly asks to contact a developer, staff, admin, or requires human help (e.g., 'contact developer', 'talk to a real person', 'need human help'), the intent is 'ESCALATE_TO_STAFF'.",
-                "If the user asks a general question, needs help with a known issue, or provides more information, the intent is 'CONTINUE_CONVERSATION'.",
-                "If the user explicitly asks to close the ticket, says they are done, or expresses that their issue is resolved, the intent is 'CLOSE_TICKET'.",
-                "You MUST respond in a specific JSON format: {\"intent\": \"<INTENT_HERE>\", \"reply\": \"<YOUR_REPLY_HERE>\"}.",
-                "For 'CONTINUE_CONVERSATION', the 'reply' should be a helpful answer to the user's question.",
-                "For 'CLOSE_TICKET', the 'reply' should be a friendly closing message.",
-                "For 'ESCALATE_TO_STAFF', the 'reply' should inform the user that you have notified the staff and they will be in touch shortly."
-            ]
-            
-            knowledge_base = database.db_get_knowledge_base(guild.id)
-            if knowledge_base:
-                system_prompt_parts.append("\n--- SERVER KNOWLEDGE BASE (Use this for context when replying) ---")
-                system_prompt_parts.extend(knowledge_base)
-                system_prompt_parts.append("--- END KNOWLEDGE BASE ---")
-            
-            final_system_prompt = "\n".join(system_prompt_parts)
-
-            user_prompt = f"""
-            Here is the conversation history:
-            --- TICKET HISTORY ---
-            {history_str}
-            --- END HISTORY ---
-            
-            Analyze the last message from the user based on the rules and provide your response in the required JSON format.
-            """
-
-            api_messages = [
-                {"role": "system", "content": final_system_prompt},
-                {"role": "user", "content": user_prompt}
-            ]
+            kb_version, knowledge_base = knowledge_bases.get(guild.id)
+            if conversation.kb_version != kb_version:
+                conversation.set_system_prompt(kb_version, _ai_ticket_system_prompt(knowledge_base))
+            api_messages = conversation.build_messages(TICKET_AI_PROMPT_BUDGET)
+            logging.info(f"[AI Reply] 票据 {ticket_info['ticket_id']}: 新增 {added} 轮对话，提示词包含 {len(api_messages) - 1} 条消息。")
             
             logging.info(f"[AI Reply] 正在为票据 {ticket_info['ticket_id']} 调用DeepSeek API进行意图识别...")
             async with aiohttp.ClientSession() as session:
@@ -6724,6 +6662,7 @@ async def handle_ai_ticket_reply(message: discord.Message):
                         ai_raw_content = None
                         api_error = f"API Error, Status: {response.status}, Body: {await response.text()}"
 
+            if reply_guard: reply_guard.commit()
             final_check_ticket_info = database.db_get_ticket_by_channel(channel.id)
             if not final_check_ticket_info or not final_check_ticket_info.get('is_ai_managed'):
                 logging.warning(f"[AI Reply] 在AI生成回复后，票据 {ticket_info['ticket_id']} 状态已变为人工模式。取消发送AI消息。")
@@ -6739,8 +6678,8 @@ async def handle_ai_ticket_reply(message: discord.Message):
                     if intent == "ESCALATE_TO_STAFF":
                         logging.info(f"[AI Reply] 识别到上报人工意图，准备通知管理员并回复用户 (票据: {ticket_info['ticket_id']})。")
                         database.db_set_ticket_ai_managed_status(ticket_info['ticket_id'], False)
-                        if socketio:
-                            socketio.emit('ticket_ai_status_changed', {'ticket_id': str(ticket_info['ticket_id']), 'is_ai_managed': False}, room=f'guild_{guild.id}')
+                        if socket_events:
+                            socket_events.publish('ticket_ai_status_changed', {'ticket_id': str(ticket_info['ticket_id']), 'is_ai_managed': False}, room=f'guild_{guild.id}', key=ticket_info['ticket_id'])
                         embed_to_user = discord.Embed(description=reply_text, color=discord.Color.orange())
                         embed_to_user.set_author(name="AI客服助理", icon_url=bot.user.display_avatar.url)
                         await channel.send(embed=embed_to_user)
@@ -6800,7 +6739,7 @@ async def handle_ai_ticket_reply(message: discord.Message):
                         
                         sent_message = await channel.send(embed=embed)
                         
-                        if socketio:
+                        if socket_events:
                             msg_data_for_web = {
                                 'id': str(sent_message.id),
                                 'author': { 'id': str(bot.user.id), 'name': "AI客服助理", 'avatar_url': str(bot.user.display_avatar.url), 'is_bot': True },
@@ -6809,7 +6748,7 @@ async def handle_ai_ticket_reply(message: discord.Message):
                                 'timestamp': sent_message.created_at.isoformat(),
                                 'channel_id': str(channel.id)
                             }
-                            socketio.emit('new_ticket_message', msg_data_for_web, room=f'ticket_{channel.id}')
+                            socket_events.publish('new_ticket_message', msg_data_for_web, room=f'ticket_{channel.id}')
                     else:
                         logging.warning(f"[AI Reply] AI返回了未知的意图: '{intent}'")
 
@@ -6824,17 +6763,14 @@ async def handle_ai_ticket_reply(message: discord.Message):
 
 
 @web_app.route('/api/guild/<int:guild_id>/ticket/<int:ticket_id>/toggle_ai_assist', methods=['POST'])
+@worker_local
 def api_toggle_ai_assist(guild_id, ticket_id):
     is_authed, error = check_auth(guild_id, required_permission="tab_tickets")
     if not is_authed:
         return jsonify(status="error", message=error[0]), error[1]
 
-    future = asyncio.run_coroutine_threadsafe(
-        _toggle_ai_assist_async(guild_id, ticket_id),
-        bot.loop
-    )
     try:
-        result_json, status_code = future.result(timeout=120)
+        result_json, status_code = bot_call(_toggle_ai_assist_async, guild_id, ticket_id, timeout=120)
         return jsonify(result_json), status_code
     except Exception as e:
         logging.error(f"切换AI托管模式时发生错误 (Ticket ID: {ticket_id}): {e}", exc_info=True)
@@ -6851,6 +6787,11 @@ async def _toggle_ai_assist_async(guild_id, ticket_id):
     # 无论开启还是关闭，都先更新数据库
     if database.db_set_ticket_ai_managed_status(ticket_id, new_status):
         logging.info(f"[AI Toggle] 票据 {ticket_id} 的AI托管状态已从 {current_status} 切换为 {new_status}。")
+        if not new_status:
+            ticket_ai_replies.cancel(ticket_info['channel_id']) # 丢弃尚未发出的AI回复
+        if socket_events: # 开启和关闭都要通知其它打开面板的客户端
+            socket_events.publish('ticket_ai_status_changed', {'ticket_id': str(ticket_id), 'is_ai_managed': new_status},
+                                  room=f'guild_{guild_id}', key=ticket_id)
         
         # 【核心修复】只有在从“关闭”变为“开启”时，才触发一次AI回复
         if new_status:
@@ -6863,8 +6804,8 @@ async def _toggle_ai_assist_async(guild_id, ticket_id):
                         last_user_message = msg
                         break
                 
-                if last_user_message:
-                    await handle_ai_ticket_reply(last_user_message)
+                if last_user_message: # 与 on_message 共用调度器：同一票据的回复不会并行，新消息可以取消它
+                    ticket_ai_replies.submit(channel.id, lambda guard: handle_ai_ticket_reply(last_user_message, None, guard))
         
         # 无论如何，都返回成功和新的状态
         return {'status': 'success', 'is_ai_managed': new_status}, 200
@@ -7262,6 +7203,7 @@ def api_guild_permissions(guild_id):
                 "name": role.name,
                 "permissions": permissions_list
             }
+            web_auth.invalidate_guild(guild_id)
             save_server_settings() # 持久化到文件
             return jsonify(status="success", message=f"已成功保存身份组 '{role.name}' 的权限。", permissions=web_permissions.get(guild_id, {}))
 
@@ -7271,6 +7213,7 @@ def api_guild_permissions(guild_id):
                 del web_permissions[guild_id][str(role.id)]
                 if not web_permissions[guild_id]: # 如果删除了最后一个，则移除服务器键
                     del web_permissions[guild_id]
+                web_auth.invalidate_guild(guild_id)
                 save_server_settings() # 持久化到文件
                 return jsonify(status="success", message=f"已成功删除身份组 '{role.name}' 的权限组。", permissions=web_permissions.get(guild_id, {}))
             else:
@@ -7279,20 +7222,18 @@ def api_guild_permissions(guild_id):
         return jsonify(status="error", message="未知的操作。"), 400 
     
 @web_app.route('/api/guild/<int:guild_id>/ticket/<int:channel_id>/history')
+@worker_local
 def api_get_ticket_history(guild_id, channel_id):
     # 权限检查
     is_authed, error = check_auth(guild_id, required_permission="tab_tickets")
     if not is_authed:
         return jsonify(status="error", message=error[0]), error[1]
     
-    # 使用 run_coroutine_threadsafe 在 eventlet 线程中安全地调度 asyncio 任务
-    future = asyncio.run_coroutine_threadsafe(
-        _get_ticket_history_async(guild_id, channel_id), 
-        bot.loop
-    )
+    before = request.args.get('before', type=int) # 游标：只返回比这条消息更早的消息
+    limit = max(1, min(request.args.get('limit', 50, type=int), 100))
     try:
-        # 等待异步任务完成并获取结果
-        result_data, status_code = future.result(timeout=20)
+        # 在机器人事件循环上 (或经由 RPC 在机器人进程中) 获取历史记录
+        result_data, status_code = bot_call(_get_ticket_history_async, guild_id, channel_id, before, limit, timeout=20)
         return jsonify(result_data), status_code
     except Exception as e:
         logging.error(f"获取票据历史记录时发生超时或未知错误: {e}", exc_info=True)
@@ -7303,23 +7244,18 @@ def api_get_ticket_history(guild_id, channel_id):
 
 
 # 我们需要将获取历史记录的逻辑封装在一个异步辅助函数中
-async def _get_ticket_history_async(guild_id, channel_id):
+async def _get_ticket_history_async(guild_id, channel_id, before=None, limit=50):
     try:
-        # 【最终修复】使用 fetch_guild 强制从API获取服务器对象，不再依赖缓存
-        try:
-            guild = await bot.fetch_guild(guild_id)
-        except (discord.NotFound, discord.Forbidden):
-            # 如果服务器不存在或机器人被踢了，则直接返回错误
-            return {'status': 'error', 'message': '服务器未找到或机器人不在该服务器中'}, 404
-        
-        # 使用 fetch_channel 强制从API获取频道对象
-        try:
-            channel = await guild.fetch_channel(channel_id)
-        except (discord.NotFound, discord.Forbidden):
-            return {'status': 'error', 'message': '票据频道未找到或已删除'}, 404
+        # 优先使用网关缓存中的频道；只有缓存中没有时才通过 API 获取
+        channel = bot.get_channel(channel_id)
+        if channel is None:
+            try:
+                channel = await bot.fetch_channel(channel_id)
+            except (discord.NotFound, discord.Forbidden):
+                return {'status': 'error', 'message': '票据频道未找到或已删除'}, 404
         
-        # 验证这确实是一个文本频道
-        if not isinstance(channel, discord.TextChannel):
+        # 验证这确实是该服务器中的一个文本频道
+        if not isinstance(channel, discord.TextChannel) or channel.guild.id != guild_id:
             return {'status': 'error', 'message': '目标ID不是一个有效的文本频道'}, 400
 
         # 使用数据库验证该频道是否为一个有效的、开启的票据
@@ -7327,34 +7263,10 @@ async def _get_ticket_history_async(guild_id, channel_id):
         if not ticket_info or ticket_info['status'] not in ['OPEN', 'CLAIMED']:
             return {'status': 'error', 'message': '非法的票据频道ID或该票据已关闭'}, 403
 
-        # (后续的聊天记录获取逻辑保持不变)
-        history = []
-        async for message in channel.history(limit=100, oldest_first=True):
-            safe_embeds = []
-            for embed in message.embeds:
-                safe_embed = {
-                    'title': getattr(embed, 'title', None),
-                    'description': getattr(embed, 'description', None),
-                    'color': embed.color.value if embed.color else None,
-                    'author': {'name': embed.author.name} if getattr(embed, 'author', None) and getattr(embed.author, 'name', None) else None,
-                    'footer': {'text': embed.footer.text} if getattr(embed, 'footer', None) and getattr(embed.footer, 'text', None) else None
-                }
-                safe_embeds.append(safe_embed)
-            
-            history.append({
-                'id': str(message.id),
-                'author': {
-                    'id': str(message.author.id),
-                    'name': message.author.display_name,
-                    'avatar_url': str(message.author.display_avatar.url),
-                    'is_bot': message.author.bot
-                },
-                'content': message.clean_content,
-                'embeds': safe_embeds,
-                'timestamp': message.created_at.isoformat()
-            })
-            
-        return {'status': 'success', 'history': history}, 200
+        # 最近的消息来自票据消息缓存；向上翻页超出缓存范围时才调用 channel.history(before=...)
+        records, has_more = await ticket_messages.history(channel, limit=limit, before=before)
+        history = [ticket_message_cache.public(r) for r in records]
+        return {'status': 'success', 'history': history, 'has_more': has_more, 'next_before': history[0]['id'] if has_more and history else None}, 200
     except discord.Forbidden:
         return {'status': 'error', 'message': '机器人缺少读取此频道历史记录的权限。'}, 403
     except Exception as e:
@@ -7451,6 +7363,7 @@ async def _create_backup_async(guild_id):
             })
 
         channel_info = {
+            "original_id": str(channel.id),
             "name": channel.name,
             "category_original_id": str(channel.category.id) if channel.category else None,
             "overwrites": overwrites_data # 【新增】保存权限覆盖
@@ -7469,14 +7382,20 @@ async def _create_backup_async(guild_id):
 
 
 
-@web_app.route('/api/guild/<int:guild_id>/backup', methods=['GET'])
-def api_create_backup(guild_id):
-    # 权限检查
+def _check_backup_access(guild_id):
+    """备份相关接口的统一权限检查：仅服务器所有者或超级用户。返回 (guild, 错误响应)。"""
     user_info = session.get('user', {})
     guild = bot.get_guild(guild_id)
-    if not guild: return jsonify(status="error", message="服务器未找到"), 404
+    if not guild: return None, (jsonify(status="error", message="服务器未找到"), 404)
     is_owner = (not user_info.get('is_sub_account') and str(user_info.get('id')) == str(guild.owner_id))
-    if not user_info.get('is_superuser') and not is_owner: return jsonify(status="error", message="无权访问"), 403
+    if not user_info.get('is_superuser') and not is_owner: return None, (jsonify(status="error", message="无权访问"), 403)
+    return guild, None
+
+@web_app.route('/api/guild/<int:guild_id>/backup', methods=['GET'])
+def api_create_backup(guild_id):
+    # 权限检查
+    guild, error = _check_backup_access(guild_id)
+    if error: return error
     
     future = asyncio.run_coroutine_threadsafe(_create_backup_async(guild_id), bot.loop)
     try:
@@ -7484,27 +7403,78 @@ def api_create_backup(guild_id):
         if backup_data is None:
             return jsonify(status="error", message="创建备份失败，服务器未找到"), 404
 
-        backup_json = json.dumps(backup_data, indent=4, ensure_ascii=False)
-        filename = f"backup-{guild.name.replace(' ', '_')}-{datetime.datetime.now().strftime('%Y%m%d')}.json"
+        # 同时存入服务器端的版本库 (内容未变化时不会产生新版本)
+        entry = guild_backup_store.save_snapshot(guild_id, backup_data, trigger="manual")
+
+        backup_json = json.dumps(backup_data, ensure_ascii=False, separators=(',', ':'))
+        filename = f"backup-{guild.name.replace(' ', '_')}-{datetime.datetime.now().strftime('%Y%m%d')}-v{entry['version']}.json"
         
         # 使用 BytesIO 在内存中创建文件，避免磁盘读写
         str_io = io.BytesIO(backup_json.encode('utf-8'))
         
-        return send_file(str_io,
-                         mimetype='application/json',
-                         as_attachment=True,
-                         download_name=filename)
+        response = send_file(str_io,
+                             mimetype='application/json',
+                             as_attachment=True,
+                             download_name=filename)
+        response.headers['X-Backup-Version'] = str(entry['version'])
+        return response
 
     except Exception as e:
         logging.error(f"创建备份时出错 (Guild {guild_id}): {e}", exc_info=True)
         return jsonify(status="error", message=f"创建备份时发生内部错误: {e}"), 500
 
+@web_app.route('/api/guild/<int:guild_id>/backups', methods=['GET'])
+def api_list_backups(guild_id):
+    guild, error = _check_backup_access(guild_id)
+    if error: return error
+    versions = [
+        {k: entry.get(k) for k in ("version", "created_at", "trigger", "kind", "summary")}
+        for entry in guild_backup_store.list_versions(guild_id)
+    ]
+    return jsonify(status="success", versions=list(reversed(versions)))
+
+@web_app.route('/api/guild/<int:guild_id>/backups/<int:version>', methods=['GET'])
+def api_download_backup_version(guild_id, version):
+    guild, error = _check_backup_access(guild_id)
+    if error: return error
+    snapshot = guild_backup_store.load_snapshot(guild_id, version)
+    if snapshot is None:
+        return jsonify(status="error", message=f"未找到备份版本 v{version}。"), 404
+    backup_json = json.dumps(snapshot, ensure_ascii=False, separators=(',', ':'))
+    filename = f"backup-{guild.name.replace(' ', '_')}-v{version}.json"
+    return send_file(io.BytesIO(backup_json.encode('utf-8')), mimetype='application/json', as_attachment=True, download_name=filename)
+
+@web_app.route('/api/guild/<int:guild_id>/backups/<int:old_version>/diff/<int:new_version>', methods=['GET'])
+def api_diff_backup_versions(guild_id, old_version, new_version):
+    guild, error = _check_backup_access(guild_id)
+    if error: return error
+    delta = guild_backup_store.diff_versions(guild_id, old_version, new_version)
+    if delta is None:
+        return jsonify(status="error", message="指定的备份版本不存在。"), 404
+    return jsonify(status="success", summary=backup_store.summarize_delta(delta), diff=delta)
+
+async def scheduled_backup_loop():
+    """定时为所有服务器创建备份。版本库只存与上一版本的增量，未变化的服务器不会产生新版本。"""
+    await bot.wait_until_ready()
+    while not bot.is_closed():
+        await asyncio.sleep(SCHEDULED_BACKUP_INTERVAL_HOURS * 3600)
+        saved = 0
+        for guild in list(bot.guilds):
+            try:
+                backup_data = await _create_backup_async(guild.id)
+                if backup_data is None: continue
+                entry = await bot.loop.run_in_executor(None, guild_backup_store.save_snapshot, guild.id, backup_data, "scheduled")
+                if not entry.get("unchanged"): saved += 1
+            except Exception as e:
+                logging.error(f"[定时备份] 服务器 {guild.id} 备份失败: {e}", exc_info=True)
+        print(f"[定时备份] 本轮完成，{saved} 个服务器产生了新版本。")
+
 async def _perform_restore_async(guild_id, backup_data, sid):
     """
-    【V6 - 权限增强版】长时间运行的恢复任务。
-    - 恢复所有角色及其通用权限。
-    - 恢复所有频道和分类。
-    - 在所有结构创建完毕后，统一恢复所有频道的权限覆盖。
+    【V7 - 增量并发版】长时间运行的恢复任务。
+    - 由 restore_planner 按 身份组 -> 分类 -> 频道 的依赖顺序分阶段恢复。
+    - 与现有结构做差异比较，未变化的对象直接跳过，多余的对象才删除。
+    - 同阶段内的操作并发执行，权限覆盖在创建频道时一并写入。
     """
     # 辅助函数，用于向前端发送日志
     def log_progress(message, type='info'):
@@ -7520,109 +7490,12 @@ async def _perform_restore_async(guild_id, backup_data, sid):
             return
 
         log_progress('恢复进程已启动...', 'info')
-        
-        # --- 阶段 1: 删除现有结构 ---
-        log_progress('--- 阶段 1: 删除现有结构 (此过程可能需要几分钟，请耐心等待) ---', 'warn')
-        
-        log_progress(f"开始删除服务器中的 {len(guild.channels)} 个频道...")
-        for channel in guild.channels:
-            try:
-                log_progress(f"  正在删除频道: #{channel.name}...")
-                await channel.delete(reason="服务器恢复")
-                await asyncio.sleep(1.2)
-            except discord.HTTPException as e:
-                log_progress(f"  警告：删除频道 #{channel.name} 失败 (可能是必要频道或权限问题): {e}", 'warn')
-
-        log_progress(f"开始删除服务器中的 {len(guild.roles)} 个身份组...")
-        for role in sorted(guild.roles, key=lambda r: r.position):
-             if not role.is_default() and not role.is_bot_managed() and not role.is_integration() and not role.is_premium_subscriber():
-                try:
-                    log_progress(f"  正在删除身份组: @{role.name}...")
-                    await role.delete(reason="服务器恢复")
-                    await asyncio.sleep(1.2)
-                except discord.HTTPException as e:
-                    log_progress(f"  警告：删除身份组 @{role.name} 失败 (可能是层级问题): {e}", 'warn')
-
-        log_progress('阶段 1 完成。', 'success')
-        
-        # --- 阶段 2: 创建新结构 (角色与频道) ---
-        log_progress('--- 阶段 2: 创建新结构 ---', 'warn')
-        role_map = {} # { old_id_str: new_role_object }
-        
-        # 从上到下创建身份组 (因为备份时是从高到低存的，所以用reversed)
-        for role_data in reversed(backup_data.get('roles', [])):
-            log_progress(f"  正在创建身份组: @{role_data['name']}...")
-            new_role = await guild.create_role(
-                name=role_data['name'],
-                permissions=discord.Permissions(role_data['permissions']),
-                color=discord.Color(role_data['color']),
-                hoist=role_data['hoist'],
-                mentionable=role_data['mentionable'],
-                reason="服务器恢复"
-            )
-            role_map[role_data['original_id']] = new_role
-            await asyncio.sleep(1.2)
-
-        category_map = {} # { old_id_str: new_category_object }
-        for cat_data in backup_data.get('categories', []):
-            log_progress(f"  正在创建分类: {cat_data['name']}...")
-            new_cat = await guild.create_category(name=cat_data['name'], reason="服务器恢复")
-            category_map[cat_data['original_id']] = new_cat
-            await asyncio.sleep(1.2)
-        
-        # 创建文本和语音频道
-        for chan_data in backup_data.get('text_channels', []):
-            category = category_map.get(chan_data.get('category_original_id'))
-            log_progress(f"  正在创建文本频道: #{chan_data['name']}...")
-            await guild.create_text_channel(name=chan_data['name'], topic=chan_data.get('topic'), category=category, reason="服务器恢复")
-            await asyncio.sleep(1.2)
-            
-        for chan_data in backup_data.get('voice_channels', []):
-            category = category_map.get(chan_data.get('category_original_id'))
-            log_progress(f"  正在创建语音频道: #{chan_data['name']}...")
-            await guild.create_voice_channel(name=chan_data['name'], user_limit=chan_data.get('user_limit',0), bitrate=chan_data.get('bitrate', 64000), category=category, reason="服务器恢复")
-            await asyncio.sleep(1.2)
-        log_progress('阶段 2 完成。', 'success')
-
-        # --- 【【【新增/增强】】】 阶段 3: 应用权限 ---
-        log_progress('--- 阶段 3: 应用权限 (这可能需要一些时间) ---', 'warn')
-        log_progress('等待Discord同步新创建的频道和身份组...', 'info')
-        await asyncio.sleep(5) # 给Discord一点时间处理所有创建操作
-        
-        # 重新获取所有频道和身份组以确保我们有最新的对象
-        fresh_channels = {c.name: c for c in await guild.fetch_channels()}
-        fresh_roles = {r.name: r for r in await guild.fetch_roles()}
-        
-        # 更新role_map和category_map，使用新的、新鲜的对象
-        for old_id, old_role_obj in list(role_map.items()):
-            if old_role_obj.name in fresh_roles:
-                role_map[old_id] = fresh_roles[old_role_obj.name]
-        for old_id, old_cat_obj in list(category_map.items()):
-            if old_cat_obj.name in fresh_channels:
-                 category_map[old_id] = fresh_channels[old_cat_obj.name]
-
-        all_channels_data = backup_data.get('categories', []) + backup_data.get('text_channels', []) + backup_data.get('voice_channels', [])
-        for chan_data in all_channels_data:
-            channel = fresh_channels.get(chan_data['name'])
-            if not channel:
-                log_progress(f"警告：找不到频道/分类 '{chan_data['name']}' 来应用权限。", 'warn')
-                continue
-            
-            for overwrite_data in chan_data.get('overwrites', []):
-                if overwrite_data['target_type'] == 'role':
-                    target_role = role_map.get(overwrite_data['target_original_id'])
-                    if not target_role: continue
-                    
-                    overwrite = discord.PermissionOverwrite()
-                    overwrite.update(allow=discord.Permissions(overwrite_data['allow']), deny=discord.Permissions(overwrite_data['deny']))
-                    
-                    try:
-                        await channel.set_permissions(target_role, overwrite=overwrite, reason="服务器恢复")
-                        log_progress(f"  已应用权限到 '{channel.name}' for '@{target_role.name}'")
-                        await asyncio.sleep(0.8) # 权限更新也需要慢一点
-                    except Exception as perm_err:
-                        log_progress(f"  错误: 应用权限到 '{channel.name}' for '@{target_role.name}' 失败: {perm_err}", 'error')
-                # (暂时不处理成员的特定权限覆盖，以简化流程)
+        started_at = time.monotonic()
+        stats = await restore_planner.GuildRestorePlanner(guild, backup_data, log_progress).run()
+        log_progress(
+            f"统计：新建 {stats['created']}，更新 {stats['updated']}，未变化跳过 {stats['unchanged']}，"
+            f"删除 {stats['deleted']}，失败 {stats['failed']}，耗时 {time.monotonic() - started_at:.1f} 秒。", 'info'
+        )
 
         log_progress('✅ 服务器恢复完成！', 'success')
         socketio.emit('restore_finished', {'status': 'success'}, room=sid)
@@ -7713,15 +7586,16 @@ async def send_reply_to_discord(guild_id, channel_id, user_info, content):
         if ticket_info:
             # 只要人工回复，就关闭AI托管
             database.db_set_ticket_ai_managed_status(ticket_info['ticket_id'], False)
+            ticket_ai_replies.cancel(ticket_info['channel_id'])
             # 通过socket通知前端，AI状态已改变
-            if socketio:
-                socketio.emit('ticket_ai_status_changed', {
+            if socket_events:
+                socket_events.publish('ticket_ai_status_changed', {
                     'ticket_id': str(ticket_info['ticket_id']),
                     'is_ai_managed': False
-                }, room=f'guild_{guild_id}')
+                }, room=f'guild_{guild_id}', key=ticket_info['ticket_id'])
         # 【【【新增代码结束】】】
 
-        if socketio:
+        if socket_events:
             msg_data_for_web = {
                 'id': str(sent_message.id),
                 'author': {
@@ -7735,7 +7609,7 @@ async def send_reply_to_discord(guild_id, channel_id, user_info, content):
                 'timestamp': sent_message.created_at.isoformat(),
                 'channel_id': str(channel.id)
             }
-            socketio.emit('new_ticket_message', msg_data_for_web, room=f'ticket_{channel.id}')
+            socket_events.publish('new_ticket_message', msg_data_for_web, room=f'ticket_{channel.id}')
 
     except Exception as e:
         print(f"从Web面板发送票据回复到频道 {channel_id} 时出错: {e}")
@@ -7892,6 +7766,7 @@ async def perform_action(guild_id, action, data, user_session):
         elif base_action == 'kb_remove':
             entry_order_to_remove = target_id # target_id 就是前端传来的序号
             success = database.db_remove_knowledge_base_entry_by_order(guild.id, entry_order_to_remove)
+            knowledge_bases.invalidate(guild.id)
             if success:
                 return jsonify(status="success", message=f"已成功删除知识库条目 #{entry_order_to_remove}。")
             else:
@@ -8041,6 +7916,7 @@ async def perform_action(guild_id, action, data, user_session):
             if active_log:
                 handler_id = moderator_member.id if moderator_member else None
                 database.db_deactivate_log(active_log['log_id'], reason, handler_id)
+                cancel_expiry("mute", active_log['log_id'])
             database.db_log_moderation_action(guild.id, target_id, moderator_member.id if moderator_member else None, 'unmute', reason, int(time.time()))
             return jsonify(status="success", message=f"已解除用户 {member.display_name} 的禁言。")
 
@@ -8139,7 +8015,9 @@ async def handle_form_submission(guild_id, data, user_session):
             duration_minutes = int(data.get('duration_minutes', 0))
             duration = datetime.timedelta(minutes=duration_minutes) if duration_minutes > 0 else datetime.timedelta(days=28)
             await member.timeout(duration, reason=f"由 {moderator_display_name} 从Web面板操作")
-            database.db_log_moderation_action(guild.id, member.id, moderator_id_for_db, 'mute', data.get('reason'), int(time.time()), duration.total_seconds(), int((discord.utils.utcnow() + duration).timestamp()))
+            expires_at = int((discord.utils.utcnow() + duration).timestamp())
+            log_id = database.db_log_moderation_action(guild.id, member.id, moderator_id_for_db, 'mute', data.get('reason'), int(time.time()), duration.total_seconds(), expires_at)
+            schedule_expiry("mute", log_id, expires_at)
             return jsonify(status="success", message=f"已禁言用户 {member.display_name}。")
 
         # --- 经济系统余额表单 ---
@@ -8225,6 +8103,7 @@ async def handle_form_submission(guild_id, data, user_session):
             content = data.get('content', '').strip()
             if not content: return jsonify(status="error", message="内容不能为空。")
             success, msg = database.db_add_knowledge_base_entry(guild_id, content, MAX_KB_ENTRIES_PER_GUILD)
+            knowledge_bases.invalidate(guild_id)
             return jsonify(status="success" if success else "error", message=msg)
 
         # --- FAQ添加表单 ---
@@ -8312,6 +8191,66 @@ async def handle_form_submission(guild_id, data, user_session):
         logging.error(f"处理表单 '{form_id}' 时发生错误", exc_info=True)
         return jsonify(status="error", message=f"发生内部服务器错误: {e}"), 500
 
+# =========================================
+# == Web 工作进程模式
+# =========================================
+# 工作进程中不能直接处理 (需要读取 Discord 缓存)、转发给机器人进程执行的 Socket.IO 事件
+FORWARDED_SOCKET_EVENTS = {'start_restore': handle_start_restore} if FLASK_AVAILABLE else {}
+web_workers_stopping = threading.Event()
+
+def dispatch_forwarded_socket_event(event, data, sid, cookie):
+    """机器人进程中用原连接的会话和 sid 执行工作进程转发过来的 Socket.IO 事件。"""
+    with web_app.test_request_context('/', headers={'Cookie': cookie} if cookie else None):
+        request.sid = sid
+        request.namespace = '/'
+        FORWARDED_SOCKET_EVENTS[event](data)
+
+def register_bot_rpc_handlers(server: bot_rpc.RPCServer):
+    server.register('stats', stats_snapshot)
+    server.register('web_auth', _compiled_web_auth, blocking=True)
+    server.register('http', dispatch_forwarded_request, blocking=True)
+    server.register('socket_event', dispatch_forwarded_socket_event, blocking=True)
+    # 工作进程中的路由通过 bot_call/bot_submit 调用的命令
+    for command in (_ticket_ai_suggest_async, _toggle_ai_assist_async, _get_ticket_history_async,
+                    send_reply_to_discord, resume_global_broadcast, perform_global_broadcast):
+        server.register(command.__name__, command)
+
+def forward_socket_event(event):
+    def handler(data):
+        try:
+            bot_rpc_client.call('socket_event', event, data, request.sid, request.headers.get('Cookie'), timeout=FORWARDED_REQUEST_TIMEOUT)
+        except (bot_rpc.RPCError, TimeoutError) as e:
+            logging.error(f"[WebWorker] 转发 Socket.IO 事件 {event} 失败: {e}")
+    return handler
+
+def run_web_worker():
+    """Web 工作进程入口 (python role_manager_bot.py --web-worker)，不运行 Discord 机器人。"""
+    for event in FORWARDED_SOCKET_EVENTS:
+        socketio.on_event(event, forward_socket_event(event))
+    print(f"[WebWorker] 工作进程 {os.getpid()} 已启动，机器人 RPC: {BOT_RPC_SOCKET}")
+    run_web_server()
+
+def start_web_workers(count: int):
+    """在机器人进程中启动 count 个 Web 工作进程 (共享 PORT 端口)，异常退出后自动重启。"""
+    def supervise(index):
+        while not web_workers_stopping.is_set():
+            proc = subprocess.Popen([sys.executable, os.path.abspath(__file__), "--web-worker"])
+            web_worker_processes[index] = proc
+            code = proc.wait()
+            if web_workers_stopping.is_set():
+                return
+            logging.error(f"[WebWorker] 工作进程 #{index} (PID {proc.pid}) 已退出，返回码 {code}，{WEB_WORKER_RESTART_DELAY} 秒后重启。")
+            time.sleep(WEB_WORKER_RESTART_DELAY)
+    for index in range(count):
+        threading.Thread(target=supervise, args=(index,), name=f"web-worker-{index}", daemon=True).start()
+    print(f"已启动 {count} 个 Web 工作进程 (WEB_PANEL_MODE=process)。")
+
+def stop_web_workers():
+    web_workers_stopping.set()
+    for proc in web_worker_processes.values():
+        if proc.poll() is None:
+            proc.terminate()
+
 # --- 启动流程 ---
 def run_web_server():
     if not web_app or not socketio:
@@ -8320,6 +8259,8 @@ def run_web_server():
     
     flask_port = int(os.environ.get("PORT", 5000))
     print(f"Flask+SocketIO 服务器正在启动，由 eventlet 提供服务，地址: http://0.0.0.0:{flask_port}")
+    if socket_events:
+        socket_events.start() # 按房间批量推送票据/审核事件
     
     try:
         # 这是 eventlet 推荐的生产环境启动方式
@@ -8342,34 +8283,92 @@ def handle_start_global_broadcast(data):
             socketio.emit('broadcast_finished', {'status': 'error'}, room=request.sid)
             return
 
-        # 使用 run_coroutine_threadsafe 安全地启动异步任务
-        asyncio.run_coroutine_threadsafe(
-            perform_global_broadcast(data, request.sid),
-            bot.loop
-        )
+        # 传入 job_id 表示重新接入 (或继续) 一个已存在的广播任务
+        resume_job_id = data.get('job_id')
+        if resume_job_id:
+            job = database.db_get_broadcast_job(int(resume_job_id))
+            if not job:
+                socketio.emit('broadcast_log', {'message': f'错误：广播任务 #{resume_job_id} 不存在。', 'type': 'error'}, room=request.sid)
+                socketio.emit('broadcast_finished', {'status': 'error'}, room=request.sid)
+                return
+            join_room(f"broadcast_{job['job_id']}")
+            bot_submit(resume_global_broadcast, job['job_id'])
+            return
 
-async def perform_global_broadcast(data, sid):
-    """
-    执行全局广播的异步后台任务。
-    """
+        title = data.get('title')
+        message_template = data.get('message')
+        if not title or not message_template:
+            socketio.emit('broadcast_log', {'message': '错误：标题和消息内容不能为空。', 'type': 'error'}, room=request.sid)
+            socketio.emit('broadcast_finished', {'status': 'error'}, room=request.sid)
+            return
+
+        job_id = database.db_create_broadcast_job(title, message_template, data.get('invite_url'), user_info.get('username'))
+        if not job_id:
+            socketio.emit('broadcast_log', {'message': '错误：无法创建广播任务。', 'type': 'error'}, room=request.sid)
+            socketio.emit('broadcast_finished', {'status': 'error'}, room=request.sid)
+            return
+        # 进度发往任务房间，刷新页面后可以通过 job_id 重新接入
+        join_room(f'broadcast_{job_id}')
+
+        # 在机器人事件循环上启动异步任务 (工作进程中经由 RPC)
+        bot_submit(perform_global_broadcast, job_id, data)
+
+# 正在本进程中执行的广播任务 {job_id: asyncio.Task}
+active_broadcast_tasks = {}
+
+def _broadcast_reporter(job_id):
     def log_progress(message, type='info'):
         # 这个内部函数帮助我们将日志发送回前端
-        socketio.emit('broadcast_log', {'message': message, 'type': type}, room=sid)
+        print(f"[广播 #{job_id}] {message}")
+        socketio.emit('broadcast_log', {'message': message, 'type': type, 'job_id': job_id}, room=f'broadcast_{job_id}')
         socketio.sleep(0)
+    return log_progress
+
+async def _run_broadcast_job(job_id):
+    job = await bot.loop.run_in_executor(None, database.db_get_broadcast_job, job_id)
+    runner = broadcast_engine.BroadcastJobRunner(bot, job, _broadcast_reporter(job_id))
+    try:
+        success = await runner.run()
+    finally:
+        active_broadcast_tasks.pop(job_id, None)
+    socketio.emit('broadcast_finished', {'status': 'success' if success else 'error', 'job_id': job_id}, room=f'broadcast_{job_id}')
+
+async def resume_global_broadcast(job_id):
+    """继续一个中断的广播任务；如果它已在本进程中运行，则只是让调用者接收进度。"""
+    log_progress = _broadcast_reporter(job_id)
+    if job_id in active_broadcast_tasks:
+        log_progress(f'已重新接入正在运行的广播任务 #{job_id}。', 'info')
+        return
+    job = await bot.loop.run_in_executor(None, database.db_get_broadcast_job, job_id)
+    if not job or job['status'] != 'RUNNING':
+        log_progress(f"广播任务 #{job_id} 当前状态为 {job['status'] if job else '不存在'}，无需继续。", 'warn')
+        socketio.emit('broadcast_finished', {'status': 'success', 'job_id': job_id}, room=f'broadcast_{job_id}')
+        return
+    active_broadcast_tasks[job_id] = asyncio.current_task()
+    await _run_broadcast_job(job_id)
+
+async def resume_unfinished_broadcasts():
+    """机器人启动后继续执行上次被中断的广播任务。"""
+    await bot.wait_until_ready()
+    jobs = await bot.loop.run_in_executor(None, database.db_get_unfinished_broadcast_jobs)
+    for job in jobs:
+        if job['job_id'] not in active_broadcast_tasks:
+            print(f"[广播] 正在继续上次中断的广播任务 #{job['job_id']}...")
+            active_broadcast_tasks[job['job_id']] = bot.loop.create_task(_run_broadcast_job(job['job_id']))
+
+async def perform_global_broadcast(job_id, data):
+    """
+    执行全局广播的异步后台任务。
+    收件人先写入 SQLite 队列，再由 broadcast_engine 按自适应速率逐个发送并定期保存断点。
+    """
+    log_progress = _broadcast_reporter(job_id)
+    active_broadcast_tasks[job_id] = asyncio.current_task()
 
-    title = data.get('title')
-    message_template = data.get('message')
-    invite_url = data.get('invite_url')
     # 【新增】获取目标服务器信息
     broadcast_to_all = data.get('broadcast_to_all', False)
     target_guild_ids = {int(gid) for gid in data.get('target_guilds', []) if gid.isdigit()}
 
-    if not title or not message_template:
-        log_progress('错误：标题和消息内容不能为空。', 'error')
-        socketio.emit('broadcast_finished', {'status': 'error'}, room=sid)
-        return
-
-    log_progress('全局广播任务已启动...', 'info')
+    log_progress(f'全局广播任务 #{job_id} 已创建...', 'info')
     
     # 【修改】根据前端传来的数据筛选目标服务器
     if broadcast_to_all:
@@ -8380,77 +8379,41 @@ async def perform_global_broadcast(data, sid):
         log_progress(f'目标: {len(target_guilds)} 个特定服务器。', 'info')
 
     if not target_guilds:
+        active_broadcast_tasks.pop(job_id, None)
+        await bot.loop.run_in_executor(None, database.db_set_broadcast_job_status, job_id, 'FAILED')
         log_progress('错误：找不到任何目标服务器进行广播。', 'error')
-        socketio.emit('broadcast_finished', {'status': 'error'}, room=sid)
+        socketio.emit('broadcast_finished', {'status': 'error', 'job_id': job_id}, room=f'broadcast_{job_id}')
         return
-    
-    sent_count = 0
-    fail_count = 0
-    
-    all_members_to_dm = []
-    # 【修改】从筛选后的服务器列表中收集成员
-    for guild in target_guilds:
-        if not guild.chunked:
-            try:
-                await guild.chunk(cache=True)
-            except Exception as e:
-                log_progress(f"警告：无法获取服务器 '{guild.name}' 的完整成员列表: {e}", 'warn')
-        all_members_to_dm.extend(list(guild.members))
 
-    # 使用集合去重，防止同一用户在多个目标服务器中被重复广播
-    unique_members = {member.id: member for member in all_members_to_dm}.values()
-
-    total_users = len(unique_members)
+    total_users = await broadcast_engine.enqueue_broadcast_recipients(bot, job_id, target_guilds, log_progress)
     log_progress(f"将在 {len(target_guilds)} 个服务器中，向 {total_users} 名独立用户发送广播。", 'info')
-
-    for i, member in enumerate(unique_members):
-        if member.bot:
-            continue
-
-        message_content = message_template.replace('{user_name}', member.display_name).replace('{server_name}', member.guild.name)
-        
-        embed = discord.Embed(
-            title=title,
-            description=message_content,
-            color=discord.Color.blue(),
-            timestamp=discord.utils.utcnow()
-        )
-        if invite_url:
-            embed.add_field(name="专属邀请", value=f"点击这里加入我们的社区：\n{invite_url}", inline=False)
-        
-        if bot.user.avatar:
-            embed.set_footer(text=f"来自 {bot.user.name} 开发团队", icon_url=bot.user.avatar.url)
-
-        try:
-            await member.send(embed=embed)
-            sent_count += 1
-            log_progress(f"({i+1}/{total_users}) 成功发送到: {member.name} ({member.guild.name})", 'info')
-        except discord.Forbidden:
-            fail_count += 1
-            log_progress(f"({i+1}/{total_users}) 发送失败 (Forbidden): {member.name} ({member.guild.name})", 'warn')
-        except Exception as e:
-            fail_count += 1
-            log_progress(f"({i+1}/{total_users}) 发送失败 (Error: {type(e).__name__}): {member.name}", 'error')
-
-        # 速率限制
-        await asyncio.sleep(1.5)
-
-    log_progress(f"广播任务完成！成功: {sent_count}, 失败: {fail_count}。", 'success')
-    socketio.emit('broadcast_finished', {'status': 'success'}, room=sid)
+    await _run_broadcast_job(job_id)
 
 if __name__ == "__main__":
+    if IS_WEB_WORKER:
+        if not (web_app and socketio):
+            print("❌ 致命错误：Flask/SocketIO 不可用，Web 工作进程无法启动。")
+            exit()
+        run_web_worker()
+        exit()
     print("正在启动系统...")
     if not BOT_TOKEN:
         print("❌ 致命错误：无法启动，因为 DISCORD_BOT_TOKEN 未设置。")
         exit()
     if alipay_client:
         alipay_port = 8080 
+        database.initialize_database() # 回调监听器在机器人登录前就开始接收通知，先确保收件箱表存在
         http_thread = threading.Thread(target=run_http_server, args=(alipay_port,), daemon=True)
         http_thread.start()
         print(f"支付宝回调监听器已在后台线程启动，端口: {alipay_port}")
     if web_app and socketio and all([WEB_ADMIN_PASSWORD, DISCORD_CLIENT_ID, DISCORD_CLIENT_SECRET, DISCORD_REDIRECT_URI]):
-        web_thread = threading.Thread(target=run_web_server, daemon=True)
-        web_thread.start()
+        sub_accounts.start() # 后台批量写入副账号的 last_used_at，并定时重新加载副账号
+        if WEB_PANEL_MODE == "process":
+            socket_events.start() # 批量事件经由 RPC 推送给工作进程
+            start_web_workers(WEB_WORKERS)
+        else:
+            web_thread = threading.Thread(target=run_web_server, daemon=True)
+            web_thread.start()
     else:
         print("⚠️ 警告: Web管理面板配置不完整或Flask/SocketIO不可用，Web服务未启动。")
     try:
@@ -8463,4 +8426,5 @@ if __name__ == "__main__":
     except Exception as e:
         logging.critical(f"启动机器人时发生致命错误: {e}", exc_info=True)
     finally:
+        stop_web_workers()
         print("机器人主循环已结束。程序正在退出。")
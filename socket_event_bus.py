@@ -0,0 +1,313 @@
+# socket_event_bus.py
+"""
+机器人事件循环与 Socket.IO 之间的事件总线。
+
+- publish() 只把事件追加到线程安全的收件队列 (deque) 中立即返回，机器人事件循环不再直接调用
+  socketio.emit (序列化 + 逐个客户端发送)。
+- 刷新任务每 window 秒 (默认 100ms) 把收件队列按 (房间, 事件) 分组，每组只发送一次
+  "<事件>_batch"，内容为 {'events': [...], 'dropped': 丢弃数}。
+- 每种事件有自己的策略 (EVENT_POLICIES):
+    * DROP_OLDEST: 全部按顺序送达；某房间积压超过 max_pending 条时丢弃最旧的，并把丢弃数告诉前端
+      (前端可据此重新拉取)。用于票据消息和审核事件。
+    * COALESCE:    同一 key 在一个窗口内只保留最新的一条，每个窗口结束时都会发送。
+      用于票据 AI 托管状态这类"状态"事件。不跨窗口比较"上次发送的内容"：状态也可能经由不发布事件的路径改变，
+      跨窗口抑制会把真实的状态变化当成重复而吞掉。
+- 载荷差分 (delta=True): 批次中的事件如果与前一条的字段集合相同，只发送值有变化的字段并带上 "_d": 1，
+  前端用前一条补齐 (见 static/js/main.js 的 onSocketBatch)。同一作者连续发言时，作者信息、频道 ID、
+  空 embeds 等都不再重复发送。
+- stats() 报告最近 RATE_WINDOW 秒内每秒发出的事件数和 emit 次数，以及累计的丢弃/合并数。
+
+突发压力测试 (模拟刷屏/袭击，对比逐条 emit):
+    python socket_event_bus.py --rooms 20 --rate 3000 --seconds 3
+"""
+import json
+import logging
+import threading
+import time
+from collections import OrderedDict, deque
+from typing import Any, Dict, List, Optional, Tuple
+
+DEFAULT_WINDOW = 0.1
+BATCH_SUFFIX = "_batch"
+RATE_WINDOW = 10.0
+
+DROP_OLDEST = "drop_oldest"
+COALESCE = "coalesce"
+
+# 事件名 -> (策略, 每个房间最多积压的条数, 是否差分)
+EVENT_POLICIES: Dict[str, Tuple[str, int, bool]] = {
+    "new_ticket_message": (DROP_OLDEST, 200, True),
+    "new_violation": (DROP_OLDEST, 100, True),
+    "ticket_ai_status_changed": (COALESCE, 1000, False),
+}
+DEFAULT_POLICY = (DROP_OLDEST, 200, False)
+
+
+def delta_encode(events: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """批次内差分：与前一条字段集合相同时只保留变化的字段，并标记 "_d": 1。"""
+    encoded, previous = [], None
+    for payload in events:
+        if previous is not None and payload.keys() == previous.keys():
+            item = {k: v for k, v in payload.items() if previous[k] != v}
+            item["_d"] = 1
+        else:
+            item = payload
+        encoded.append(item)
+        previous = payload
+    return encoded
+
+
+def delta_decode(encoded: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """delta_encode 的逆运算 (与前端 onSocketBatch 的逻辑相同，用于测试)。"""
+    events, previous = [], None
+    for item in encoded:
+        if item.get("_d") and previous is not None:
+            payload = {**previous, **item}
+            del payload["_d"]
+        else:
+            payload = item
+        events.append(payload)
+        previous = payload
+    return events
+
+
+class _RoomQueue:
+    """单个 (房间, 事件) 的待发送事件。只由刷新任务访问。"""
+    __slots__ = ("items", "keyed", "dropped")
+
+    def __init__(self):
+        self.items: deque = deque()
+        self.keyed: "OrderedDict[Any, Dict[str, Any]]" = OrderedDict()
+        self.dropped = 0
+
+
+class SocketEventBus:
+    def __init__(self, socketio, window: float = DEFAULT_WINDOW, policies: Optional[Dict[str, Tuple[str, int, bool]]] = None):
+        self.socketio = socketio
+        self.window = window
+        self.policies = {**EVENT_POLICIES, **(policies or {})}
+        self._inbox: deque = deque()  # (事件, 房间, 载荷, key)；append/popleft 是线程安全的
+        self._rooms: "OrderedDict[Tuple[str, str], _RoomQueue]" = OrderedDict()
+        self._lock = threading.Lock()  # 只保护统计数据
+        self._flush_lock = threading.Lock()  # stop() 与刷新任务可能同时 flush
+        self._rate_samples: deque = deque()  # (时间, 累计事件数, 累计 emit 次数)
+        self._started = False
+        self._stopped = False
+        self.published = 0
+        self.emitted_events = 0
+        self.emits = 0
+        self.dropped = 0
+        self.coalesced = 0
+        self.errors = 0
+
+    def policy(self, event: str) -> Tuple[str, int, bool]:
+        return self.policies.get(event, DEFAULT_POLICY)
+
+    def publish(self, event: str, payload: Dict[str, Any], room: str, key: Any = None):
+        """可从任意线程 (包括机器人事件循环) 调用，不做任何 I/O。COALESCE 事件需要提供 key。"""
+        self._inbox.append((event, room, payload, key))
+        self.published += 1
+
+    # ---------------------------------------------------------------
+    # 刷新
+    # ---------------------------------------------------------------
+    def _drain(self):
+        inbox = self._inbox
+        while inbox:
+            event, room, payload, key = inbox.popleft()
+            strategy, max_pending, _ = self.policy(event)
+            queue = self._rooms.get((room, event))
+            if queue is None:
+                queue = self._rooms[(room, event)] = _RoomQueue()
+            if strategy == COALESCE:
+                if key in queue.keyed:
+                    self.coalesced += 1
+                    queue.keyed.move_to_end(key)
+                queue.keyed[key] = payload
+                if len(queue.keyed) > max_pending:
+                    queue.keyed.popitem(last=False)
+                    queue.dropped += 1
+            else:
+                queue.items.append(payload)
+                if len(queue.items) > max_pending:
+                    queue.items.popleft()
+                    queue.dropped += 1
+
+    def flush(self) -> int:
+        """发送当前积压的全部事件，返回发送的事件数。"""
+        with self._flush_lock:
+            return self._flush()
+
+    def _flush(self) -> int:
+        self._drain()
+        sent = 0
+        rooms, self._rooms = self._rooms, OrderedDict()
+        for (room, event), queue in rooms.items():
+            strategy, _, delta = self.policy(event)
+            events = list(queue.keyed.values()) if strategy == COALESCE else list(queue.items)
+            if not events and not queue.dropped:
+                continue
+            try:
+                self.socketio.emit(event + BATCH_SUFFIX, {"events": delta_encode(events) if delta else events,
+                                                         "dropped": queue.dropped}, room=room)
+            except Exception as e:
+                self.errors += 1
+                logging.error(f"[SocketEventBus] 向房间 {room} 发送 {event} 批次失败: {e}", exc_info=True)
+                continue
+            sent += len(events)
+            with self._lock:
+                self.emits += 1
+                self.emitted_events += len(events)
+                self.dropped += queue.dropped
+        now = time.monotonic()
+        with self._lock:
+            self._rate_samples.append((now, self.emitted_events, self.emits))
+            while len(self._rate_samples) > 1 and self._rate_samples[0][0] < now - RATE_WINDOW:
+                self._rate_samples.popleft()
+        return sent
+
+    def _run(self):
+        while not self._stopped:
+            self.socketio.sleep(self.window)
+            try:
+                self.flush()
+            except Exception as e:
+                logging.error(f"[SocketEventBus] 刷新事件时出错: {e}", exc_info=True)
+
+    def start(self):
+        """在 Web 服务器启动前调用；刷新任务作为 Socket.IO 后台任务运行 (eventlet 下为绿色线程)。"""
+        if not self._started:
+            self._started = True
+            self._stopped = False
+            self.socketio.start_background_task(self._run)
+
+    def stop(self):
+        self._stopped = True
+        self._started = False
+        self.flush()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            samples = self._rate_samples
+            span = samples[-1][0] - samples[0][0] if len(samples) > 1 else 0.0
+            return {
+                "events_per_sec": round((samples[-1][1] - samples[0][1]) / span, 1) if span else 0.0,
+                "emits_per_sec": round((samples[-1][2] - samples[0][2]) / span, 1) if span else 0.0,
+                "published": self.published,
+                "emitted_events": self.emitted_events,
+                "emits": self.emits,
+                "dropped": self.dropped,
+                "coalesced": self.coalesced,
+                "errors": self.errors,
+                "pending": len(self._inbox),
+            }
+
+
+# =========================================
+# == 突发压力测试
+# =========================================
+class _FakeSocketIO:
+    """统计 emit 次数和序列化后的字节数；每次 emit 模拟 emit_us 微秒的发送开销。"""
+
+    def __init__(self, emit_us: float):
+        self.emit_us = emit_us
+        self.bytes = 0
+        self.calls = 0
+        self.received: Dict[str, List[Dict[str, Any]]] = {}
+        self.latencies: List[float] = []
+
+    def emit(self, event, data, room=None):
+        self.calls += 1
+        self.bytes += len(json.dumps(data, ensure_ascii=False))
+        deadline = time.perf_counter() + self.emit_us / 1e6
+        while time.perf_counter() < deadline:
+            pass
+        if event.endswith(BATCH_SUFFIX):
+            events = delta_decode(data["events"]) if EVENT_POLICIES.get(event[:-len(BATCH_SUFFIX)], DEFAULT_POLICY)[2] else data["events"]
+        else:
+            events = [data]
+        now = time.perf_counter()
+        self.latencies.extend(now - e["_published"] for e in events if "_published" in e)
+        self.received.setdefault(room, []).extend(events)
+
+    def sleep(self, seconds):
+        time.sleep(seconds)
+
+    def start_background_task(self, target, *args):
+        thread = threading.Thread(target=target, args=args, daemon=True)
+        thread.start()
+        return thread
+
+
+def _raid_workload(rooms: int, rate: int, seconds: float):
+    import random
+    authors = [{"id": str(10_000 + i), "name": f"raider-{i}", "avatar_url": f"https://cdn.discordapp.com/avatars/{10_000 + i}/a_{i:032x}.png", "is_bot": False}
+               for i in range(30)]
+    workload = []
+    for i in range(int(rate * seconds)):
+        room = random.randrange(rooms)
+        # 袭击时少数账号反复刷屏：连续消息多来自同一作者
+        author = authors[room % len(authors)] if random.random() < 0.8 else random.choice(authors)
+        workload.append(("new_ticket_message", f"ticket_{room}", {
+            "id": str(1_000_000 + i), "author": author, "content": f"spam spam spam {random.randrange(5)}",
+            "embeds": [], "timestamp": "2025-01-01T00:00:00+00:00", "channel_id": str(room),
+        }, None))
+        if i % 50 == 0:
+            workload.append(("ticket_ai_status_changed", "guild_1", {"ticket_id": str(room), "is_ai_managed": False}, room))
+    return workload
+
+
+def _run_benchmark(rooms: int, rate: int, seconds: float, emit_us: float):
+    workload = _raid_workload(rooms, rate, seconds)
+    interval = 1.0 / rate
+
+    def produce(send):
+        started = time.perf_counter()
+        busy = 0.0
+        for n, (event, room, payload, key) in enumerate(workload):
+            target = started + n * interval
+            while time.perf_counter() < target:
+                time.sleep(0.0005)
+            payload = {**payload, "_published": time.perf_counter()}
+            t0 = time.perf_counter()
+            send(event, room, payload, key)
+            busy += time.perf_counter() - t0
+        return busy
+
+    def report(label, sio, busy, extra=""):
+        lat = sorted(sio.latencies)
+        p95 = lat[int(len(lat) * 0.95)] * 1000 if lat else 0.0
+        print(f"  {label:<10} emit {sio.calls:>6} 次, {sio.bytes / 1024:>8.0f} KiB, 事件循环占用 {busy * 1000:>7.0f}ms, "
+              f"送达 p95 {p95:>6.1f}ms{extra}")
+
+    direct = _FakeSocketIO(emit_us)
+    busy = produce(lambda event, room, payload, key: direct.emit(event, payload, room=room))
+    report("逐条 emit", direct, busy)
+
+    batched = _FakeSocketIO(emit_us)
+    bus = SocketEventBus(batched)
+    bus.start()
+    busy = produce(lambda event, room, payload, key: bus.publish(event, payload, room, key))
+    time.sleep(bus.window * 2)
+    stats = bus.stats()
+    bus.stop()
+    report("事件总线", batched, busy)
+    for room, events in direct.received.items():
+        if room.startswith("ticket_"):
+            # 积压超限时会丢弃最旧的消息，但送达的消息必须按原顺序且内容一致
+            expected = iter(e["id"] for e in events)
+            assert all(any(i == got["id"] for i in expected) for got in batched.received.get(room, [])), "批量发送后消息顺序不一致"
+    assert stats["emitted_events"] + stats["dropped"] + stats["coalesced"] == stats["published"]
+    print(f"  总线统计: {stats}")
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Socket.IO 事件总线突发压力测试")
+    parser.add_argument("--rooms", type=int, default=20)
+    parser.add_argument("--rate", type=int, default=3000, help="每秒产生的票据消息数")
+    parser.add_argument("--seconds", type=float, default=3.0)
+    parser.add_argument("--emit-us", type=float, default=50.0, help="模拟每次 emit 的发送开销 (微秒)")
+    args = parser.parse_args()
+    print(f"{args.rooms} 个票据房间, 每秒 {args.rate} 条消息, 持续 {args.seconds:.0f} 秒:")
+    _run_benchmark(args.rooms, args.rate, args.seconds, args.emit_us)
@@ -71,6 +71,27 @@ async function apiRequest(endpoint, options = {}) {
     }
 }
 
+// 后端事件总线 (socket_event_bus.py) 按房间每 100ms 推送一次 "<事件>_batch": { events: [...], dropped: n }
+// 带 _d 标记的事件只包含与前一条不同的字段，用前一条补齐
+function onSocketBatch(socket, event, handler, onDropped = null) {
+    socket.on(`${event}_batch`, (batch) => {
+        let previous = null;
+        for (const item of batch.events) {
+            let data = item;
+            if (item._d && previous) {
+                data = Object.assign({}, previous, item);
+                delete data._d;
+            }
+            handler(data);
+            previous = data;
+        }
+        if (batch.dropped > 0) {
+            console.warn(`[Socket.IO] ${event}: 积压过多，服务器丢弃了 ${batch.dropped} 条事件。`);
+            if (onDropped) onDropped(batch.dropped);
+        }
+    });
+}
+
 function setupCommonEventListeners(GUILD_ID, renderers = {}) {
     console.log(`[setupEventListeners] 为服务器/全局绑定通用事件...`);
     const body = document.body;
@@ -715,7 +736,7 @@ function initializeAuditCorePage() {
             console.log(`%c[AuditCorePage] Socket.IO已连接! Socket ID: ${socket.id}`, 'color: #00ff00; font-weight: bold;');
             socket.emit('join_audit_room', { guild_id: GUILD_ID });
         });
-        socket.on('new_violation', (data) => renderViolationCard(data));
+        onSocketBatch(socket, 'new_violation', (data) => renderViolationCard(data), () => fetchHistory());
         socket.on('connect_error', (err) => console.error('[AuditCorePage] Socket.IO连接错误:', err));
     } catch (e) { console.error("无法初始化Socket.IO:", e); }
     logContainer.addEventListener('click', (event) => {
@@ -0,0 +1,241 @@
+# sub_account_auth.py
+"""
+Web 面板副账号认证。
+
+- 数据库只保存访问密钥的 SHA-256 哈希 (database.hash_access_key)。登录时对输入的密钥求哈希，
+  在内存映射中查找，再用 hmac.compare_digest 以恒定时间比较哈希。
+- 副账号的已解析权限保存在内存中，登录和每次请求的鉴权都不再查询数据库、不再解析 JSON。
+  内存映射包含全部副账号：登录时查不到的密钥直接判定为无效，不会为每次失败的尝试查询数据库
+  (未登录即可触发，不能让无效密钥变成数据库负载)。
+- 本进程新建、修改或删除副账号后调用 register() / invalidate() 立即更新映射；
+  其它进程做的修改由后台线程每 RELOAD_INTERVAL 秒整体重新加载一次；重新加载时权限变化或被删除的账号
+  会传给 on_change (机器人用它让 web_auth 中已编译的权限失效)。
+- last_used_at 不再在每次登录时 UPDATE + commit，而是记在内存里，
+  由后台线程每 LAST_USED_FLUSH_INTERVAL 秒用一次 executemany 批量写入。
+
+登录吞吐量测试 (对比旧的明文查询 + 解析 JSON + 每次提交):
+    python sub_account_auth.py --accounts 200 --logins 20000
+"""
+import hmac
+import logging
+import threading
+import time
+from typing import Any, Callable, Dict, Optional
+
+import database
+
+LAST_USED_FLUSH_INTERVAL = 60.0
+RELOAD_INTERVAL = 30.0
+
+
+class SubAccountAuth:
+    """线程安全。"""
+
+    def __init__(self, flush_interval: float = LAST_USED_FLUSH_INTERVAL, reload_interval: float = RELOAD_INTERVAL,
+                 on_change: Optional[Callable[[int], None]] = None):
+        self.flush_interval = flush_interval
+        self.on_change = on_change
+        self.reload_interval = reload_interval
+        self._lock = threading.Lock()
+        self._accounts: Dict[int, Optional[Dict[str, Any]]] = {}  # id -> 账号 (None 表示已确认不存在)
+        self._by_hash: Dict[str, int] = {}
+        self._last_used: Dict[int, int] = {}
+        self._loaded = False
+        self._loaded_at = 0.0
+        self._stop = threading.Event()
+        self._flusher: Optional[threading.Thread] = None
+        self.logins = 0
+        self.failed_logins = 0
+        self.db_lookups = 0
+
+    def _remember(self, account: Dict[str, Any]):
+        self._accounts[account['id']] = account
+        self._by_hash[account['key_hash']] = account['id']
+
+    def load(self):
+        """加载全部副账号 (数量很少)，整体替换内存映射。"""
+        accounts = database.db_get_sub_account_credentials()
+        with self._lock:
+            self.db_lookups += 1
+            previous = self._accounts
+            self._accounts, self._by_hash = {}, {}
+            for account in accounts:
+                self._remember(account)
+            changed = [account_id for account_id, account in previous.items()
+                       if account and self._accounts.get(account_id, {}).get('permissions') != account['permissions']]
+            self._loaded = True
+            self._loaded_at = time.monotonic()
+        if self.on_change:
+            for account_id in changed:
+                self.on_change(account_id)
+
+    # ---------------------------------------------------------------
+    # 认证与权限
+    # ---------------------------------------------------------------
+    def authenticate(self, access_key: str) -> Optional[Dict[str, Any]]:
+        """密钥有效时返回 {'id', 'account_name', 'permissions'}，否则返回 None。"""
+        if not access_key:
+            return None
+        if not self._loaded:
+            self.load()
+        key_hash = database.hash_access_key(access_key)
+        with self._lock:
+            account_id = self._by_hash.get(key_hash)
+            account = self._accounts.get(account_id) if account_id is not None else None
+        if account is None or not hmac.compare_digest(account['key_hash'], key_hash):
+            with self._lock: self.failed_logins += 1
+            return None
+        with self._lock:
+            self.logins += 1
+            self._last_used[account['id']] = int(time.time())
+        return {'id': account['id'], 'account_name': account['account_name'], 'permissions': account['permissions']}
+
+    def permissions(self, account_id: int) -> Optional[Dict[str, Any]]:
+        """副账号当前的权限；账号已删除时返回 None。"""
+        with self._lock:
+            if account_id in self._accounts:
+                account = self._accounts[account_id]
+                return account['permissions'] if account else None
+        rows = database.db_get_sub_account_credentials(account_id=account_id)
+        with self._lock:
+            if rows:
+                self._remember(rows[0])
+                return rows[0]['permissions']
+            self._accounts[account_id] = None
+            return None
+
+    def register(self, access_key: str):
+        """本进程新建副账号后调用，新密钥立即可以登录。"""
+        rows = database.db_get_sub_account_credentials(key_hash=database.hash_access_key(access_key))
+        with self._lock:
+            self.db_lookups += 1
+            for account in rows:
+                self._remember(account)
+
+    def invalidate(self, account_id: int):
+        """副账号权限被修改或账号被删除后调用：从数据库重新读取该账号。"""
+        rows = database.db_get_sub_account_credentials(account_id=account_id)
+        with self._lock:
+            self.db_lookups += 1
+            for key_hash in [h for h, i in self._by_hash.items() if i == account_id]:
+                del self._by_hash[key_hash]
+            if rows:
+                self._remember(rows[0])
+            else:
+                self._accounts[account_id] = None
+
+    # ---------------------------------------------------------------
+    # last_used_at 批量写入
+    # ---------------------------------------------------------------
+    def flush(self) -> int:
+        with self._lock:
+            pending, self._last_used = self._last_used, {}
+        if pending and not database.db_touch_sub_accounts(pending):
+            with self._lock: # 写入失败，合并回待写入列表下次重试
+                for account_id, ts in pending.items():
+                    self._last_used[account_id] = max(ts, self._last_used.get(account_id, 0))
+            return 0
+        return len(pending)
+
+    def _flush_loop(self):
+        last_flush = time.monotonic()
+        while not self._stop.wait(min(self.flush_interval, self.reload_interval)):
+            try:
+                if time.monotonic() - self._loaded_at >= self.reload_interval:
+                    self.load()
+                if time.monotonic() - last_flush >= self.flush_interval:
+                    last_flush = time.monotonic()
+                    self.flush()
+            except Exception as e:
+                logging.error(f"[SubAccountAuth] 后台刷新副账号时出错: {e}", exc_info=True)
+
+    def start(self):
+        if self._flusher is None or not self._flusher.is_alive():
+            self._stop.clear()
+            self._flusher = threading.Thread(target=self._flush_loop, name="sub-account-refresh", daemon=True)
+            self._flusher.start()
+
+    def stop(self):
+        self._stop.set()
+        self.flush()
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {"logins": self.logins, "failed_logins": self.failed_logins, "db_lookups": self.db_lookups,
+                    "cached_accounts": sum(1 for a in self._accounts.values() if a), "pending_last_used": len(self._last_used)}
+
+
+# =========================================
+# == 登录吞吐量测试
+# =========================================
+def _run_benchmark(accounts: int, logins: int, bot_writes_per_sec: float):
+    import json
+    import os
+    import random
+    import secrets
+    import tempfile
+
+    with tempfile.TemporaryDirectory() as tmp:
+        database.DATABASE_FILE = os.path.join(tmp, "bench.db")
+        database.initialize_database()
+        permissions = {"global_permissions": ["page_settings"], "guilds": [str(g) for g in range(20)]}
+        keys = [database.db_create_sub_account(f"account-{i}", permissions) for i in range(accounts)]
+        # 旧格式的明文密钥表，用于对比
+        conn = database.get_db_connection()
+        conn.execute("CREATE TABLE legacy_sub_accounts (id INTEGER PRIMARY KEY, account_name TEXT, access_key TEXT UNIQUE, "
+                     "permissions_json TEXT, last_used_at INTEGER)")
+        conn.execute("CREATE INDEX idx_legacy_key ON legacy_sub_accounts (access_key)")
+        conn.executemany("INSERT INTO legacy_sub_accounts (account_name, access_key, permissions_json) VALUES (?, ?, ?)",
+                         [(f"account-{i}", key, json.dumps(permissions)) for i, key in enumerate(keys)])
+        conn.commit(); conn.close()
+
+        def legacy_validate(access_key):
+            conn = database.get_db_connection()
+            try:
+                row = conn.execute("SELECT id, account_name, permissions_json FROM legacy_sub_accounts WHERE access_key = ?", (access_key,)).fetchone()
+                if not row:
+                    return None
+                account = dict(row); account['permissions'] = json.loads(account['permissions_json'])
+                conn.execute("UPDATE legacy_sub_accounts SET last_used_at = ? WHERE id = ?", (int(time.time()), account['id']))
+                conn.commit()
+                return account
+            finally:
+                conn.close()
+
+        # 模拟机器人同时在写数据库 (余额、日志等)
+        stop = threading.Event()
+
+        def bot_writer():
+            conn = database.get_db_connection()
+            conn.execute("CREATE TABLE IF NOT EXISTS bench_bot_writes (v INTEGER)")
+            while not stop.is_set():
+                conn.execute("INSERT INTO bench_bot_writes (v) VALUES (?)", (random.random(),)); conn.commit()
+                if bot_writes_per_sec > 0:
+                    time.sleep(1 / bot_writes_per_sec)
+            conn.close()
+
+        workload = [random.choice(keys) if random.random() > 0.05 else secrets.token_urlsafe(32) for _ in range(logins)]
+        writer = threading.Thread(target=bot_writer, daemon=True)
+        writer.start()
+        auth = SubAccountAuth()
+        for label, fn in (("旧: 明文查询 + 每次提交", legacy_validate), ("SubAccountAuth", auth.authenticate)):
+            started = time.perf_counter()
+            ok = sum(1 for key in workload if fn(key))
+            elapsed = time.perf_counter() - started
+            print(f"  {label:<24} {logins / elapsed:>9.0f} 次/秒  (成功 {ok}/{logins})")
+        stop.set(); writer.join()
+        started = time.perf_counter()
+        flushed = auth.flush()
+        print(f"  批量写入 last_used_at: {flushed} 个账号, {(time.perf_counter() - started) * 1000:.1f}ms")
+        print(f"  {auth.stats()}")
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="副账号登录吞吐量测试")
+    parser.add_argument("--accounts", type=int, default=200)
+    parser.add_argument("--logins", type=int, default=20000)
+    parser.add_argument("--bot-writes-per-sec", type=float, default=200.0, help="模拟机器人并发写入的频率 (0 = 不限速)")
+    args = parser.parse_args()
+    print(f"{args.accounts} 个副账号, {args.logins} 次登录 (5% 无效密钥), 机器人并发写入 {args.bot_writes_per_sec:.0f} 次/秒:")
+    _run_benchmark(args.accounts, args.logins, args.bot_writes_per_sec)
@@ -0,0 +1,230 @@
+# ticket_ai_state.py
+"""
+AI 托管票据的对话状态。
+
+- TicketConversation 保存一个票据已整理好的对话轮次 (角色、发言者、文本、估算的 token 数)。
+  每次回复前只把票据消息缓存 (ticket_message_cache.py) 中比 last_message_id 更新的消息追加进来，
+  不再重新获取并格式化整段历史。
+- 提示词按角色分条发送 (system / user / assistant)，而不是把整段历史拼接成一个大字符串。
+  build_messages() 从最新的轮次往前装入，直到 token 预算用完，更早的轮次被丢弃，
+  因此长票据的提示词大小有上限。
+- KnowledgeBaseCache 按服务器缓存知识库条目和版本号；知识库被修改时调用 invalidate()，
+  对话状态只在版本号变化时重新生成系统提示词。
+
+token 数用字符数粗略估算 (CJK 字符按 1 token，其余按 4 个字符 1 token)，只用于预算，不需要精确。
+
+基准测试 (模拟一个不断变长的票据，对比每次回复重新拼接整段历史):
+    python ticket_ai_state.py --turns 300 --budget 3000
+"""
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+DEFAULT_PROMPT_BUDGET = 6000   # 整个提示词 (系统提示词 + 对话) 的 token 上限
+DEFAULT_MAX_TURNS = 200
+DEFAULT_MAX_CONVERSATIONS = 500
+TURN_OVERHEAD_TOKENS = 4       # 每条消息的角色标记等额外开销
+
+
+def estimate_tokens(text: str) -> int:
+    cjk = sum(1 for ch in text if ch >= '⺀')
+    return cjk + (len(text) - cjk + 3) // 4 + TURN_OVERHEAD_TOKENS
+
+
+class KnowledgeBaseCache:
+    """线程安全。loader(guild_id) 返回知识库条目列表 (例如 database.db_get_knowledge_base)。"""
+
+    def __init__(self, loader: Callable[[int], List[str]]):
+        self._loader = loader
+        self._lock = threading.Lock()
+        self._entries: Dict[int, Tuple[int, List[str]]] = {}
+        self._versions: Dict[int, int] = {}
+        self.hits = 0
+        self.loads = 0
+
+    def get(self, guild_id: int) -> Tuple[int, List[str]]:
+        """返回 (版本号, 条目列表)。"""
+        with self._lock:
+            cached = self._entries.get(guild_id)
+            if cached is not None:
+                self.hits += 1
+                return cached
+            version = self._versions.get(guild_id, 0)
+        entries = self._loader(guild_id)
+        with self._lock:
+            self.loads += 1
+            if self._versions.get(guild_id, 0) == version: # 加载期间没有被修改
+                self._entries[guild_id] = (version, entries)
+        return version, entries
+
+    def invalidate(self, guild_id: int):
+        with self._lock:
+            self._versions[guild_id] = self._versions.get(guild_id, 0) + 1
+            self._entries.pop(guild_id, None)
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {"hits": self.hits, "loads": self.loads, "cached_guilds": len(self._entries)}
+
+
+class TicketConversation:
+    """单个票据的对话状态。只在机器人事件循环中使用。"""
+
+    def __init__(self, ticket_id: int, channel_id: int, creator_id: int, max_turns: int = DEFAULT_MAX_TURNS):
+        self.ticket_id = ticket_id
+        self.channel_id = channel_id
+        self.creator_id = str(creator_id)
+        self.max_turns = max_turns
+        self.turns: List[Dict[str, Any]] = []   # {'id', 'role', 'content', 'tokens'}
+        self.last_message_id = 0
+        self.kb_version: Optional[int] = None
+        self.system_prompt = ""
+        self.system_tokens = 0
+
+    def _turn_from_record(self, record: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        author = record['author']
+        if author['is_bot'] and not record['embeds']:
+            return None # 忽略没有嵌入内容的机器人消息
+        content = record['content']
+        if record['embeds'] and record['embeds'][0].get('description'):
+            content = f"{content} {record['embeds'][0]['description']}"
+        content = content.strip()
+        if not content:
+            return None
+        if author['id'] == self.creator_id:
+            role = "user"
+        else: # 员工和机器人 (AI 客服、系统消息) 都属于客服一方
+            content = f"[{'Staff' if not author['is_bot'] else 'System'} {record.get('_username', author['name'])}] {content}"
+            role = "assistant"
+        return {'id': int(record['id']), 'role': role, 'content': content, 'tokens': estimate_tokens(content)}
+
+    def sync(self, records: Iterable[Dict[str, Any]]) -> int:
+        """追加比 last_message_id 更新的消息记录 (按时间升序)，返回新增的轮次数。"""
+        added = 0
+        for record in records:
+            message_id = int(record['id'])
+            if message_id <= self.last_message_id:
+                continue
+            self.last_message_id = message_id
+            turn = self._turn_from_record(record)
+            if turn:
+                self.turns.append(turn)
+                added += 1
+        if len(self.turns) > self.max_turns:
+            del self.turns[:len(self.turns) - self.max_turns]
+        return added
+
+    def set_system_prompt(self, kb_version: int, prompt: str):
+        self.kb_version = kb_version
+        self.system_prompt = prompt
+        self.system_tokens = estimate_tokens(prompt)
+
+    def build_messages(self, budget: int = DEFAULT_PROMPT_BUDGET) -> List[Dict[str, str]]:
+        """
+        生成发送给聊天接口的消息列表：系统提示词 + 预算内最新的若干轮对话 (至少包含最新的一轮)。
+        相邻的同角色轮次合并为一条消息。
+        """
+        remaining = budget - self.system_tokens
+        selected: List[Dict[str, Any]] = []
+        for turn in reversed(self.turns):
+            if turn['tokens'] > remaining and selected:
+                break
+            remaining -= turn['tokens']
+            selected.append(turn)
+        selected.reverse()
+        messages = [{"role": "system", "content": self.system_prompt}]
+        for turn in selected:
+            if messages[-1]['role'] == turn['role']:
+                messages[-1] = {"role": turn['role'], "content": f"{messages[-1]['content']}\n{turn['content']}"}
+            else:
+                messages.append({"role": turn['role'], "content": turn['content']})
+        return messages
+
+
+class TicketConversationStore:
+    """按频道 ID 保存对话状态 (LRU)。"""
+
+    def __init__(self, max_conversations: int = DEFAULT_MAX_CONVERSATIONS):
+        self.max_conversations = max_conversations
+        self._lock = threading.Lock()
+        self._conversations: "OrderedDict[int, TicketConversation]" = OrderedDict()
+
+    def get(self, ticket_info: Dict[str, Any]) -> TicketConversation:
+        channel_id = ticket_info['channel_id']
+        with self._lock:
+            conversation = self._conversations.get(channel_id)
+            if conversation is None or conversation.ticket_id != ticket_info['ticket_id']:
+                conversation = TicketConversation(ticket_info['ticket_id'], channel_id, ticket_info['creator_id'])
+                self._conversations[channel_id] = conversation
+                while len(self._conversations) > self.max_conversations:
+                    self._conversations.popitem(last=False)
+            else:
+                self._conversations.move_to_end(channel_id)
+            return conversation
+
+    def forget(self, channel_id: int):
+        with self._lock:
+            self._conversations.pop(channel_id, None)
+
+    def attach(self, bot):
+        """票据频道被删除 (关闭) 时释放对话状态。"""
+        async def on_guild_channel_delete(channel):
+            self.forget(channel.id)
+        bot.add_listener(on_guild_channel_delete)
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {"conversations": len(self._conversations),
+                    "turns": sum(len(c.turns) for c in self._conversations.values())}
+
+
+# =========================================
+# == 基准测试
+# =========================================
+def _run_benchmark(turns: int, budget: int):
+    import json
+    import random
+
+    words = ["订单", "充值", "没有到账", "请问", "refund", "payment", "account", "help", "谢谢", "截图"]
+    records = []
+    for i in range(turns):
+        creator = i % 2 == 0
+        text = " ".join(random.choice(words) for _ in range(random.randint(5, 40)))
+        records.append({'id': str(1000 + i), 'author': {'id': '7' if creator else '9', 'name': 'u', 'is_bot': not creator},
+                        'content': text if creator else '', 'embeds': [] if creator else [{'description': text}], '_username': 'u'})
+    kb = [f"FAQ {i}: " + " ".join(random.choice(words) for _ in range(30)) for i in range(20)]
+    system_prompt = "You are a support assistant.\n" + "\n".join(kb)
+
+    legacy_chars = new_chars = 0
+    legacy_time = new_time = 0.0
+    conversation = TicketConversation(1, 1, 7)
+    conversation.set_system_prompt(0, system_prompt)
+    for n in range(1, turns + 1, 2): # 每条用户消息触发一次回复
+        started = time.perf_counter()
+        lines = []
+        for record in records[:n]: # 旧: 每次都重新格式化整段历史
+            content = (record['content'] + (f" [Embed: {record['embeds'][0]['description']}]" if record['embeds'] else '')).strip()
+            lines.append(f"{'User' if record['author']['id'] == '7' else 'System'} (u): {content}")
+        legacy = [{"role": "system", "content": system_prompt}, {"role": "user", "content": "\n".join(lines)}]
+        legacy_time += time.perf_counter() - started
+        legacy_chars += len(json.dumps(legacy, ensure_ascii=False))
+
+        started = time.perf_counter()
+        conversation.sync(records[n - 2:n] if n > 1 else records[:1]) # 只追加新消息
+        messages = conversation.build_messages(budget)
+        new_time += time.perf_counter() - started
+        new_chars += len(json.dumps(messages, ensure_ascii=False))
+    replies = (turns + 1) // 2
+    print(f"  旧: 整段历史拼接     平均提示词 {legacy_chars / replies:>8.0f} 字符   构建耗时 {legacy_time / replies * 1e6:>7.1f}µs/次")
+    print(f"  TicketConversation   平均提示词 {new_chars / replies:>8.0f} 字符   构建耗时 {new_time / replies * 1e6:>7.1f}µs/次")
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="票据 AI 对话状态基准测试")
+    parser.add_argument("--turns", type=int, default=300)
+    parser.add_argument("--budget", type=int, default=3000)
+    args = parser.parse_args()
+    print(f"票据共 {args.turns} 条消息, token 预算 {args.budget}:")
+    _run_benchmark(args.turns, args.budget)
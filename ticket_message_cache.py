@@ -0,0 +1,296 @@
+# ticket_message_cache.py
+"""
+票据频道的消息缓存 (每个频道一个环形缓冲区)。
+
+- 频道第一次被读取时 (Web 面板打开票据 / AI 读取历史) 用一次 channel.history() 取最近 capacity 条消息，
+  之后该频道的新消息、编辑、删除都由网关事件 (attach() 注册的监听器) 增量写入缓冲区，
+  同一票据后续的历史读取不再调用 REST API。
+- 缓冲区只保存最近 capacity 条连续的消息；首次加载时取回的消息少于 capacity 说明已经到了频道开头
+  (reaches_start)，此时任何 before 游标都能完全由缓存回答。更早的分页才会回退到 channel.history(before=...)。
+- 未被读取过的频道不跟踪：on_message 对它们只做一次字典查找。最多同时跟踪 max_channels 个频道 (LRU)，
+  频道删除 (票据关闭) 时立即释放。
+- 加载期间到达的消息先写入缓冲区，加载完成后与 REST 结果按消息 ID 合并去重。
+- 无法从事件中获得完整消息的编辑 (旧版 discord.py) 会让该频道失效，下次读取时重新加载。
+
+缓存记录与 /api/guild/<id>/ticket/<channel>/history 返回的消息格式相同；以下划线开头的字段仅供内部使用。
+
+基准测试 (模拟员工反复打开票据 + AI 每次回复读取历史):
+    python ticket_message_cache.py --tickets 50 --loads 2000
+"""
+import asyncio
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+
+import discord
+
+DEFAULT_CAPACITY = 200
+DEFAULT_MAX_CHANNELS = 500
+
+
+def to_record(message: discord.Message) -> Dict[str, Any]:
+    """把消息转换为可直接 JSON 序列化的记录。"""
+    embeds = [{
+        'title': embed.title,
+        'description': embed.description,
+        'color': embed.color.value if embed.color else None,
+        'author': {'name': embed.author.name} if embed.author and embed.author.name else None,
+        'footer': {'text': embed.footer.text} if embed.footer and embed.footer.text else None,
+    } for embed in message.embeds]
+    return {
+        'id': str(message.id),
+        'author': {
+            'id': str(message.author.id),
+            'name': message.author.display_name,
+            'avatar_url': str(message.author.display_avatar.url),
+            'is_bot': message.author.bot,
+        },
+        'content': message.clean_content,
+        'embeds': embeds,
+        'timestamp': message.created_at.isoformat(),
+        '_username': message.author.name,
+    }
+
+
+def public(record: Dict[str, Any]) -> Dict[str, Any]:
+    return {k: v for k, v in record.items() if not k.startswith('_')}
+
+
+class _ChannelBuffer:
+    __slots__ = ('messages', 'reaches_start', 'ready')
+
+    def __init__(self):
+        self.messages: "OrderedDict[int, Dict[str, Any]]" = OrderedDict()  # 消息 ID 升序
+        self.reaches_start = False
+        self.ready = False
+
+
+class TicketMessageCache:
+    """线程安全 (stats() 可能在 Web 线程中调用)；history() 必须在机器人事件循环中调用。"""
+
+    def __init__(self, capacity: int = DEFAULT_CAPACITY, max_channels: int = DEFAULT_MAX_CHANNELS):
+        self.capacity = capacity
+        self.max_channels = max_channels
+        self._lock = threading.Lock()
+        self._channels: "OrderedDict[int, _ChannelBuffer]" = OrderedDict()
+        self._loading: Dict[int, asyncio.Future] = {}
+        self.hits = 0
+        self.loads = 0
+        self.rest_calls = 0
+        self.events = 0
+
+    # ---------------------------------------------------------------
+    # 内部
+    # ---------------------------------------------------------------
+    def _trim(self, buffer: _ChannelBuffer):
+        while len(buffer.messages) > self.capacity:
+            buffer.messages.popitem(last=False)
+            buffer.reaches_start = False
+
+    def _insert(self, buffer: _ChannelBuffer, record: Dict[str, Any]):
+        message_id = int(record['id'])
+        messages = buffer.messages
+        newest = next(reversed(messages)) if messages and message_id not in messages else None
+        messages[message_id] = record
+        if newest is not None and message_id < newest: # 乱序到达 (很少见)：重新排序
+            buffer.messages = OrderedDict(sorted(messages.items()))
+        self._trim(buffer)
+
+    async def _load(self, channel) -> _ChannelBuffer:
+        """第一次读取频道：注册缓冲区 (使加载期间的新消息也能写入)，再用一次 REST 调用取最近 capacity 条。"""
+        pending = self._loading.get(channel.id)
+        if pending is not None:
+            return await asyncio.shield(pending)
+        future = asyncio.get_running_loop().create_future()
+        self._loading[channel.id] = future
+        buffer = _ChannelBuffer()
+        with self._lock:
+            self._channels[channel.id] = buffer
+            while len(self._channels) > self.max_channels:
+                self._channels.popitem(last=False)
+            self.loads += 1
+            self.rest_calls += 1
+        try:
+            fetched = [to_record(m) async for m in channel.history(limit=self.capacity)]
+            with self._lock:
+                merged = {int(r['id']): r for r in fetched}
+                merged.update(buffer.messages) # 加载期间由事件写入的版本更新
+                buffer.messages = OrderedDict(sorted(merged.items()))
+                buffer.reaches_start = len(fetched) < self.capacity
+                buffer.ready = True
+                self._trim(buffer)
+            future.set_result(buffer)
+            return buffer
+        except BaseException as e:
+            with self._lock:
+                if self._channels.get(channel.id) is buffer:
+                    del self._channels[channel.id]
+            if isinstance(e, asyncio.CancelledError):
+                future.cancel()
+            else:
+                future.set_exception(e)
+                future.exception() # 没有并发等待者时避免 "Future exception was never retrieved"
+            raise
+        finally:
+            self._loading.pop(channel.id, None)
+
+    # ---------------------------------------------------------------
+    # 读取
+    # ---------------------------------------------------------------
+    async def history(self, channel, limit: int = 50, before: Optional[int] = None) -> Tuple[List[Dict[str, Any]], bool]:
+        """
+        返回 (按时间升序的最多 limit 条记录, 是否还有更早的消息)。
+        before 为消息 ID 游标：只返回比它更早的消息。
+        """
+        with self._lock:
+            buffer = self._channels.get(channel.id)
+            if buffer is not None and buffer.ready:
+                self._channels.move_to_end(channel.id)
+                self.hits += 1
+        if buffer is None or not buffer.ready:
+            buffer = await self._load(channel)
+        with self._lock:
+            records = [r for message_id, r in buffer.messages.items() if before is None or message_id < before]
+            reaches_start = buffer.reaches_start
+        if len(records) >= limit or reaches_start:
+            return records[-limit:], len(records) > limit or not reaches_start
+        # 游标超出了缓冲区的范围：从 REST 补齐更早的消息 (不写入缓冲区，缓冲区只保存最新的连续消息)
+        cursor = int(records[0]['id']) if records else before
+        missing = limit - len(records)
+        with self._lock: self.rest_calls += 1
+        older = [to_record(m) async for m in channel.history(limit=missing, before=discord.Object(id=cursor) if cursor else None)]
+        older.reverse()
+        return older + records, len(older) == missing
+
+    def is_tracked(self, channel_id: int) -> bool:
+        with self._lock:
+            return channel_id in self._channels
+
+    # ---------------------------------------------------------------
+    # 网关事件 (机器人事件循环)
+    # ---------------------------------------------------------------
+    def add(self, message: discord.Message):
+        with self._lock:
+            buffer = self._channels.get(message.channel.id)
+            if buffer is not None:
+                self.events += 1
+                self._insert(buffer, to_record(message))
+
+    def update(self, channel_id: int, message_id: int, message: Optional[discord.Message]):
+        with self._lock:
+            buffer = self._channels.get(channel_id)
+            if buffer is None or (buffer.ready and message_id not in buffer.messages):
+                return # 未跟踪，或是缓冲区范围之外的旧消息
+            self.events += 1
+            if message is None:
+                del self._channels[channel_id]
+            else:
+                self._insert(buffer, to_record(message))
+
+    def delete(self, channel_id: int, message_ids):
+        with self._lock:
+            buffer = self._channels.get(channel_id)
+            if buffer is not None:
+                self.events += 1
+                for message_id in message_ids:
+                    buffer.messages.pop(message_id, None)
+
+    def forget(self, channel_id: int):
+        with self._lock:
+            self._channels.pop(channel_id, None)
+
+    def attach(self, bot):
+        """注册网关事件监听器 (add_listener，不覆盖已有的 @bot.event 处理器)。"""
+        async def on_message(message):
+            self.add(message)
+
+        async def on_raw_message_edit(payload):
+            self.update(payload.channel_id, payload.message_id, getattr(payload, 'message', None))
+
+        async def on_raw_message_delete(payload):
+            self.delete(payload.channel_id, (payload.message_id,))
+
+        async def on_raw_bulk_message_delete(payload):
+            self.delete(payload.channel_id, payload.message_ids)
+
+        async def on_guild_channel_delete(channel):
+            self.forget(channel.id)
+
+        for listener in (on_message, on_raw_message_edit, on_raw_message_delete, on_raw_bulk_message_delete, on_guild_channel_delete):
+            bot.add_listener(listener)
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {"channels": len(self._channels), "messages": sum(len(b.messages) for b in self._channels.values()),
+                    "hits": self.hits, "loads": self.loads, "rest_calls": self.rest_calls, "events": self.events}
+
+
+# =========================================
+# == 基准测试
+# =========================================
+def _run_benchmark(tickets: int, loads: int, rest_latency: float, messages_per_load: int):
+    import datetime
+    import random
+    import time
+    from types import SimpleNamespace as NS
+
+    class FakeChannel:
+        def __init__(self, channel_id: int, count: int):
+            self.id = channel_id
+            self.rest_calls = 0
+            now = datetime.datetime.now(datetime.timezone.utc)
+            author = NS(id=7, name="user", display_name="User", bot=False, display_avatar=NS(url="https://cdn.discordapp.com/embed/avatars/0.png"))
+            self.messages = [NS(id=channel_id * 10 ** 6 + i, author=author, clean_content=f"message {i}", embeds=[], created_at=now, channel=self)
+                             for i in range(count)]
+
+        async def history(self, limit=100, before=None, oldest_first=None):
+            self.rest_calls += (limit + 99) // 100 # REST 每页最多 100 条
+            await asyncio.sleep(rest_latency * ((limit + 99) // 100))
+            candidates = [m for m in self.messages if before is None or m.id < before.id]
+            page = candidates[:limit] if oldest_first else candidates[::-1][:limit]
+            for message in page:
+                yield message
+
+        def send(self):
+            message = NS(**vars(self.messages[-1])); message.id += 1
+            self.messages.append(message)
+            return message
+
+    async def main():
+        channels = [FakeChannel(i + 1, random.randint(5, 300)) for i in range(tickets)]
+        cache = TicketMessageCache()
+        workload = [random.choice(channels) for _ in range(loads)]
+
+        started = time.perf_counter()
+        for channel in workload: # 旧: 每次打开票据 / AI 回复都从头取 100 条
+            [to_record(m) async for m in channel.history(limit=100, oldest_first=True)]
+        legacy_elapsed, legacy_calls = time.perf_counter() - started, sum(c.rest_calls for c in channels)
+
+        for channel in channels: channel.rest_calls = 0
+        started = time.perf_counter()
+        for i, channel in enumerate(workload):
+            for _ in range(messages_per_load): # 两次读取之间票据里的新消息经由 on_message 写入
+                cache.add(channel.send())
+            await cache.history(channel, limit=50)
+            if i % 10 == 0: # 偶尔向上翻页
+                records, _ = await cache.history(channel, limit=50)
+                if records: await cache.history(channel, limit=50, before=int(records[0]['id']))
+        cached_elapsed, cached_calls = time.perf_counter() - started, sum(c.rest_calls for c in channels)
+
+        print(f"  旧: 每次读取调用 channel.history()   {legacy_calls:>6} 次 REST  {legacy_elapsed:6.2f}s")
+        print(f"  TicketMessageCache                {cached_calls:>6} 次 REST  {cached_elapsed:6.2f}s")
+        print(f"  {cache.stats()}")
+
+    asyncio.run(main())
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="票据消息缓存基准测试")
+    parser.add_argument("--tickets", type=int, default=50)
+    parser.add_argument("--loads", type=int, default=2000)
+    parser.add_argument("--rest-latency", type=float, default=0.002, help="模拟每次 REST 调用的延迟 (秒)")
+    parser.add_argument("--messages-per-load", type=int, default=1)
+    args = parser.parse_args()
+    print(f"{args.tickets} 个票据, {args.loads} 次历史读取, 每次读取之间 {args.messages_per_load} 条新消息:")
+    _run_benchmark(args.tickets, args.loads, args.rest_latency, args.messages_per_load)
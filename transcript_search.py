@@ -0,0 +1,205 @@
+# transcript_search.py
+"""
+票据聊天记录全文搜索。
+
+- TranscriptIndexer: 生成聊天记录时逐条收集消息，批量写入 SQLite FTS5 索引 (在线程池中执行)。
+- backfill_transcript_index: 为索引建立之前已存在的 transcripts/ 文件回填索引 (解析我们自己生成的 HTML)。
+- search_transcripts: 供 Web API 调用，返回按相关度排序、已转义并高亮的片段。
+"""
+import asyncio
+import gzip
+import html
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+from html.parser import HTMLParser
+from typing import Any, Dict, List, Optional, Tuple
+
+import database
+
+INDEX_BATCH_SIZE = 500
+MIN_TRIGRAM_TERM_LENGTH = 3
+MAX_SNIPPET_CHARS = 120
+
+_INDEX_EXECUTOR = ThreadPoolExecutor(max_workers=1, thread_name_prefix="transcript-index")
+
+
+class TranscriptIndexer:
+    """
+    作为 transcript_writer.write_ticket_transcript 的 on_message 回调使用。
+    传入 loop 时 (机器人事件循环中) 每批 INDEX_BATCH_SIZE 行交给单线程的索引线程池写入，不阻塞事件循环，
+    结束时调用 await finish_async()；不传 loop 时 (回填，已在线程池中) 同步写入，结束时调用 finish()。
+    """
+
+    def __init__(self, ticket_id: int, guild_id: int, loop: Optional[asyncio.AbstractEventLoop] = None):
+        self.ticket_id = ticket_id
+        self.guild_id = guild_id
+        self.count = 0
+        self._rows: List[Tuple[int, int, str, str, str]] = []
+        self._loop = loop
+        self._pending: List[asyncio.Future] = []
+
+    def add(self, author: str, timestamp: str, content: str):
+        if not content:
+            return
+        self._rows.append((self.ticket_id, self.guild_id, author, timestamp, content))
+        self.count += 1
+        if len(self._rows) >= INDEX_BATCH_SIZE:
+            self.flush()
+
+    def add_message(self, msg):
+        parts = [msg.content or ""]
+        for embed in msg.embeds:
+            parts.extend(filter(None, (embed.title, embed.description)))
+            parts.extend(f"{f.name}: {f.value}" for f in embed.fields)
+        self.add(msg.author.name, msg.created_at.strftime("%Y-%m-%d %H:%M:%S UTC"), "\n".join(p for p in parts if p))
+
+    def flush(self):
+        rows, self._rows = self._rows, []
+        if not rows:
+            return
+        if self._loop is None:
+            database.db_index_transcript_messages(rows)
+        else: # 单线程池保证批次按顺序写入，且不会与其它索引写入争用 SQLite 写锁
+            self._pending = [f for f in self._pending if not f.done()]
+            self._pending.append(self._loop.run_in_executor(_INDEX_EXECUTOR, database.db_index_transcript_messages, rows))
+
+    def finish(self):
+        self.flush()
+        database.db_mark_transcript_indexed(self.ticket_id, self.guild_id, self.count)
+
+    async def finish_async(self):
+        self.flush()
+        pending, self._pending = self._pending, []
+        if pending:
+            await asyncio.gather(*pending)
+        await self._loop.run_in_executor(_INDEX_EXECUTOR, database.db_mark_transcript_indexed,
+                                         self.ticket_id, self.guild_id, self.count)
+
+
+# =========================================
+# == 回填：解析已有的聊天记录文件
+# =========================================
+class _TranscriptHTMLExtractor(HTMLParser):
+    """按 class 名提取每条消息的 author / timestamp / 正文与嵌入文本。"""
+
+    _TEXT_CLASSES = {"content", "embed-title", "embed-description", "embed-field"}
+
+    def __init__(self, indexer: TranscriptIndexer):
+        super().__init__(convert_charrefs=True)
+        self.indexer = indexer
+        self._capture: Optional[str] = None
+        self._depth = 0
+        self._current: Dict[str, Any] = {}
+
+    def _emit(self):
+        if self._current:
+            self.indexer.add(self._current.get("author", "").strip().rstrip("#"), self._current.get("timestamp", "").strip(),
+                             "\n".join(t.strip() for t in self._current.get("text", []) if t.strip()))
+        self._current = {}
+
+    def handle_starttag(self, tag, attrs):
+        classes = set((dict(attrs).get("class") or "").split())
+        if tag == "div" and "message" in classes:
+            self._emit()
+            self._current = {"text": []}
+        if self._capture:
+            self._depth += 1
+            if tag == "br":
+                self._depth -= 1
+                self._append("\n")
+            return
+        if "author" in classes:
+            self._capture, self._depth = "author", 1
+        elif "timestamp" in classes:
+            self._capture, self._depth = "timestamp", 1
+        elif classes & self._TEXT_CLASSES:
+            self._capture, self._depth = "text", 1
+            self._current.setdefault("text", []).append("")
+
+    def handle_startendtag(self, tag, attrs):
+        if self._capture and tag == "br":
+            self._append("\n")
+
+    def handle_endtag(self, tag):
+        if self._capture:
+            self._depth -= 1
+            if self._depth <= 0:
+                self._capture = None
+
+    def handle_data(self, data):
+        if self._capture:
+            self._append(data)
+
+    def _append(self, data):
+        if self._capture == "text":
+            self._current["text"][-1] += data
+        else:
+            self._current[self._capture] = self._current.get(self._capture, "") + data
+
+    def close(self):
+        super().close()
+        self._emit()
+
+
+def index_transcript_file(ticket_id: int, guild_id: int, path: str) -> int:
+    indexer = TranscriptIndexer(ticket_id, guild_id)
+    if os.path.exists(path):
+        opener = gzip.open if path.endswith(".gz") else open
+        parser = _TranscriptHTMLExtractor(indexer)
+        with opener(path, "rt", encoding="utf-8", errors="replace") as f:
+            while chunk := f.read(64 * 1024):
+                parser.feed(chunk)
+        parser.close()
+    # 文件缺失时同样标记为已处理，避免每次启动都重试
+    indexer.finish()
+    return indexer.count
+
+
+def backfill_transcript_index(folder: str) -> Tuple[int, int]:
+    """为尚未建立索引的历史聊天记录回填索引。阻塞执行，请放在线程池中调用。返回 (票据数, 消息数)。"""
+    tickets = database.db_get_unindexed_transcript_tickets()
+    total_messages = 0
+    for ticket in tickets:
+        try:
+            total_messages += index_transcript_file(ticket["ticket_id"], ticket["guild_id"],
+                                                    os.path.join(folder, os.path.basename(ticket["transcript_filename"])))
+        except Exception as e:
+            logging.error(f"[TranscriptSearch] 回填票据 {ticket['ticket_id']} 的索引失败: {e}", exc_info=True)
+    return len(tickets), total_messages
+
+
+# =========================================
+# == 搜索
+# =========================================
+def _highlight(snippet: str) -> str:
+    return html.escape(snippet).replace("\x02", "<mark>").replace("\x03", "</mark>")
+
+
+def _manual_snippet(content: str, terms: List[str]) -> str:
+    lowered = content.lower()
+    first = min((i for i in (lowered.find(t.lower()) for t in terms) if i >= 0), default=0)
+    start = max(first - MAX_SNIPPET_CHARS // 3, 0)
+    window = content[start:start + MAX_SNIPPET_CHARS]
+    escaped = html.escape(window)
+    for term in sorted(set(terms), key=len, reverse=True):
+        escaped = escaped.replace(html.escape(term), f"<mark>{html.escape(term)}</mark>")
+    return ("…" if start > 0 else "") + escaped + ("…" if start + MAX_SNIPPET_CHARS < len(content) else "")
+
+
+def search_transcripts(guild_id: int, query: str, limit: int = 20) -> List[Dict[str, Any]]:
+    """返回 [{ticket_id, transcript_filename, author, timestamp, snippet(HTML), ...}]。"""
+    terms = [t for t in query.split() if t]
+    if not terms:
+        return []
+    if min(len(t) for t in terms) < MIN_TRIGRAM_TERM_LENGTH:
+        rows = database.db_search_transcripts_substring(guild_id, terms, limit)
+        for row in rows:
+            row["snippet"] = _manual_snippet(row.pop("content"), terms)
+        return rows
+    # 每个词用双引号包裹，避免用户输入被当作 FTS5 查询语法
+    fts_query = " ".join('"' + t.replace('"', '""') + '"' for t in terms)
+    rows = database.db_search_transcripts(guild_id, fts_query, limit)
+    for row in rows:
+        row["snippet"] = _highlight(row["snippet"] or "")
+    return rows
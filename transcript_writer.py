@@ -0,0 +1,262 @@
+# transcript_writer.py
+"""
+流式票据聊天记录 (HTML) 生成器。
+
+消息从 channel.history() 逐条取出、转义后按块写入磁盘，内存占用与消息总数无关；
+压缩和写盘在线程池中进行，不阻塞机器人事件循环 (网关心跳)。
+默认输出 gzip 压缩的 .html.gz 文件，Web 面板直接以 Content-Encoding: gzip 返回给浏览器。
+
+基准测试 (需要安装 discord.py):
+    python transcript_writer.py --bench 10000
+"""
+import asyncio
+import datetime
+import gzip
+import html
+import io
+import os
+import time
+from typing import Any, Callable, Dict, Optional, Tuple
+
+import discord
+
+TRANSCRIPT_FOLDER = "transcripts"
+WRITE_EVERY_MESSAGES = 200  # 每渲染这么多条消息交给线程池写盘一次
+
+TRANSCRIPT_CSS = (
+    "body{font-family:'Whitney','Helvetica Neue',Helvetica,Arial,sans-serif;margin:0;background:#36393f;color:#dcddde;font-size:16px;line-height:1.6}"
+    ".container{max-width:90%;width:800px;margin:20px auto;padding:20px;border-radius:8px;box-shadow:0 0 15px rgba(0,0,0,.5)}"
+    ".header{text-align:center;border-bottom:1px solid #4f545c;padding-bottom:15px;margin-bottom:20px}"
+    ".header h1{color:#fff;margin:0 0 5px;font-size:24px}.header p{font-size:12px;color:#b9bbbe;margin:0}"
+    ".message{display:flex;flex-direction:column;padding:12px 0;border-top:1px solid #40444b}"
+    ".message-header{display:flex;align-items:center;margin-bottom:6px}"
+    ".author-avatar{width:40px;height:40px;border-radius:50%;margin-right:12px;background:#2f3136}"
+    ".author{flex-grow:1;font-weight:500;color:#fff}.timestamp{font-size:.75em;color:#72767d;margin-left:8px;white-space:nowrap}"
+    ".content-area{margin-left:52px}.content p{margin:0 0 5px;white-space:pre-wrap;word-wrap:break-word}"
+    ".attachments,.embed{margin-top:8px;font-size:.9em}.attachments{padding:5px;background:#2f3136;border-radius:3px}"
+    ".attachments a{color:#00aff4;text-decoration:none;margin-right:5px}"
+    ".embed{border-left:4px solid #4f545c;padding:10px;background:#2f3136;border-radius:4px;margin-bottom:5px}"
+    ".embed-title{font-weight:bold;color:#fff;margin-bottom:4px}.embed-description{color:#b9bbbe;font-size:.95em}"
+    ".embed-fields{display:flex;flex-wrap:wrap;margin-top:8px}.embed-field{padding:5px;margin-bottom:5px;flex-basis:100%}"
+    ".embed-field-inline{flex-basis:calc(50% - 10px);margin-right:10px}.embed-field strong{color:#fff}"
+    ".embed-footer,.embed-author{font-size:.8em;color:#72767d;margin-top:5px}"
+    ".system-message .content p{font-style:italic;color:#72767d}em{color:#b9bbbe}"
+)
+
+
+def _escape_multiline(text: str) -> str:
+    return html.escape(text).replace("\n", "<br>")
+
+
+def _render_embed(index: int, embed: discord.Embed) -> str:
+    parts = [f'<div class="embed embed-{index}">']
+    if embed.title:
+        parts.append(f'<div class="embed-title">{html.escape(embed.title)}</div>')
+    if embed.description:
+        parts.append(f'<div class="embed-description">{_escape_multiline(embed.description)}</div>')
+    if embed.fields:
+        parts.append('<div class="embed-fields">')
+        for field in embed.fields:
+            inline_class = " embed-field-inline" if field.inline else ""
+            name = html.escape(field.name) if field.name else " "
+            value = _escape_multiline(field.value) if field.value else " "
+            parts.append(f'<div class="embed-field{inline_class}"><strong>{name}</strong><br>{value}</div>')
+        parts.append('</div>')
+    if embed.footer and embed.footer.text:
+        parts.append(f'<div class="embed-footer">{html.escape(embed.footer.text)}</div>')
+    if embed.author and embed.author.name:
+        parts.append(f'<div class="embed-author">作者: {html.escape(embed.author.name)}</div>')
+    if not embed.title and not embed.description and not embed.fields:
+        parts.append('<em>(嵌入内容)</em>')
+    parts.append('</div>')
+    return "".join(parts)
+
+
+def is_system_message(msg: discord.Message) -> bool:
+    return msg.type not in (discord.MessageType.default, discord.MessageType.reply)
+
+
+def render_message_html(msg: discord.Message) -> str:
+    """把一条消息渲染为一段独立的 HTML，标记结构与面板中的聊天记录样式一致。"""
+    author = msg.author
+    discriminator = author.discriminator if author.discriminator != '0' else ''
+    author_name_full = html.escape(f"{author.name}#{discriminator}")
+    timestamp = msg.created_at.strftime("%Y-%m-%d %H:%M:%S UTC")
+
+    system = is_system_message(msg)
+    if system:
+        content = f"<em>系统消息: {html.escape(msg.system_content)}</em>" if msg.system_content else f"<em>(系统消息: {msg.type.name})</em>"
+    else:
+        content = _escape_multiline(msg.content) if msg.content else ""
+
+    parts = [
+        f'<div class="message{" system-message" if system else ""}"><div class="message-header">'
+        f'<img src="{html.escape(author.display_avatar.url)}" alt="{html.escape(author.name)}\'s avatar" class="author-avatar" loading="lazy">'
+        f'<span class="author" title="User ID: {author.id}">{author_name_full}</span>'
+        f'<span class="timestamp">{timestamp}</span></div><div class="content-area">'
+    ]
+    if content:
+        parts.append(f'<div class="content"><p>{content}</p></div>')
+    if msg.attachments:
+        links = ", ".join(
+            f'<a href="{html.escape(a.url)}" target="_blank" rel="noopener noreferrer">[{html.escape(a.filename)}]</a>'
+            for a in msg.attachments
+        )
+        parts.append(f'<div class="attachments">附件: {links}</div>')
+    for index, embed in enumerate(msg.embeds, start=1):
+        parts.append(_render_embed(index, embed))
+    parts.append('</div></div>\n')
+    return "".join(parts)
+
+
+def _render_header(channel) -> str:
+    generated_at = datetime.datetime.now(datetime.timezone.utc).strftime("%Y-%m-%d %H:%M:%S UTC")
+    name = html.escape(channel.name)
+    return (
+        '<!DOCTYPE html><html lang="zh-CN"><head><meta charset="UTF-8">'
+        '<meta name="viewport" content="width=device-width, initial-scale=1.0">'
+        f'<title>票据记录 - {name}</title><style>{TRANSCRIPT_CSS}</style></head>'
+        '<body><div class="container"><div class="header">'
+        f'<h1>票据记录: #{name}</h1>'
+        f'<p>服务器: {html.escape(channel.guild.name)} ({channel.guild.id})</p>'
+        f'<p>频道 ID: {channel.id}</p><p>生成时间: {generated_at}</p></div>\n'
+    )
+
+
+def _open_writer(path: str, compress: bool) -> Tuple[io.TextIOWrapper, Any]:
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    raw = open(path, "wb")
+    stream = gzip.GzipFile(fileobj=raw, mode="wb", compresslevel=6) if compress else raw
+    return io.TextIOWrapper(stream, encoding="utf-8", write_through=False), raw
+
+
+def _finish_writer(writer: io.TextIOWrapper, raw, tmp_path: str, path: str) -> int:
+    writer.close()  # 依次关闭 TextIOWrapper -> GzipFile
+    if not raw.closed:
+        raw.close()
+    os.replace(tmp_path, path)
+    return os.path.getsize(path)
+
+
+def _discard_writer(raw, tmp_path: str):
+    if not raw.closed:
+        raw.close()
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+
+
+async def write_ticket_transcript(channel: discord.TextChannel, path: str, compress: bool = True,
+                                  on_message: Optional[Callable[[discord.Message], Any]] = None) -> Optional[Dict[str, Any]]:
+    """
+    把频道的完整历史按时间顺序流式写入 path。compress=True 时写 gzip。
+    消息在事件循环中渲染，每 WRITE_EVERY_MESSAGES 条拼成一块交给线程池压缩并写盘；
+    同一时间最多一块在写，下一块的获取/渲染与上一块的写入并行。
+    on_message 会对每条消息调用一次 (例如写入搜索索引)。
+    返回 {"path", "message_count", "bytes"}；频道类型不支持时返回 None。
+    """
+    if not isinstance(channel, discord.TextChannel):
+        return None
+
+    loop = asyncio.get_running_loop()
+    tmp_path = f"{path}.tmp"
+    writer, raw = await loop.run_in_executor(None, _open_writer, tmp_path, compress)
+    pending: Optional[asyncio.Future] = None
+    chunk = [_render_header(channel)]
+    count = 0
+    try:
+        async for msg in channel.history(limit=None, oldest_first=True):
+            chunk.append(render_message_html(msg))
+            if on_message is not None:
+                on_message(msg)
+            count += 1
+            if count % WRITE_EVERY_MESSAGES == 0:
+                if pending is not None:
+                    await pending
+                pending = loop.run_in_executor(None, writer.write, "".join(chunk))
+                chunk = []
+                await asyncio.sleep(0)
+        if count == 0:
+            chunk.append('<p style="text-align:center">此票据中没有消息。</p>')
+        chunk.append('</div></body></html>\n')
+        if pending is not None:
+            await pending
+        pending = loop.run_in_executor(None, writer.write, "".join(chunk))
+        await pending
+        size = await loop.run_in_executor(None, _finish_writer, writer, raw, tmp_path, path)
+    except BaseException:
+        if pending is not None and not pending.done():
+            await asyncio.wait({pending}) # 等线程池中的写入结束后再关闭文件
+        await loop.run_in_executor(None, _discard_writer, raw, tmp_path)
+        raise
+    return {"path": path, "message_count": count, "bytes": size}
+
+
+def open_transcript_for_upload(path: str, filename: str) -> discord.File:
+    """以 discord.File 形式上传聊天记录；压缩文件边读边解压，对方收到的仍是可直接打开的 .html。"""
+    if path.endswith(".gz"):
+        return discord.File(gzip.open(path, "rb"), filename=filename[:-3] if filename.endswith(".gz") else filename)
+    return discord.File(path, filename=filename)
+
+
+# =========================================
+# == 基准测试
+# =========================================
+async def _run_benchmark(message_count: int):
+    import tempfile
+    import tracemalloc
+    from types import SimpleNamespace
+
+    author = SimpleNamespace(name="benchmark_user", discriminator="0", id=1234567890,
+                             display_avatar=SimpleNamespace(url="https://cdn.discordapp.com/embed/avatars/0.png"))
+    embed = discord.Embed(title="示例嵌入", description="第一行\n第二行 <b>不会被解析</b>")
+    embed.add_field(name="字段", value="值", inline=True).set_footer(text="页脚")
+    created_at = datetime.datetime.now(datetime.timezone.utc)
+
+    def make_message(i):
+        return SimpleNamespace(
+            author=author, created_at=created_at, type=discord.MessageType.default, system_content=None,
+            content=f"消息 #{i}: 这是一条用于基准测试的较长消息 & <script>alert({i})</script>\n" * 3,
+            attachments=[], embeds=[embed] if i % 10 == 0 else [],
+        )
+
+    class FakeChannel(discord.TextChannel):
+        def __init__(self):
+            self.name = "bench-ticket"
+            self.id = 1
+            self.guild = SimpleNamespace(name="Benchmark Guild", id=1)
+
+        async def history(self, limit=None, oldest_first=True):
+            for i in range(message_count):
+                yield make_message(i)
+
+    channel = FakeChannel()
+    with tempfile.TemporaryDirectory() as tmp:
+        for compress in (False, True):
+            path = os.path.join(tmp, "bench.html.gz" if compress else "bench.html")
+            max_lag = 0.0
+            writing = True
+
+            async def heartbeat(): # 模拟网关心跳，记录事件循环被阻塞的最长时间
+                nonlocal max_lag
+                while writing:
+                    before = time.perf_counter()
+                    await asyncio.sleep(0.005)
+                    max_lag = max(max_lag, time.perf_counter() - before - 0.005)
+
+            ticker = asyncio.ensure_future(heartbeat())
+            tracemalloc.start()
+            started = time.perf_counter()
+            stats = await write_ticket_transcript(channel, path, compress=compress)
+            elapsed = time.perf_counter() - started
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            writing = False
+            await ticker
+            print(f"{'gzip' if compress else 'html'}: {stats['message_count']} 条消息, {elapsed:.2f} 秒, "
+                  f"文件 {stats['bytes'] / 1024:.0f} KiB, 峰值内存 {peak / 1024:.0f} KiB, 事件循环最长阻塞 {max_lag * 1000:.1f}ms")
+
+
+if __name__ == "__main__":
+    import sys
+    count = int(sys.argv[sys.argv.index("--bench") + 1]) if "--bench" in sys.argv else 10000
+    asyncio.run(_run_benchmark(count))
@@ -0,0 +1,213 @@
+# web_auth_cache.py
+"""
+Web 面板授权缓存。
+
+- PermissionIndex 把 AVAILABLE_PERMISSIONS 中的每个页面/标签页映射到一个二进制位，
+  一个用户在某服务器的全部权限编译成一个整数 (位集)，鉴权只是一次位测试。
+- AuthCache 按 (主体, 服务器) 缓存编译结果。主体为 Discord 用户 ID 或 "sub_<id>" 形式的副账号 ID。
+  以下情况需要让缓存失效 (由机器人在对应事件中调用)：
+    * 成员身份组变化 / 离开服务器       -> invalidate_member
+    * 身份组权限变化、删除、服务器转让   -> invalidate_guild
+    * Web 面板身份组权限编辑            -> invalidate_guild
+    * 副账号权限编辑 / 删除             -> invalidate_principal
+  每个服务器有一个代数计数器；计算期间发生失效时，算出的旧结果不会写入缓存。
+- 带错误的结果 (不是成员、机器人不在服务器中等) 不缓存：用户加入服务器、机器人加入服务器或成员列表
+  加载完成时都没有对应的失效调用，缓存错误会让用户一直被拒绝。拒绝的计算本身很便宜。
+
+延迟对比 (每次请求重新计算 vs. 缓存位测试):
+    python web_auth_cache.py --members 5000 --roles 200 --requests 200000
+"""
+import threading
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+GUILD_MANAGEMENT_PAGE = "page_guild_management"
+
+# 编译结果: (权限位集, 错误)。错误非 None 时表示该主体不能访问此服务器 (消息, HTTP 状态码)
+CompiledAuth = Tuple[int, Optional[Tuple[str, int]]]
+
+
+class PermissionIndex:
+    def __init__(self, available_permissions: Dict[str, Dict[str, Any]]):
+        self.bits: Dict[str, int] = {}
+        self.names: Dict[str, str] = {}
+        for page_id, page_data in available_permissions.items():
+            self._add(page_id, page_data["name"])
+            for tab_id, tab_name in page_data.get("tabs", {}).items():
+                self._add(tab_id, tab_name)
+        self.all_mask = (1 << len(self.bits)) - 1
+        self.tab_mask = self.mask_of(p for p in self.bits if p.startswith("tab_"))
+        self.guild_management_mask = self.mask_of([GUILD_MANAGEMENT_PAGE, *available_permissions.get(GUILD_MANAGEMENT_PAGE, {}).get("tabs", {})])
+
+    def _add(self, perm_id: str, name: str):
+        self.bits[perm_id] = 1 << len(self.bits)
+        self.names[perm_id] = name
+
+    def mask_of(self, perms: Iterable[str]) -> int:
+        mask = 0
+        for perm in perms:
+            mask |= self.bits.get(perm, 0)
+        return mask
+
+    def perms_of(self, mask: int) -> List[str]:
+        return [perm for perm, bit in self.bits.items() if mask & bit]
+
+    def display_name(self, perm_id: Optional[str]) -> str:
+        return self.names.get(perm_id, "未知页面")
+
+
+# =========================================
+# == 权限编译
+# =========================================
+def compile_sub_account(index: PermissionIndex, permissions: Dict[str, Any], guild_id: Optional[int]) -> CompiledAuth:
+    if permissions.get('can_manage_all_guilds'):
+        return index.all_mask, None
+    if guild_id is None:
+        return 0, None
+    mask = index.mask_of(permissions.get('global_permissions', []))
+    if str(guild_id) not in permissions.get('guilds', []):
+        return mask, (f"副账号无权访问服务器 {guild_id}", 403)
+    # 副账号如果能访问服务器，则授予其下所有标签页权限 (这是针对副账号的特定逻辑)
+    return mask | index.guild_management_mask, None
+
+
+def compile_member(index: PermissionIndex, guild, user_id: Any, guild_web_perms: Dict[str, Dict[str, Any]]) -> CompiledAuth:
+    if not guild:
+        return 0, ("机器人不在该服务器中或服务器ID无效。", 404)
+    try:
+        member = guild.get_member(int(user_id))
+    except (ValueError, TypeError):
+        return 0, ("无效的用户ID格式。", 400)
+    if not member:
+        return 0, ("您不是该服务器的成员。", 403)
+    # 服务器所有者或管理员拥有所有权限
+    if member.id == guild.owner_id or member.guild_permissions.administrator:
+        return index.all_mask, None
+    mask = 0
+    for role in member.roles:
+        role_perms = guild_web_perms.get(str(role.id))
+        if role_perms:
+            mask |= index.mask_of(role_perms.get("permissions", []))
+    # 拥有任何一个子标签页的权限时自动获得父页面的访问权 (这样才能看到父级导航菜单)，反之则不然
+    if mask & index.tab_mask:
+        mask |= index.bits[GUILD_MANAGEMENT_PAGE]
+    return mask, None
+
+
+# =========================================
+# == 缓存
+# =========================================
+class AuthCache:
+    def __init__(self):
+        self._entries: Dict[int, Dict[str, CompiledAuth]] = {}  # guild_id -> {主体: 编译结果}
+        self._generations: Dict[int, int] = {}
+        self._generation = 0  # 全局失效 (副账号权限变化影响所有服务器)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def generation(self, guild_id: int) -> Tuple[int, int]:
+        return self._generation, self._generations.get(guild_id, 0)
+
+    def get(self, principal: str, guild_id: int) -> Optional[CompiledAuth]:
+        entry = self._entries.get(guild_id, {}).get(principal)
+        if entry is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return entry
+
+    def put(self, principal: str, guild_id: int, compiled: CompiledAuth, generation: Tuple[int, int]):
+        with self._lock:
+            if self.generation(guild_id) != generation:
+                return # 计算期间缓存已失效，结果可能是旧的
+            self._entries.setdefault(guild_id, {})[principal] = compiled
+
+    def get_or_compile(self, principal: str, guild_id: int, compile_fn) -> CompiledAuth:
+        entry = self.get(principal, guild_id)
+        if entry is None:
+            generation = self.generation(guild_id)
+            entry = compile_fn()
+            if entry[1] is None:
+                self.put(principal, guild_id, entry, generation)
+        return entry
+
+    def invalidate_member(self, guild_id: int, principal: Any):
+        with self._lock:
+            self._generations[guild_id] = self._generations.get(guild_id, 0) + 1
+            self._entries.get(guild_id, {}).pop(str(principal), None)
+
+    def invalidate_guild(self, guild_id: int):
+        with self._lock:
+            self._generations[guild_id] = self._generations.get(guild_id, 0) + 1
+            self._entries.pop(guild_id, None)
+
+    def invalidate_principal(self, principal: Any):
+        principal = str(principal)
+        with self._lock:
+            self._generation += 1
+            for entries in self._entries.values():
+                entries.pop(principal, None)
+
+    def clear(self):
+        with self._lock:
+            self._generation += 1
+            self._entries.clear()
+
+    def stats(self) -> Dict[str, int]:
+        return {"hits": self.hits, "misses": self.misses, "entries": sum(len(e) for e in self._entries.values())}
+
+
+# =========================================
+# == 延迟对比
+# =========================================
+def _run_benchmark(members: int, roles: int, roles_per_member: int, requests: int):
+    import random
+    import time
+    from types import SimpleNamespace
+
+    available = {
+        "page_guild_management": {"name": "服务器管理", "tabs": {f"tab_{i}": f"标签 {i}" for i in range(5)}},
+        **{f"page_{i}": {"name": f"页面 {i}"} for i in range(8)},
+    }
+    index = PermissionIndex(available)
+    all_perms = list(index.bits)
+    guild_roles = [SimpleNamespace(id=10_000 + i) for i in range(roles)]
+    guild_web_perms = {str(r.id): {"name": str(r.id), "permissions": random.sample(all_perms, 3)} for r in random.sample(guild_roles, roles // 4)}
+    no_admin = SimpleNamespace(administrator=False)
+    member_map = {uid: SimpleNamespace(id=uid, roles=random.sample(guild_roles, roles_per_member), guild_permissions=no_admin)
+                  for uid in range(1, members + 1)}
+    guild = SimpleNamespace(id=1, owner_id=0, get_member=member_map.get)
+    workload = [(str(random.randint(1, members)), random.choice(all_perms)) for _ in range(requests)]
+
+    def uncached(user_id, perm):
+        # 旧做法：每次请求重新计算完整的权限列表再做成员判断
+        mask, error = compile_member(index, guild, user_id, guild_web_perms)
+        return error is None and perm in index.perms_of(mask)
+
+    cache = AuthCache()
+
+    def cached(user_id, perm):
+        mask, error = cache.get_or_compile(user_id, 1, lambda: compile_member(index, guild, user_id, guild_web_perms))
+        return error is None and bool(mask & index.bits[perm])
+
+    results = {}
+    for label, fn in (("每次重新计算", uncached), ("缓存位测试", cached)):
+        started = time.perf_counter()
+        granted = sum(1 for user_id, perm in workload if fn(user_id, perm))
+        elapsed = time.perf_counter() - started
+        results[label] = granted
+        print(f"  {label:<10} {elapsed / requests * 1e6:>7.2f} µs/请求  (通过 {granted}/{requests})")
+    assert len(set(results.values())) == 1, "缓存结果与重新计算不一致"
+    print(f"  缓存: {cache.stats()}")
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Web 面板鉴权延迟对比")
+    parser.add_argument("--members", type=int, default=5000)
+    parser.add_argument("--roles", type=int, default=200)
+    parser.add_argument("--roles-per-member", type=int, default=8)
+    parser.add_argument("--requests", type=int, default=200000)
+    args = parser.parse_args()
+    print(f"{args.members} 名成员, {args.roles} 个身份组, 每人 {args.roles_per_member} 个身份组, {args.requests} 次鉴权:")
+    _run_benchmark(args.members, args.roles, args.roles_per_member, args.requests)